@@ -61,9 +61,30 @@ class zulip::app_frontend_base {
   if $tornado_processes > 1 {
     $tornado_ports = range(9800, 9800 + $tornado_processes)
     $tornado_multiprocess = true
+
+    # Lists the realms pinned to a Tornado process; maintained by
+    # `./manage.py tornado_shards`.
+    file { '/home/zulip/tornado/nginx_sharding.conf':
+      ensure  => file,
+      replace => false,
+      require => File['/home/zulip/tornado'],
+      owner   => 'zulip',
+      group   => 'zulip',
+      mode    => '0644',
+      content => '',
+      before  => File['/etc/nginx/zulip-include/tornado-upstreams'],
+    }
   } else {
     $tornado_multiprocess = false
   }
+  file { '/etc/nginx/zulip-include/tornado-upstreams':
+    require => Package[$zulip::common::nginx],
+    owner   => 'root',
+    group   => 'root',
+    mode    => '0644',
+    content => template('zulip/nginx/tornado-upstreams.conf.template.erb'),
+    notify  => Service['nginx'],
+  }
 
   # This determines whether we run queue processors multithreaded or
   # multiprocess.  Multiprocess scales much better, but requires more
@@ -79,6 +100,10 @@ class zulip::app_frontend_base {
   }
   $message_sender_processes = zulipconf('application_server', 'message_sender_processes',
                                         $message_sender_default_processes)
+  # The number of processes in the markdown render server (see
+  # zerver/lib/bugdown/render_server.py); 0 means we don't run one.
+  # Django only uses it if BUGDOWN_RENDER_SERVER_SOCKET is set.
+  $render_server_processes = zulipconf('application_server', 'render_server_processes', 0)
   file { "${zulip::common::supervisor_conf_dir}/zulip.conf":
     ensure  => file,
     require => Package[supervisor],
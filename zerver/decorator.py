@@ -27,8 +27,8 @@ from zerver.lib.exceptions import RateLimited, JsonableError, ErrorCode, \
 from zerver.lib.types import ViewFuncT
 from zerver.lib.validator import to_non_negative_int
 
-from zerver.lib.rate_limiter import incr_ratelimit, is_ratelimited, \
-    api_calls_left, RateLimitedUser, RateLimiterLockingException
+from zerver.lib.rate_limiter import check_and_incr_ratelimit, \
+    check_and_incr_ratelimit_local, RateLimitedUser
 from zerver.lib.request import REQ, has_request_variables, RequestVariableMissingError
 
 from functools import wraps
@@ -782,7 +782,10 @@ def rate_limit_user(request: HttpRequest, user: UserProfile, domain: str) -> Non
     the rate limit information"""
 
     entity = RateLimitedUser(user, domain=domain)
-    ratelimited, time = is_ratelimited(entity)
+    if settings.RATE_LIMITING_LOCAL_BUCKETS:
+        ratelimited, time, calls_remaining, time_reset = check_and_incr_ratelimit_local(entity)
+    else:
+        ratelimited, time, calls_remaining, time_reset = check_and_incr_ratelimit(entity)
     request._ratelimit_applied_limits = True
     request._ratelimit_secs_to_freedom = time
     request._ratelimit_over_limit = ratelimited
@@ -791,16 +794,6 @@ def rate_limit_user(request: HttpRequest, user: UserProfile, domain: str) -> Non
         statsd.incr("ratelimiter.limited.%s.%s" % (type(user), user.id))
         raise RateLimited()
 
-    try:
-        incr_ratelimit(entity)
-    except RateLimiterLockingException:
-        logging.warning("Deadlock trying to incr_ratelimit for %s on %s" % (
-            user.id, request.path))
-        # rate-limit users who are hitting the API so hard we can't update our stats.
-        raise RateLimited()
-
-    calls_remaining, time_reset = api_calls_left(entity)
-
     request._ratelimit_remaining = calls_remaining
     request._ratelimit_secs_to_freedom = time_reset
 
@@ -17,7 +17,6 @@ from analytics.lib.counts import COUNT_STATS, do_increment_logging_stat, \
 
 from zerver.lib.bugdown import (
     version as bugdown_version,
-    url_embed_preview_enabled,
     convert as bugdown_convert,
 )
 from zerver.lib.addressee import Addressee
@@ -29,11 +28,14 @@ from zerver.lib.bot_config import (
 )
 from zerver.lib.cache import (
     bot_dict_fields,
+    bump_stream_recipient_info_version,
     delete_user_profile_caches,
     to_dict_cache_key_id,
     user_profile_by_api_key_cache_key,
 )
 from zerver.lib.context_managers import lockfile
+from zerver.lib.deferred_user_messages import fill_in_deferred_user_messages, \
+    record_deferred_user_messages
 from zerver.lib.email_mirror_helpers import encode_email_address, encode_email_address_helper
 from zerver.lib.emoji import emoji_name_to_emoji_code, get_emoji_file_name
 from zerver.lib.exceptions import StreamDoesNotExistError, \
@@ -43,6 +45,7 @@ from zerver.lib.message import (
     access_message,
     MessageDict,
     render_markdown,
+    render_markdown_batch,
     update_first_visible_message_id,
 )
 from zerver.lib.realm_icon import realm_icon_url
@@ -55,10 +58,13 @@ from zerver.lib.stream_subscription import (
     get_active_subscriptions_for_stream_ids,
     get_bulk_stream_subscriber_info,
     get_stream_subscriptions_for_user,
+    get_stream_recipient_info,
     get_stream_subscriptions_for_users,
     num_subscribers_for_stream_id,
 )
 from zerver.lib.stream_topic import StreamTopicTarget
+from zerver.lib.unread_index import invalidate_realm_unread_indexes, \
+    invalidate_unread_indexes, remove_from_unread_index
 from zerver.lib.topic import (
     filter_by_exact_message_topic,
     filter_by_topic_name_via_message,
@@ -153,9 +159,11 @@ from analytics.models import StreamCount
 if settings.BILLING_ENABLED:
     from corporate.lib.stripe import update_license_ledger_if_needed
 
+import array
 import ujson
 import time
 import datetime
+import io
 import os
 import platform
 import logging
@@ -767,6 +775,7 @@ def do_deactivate_stream(stream: Stream, log: bool=True) -> None:
     affected_user_ids = can_access_stream_user_ids(stream)
 
     get_active_subscriptions_for_stream_id(stream.id).update(active=False)
+    bump_stream_recipient_info_version([get_stream_recipient(stream.id).id])
 
     was_invite_only = stream.invite_only
     stream.deactivated = True
@@ -914,6 +923,25 @@ def render_incoming_message(message: Message,
         raise JsonableError(_('Unable to render message'))
     return rendered_content
 
+def render_incoming_messages(messages: List[MutableMapping[str, Any]],
+                             email_gateway: Optional[bool]=False) -> List[str]:
+    """Renders the messages being sent by do_send_messages in one batch,
+    so that with a render server they are rendered in parallel."""
+    batch = []  # type: List[Dict[str, Any]]
+    for message in messages:
+        batch.append(dict(
+            message=message['message'],
+            content=message['message'].content,
+            realm=message['realm'],
+            realm_alert_words_automaton=get_alert_word_automaton(message['realm']),
+            mention_data=message['mention_data'],
+            email_gateway=email_gateway,
+        ))
+    try:
+        return render_markdown_batch(batch)
+    except BugdownRenderingException:
+        raise JsonableError(_('Unable to render message'))
+
 def get_typing_user_profiles(recipient: Recipient, sender_id: int) -> List[UserProfile]:
     if recipient.type == Recipient.STREAM:
         '''
@@ -968,33 +996,16 @@ def get_recipient_info(recipient: Recipient,
         # of this function for different message types.
         assert(stream_topic is not None)
 
-        subscription_rows = stream_topic.get_active_subscriptions().values(
-            'user_profile_id',
-            'push_notifications',
-            'email_notifications',
-            'in_home_view',
-        ).order_by('user_profile_id')
-
-        message_to_user_ids = [
-            row['user_profile_id']
-            for row in subscription_rows
-        ]
+        # This is usually cached; see get_stream_recipient_info.
+        stream_recipient_info = get_stream_recipient_info(recipient.id)
 
-        user_ids_muting_topic = stream_topic.user_ids_muting_topic()
+        message_to_user_ids = stream_recipient_info['user_ids']
 
-        stream_push_user_ids = {
-            row['user_profile_id']
-            for row in subscription_rows
-            # Note: muting a stream overrides stream_push_notify
-            if row['push_notifications'] and row['in_home_view']
-        } - user_ids_muting_topic
+        user_ids_muting_topic = stream_recipient_info['user_ids_muting_topic'].get(
+            stream_topic.topic_name.lower(), set())
 
-        stream_email_user_ids = {
-            row['user_profile_id']
-            for row in subscription_rows
-            # Note: muting a stream overrides stream_email_notify
-            if row['email_notifications'] and row['in_home_view']
-        } - user_ids_muting_topic
+        stream_push_user_ids = stream_recipient_info['push_user_ids'] - user_ids_muting_topic
+        stream_email_user_ids = stream_recipient_info['email_user_ids'] - user_ids_muting_topic
 
     elif recipient.type == Recipient.HUDDLE:
         message_to_user_ids = get_huddle_user_ids(recipient)
@@ -1215,10 +1226,12 @@ def do_send_messages(messages_maybe_none: Sequence[Optional[MutableMapping[str,
         message['sender_queue_id'] = message.get('sender_queue_id', None)
         message['realm'] = message.get('realm', message['message'].sender.realm)
 
-        mention_data = bugdown.MentionData(
-            realm_id=message['realm'].id,
-            content=message['message'].content,
-        )
+    # Fetch the users and groups that might be mentioned in any of the
+    # messages, with one set of queries per realm.
+    mention_datas = bugdown.get_mention_data_batch(
+        [(message['realm'].id, message['message'].content) for message in messages])
+
+    for (message, mention_data) in zip(messages, mention_datas):
         message['mention_data'] = mention_data
 
         if message['message'].is_stream_message():
@@ -1246,17 +1259,12 @@ def do_send_messages(messages_maybe_none: Sequence[Optional[MutableMapping[str,
         message['default_bot_user_ids'] = info['default_bot_user_ids']
         message['service_bot_tuples'] = info['service_bot_tuples']
 
-        # Render our messages.
         assert message['message'].rendered_content is None
 
-        rendered_content = render_incoming_message(
-            message['message'],
-            message['message'].content,
-            message['active_user_ids'],
-            message['realm'],
-            mention_data=message['mention_data'],
-            email_gateway=email_gateway,
-        )
+    # Render our messages.
+    rendered_contents = render_incoming_messages(messages, email_gateway=email_gateway)
+
+    for (message, rendered_content) in zip(messages, rendered_contents):
         message['message'].rendered_content = rendered_content
         message['message'].rendered_content_version = bugdown_version
         links_for_embed |= message['message'].links_for_preview
@@ -1282,10 +1290,10 @@ def do_send_messages(messages_maybe_none: Sequence[Optional[MutableMapping[str,
         message['message'].update_calculated_fields()
 
     # Save the message receipts in the database
-    user_message_flags = defaultdict(dict)  # type: Dict[int, Dict[int, List[str]]]
+    user_message_flags = {}  # type: Dict[int, Dict[int, List[str]]]
     with transaction.atomic():
         Message.objects.bulk_create([message['message'] for message in messages])
-        ums = []  # type: List[UserMessageLite]
+        ums = []  # type: List[UserMessageBatch]
         for message in messages:
             # Service bots (outgoing webhook bots and embedded bots) don't store UserMessage rows;
             # they will be processed later.
@@ -1299,10 +1307,18 @@ def do_send_messages(messages_maybe_none: Sequence[Optional[MutableMapping[str,
                 mentioned_user_ids=mentioned_user_ids,
             )
 
-            for um in user_messages:
-                user_message_flags[message['message'].id][um.user_profile_id] = um.flags_list()
+            user_message_flags[message['message'].id] = user_messages.flags_lists()
 
-            ums.extend(user_messages)
+            if should_defer_fan_out(message, user_messages):
+                # Only the rows that notifications and the sender's
+                # client need right away are written now; see
+                # zerver/lib/deferred_user_messages.py.
+                (user_messages, deferred_user_messages) = user_messages.partition(
+                    message['stream_push_user_ids'] | message['stream_email_user_ids'] |
+                    user_messages.user_flags.keys() | {message['message'].sender_id})
+                message['deferred_user_ids'] = deferred_user_messages.user_ids.tolist()
+
+            ums.append(user_messages)
 
             message['message'].service_queue_events = get_service_bot_events(
                 sender=message['message'].sender,
@@ -1322,6 +1338,17 @@ def do_send_messages(messages_maybe_none: Sequence[Optional[MutableMapping[str,
         for message in messages:
             do_widget_post_save_actions(message)
 
+    for message in messages:
+        if message.get('deferred_user_ids'):
+            record_deferred_user_messages(message['realm'].id, message['message'].id,
+                                          message['deferred_user_ids'])
+            queue_json_publish('deferred_work', {
+                'type': 'fan_out_user_messages',
+                'realm_id': message['realm'].id,
+                'message_id': message['message'].id,
+                'user_ids': message['deferred_user_ids'],
+            })
+
     for message in messages:
         # Deliver events to the real-time push system, as well as
         # enqueuing any additional processing triggered by the message.
@@ -1395,7 +1422,7 @@ def do_send_messages(messages_maybe_none: Sequence[Optional[MutableMapping[str,
             event['sender_queue_id'] = message['sender_queue_id']
         send_event(message['realm'], event, users)
 
-        if url_embed_preview_enabled(message['message']) and links_for_embed:
+        if links_for_embed:
             event_data = {
                 'message_id': message['message'].id,
                 'message_content': message['message'].content,
@@ -1436,52 +1463,98 @@ def do_send_messages(messages_maybe_none: Sequence[Optional[MutableMapping[str,
     # intermingle sending zephyr messages with other messages.
     return already_sent_ids + [message['message'].id for message in messages]
 
-class UserMessageLite:
+class UserMessageBatch:
     '''
-    The Django ORM is too slow for bulk operations.  This class
-    is optimized for the simple use case of inserting a bunch of
-    rows into zerver_usermessage.
+    The UserMessage rows to create for a message.  Messages to big
+    streams have tens of thousands of recipients, nearly all of whom
+    get the same flags, so rather than an object per row, we store
+    the user IDs as an array, the flags most of the users get, and
+    the (few) users whose flags differ from those.
     '''
-    def __init__(self, user_profile_id: int, message_id: int, flags: int) -> None:
-        self.user_profile_id = user_profile_id
+    def __init__(self, message_id: int, user_ids: Iterable[int], default_flags: int,
+                 user_flags: Dict[int, int]) -> None:
         self.message_id = message_id
-        self.flags = flags
+        self.user_ids = array.array('q', sorted(user_ids))
+        self.default_flags = default_flags
+        self.user_flags = user_flags
+
+    def __len__(self) -> int:
+        return len(self.user_ids)
+
+    def flags_for_user(self, user_id: int) -> int:
+        return self.user_flags.get(user_id, self.default_flags)
+
+    def partition(self, user_ids: AbstractSet[int]) -> Tuple['UserMessageBatch',
+                                                             'UserMessageBatch']:
+        '''
+        Splits the batch in two: the rows for `user_ids`, and the rest.
+        '''
+        return (
+            UserMessageBatch(self.message_id,
+                             (user_id for user_id in self.user_ids if user_id in user_ids),
+                             self.default_flags,
+                             self.user_flags),
+            UserMessageBatch(self.message_id,
+                             (user_id for user_id in self.user_ids if user_id not in user_ids),
+                             self.default_flags,
+                             {user_id: flags for (user_id, flags) in self.user_flags.items()
+                              if user_id not in user_ids}),
+        )
+
+    def flags_lists(self) -> Dict[int, List[str]]:
+        # The users with the default flags share one list.
+        flags_lists = dict.fromkeys(self.user_ids,
+                                    UserMessage.flags_list_for_flags(self.default_flags))
+        for user_id, flags in self.user_flags.items():
+            flags_lists[user_id] = UserMessage.flags_list_for_flags(flags)
+        return flags_lists
 
-    def flags_list(self) -> List[str]:
-        return UserMessage.flags_list_for_flags(self.flags)
+def should_defer_fan_out(message: MutableMapping[str, Any],
+                         user_messages: UserMessageBatch) -> bool:
+    '''
+    Whether to leave most of the UserMessage rows for a message to the
+    deferred_work queue processor.  We only do this for public
+    streams, since users can read their messages without a UserMessage
+    row, and only when the rows we defer would all have no flags set.
+    '''
+    min_recipients = settings.DEFERRED_FAN_OUT_MIN_RECIPIENTS
+    if min_recipients is None or len(user_messages) < min_recipients:
+        return False
+    if not message['message'].is_stream_message() or user_messages.default_flags != 0:
+        return False
+
+    if message['stream'] is None:
+        stream_id = message['message'].recipient.type_id
+        message['stream'] = Stream.objects.select_related("realm").get(id=stream_id)
+    return message['stream'].is_public()
 
 def create_user_messages(message: Message,
                          um_eligible_user_ids: Set[int],
                          long_term_idle_user_ids: Set[int],
                          stream_push_user_ids: Set[int],
                          stream_email_user_ids: Set[int],
-                         mentioned_user_ids: Set[int]) -> List[UserMessageLite]:
-    ums_to_create = []
-    for user_profile_id in um_eligible_user_ids:
-        um = UserMessageLite(
-            user_profile_id=user_profile_id,
-            message_id=message.id,
-            flags=0,
-        )
-        ums_to_create.append(um)
-
+                         mentioned_user_ids: Set[int]) -> UserMessageBatch:
+    # Flags that every recipient gets.
+    default_flags = 0
     # These properties on the Message are set via
     # render_markdown by code in the bugdown inline patterns
-    wildcard = message.mentions_wildcard
-    ids_with_alert_words = message.user_ids_with_alert_words
+    if message.mentions_wildcard:
+        default_flags |= UserMessage.flags.wildcard_mentioned
+    if message.recipient.type in [Recipient.HUDDLE, Recipient.PERSONAL]:
+        default_flags |= UserMessage.flags.is_private
 
-    for um in ums_to_create:
-        if um.user_profile_id == message.sender.id and \
-                message.sent_by_human():
-            um.flags |= UserMessage.flags.read
-        if wildcard:
-            um.flags |= UserMessage.flags.wildcard_mentioned
-        if um.user_profile_id in mentioned_user_ids:
-            um.flags |= UserMessage.flags.mentioned
-        if um.user_profile_id in ids_with_alert_words:
-            um.flags |= UserMessage.flags.has_alert_word
-        if message.recipient.type in [Recipient.HUDDLE, Recipient.PERSONAL]:
-            um.flags |= UserMessage.flags.is_private
+    # Flags that only some recipients get; we only touch those
+    # recipients, rather than checking every recipient for each flag.
+    user_flags = {}  # type: Dict[int, int]
+
+    def add_flag(user_ids: AbstractSet[int], flag: int) -> None:
+        for user_id in user_ids & um_eligible_user_ids:
+            user_flags[user_id] = user_flags.get(user_id, default_flags) | flag
+
+    if message.sent_by_human():
+        add_flag({message.sender_id}, UserMessage.flags.read)
+    add_flag(mentioned_user_ids, UserMessage.flags.mentioned)
+    add_flag(message.user_ids_with_alert_words, UserMessage.flags.has_alert_word)
 
     # For long_term_idle (aka soft-deactivated) users, we are allowed
     # to optimize by lazily not creating UserMessage rows that would
@@ -1502,40 +1575,67 @@ def create_user_messages(message: Message,
     #
     # See https://zulip.readthedocs.io/en/latest/subsystems/sending-messages.html#soft-deactivation
     # for details on this system.
-    user_messages = []
-    for um in ums_to_create:
-        if (um.user_profile_id in long_term_idle_user_ids and
-                um.user_profile_id not in stream_push_user_ids and
-                um.user_profile_id not in stream_email_user_ids and
-                message.is_stream_message() and
-                int(um.flags) == 0):
-            continue
-        user_messages.append(um)
+    user_ids = um_eligible_user_ids
+    if message.is_stream_message() and default_flags == 0:
+        lazy_user_ids = ((long_term_idle_user_ids & um_eligible_user_ids) -
+                         stream_push_user_ids - stream_email_user_ids - user_flags.keys())
+        if lazy_user_ids:
+            user_ids = um_eligible_user_ids - lazy_user_ids
+
+    return UserMessageBatch(
+        message_id=message.id,
+        user_ids=user_ids,
+        default_flags=default_flags,
+        user_flags=user_flags,
+    )
 
-    return user_messages
+# Above this many rows, bulk_insert_ums loads them with COPY rather
+# than an INSERT statement.
+USER_MESSAGE_COPY_THRESHOLD = 1000
 
-def bulk_insert_ums(ums: List[UserMessageLite]) -> None:
+def bulk_insert_ums(ums: List[UserMessageBatch]) -> None:
     '''
     Doing bulk inserts this way is much faster than using Django,
     since we don't have any ORM overhead.  Profiling with 1000
     users shows a speedup of 0.436 -> 0.027 seconds, so we're
     talking about a 15x speedup.
+
+    For messages to big streams, we use COPY, which saves PostgreSQL
+    from parsing (and us from building) one huge INSERT statement.
     '''
-    if not ums:
+    num_rows = sum(len(batch) for batch in ums)
+    if num_rows == 0:
         return
 
-    vals = ','.join([
-        '(%d, %d, %d)' % (um.user_profile_id, um.message_id, um.flags)
-        for um in ums
-    ])
-    query = '''
-        INSERT into
-            zerver_usermessage (user_profile_id, message_id, flags)
-        VALUES
-    ''' + vals
+    if num_rows <= USER_MESSAGE_COPY_THRESHOLD:
+        vals = ','.join([
+            '(%d, %d, %d)' % (user_id, batch.message_id, batch.flags_for_user(user_id))
+            for batch in ums
+            for user_id in batch.user_ids
+        ])
+        query = '''
+            INSERT into
+                zerver_usermessage (user_profile_id, message_id, flags)
+            VALUES
+        ''' + vals
+
+        with connection.cursor() as cursor:
+            cursor.execute(query)
+        return
+
+    buf = io.StringIO()
+    for batch in ums:
+        # Each row is the user ID followed by one of very few suffixes.
+        default_suffix = '\t%d\t%d\n' % (batch.message_id, batch.default_flags)
+        suffixes = {user_id: '\t%d\t%d\n' % (batch.message_id, flags)
+                    for user_id, flags in batch.user_flags.items()}
+        buf.writelines(str(user_id) + suffixes.get(user_id, default_suffix)
+                       for user_id in batch.user_ids)
+    buf.seek(0)
 
     with connection.cursor() as cursor:
-        cursor.execute(query)
+        cursor.copy_expert(
+            'COPY zerver_usermessage (user_profile_id, message_id, flags) FROM STDIN', buf)
 
 def do_add_submessage(realm: Realm,
                       sender_id: int,
@@ -2795,6 +2895,8 @@ def bulk_add_subscriptions(streams: Iterable[Stream],
         Subscription.objects.bulk_create([sub for (sub, stream) in subs_to_add])
         sub_ids = [sub.id for (sub, stream) in subs_to_activate]
         Subscription.objects.filter(id__in=sub_ids).update(active=True)
+        bump_stream_recipient_info_version(
+            {sub.recipient_id for (sub, stream) in subs_to_add + subs_to_activate})
         occupied_streams_after = list(get_occupied_streams(realm))
 
     # Log Subscription Activities in RealmAuditLog
@@ -2985,6 +3087,8 @@ def bulk_remove_subscriptions(users: Iterable[UserProfile],
         Subscription.objects.filter(
             id__in=sub_ids_to_deactivate,
         ) .update(active=False)
+        bump_stream_recipient_info_version(
+            {sub.recipient_id for (sub, stream) in subs_to_deactivate})
         occupied_streams_after = list(get_occupied_streams(our_realm))
 
     # Log Subscription Activities in RealmAuditLog
@@ -3909,6 +4013,7 @@ def do_update_pointer(user_profile: UserProfile, client: Client,
                                    message__id__gt=prev_pointer,
                                    message__id__lte=pointer).extra(where=[UserMessage.where_unread()]) \
                            .update(flags=F('flags').bitor(UserMessage.flags.read))
+        invalidate_unread_indexes([user_profile.id])
         do_clear_mobile_push_notifications_for_ids(user_profile, app_message_ids)
 
     event = dict(type='pointer', pointer=pointer)
@@ -3948,6 +4053,8 @@ def do_update_user_status(user_profile: UserProfile,
 def do_mark_all_as_read(user_profile: UserProfile, client: Client) -> int:
     log_statsd_event('bankruptcy')
 
+    fill_in_deferred_user_messages(user_profile)
+
     msgs = UserMessage.objects.filter(
         user_profile=user_profile
     ).extra(
@@ -3957,6 +4064,7 @@ def do_mark_all_as_read(user_profile: UserProfile, client: Client) -> int:
     count = msgs.update(
         flags=F('flags').bitor(UserMessage.flags.read)
     )
+    invalidate_unread_indexes([user_profile.id])
 
     event = dict(
         type='update_message_flags',
@@ -3984,6 +4092,8 @@ def do_mark_stream_messages_as_read(user_profile: UserProfile,
                                     topic_name: Optional[str]=None) -> int:
     log_statsd_event('mark_stream_as_read')
 
+    fill_in_deferred_user_messages(user_profile)
+
     msgs = UserMessage.objects.filter(
         user_profile=user_profile
     )
@@ -4006,6 +4116,7 @@ def do_mark_stream_messages_as_read(user_profile: UserProfile,
     count = msgs.update(
         flags=F('flags').bitor(UserMessage.flags.read)
     )
+    remove_from_unread_index(user_profile.id, message_ids)
 
     event = dict(
         type='update_message_flags',
@@ -4056,6 +4167,8 @@ def do_update_message_flags(user_profile: UserProfile,
         raise JsonableError(_("Invalid flag: '%s'" % (flag,)))
     flagattr = getattr(UserMessage.flags, flag)
 
+    fill_in_deferred_user_messages(user_profile)
+
     assert messages is not None
     msgs = UserMessage.objects.filter(user_profile=user_profile,
                                       message__id__in=messages)
@@ -4090,6 +4203,12 @@ def do_update_message_flags(user_profile: UserProfile,
     else:
         raise AssertionError("Invalid message flags operation")
 
+    if flag == "read":
+        if operation == "add":
+            remove_from_unread_index(user_profile.id, messages)
+        else:
+            invalidate_unread_indexes([user_profile.id])
+
     event = {'type': 'update_message_flags',
              'operation': operation,
              'flag': flag,
@@ -4185,6 +4304,9 @@ def update_user_message_flags(message: Message, ums: Iterable[UserMessage]) -> N
     for um in changed_ums:
         um.save(update_fields=['flags'])
 
+    # The unread indexes store each message's flags.
+    invalidate_unread_indexes(um.user_profile_id for um in changed_ums)
+
 def update_to_dict_cache(changed_messages: List[Message]) -> List[int]:
     """Updates the message as stored in the to_dict cache (for serving
     messages)."""
@@ -4345,6 +4467,9 @@ def do_update_message(user_profile: UserProfile, message: Message, topic_name: O
 
             changed_messages += messages_list
 
+        # The unread indexes store each message's topic.
+        invalidate_realm_unread_indexes(user_profile.realm_id)
+
     message.last_edit_time = timezone_now()
     assert message.last_edit_time is not None  # assert needed because stubs for django are missing
     event['edit_timestamp'] = datetime_to_timestamp(message.last_edit_time)
@@ -4397,11 +4522,13 @@ def do_delete_messages(user_profile: UserProfile, messages: Iterable[Message]) -
                UserMessage.objects.filter(message=message.id)]
         move_messages_to_archive([message.id])
         send_event(user_profile.realm, event, ums)
+    invalidate_realm_unread_indexes(user_profile.realm_id)
 
 def do_delete_messages_by_sender(user: UserProfile) -> None:
     message_ids = Message.objects.filter(sender=user).values_list('id', flat=True).order_by('id')
     if message_ids:
         move_messages_to_archive(message_ids)
+        invalidate_realm_unread_indexes(user.realm_id)
 
 def get_streams_traffic(stream_ids: Set[int]) -> Dict[int, int]:
     stat = COUNT_STATS['messages_in_stream:is_bot:day']
@@ -1,11 +1,11 @@
 
 from django.db.models import Q
 from zerver.models import UserProfile, Realm
-from zerver.lib.cache import cache_with_key, realm_alert_words_cache_key, \
-    realm_alert_words_automaton_cache_key
+from zerver.lib.cache import cache_get_many, cache_with_key, get_realm_alert_words_version, \
+    realm_alert_words_cache_key, realm_alert_words_change_cache_key
 import ujson
 import ahocorasick
-from typing import Dict, Iterable, List
+from typing import Dict, Iterable, List, Optional, Set
 
 @cache_with_key(realm_alert_words_cache_key, timeout=3600*24)
 def alert_words_in_realm(realm: Realm) -> Dict[int, List[str]]:
@@ -15,26 +15,90 @@ def alert_words_in_realm(realm: Realm) -> Dict[int, List[str]]:
     user_ids_with_words = dict((user_id, w) for (user_id, w) in all_user_words.items() if len(w))
     return user_ids_with_words
 
-@cache_with_key(realm_alert_words_automaton_cache_key, timeout=3600*24)
-def get_alert_word_automaton(realm: Realm) -> ahocorasick.Automaton:
-    user_id_with_words = alert_words_in_realm(realm)
-    alert_word_automaton  = ahocorasick.Automaton()
-    for (user_id, alert_words) in user_id_with_words.items():
-        for alert_word in alert_words:
-            alert_word_lower = alert_word.lower()
-            if alert_word_automaton.exists(alert_word_lower):
-                (key, user_ids_for_alert_word) = alert_word_automaton.get(alert_word_lower)
-                user_ids_for_alert_word.add(user_id)
-            else:
-                alert_word_automaton.add_word(alert_word_lower, (alert_word_lower, set([user_id])))
-    alert_word_automaton.make_automaton()
+# If a process's automaton is more than this many changes behind, we
+# rebuild it rather than fetch all the changes.
+MAX_ALERT_WORD_CHANGES_TO_APPLY = 100
+
+class RealmAlertWords:
+    """
+    A realm's Aho-Corasick automaton of alert words, which each process
+    keeps for as long as it can, rather than build it (or unpickle it
+    from memcached) for each message.  The value for each word is the
+    word and the set of users who have it as an alert word; those sets
+    are shared with word_user_ids, so we can change a word's users in
+    place.  Only a word nobody had before changes the automaton.
+    """
+    def __init__(self, version: int, user_words: Dict[int, List[str]]) -> None:
+        self.version = version
+        self.user_words = {}  # type: Dict[int, Set[str]]
+        self.word_user_ids = {}  # type: Dict[str, Set[int]]
+        self.automaton = ahocorasick.Automaton()
+        for (user_id, words) in user_words.items():
+            self.set_user_words(user_id, words)
+        self.automaton.make_automaton()
+
+    def set_user_words(self, user_id: int, words: List[str]) -> bool:
+        """Returns whether we added words to the automaton, which must
+        then be rebuilt with make_automaton."""
+        new_words = set(word.lower() for word in words)
+        old_words = self.user_words.pop(user_id, set())
+        if new_words:
+            self.user_words[user_id] = new_words
+
+        # Words nobody has any more stay in the automaton, matching no
+        # users, until the next time we build it from scratch.
+        for word in old_words - new_words:
+            self.word_user_ids[word].discard(user_id)
+
+        added_words = False
+        for word in new_words - old_words:
+            if word not in self.word_user_ids:
+                self.word_user_ids[word] = set()
+                self.automaton.add_word(word, (word, self.word_user_ids[word]))
+                added_words = True
+            self.word_user_ids[word].add(user_id)
+        return added_words
+
+    def update(self, realm_id: int, version: int) -> bool:
+        """Applies the changes up to `version`; returns False if we
+        can't, and need to build the automaton from scratch."""
+        if version == self.version:
+            return True
+        if not self.version < version <= self.version + MAX_ALERT_WORD_CHANGES_TO_APPLY:
+            return False
+
+        keys = [realm_alert_words_change_cache_key(realm_id, change_version)
+                for change_version in range(self.version + 1, version + 1)]
+        changes = cache_get_many(keys)
+        if len(changes) != len(keys):
+            return False
+
+        added_words = False
+        for key in keys:
+            (user_id, alert_words) = changes[key][0]
+            if self.set_user_words(user_id, ujson.loads(alert_words)):
+                added_words = True
+        if added_words:
+            self.automaton.make_automaton()
+        self.version = version
+        return True
+
+realm_alert_words = {}  # type: Dict[int, RealmAlertWords]
+
+def get_alert_word_automaton(realm: Realm) -> Optional[ahocorasick.Automaton]:
+    version = get_realm_alert_words_version(realm.id)
+    alert_words = realm_alert_words.get(realm.id)
+    if alert_words is None or not alert_words.update(realm.id, version):
+        alert_words = RealmAlertWords(version, alert_words_in_realm(realm))
+        realm_alert_words[realm.id] = alert_words
+
     # If the kind is not AHOCORASICK after calling make_automaton, it means there is no key present
     # and hence we cannot call items on the automaton yet. To avoid it we return None for such cases
     # where there is no alert-words in the realm.
     # https://pyahocorasick.readthedocs.io/en/latest/index.html?highlight=Automaton.kind#module-constants
-    if alert_word_automaton.kind != ahocorasick.AHOCORASICK:
+    if alert_words.automaton.kind != ahocorasick.AHOCORASICK:
         return None
-    return alert_word_automaton
+    return alert_words.automaton
 
 def user_alert_words(user_profile: UserProfile) -> List[str]:
     return ujson.loads(user_profile.alert_words)
@@ -14,12 +14,13 @@ import os
 import html
 import time
 import functools
+import hashlib
 import ujson
 import xml.etree.cElementTree as etree
 from xml.etree.cElementTree import Element
 import ahocorasick
 
-from collections import deque, defaultdict
+from collections import deque, defaultdict, OrderedDict
 
 import requests
 
@@ -36,7 +37,8 @@ from zerver.lib.mention import possible_mentions, \
 from zerver.lib.url_encoding import encode_stream
 from zerver.lib.thumbnail import user_uploads_or_external
 from zerver.lib.timeout import timeout, TimeoutExpired
-from zerver.lib.cache import cache_with_key, NotFoundInCache
+from zerver.lib.cache import cache_get, cache_set, get_cache_with_key, \
+    NotFoundInCache, open_graph_image_cache_key, tweet_data_cache_key
 from zerver.lib.url_preview import preview as link_preview
 from zerver.models import (
     all_realm_filters,
@@ -180,6 +182,10 @@ def clear_state_for_testing() -> None:
     # a way to clear it.
     global LINK_REGEX
     LINK_REGEX = None
+    # The engines share their link regexes between realms, so they
+    # need to be rebuilt too.
+    md_engines.clear()
+    render_cache.clear()
 
 bugdown_logger = logging.getLogger()
 
@@ -404,7 +410,17 @@ def add_embed(root: Element, link: str, extracted_data: Dict[str, Any]) -> None:
         description_elm.set("class", "message_embed_description")
         description_elm.text = description
 
-@cache_with_key(lambda tweet_id: tweet_id, cache_name="database", with_statsd_key="tweet_data")
+# Tweets and Open Graph images are fetched by the FetchLinksEmbedData
+# queue worker (see zerver/lib/url_preview/fetcher.py), which caches
+# them; rendering only ever reads them from the cache.
+@get_cache_with_key(tweet_data_cache_key, cache_name="database")
+def tweet_data_from_cache(tweet_id: str) -> Any:
+    return
+
+@get_cache_with_key(open_graph_image_cache_key, cache_name="database")
+def open_graph_image_from_cache(url: str) -> Any:
+    return
+
 def fetch_tweet_data(tweet_id: str) -> Optional[Dict[str, Any]]:
     if settings.TEST_SUITE:
         from . import testing_mocks
@@ -469,7 +485,8 @@ HEAD_END_RE = re.compile('^/head[ >]')
 META_START_RE = re.compile('^meta[ >]')
 META_END_RE = re.compile('^/meta[ >]')
 
-def fetch_open_graph_image(url: str) -> Optional[Dict[str, Any]]:
+def fetch_open_graph_image(url: str,
+                           session: Optional[requests.Session]=None) -> Optional[Dict[str, Any]]:
     in_head = False
     # HTML will auto close meta tags, when we start the next tag add
     # a closing tag if it has not been closed yet.
@@ -477,7 +494,10 @@ def fetch_open_graph_image(url: str) -> Optional[Dict[str, Any]]:
     head = []
     # TODO: What if response content is huge? Should we get headers first?
     try:
-        content = requests.get(url, timeout=1).text
+        if session is not None:
+            content = session.get(url, timeout=5).text
+        else:
+            content = requests.get(url, timeout=5).text
     except Exception:
         return None
     # Extract the head and meta tags
@@ -533,6 +553,10 @@ def fetch_open_graph_image(url: str) -> Optional[Dict[str, Any]]:
         desc = og_desc.get('content')
     return {'image': image, 'title': title, 'desc': desc}
 
+def is_dropbox_url(url: str) -> bool:
+    netloc = urllib.parse.urlparse(url).netloc
+    return netloc == 'dropbox.com' or netloc.endswith('.dropbox.com')
+
 def get_tweet_id(url: str) -> Optional[str]:
     parsed_url = urllib.parse.urlparse(url)
     if not (parsed_url.netloc == 'twitter.com' or parsed_url.netloc.endswith('.twitter.com')):
@@ -631,7 +655,7 @@ class InlineInterestingLinkProcessor(markdown.treeprocessors.Treeprocessor):
     def dropbox_image(self, url: str) -> Optional[Dict[str, Any]]:
         # TODO: The returned Dict could possibly be a TypedDict in future.
         parsed_url = urllib.parse.urlparse(url)
-        if (parsed_url.netloc == 'dropbox.com' or parsed_url.netloc.endswith('.dropbox.com')):
+        if is_dropbox_url(url):
             is_album = parsed_url.path.startswith('/sc/') or parsed_url.path.startswith('/photos/')
             # Only allow preview Dropbox shared links
             if not (parsed_url.path.startswith('/s/') or
@@ -644,7 +668,12 @@ class InlineInterestingLinkProcessor(markdown.treeprocessors.Treeprocessor):
             # However, we might want to make use of title and description
             # in the future. If the actual image is too big, we might also
             # want to use the open graph image.
-            image_info = fetch_open_graph_image(url)
+            try:
+                image_info = open_graph_image_from_cache(url)
+                self.mark_may_embed_previews()
+            except NotFoundInCache:
+                self.add_link_for_preview(url)
+                image_info = None
 
             is_image = is_album or self.is_image(url)
 
@@ -828,7 +857,12 @@ class InlineInterestingLinkProcessor(markdown.treeprocessors.Treeprocessor):
             return None
 
         try:
-            res = fetch_tweet_data(tweet_id)
+            try:
+                res = tweet_data_from_cache(tweet_id)
+                self.mark_may_embed_previews()
+            except NotFoundInCache:
+                self.add_link_for_preview(url)
+                return None
             if res is None:
                 return None
             user = res['user']  # type: Dict[str, Any]
@@ -967,6 +1001,20 @@ class InlineInterestingLinkProcessor(markdown.treeprocessors.Treeprocessor):
             if uncle_link not in parent_links:
                 return insertion_index
 
+    def mark_may_embed_previews(self) -> None:
+        # Previews depend on third-party content (and on the link
+        # preview cache), so messages that might embed them must not
+        # be stored in the render cache.
+        self.markdown.zulip_may_embed_previews = True
+
+    def add_link_for_preview(self, url: str) -> None:
+        # The FetchLinksEmbedData queue worker fetches the preview and
+        # then renders the message again, which must not be served the
+        # preview-less rendering from the render cache.
+        self.mark_may_embed_previews()
+        if self.markdown.zulip_message is not None:
+            self.markdown.zulip_message.links_for_preview.add(url)
+
     def is_absolute_url(self, url: str) -> bool:
         return bool(urllib.parse.urlparse(url).netloc)
 
@@ -976,6 +1024,11 @@ class InlineInterestingLinkProcessor(markdown.treeprocessors.Treeprocessor):
         if len(found_urls) == 0 or len(found_urls) > self.INLINE_PREVIEW_LIMIT_PER_MESSAGE:
             return
 
+        # Tweets and Dropbox previews are rendered whatever these
+        # settings are; see twitter_link and dropbox_image.
+        if self.markdown.image_preview_enabled or self.markdown.url_embed_preview_enabled:
+            self.mark_may_embed_previews()
+
         rendered_tweet_count = 0
 
         for found_url in found_urls:
@@ -1041,7 +1094,7 @@ class InlineInterestingLinkProcessor(markdown.treeprocessors.Treeprocessor):
             try:
                 extracted_data = link_preview.link_embed_data_from_cache(url)
             except NotFoundInCache:
-                self.markdown.zulip_message.links_for_preview.add(url)
+                self.add_link_for_preview(url)
                 continue
             if extracted_data:
                 vm_id = self.vimeo_id(url)
@@ -1529,29 +1582,103 @@ def get_link_re() -> str:
         r'''\(\s*(<.*?>|((?:(?:\(.*?\))|[^\(\)]))*?)\s*((['"])(.*?)\12\s*)?\)'''
     return normal_compile(LINK_RE)
 
-def prepare_realm_pattern(source: str) -> str:
-    """ Augment a realm filter so it only matches after start-of-string,
-    whitespace, or opening delimiters, won't match if there are word
-    characters directly after, and saves what was matched as "name". """
-    return r"""(?<![^\s'"\(,:<])(?P<name>""" + source + r')(?!\w)'
+REALM_FILTER_GROUP_RE = re.compile(r'\(\?P([<=])(\w+)([>)])')
+
+class RealmFilterMatcher:
+    """Matches any of a list of realm filters with a single regex, so
+    that text is only scanned once however many filters a realm has.
+    Each filter is an alternative wrapped in a group named
+    realm_filter_<index>, and each filter's own named groups are
+    prefixed with that name, so that filters can use the same group
+    names."""
+
+    def __init__(self, realm_filters: List[Tuple[str, str, int]], first_index: int=0) -> None:
+        # Maps the name of each filter's group to the filter's index,
+        # format string, and the names of its groups, as (name in the
+        # combined regex, name in the filter).
+        self.filters = {}  # type: Dict[str, Tuple[int, str, List[Tuple[str, str]]]]
+        alternatives = []  # type: List[str]
+        for (i, (source_pattern, format_string, id)) in enumerate(realm_filters, first_index):
+            filter_group_name = 'realm_filter_%d' % (i,)
+            group_names = []  # type: List[Tuple[str, str]]
+
+            def rename_group(m: Match[str]) -> str:
+                group_name = '%s_%s' % (filter_group_name, m.group(2))
+                if m.group(1) == '<':
+                    group_names.append((group_name, m.group(2)))
+                return '(?P%s%s%s' % (m.group(1), group_name, m.group(3))
+            source_pattern = REALM_FILTER_GROUP_RE.sub(rename_group, source_pattern)
+            alternatives.append('(?P<%s>%s)' % (filter_group_name, source_pattern))
+            self.filters[filter_group_name] = (i, format_string, group_names)
+        # Only match after start-of-string, whitespace, or opening
+        # delimiters, and not if there are word characters directly
+        # after.
+        self.pattern = r"""(?<![^\s'"\(,:<])(?:""" + '|'.join(alternatives) + r')(?!\w)'
+        self.regex = re.compile(self.pattern, re.UNICODE)
+
+    def get_match(self, m: Match[str]) -> Tuple[int, str, str]:
+        """Returns the index of the filter that matched, the URL, and the
+        matched text."""
+        # We can't use m.lastgroup, since RealmFilterPattern wraps the
+        # regex in a trailing group of its own; exactly one filter's
+        # group participates in the match.
+        filter_group_name = next(name for name in self.filters
+                                 if m.group(name) is not None)
+        (index, format_string, group_names) = self.filters[filter_group_name]
+        groups = {name: m.group(group_name) for (group_name, name) in group_names}
+        return (index, format_string % groups, m.group(filter_group_name))
+
+def make_realm_filter_matchers(realm_filters: List[Tuple[str, str, int]],
+                               combine: bool=True) -> List[RealmFilterMatcher]:
+    if not realm_filters:
+        return []
+    if combine:
+        try:
+            return [RealmFilterMatcher(realm_filters)]
+        except re.error:
+            # Should be impossible, since each filter compiles on its
+            # own, but if the combined regex doesn't, we can still
+            # match the filters one at a time.
+            logging.warning("Could not combine realm filters: %s" % (realm_filters,))
+            pass
+    return [RealmFilterMatcher([realm_filter], i)
+            for (i, realm_filter) in enumerate(realm_filters)]
+
+# How many realms' compiled realm filters each process keeps, least
+# recently used first; realms that haven't sent a message in a while
+# get theirs compiled again on demand.
+REALM_FILTER_CACHE_SIZE = 1000
+
+# The matchers for each realm_filters_key, along with the filters they
+# were built from; they are rebuilt whenever the filters change.
+realm_filter_matchers = OrderedDict()  # type: OrderedDict[int, Tuple[List[Tuple[str, str, int]], List[RealmFilterMatcher]]]
+
+def get_realm_filter_matchers(realm_filters_key: int,
+                              realm_filters: List[Tuple[str, str, int]]) -> List[RealmFilterMatcher]:
+    cached = realm_filter_matchers.get(realm_filters_key)
+    if cached is None or cached[0] != realm_filters:
+        cached = (realm_filters, make_realm_filter_matchers(realm_filters))
+        realm_filter_matchers[realm_filters_key] = cached
+        while len(realm_filter_matchers) > REALM_FILTER_CACHE_SIZE:
+            realm_filter_matchers.popitem(last=False)
+    else:
+        realm_filter_matchers.move_to_end(realm_filters_key)
+    return cached[1]
 
-# Given a regular expression pattern, linkifies groups that match it
-# using the provided format string to construct the URL.
+# Given a RealmFilterMatcher, linkifies text that matches any of its
+# filters using that filter's format string to construct the URL.
 class RealmFilterPattern(markdown.inlinepatterns.Pattern):
-    """ Applied a given realm filter to the input """
+    """ Applies a realm's filters to the input """
 
-    def __init__(self, source_pattern: str,
-                 format_string: str,
+    def __init__(self, matcher: RealmFilterMatcher,
                  markdown_instance: Optional[markdown.Markdown]=None) -> None:
-        self.pattern = prepare_realm_pattern(source_pattern)
-        self.format_string = format_string
-        markdown.inlinepatterns.Pattern.__init__(self, self.pattern, markdown_instance)
+        self.matcher = matcher
+        markdown.inlinepatterns.Pattern.__init__(self, matcher.pattern, markdown_instance)
 
     def handleMatch(self, m: Match[str]) -> Union[Element, str]:
         db_data = self.markdown.zulip_db_data
-        return url_to_a(db_data,
-                        self.format_string % m.groupdict(),
-                        m.group("name"))
+        (index, url, text) = self.matcher.get_match(m)
+        return url_to_a(db_data, url, text)
 
 class UserMentionPattern(markdown.inlinepatterns.Pattern):
     def handleMatch(self, m: Match[str]) -> Optional[Element]:
@@ -1606,9 +1733,9 @@ class UserGroupMentionPattern(markdown.inlinepatterns.Pattern):
             name = extract_user_group(match)
             user_group = db_data['mention_data'].get_user_group(name)
             if user_group:
-                self.markdown.zulip_message.mentions_user_group_ids.add(user_group.id)
-                name = user_group.name
-                user_group_id = str(user_group.id)
+                self.markdown.zulip_message.mentions_user_group_ids.add(user_group['id'])
+                name = user_group['name']
+                user_group_id = str(user_group['id'])
             else:
                 # Don't highlight @-mentions that don't refer to a valid user
                 # group.
@@ -1672,23 +1799,24 @@ class AlertWordsNotificationProcessor(markdown.preprocessors.Preprocessor):
     def run(self, lines: Iterable[str]) -> Iterable[str]:
         db_data = self.markdown.zulip_db_data
         if self.markdown.zulip_message and db_data is not None:
-            # We check for alert words here, the set of which are
-            # dependent on which users may see this message.
-            #
-            # Our caller passes in the list of possible_words.  We
-            # don't do any special rendering; we just append the alert words
-            # we find to the set self.markdown.zulip_message.alert_words.
-
-            realm_alert_words_automaton = db_data['realm_alert_words_automaton']
-
-            if realm_alert_words_automaton is not None:
-                content = '\n'.join(lines).lower()
-                for end_index, (original_value, user_ids) in realm_alert_words_automaton.iter(content):
-                    if self.check_valid_start_position(content, end_index - len(original_value)) and \
-                       self.check_valid_end_position(content, end_index + 1):
-                        self.markdown.zulip_message.user_ids_with_alert_words.update(user_ids)
+            # We don't do any special rendering for alert words; we
+            # just save the text to check for them in.  The check
+            # itself (see find_alert_words) happens in the Django
+            # process, after rendering, since it depends on the
+            # realm's current alert words; the render cache saves
+            # this text too, so that it also works on a cache hit.
+            self.markdown.zulip_alert_words_content = '\n'.join(lines).lower()
         return lines
 
+    def find_alert_word_user_ids(self, realm_alert_words_automaton: ahocorasick.Automaton,
+                                 content: str) -> Set[int]:
+        user_ids_with_alert_words = set()  # type: Set[int]
+        for end_index, (original_value, user_ids) in realm_alert_words_automaton.iter(content):
+            if self.check_valid_start_position(content, end_index - len(original_value)) and \
+               self.check_valid_end_position(content, end_index + 1):
+                user_ids_with_alert_words.update(user_ids)
+        return user_ids_with_alert_words
+
 # This prevents realm_filters from running on the content of a
 # Markdown link, breaking up the link.  This is a monkey-patch, but it
 # might be worth sending a version of this change upstream.
@@ -1745,6 +1873,10 @@ class Bugdown(markdown.Markdown):
             "code_block_processor_disabled": [kwargs['code_block_processor_disabled'],
                                               "Disabled for email gateway"]
         }
+        # The inline patterns for the realm filters of each
+        # realm_filters_key this engine has rendered for, along with the
+        # filters they were built from; see set_realm_filters.
+        self.realm_filter_patterns = OrderedDict()  # type: OrderedDict[int, Tuple[List[Tuple[str, str, int]], List[RealmFilterPattern]]]
 
         super().__init__(*args, **kwargs)
         self.set_output_format('html')
@@ -1861,11 +1993,43 @@ class Bugdown(markdown.Markdown):
         return reg
 
     def register_realm_filters(self, inlinePatterns: markdown.util.Registry) -> markdown.util.Registry:
-        for (pattern, format_string, id) in self.getConfig("realm_filters"):
-            inlinePatterns.register(RealmFilterPattern(pattern, format_string, self),
-                                    'realm_filters/%s' % (pattern), 45)
+        patterns = self.get_realm_filter_patterns(self.getConfig("realm"), self.getConfig("realm_filters"))
+        for (i, pattern) in enumerate(patterns):
+            inlinePatterns.register(pattern, 'realm_filters/%d' % (i,), 45)
         return inlinePatterns
 
+    def get_realm_filter_patterns(self, realm_filters_key: int,
+                                  realm_filters: List[Tuple[str, str, int]]) -> List[RealmFilterPattern]:
+        cached = self.realm_filter_patterns.get(realm_filters_key)
+        if cached is None or cached[0] != realm_filters:
+            patterns = [RealmFilterPattern(matcher, self)
+                        for matcher in get_realm_filter_matchers(realm_filters_key, realm_filters)]
+            cached = (realm_filters, patterns)
+            self.realm_filter_patterns[realm_filters_key] = cached
+            while len(self.realm_filter_patterns) > REALM_FILTER_CACHE_SIZE:
+                self.realm_filter_patterns.popitem(last=False)
+        else:
+            self.realm_filter_patterns.move_to_end(realm_filters_key)
+        return cached[1]
+
+    def set_realm_filters(self, realm_filters_key: int,
+                          realm_filters: List[Tuple[str, str, int]]) -> None:
+        """Switches this engine to rendering for the given realm, by
+        replacing its realm filter inline patterns; everything else about
+        the engine is the same for all realms."""
+        if self.getConfig("realm") == realm_filters_key and \
+                self.getConfig("realm_filters") == realm_filters:
+            return
+
+        i = 0
+        while 'realm_filters/%d' % (i,) in self.inlinePatterns:
+            self.inlinePatterns.deregister('realm_filters/%d' % (i,))
+            i += 1
+        self.config["realm"][0] = realm_filters_key
+        self.config["realm_filters"][0] = realm_filters
+        # The inline processor shares our registry, so sees the change.
+        self.register_realm_filters(self.inlinePatterns)
+
     def build_treeprocessors(self) -> markdown.util.Registry:
         # Here we build all the processors from upstream, plus a few of our own.
         treeprocessors = markdown.util.Registry()
@@ -1907,9 +2071,20 @@ class Bugdown(markdown.Markdown):
             self.preprocessors = get_sub_registry(self.preprocessors, ['custom_text_notifications'])
             self.parser.blockprocessors = get_sub_registry(self.parser.blockprocessors, ['paragraph'])
 
-md_engines = {}  # type: Dict[Tuple[int, bool], markdown.Markdown]
+# Building a markdown engine is slow, and the engines for different
+# realms only differ in their realm filters, so we only build one
+# engine for each email_gateway setting (plus one for mirrored
+# Zephyrs, which uses very few features), keyed by
+# (get_base_bugdown_key(realm_filters_key), email_gateway).  Before
+# rendering, get_md_engine swaps the realm's filters into the engine.
+md_engines = {}  # type: Dict[Tuple[int, bool], Bugdown]
 realm_filter_data = {}  # type: Dict[int, List[Tuple[str, str, int]]]
 
+def get_base_bugdown_key(realm_filters_key: int) -> int:
+    if realm_filters_key == ZEPHYR_MIRROR_BUGDOWN_KEY:
+        return ZEPHYR_MIRROR_BUGDOWN_KEY
+    return DEFAULT_BUGDOWN_KEY
+
 def make_md_engine(realm_filters_key: int, email_gateway: bool) -> None:
     md_engine_key = (realm_filters_key, email_gateway)
     if md_engine_key in md_engines:
@@ -1924,7 +2099,7 @@ def make_md_engine(realm_filters_key: int, email_gateway: bool) -> None:
 
 def build_engine(realm_filters: List[Tuple[str, str, int]],
                  realm_filters_key: int,
-                 email_gateway: bool) -> markdown.Markdown:
+                 email_gateway: bool) -> Bugdown:
     engine = Bugdown(
         realm_filters=realm_filters,
         realm=realm_filters_key,
@@ -1940,43 +2115,42 @@ def build_engine(realm_filters: List[Tuple[str, str, int]],
     return engine
 
 def topic_links(realm_filters_key: int, topic_name: str) -> List[str]:
-    matches = []  # type: List[str]
+    matches = []  # type: List[Tuple[int, str]]
 
     realm_filters = realm_filters_for_realm(realm_filters_key)
 
-    for realm_filter in realm_filters:
-        pattern = prepare_realm_pattern(realm_filter[0])
-        for m in re.finditer(pattern, topic_name):
-            matches += [realm_filter[1] % m.groupdict()]
-    return matches
+    for matcher in get_realm_filter_matchers(realm_filters_key, realm_filters):
+        for m in matcher.regex.finditer(topic_name):
+            (index, url, text) = matcher.get_match(m)
+            matches.append((index, url))
+    # List the links in the order of the filters that matched them.
+    return [url for (index, url) in sorted(matches, key=lambda match: match[0])]
 
 def maybe_update_markdown_engines(realm_filters_key: Optional[int], email_gateway: bool) -> None:
-    # If realm_filters_key is None, load all filters
+    # If realm_filters_key is None, load all filters, and build the
+    # engines up front rather than on first use.  Since realms share
+    # engines, this doesn't build an engine per realm; each realm's
+    # filters are compiled the first time it renders something.
     global realm_filter_data
     if realm_filters_key is None:
         all_filters = all_realm_filters()
         all_filters[DEFAULT_BUGDOWN_KEY] = []
         for realm_filters_key, filters in all_filters.items():
             realm_filter_data[realm_filters_key] = filters
-            make_md_engine(realm_filters_key, email_gateway)
         # Hack to ensure that getConfig("realm") is right for mirrored Zephyrs
         realm_filter_data[ZEPHYR_MIRROR_BUGDOWN_KEY] = []
-        make_md_engine(ZEPHYR_MIRROR_BUGDOWN_KEY, False)
+        for base_key in [DEFAULT_BUGDOWN_KEY, ZEPHYR_MIRROR_BUGDOWN_KEY]:
+            if (base_key, email_gateway) not in md_engines:
+                make_md_engine(base_key, email_gateway)
     else:
-        realm_filters = realm_filters_for_realm(realm_filters_key)
-        if realm_filters_key not in realm_filter_data or    \
-                realm_filter_data[realm_filters_key] != realm_filters:
-            # Realm filters data has changed, update `realm_filter_data` and any
-            # of the existing markdown engines using this set of realm filters.
-            realm_filter_data[realm_filters_key] = realm_filters
-            for email_gateway_flag in [True, False]:
-                if (realm_filters_key, email_gateway_flag) in md_engines:
-                    # Update only existing engines(if any), don't create new one.
-                    make_md_engine(realm_filters_key, email_gateway_flag)
-
-        if (realm_filters_key, email_gateway) not in md_engines:
-            # Markdown engine corresponding to this key doesn't exists so create one.
-            make_md_engine(realm_filters_key, email_gateway)
+        # Changes to the realm's filters are picked up by
+        # Bugdown.set_realm_filters.
+        realm_filter_data[realm_filters_key] = realm_filters_for_realm(realm_filters_key)
+        base_key = get_base_bugdown_key(realm_filters_key)
+        if base_key not in realm_filter_data:
+            realm_filter_data[base_key] = []
+        if (base_key, email_gateway) not in md_engines:
+            make_md_engine(base_key, email_gateway)
 
 # We want to log Markdown parser failures, but shouldn't log the actual input
 # message for privacy reasons.  The compromise is to replace all alphanumeric
@@ -2019,10 +2193,7 @@ def get_email_info(realm_id: int, emails: Set[str]) -> Dict[str, FullNameInfo]:
     }
     return dct
 
-def get_possible_mentions_info(realm_id: int, mention_texts: Set[str]) -> List[FullNameInfo]:
-    if not mention_texts:
-        return list()
-
+def get_mention_full_names(mention_texts: Set[str]) -> Set[str]:
     # Remove the trailing part of the `name|id` mention syntax,
     # thus storing only full names in full_names.
     full_names = set()
@@ -2033,6 +2204,13 @@ def get_possible_mentions_info(realm_id: int, mention_texts: Set[str]) -> List[F
             full_names.add(name_syntax_match.group("full_name"))
         else:
             full_names.add(mention_text)
+    return full_names
+
+def get_possible_mentions_info(realm_id: int, mention_texts: Set[str]) -> List[FullNameInfo]:
+    if not mention_texts:
+        return list()
+
+    full_names = get_mention_full_names(mention_texts)
 
     q_list = {
         Q(full_name__iexact=full_name)
@@ -2051,27 +2229,22 @@ def get_possible_mentions_info(realm_id: int, mention_texts: Set[str]) -> List[F
     )
     return list(rows)
 
-class MentionData:
-    def __init__(self, realm_id: int, content: str) -> None:
-        mention_texts = possible_mentions(content)
-        possible_mentions_info = get_possible_mentions_info(realm_id, mention_texts)
-        self.full_name_info = {
-            row['full_name'].lower(): row
-            for row in possible_mentions_info
-        }
-        self.user_id_info = {
-            row['id']: row
-            for row in possible_mentions_info
-        }
-        self.init_user_group_data(realm_id=realm_id, content=content)
+class MentionBatchData:
+    """The users and user groups that might be mentioned in any of
+    `contents`, fetched with one query each; MentionData picks out the
+    ones for a single piece of content."""
 
-    def init_user_group_data(self,
-                             realm_id: int,
-                             content: str) -> None:
-        user_group_names = possible_user_group_mentions(content)
-        self.user_group_name_info = get_user_group_name_info(realm_id, user_group_names)
+    def __init__(self, realm_id: int, contents: Iterable[str]) -> None:
+        mention_texts = set()  # type: Set[str]
+        user_group_names = set()  # type: Set[str]
+        for content in contents:
+            mention_texts |= possible_mentions(content)
+            user_group_names |= possible_user_group_mentions(content)
+
+        self.possible_mentions_info = get_possible_mentions_info(realm_id, mention_texts)
+        self.user_groups = list(get_user_group_name_info(realm_id, user_group_names).values())
         self.user_group_members = defaultdict(list)  # type: Dict[int, List[int]]
-        group_ids = [group.id for group in self.user_group_name_info.values()]
+        group_ids = [group['id'] for group in self.user_groups]
 
         if not group_ids:
             # Early-return to avoid the cost of hitting the ORM,
@@ -2084,6 +2257,39 @@ class MentionData:
             user_profile_id = info['user_profile_id']
             self.user_group_members[group_id].append(user_profile_id)
 
+class MentionData:
+    def __init__(self, realm_id: int, content: str,
+                 batch_data: Optional[MentionBatchData]=None) -> None:
+        if batch_data is None:
+            batch_data = MentionBatchData(realm_id, [content])
+
+        full_names = {full_name.lower() for full_name in
+                      get_mention_full_names(possible_mentions(content))}
+        possible_mentions_info = [row for row in batch_data.possible_mentions_info
+                                  if row['full_name'].lower() in full_names]
+        self.full_name_info = {
+            row['full_name'].lower(): row
+            for row in possible_mentions_info
+        }
+        self.user_id_info = {
+            row['id']: row
+            for row in possible_mentions_info
+        }
+        self.init_user_group_data(content=content, batch_data=batch_data)
+
+    def init_user_group_data(self,
+                             content: str,
+                             batch_data: MentionBatchData) -> None:
+        user_group_names = possible_user_group_mentions(content)
+        self.user_group_name_info = {
+            group['name'].lower(): group
+            for group in batch_data.user_groups
+            if group['name'] in user_group_names
+        }
+        self.user_group_members = defaultdict(list)  # type: Dict[int, List[int]]
+        for group in self.user_group_name_info.values():
+            self.user_group_members[group['id']] = list(batch_data.user_group_members[group['id']])
+
     def get_user_by_name(self, name: str) -> Optional[FullNameInfo]:
         # warning: get_user_by_name is not dependable if two
         # users of the same full name are mentioned. Use
@@ -2102,19 +2308,22 @@ class MentionData:
         """
         return set(self.user_id_info.keys())
 
-    def get_user_group(self, name: str) -> Optional[UserGroup]:
+    def get_user_group(self, name: str) -> Optional[Dict[str, Any]]:
         return self.user_group_name_info.get(name.lower(), None)
 
     def get_group_members(self, user_group_id: int) -> List[int]:
         return self.user_group_members.get(user_group_id, [])
 
-def get_user_group_name_info(realm_id: int, user_group_names: Set[str]) -> Dict[str, UserGroup]:
+def get_user_group_name_info(realm_id: int,
+                             user_group_names: Set[str]) -> Dict[str, Dict[str, Any]]:
+    # Plain dicts rather than UserGroup objects, since the MentionData
+    # goes into RenderJobs pickled for the render server.
     if not user_group_names:
         return dict()
 
     rows = UserGroup.objects.filter(realm_id=realm_id,
-                                    name__in=user_group_names)
-    dct = {row.name.lower(): row for row in rows}
+                                    name__in=user_group_names).values('id', 'name')
+    dct = {row['name'].lower(): row for row in rows}
     return dct
 
 def get_stream_name_info(realm: Realm, stream_names: Set[str]) -> Dict[str, FullNameInfo]:
@@ -2141,17 +2350,136 @@ def get_stream_name_info(realm: Realm, stream_names: Set[str]) -> Dict[str, Full
     }
     return dct
 
+def get_mention_data_batch(realm_contents: List[Tuple[int, str]]) -> List[MentionData]:
+    """Returns a MentionData for each (realm ID, content) pair, doing
+    the database queries for all the content in each realm together."""
+    contents_by_realm = defaultdict(list)  # type: Dict[int, List[str]]
+    for (realm_id, content) in realm_contents:
+        contents_by_realm[realm_id].append(content)
+    batch_data = {
+        realm_id: MentionBatchData(realm_id, contents)
+        for (realm_id, contents) in contents_by_realm.items()
+    }
+    return [MentionData(realm_id, content, batch_data[realm_id])
+            for (realm_id, content) in realm_contents]
+
+class RenderBatchData:
+    """The data used for rendering avatars, stream links and realm
+    emoji in any of `contents` (all from the same realm), fetched with
+    one query each; make_render_job picks out the rows for each piece
+    of content."""
+
+    def __init__(self, realm: Realm, contents: List[str]) -> None:
+        self.realm = realm
+        self.contents = contents
+        self.mention_batch_data = None  # type: Optional[MentionBatchData]
+
+        emails = set()  # type: Set[str]
+        stream_names = set()  # type: Set[str]
+        for content in contents:
+            emails |= possible_avatar_emails(content)
+            stream_names |= possible_linked_stream_names(content)
+        self.email_info = get_email_info(realm.id, emails)
+        self.stream_name_info = get_stream_name_info(realm, stream_names)
+
+        if any(content_has_emoji_syntax(content) for content in contents):
+            self.active_realm_emoji = realm.get_active_emoji()
+        else:
+            self.active_realm_emoji = dict()
 
-def do_convert(content: str,
-               realm_alert_words_automaton: Optional[ahocorasick.Automaton] = None,
-               message: Optional[Message]=None,
-               message_realm: Optional[Realm]=None,
-               sent_by_bot: Optional[bool]=False,
-               translate_emoticons: Optional[bool]=False,
-               mention_data: Optional[MentionData]=None,
-               email_gateway: Optional[bool]=False,
-               no_previews: Optional[bool]=False) -> str:
-    """Convert Markdown to HTML, with Zulip-specific settings and hacks."""
+    def get_mention_data(self, content: str) -> MentionData:
+        # Callers often already have a MentionData for each message,
+        # so we only fetch these if needed.
+        if self.mention_batch_data is None:
+            self.mention_batch_data = MentionBatchData(self.realm.id, self.contents)
+        return MentionData(self.realm.id, content, self.mention_batch_data)
+
+    def get_email_info(self, content: str) -> Dict[str, FullNameInfo]:
+        emails = {email.strip().lower() for email in possible_avatar_emails(content)}
+        return {email: info for (email, info) in self.email_info.items()
+                if email in emails}
+
+    def get_stream_name_info(self, content: str) -> Dict[str, FullNameInfo]:
+        stream_names = possible_linked_stream_names(content)
+        return {name: info for (name, info) in self.stream_name_info.items()
+                if name in stream_names}
+
+    def get_active_realm_emoji(self, content: str) -> Dict[str, Dict[str, Any]]:
+        if content_has_emoji_syntax(content):
+            return self.active_realm_emoji
+        return dict()
+
+
+class RenderResult:
+    """The output of rendering some content: the HTML, and the
+    attributes rendering sets on the message (mentions, alert words,
+    and links to fetch previews for).  The markdown engine's
+    `zulip_message` is one of these, rather than the Message itself,
+    so that content can be rendered in another process (see
+    zerver/lib/bugdown/render_server.py) or served from the render
+    cache."""
+
+    def __init__(self) -> None:
+        self.rendered_content = ''
+        self.mentions_wildcard = False
+        self.mentions_user_ids = set()  # type: Set[int]
+        self.mentions_user_group_ids = set()  # type: Set[int]
+        self.user_ids_with_alert_words = set()  # type: Set[int]
+        self.links_for_preview = set()  # type: Set[str]
+
+        # Used by the render cache.
+        self.may_embed_previews = False
+        self.alert_words_content = None  # type: Optional[str]
+
+    def update_message(self, message: Message) -> None:
+        if self.mentions_wildcard:
+            message.mentions_wildcard = True
+        if self.mentions_user_ids:
+            message.mentions_user_ids.update(self.mentions_user_ids)
+        if self.mentions_user_group_ids:
+            message.mentions_user_group_ids.update(self.mentions_user_group_ids)
+        if self.user_ids_with_alert_words:
+            message.user_ids_with_alert_words.update(self.user_ids_with_alert_words)
+        if self.links_for_preview:
+            message.links_for_preview.update(self.links_for_preview)
+
+class RenderJob:
+    """Everything needed to render some content.  make_render_job does
+    the database queries for the job, so that rendering it only needs
+    the realm filters."""
+
+    def __init__(self, content: str, realm_filters_key: int, email_gateway: bool,
+                 image_preview_enabled: bool, url_embed_preview_enabled: bool,
+                 db_data: Optional[DbData], logging_message_id: str,
+                 realm_alert_words_automaton: Optional[ahocorasick.Automaton]=None) -> None:
+        self.content = content
+        self.realm_filters_key = realm_filters_key
+        self.email_gateway = email_gateway
+        self.image_preview_enabled = image_preview_enabled
+        self.url_embed_preview_enabled = url_embed_preview_enabled
+        # Only set if rendering for a message.
+        self.db_data = db_data
+        self.logging_message_id = logging_message_id
+        # Only used in this process, by find_alert_words.
+        self.realm_alert_words_automaton = realm_alert_words_automaton
+
+    def __getstate__(self) -> Dict[str, Any]:
+        # The automaton can be big, and the render server doesn't need
+        # it, so we don't send it.
+        state = self.__dict__.copy()
+        state['realm_alert_words_automaton'] = None
+        return state
+
+def make_render_job(content: str,
+                    realm_alert_words_automaton: Optional[ahocorasick.Automaton] = None,
+                    message: Optional[Message]=None,
+                    message_realm: Optional[Realm]=None,
+                    sent_by_bot: Optional[bool]=False,
+                    translate_emoticons: Optional[bool]=False,
+                    mention_data: Optional[MentionData]=None,
+                    email_gateway: Optional[bool]=False,
+                    no_previews: Optional[bool]=False,
+                    batch_data: Optional[RenderBatchData]=None) -> RenderJob:
     # This logic is a bit convoluted, but the overall goal is to support a range of use cases:
     # * Nothing is passed in other than content -> just run default options (e.g. for docs)
     # * message is passed, but no realm is -> look up realm from message
@@ -2176,27 +2504,7 @@ def do_convert(content: str,
                 # delivered via zephyr_mirror
                 realm_filters_key = ZEPHYR_MIRROR_BUGDOWN_KEY
 
-    maybe_update_markdown_engines(realm_filters_key, email_gateway)
-    md_engine_key = (realm_filters_key, email_gateway)
-
-    if md_engine_key in md_engines:
-        _md_engine = md_engines[md_engine_key]
-    else:
-        if DEFAULT_BUGDOWN_KEY not in md_engines:
-            maybe_update_markdown_engines(realm_filters_key=None, email_gateway=False)
-
-        _md_engine = md_engines[(DEFAULT_BUGDOWN_KEY, email_gateway)]
-    # Reset the parser; otherwise it will get slower over time.
-    _md_engine.reset()
-
-    # Filters such as UserMentionPattern need a message.
-    _md_engine.zulip_message = message
-    _md_engine.zulip_realm = message_realm
-    _md_engine.zulip_db_data = None  # for now
-    _md_engine.image_preview_enabled = image_preview_enabled(
-        message, message_realm, no_previews)
-    _md_engine.url_embed_preview_enabled = url_embed_preview_enabled(
-        message, message_realm, no_previews)
+    db_data = None  # type: Optional[DbData]
 
     # Pre-fetch data from the DB that is used in the bugdown thread
     if message is not None:
@@ -2208,64 +2516,283 @@ def do_convert(content: str,
         # the fetches are somewhat expensive and these types of syntax
         # are uncommon enough that it's a useful optimization.
 
-        if mention_data is None:
-            mention_data = MentionData(message_realm.id, content)
-
-        emails = possible_avatar_emails(content)
-        email_info = get_email_info(message_realm.id, emails)
-
-        stream_names = possible_linked_stream_names(content)
-        stream_name_info = get_stream_name_info(message_realm, stream_names)
+        if batch_data is None:
+            batch_data = RenderBatchData(message_realm, [content])
+        assert batch_data.realm.id == message_realm.id
 
-        if content_has_emoji_syntax(content):
-            active_realm_emoji = message_realm.get_active_emoji()
-        else:
-            active_realm_emoji = dict()
+        if mention_data is None:
+            mention_data = batch_data.get_mention_data(content)
 
-        _md_engine.zulip_db_data = {
-            'realm_alert_words_automaton': realm_alert_words_automaton,
-            'email_info': email_info,
+        db_data = {
+            'email_info': batch_data.get_email_info(content),
             'mention_data': mention_data,
-            'active_realm_emoji': active_realm_emoji,
+            'active_realm_emoji': batch_data.get_active_realm_emoji(content),
             'realm_uri': message_realm.uri,
             'sent_by_bot': sent_by_bot,
-            'stream_names': stream_name_info,
+            'stream_names': batch_data.get_stream_name_info(content),
             'translate_emoticons': translate_emoticons,
         }
 
+    return RenderJob(
+        content=content,
+        realm_filters_key=realm_filters_key,
+        email_gateway=bool(email_gateway),
+        image_preview_enabled=image_preview_enabled(message, message_realm, no_previews),
+        url_embed_preview_enabled=url_embed_preview_enabled(message, message_realm, no_previews),
+        db_data=db_data,
+        logging_message_id=logging_message_id,
+        realm_alert_words_automaton=realm_alert_words_automaton,
+    )
+
+def make_render_jobs(batch: List[Dict[str, Any]]) -> List[RenderJob]:
+    """Like make_render_job, for several pieces of content; each element
+    of `batch` is a dict of keyword arguments for make_render_job.  The
+    database queries for messages in the same realm are done together."""
+    message_realms = []  # type: List[Optional[Realm]]
+    contents_by_realm = defaultdict(list)  # type: Dict[int, List[str]]
+    realms = {}  # type: Dict[int, Realm]
+    for kwargs in batch:
+        message = kwargs.get('message')
+        message_realm = kwargs.get('message_realm')
+        if message is not None:
+            if message_realm is None:
+                message_realm = message.get_realm()
+            realms[message_realm.id] = message_realm
+            contents_by_realm[message_realm.id].append(kwargs['content'])
+        message_realms.append(message_realm)
+
+    batch_data = {
+        realm_id: RenderBatchData(realms[realm_id], contents)
+        for (realm_id, contents) in contents_by_realm.items()
+    }
+
+    jobs = []  # type: List[RenderJob]
+    for (kwargs, message_realm) in zip(batch, message_realms):
+        if kwargs.get('message') is None:
+            jobs.append(make_render_job(**kwargs))
+            continue
+        assert message_realm is not None
+        jobs.append(make_render_job(**dict(kwargs, message_realm=message_realm,
+                                           batch_data=batch_data[message_realm.id])))
+    return jobs
+
+def get_md_engine(realm_filters_key: int, email_gateway: bool) -> Bugdown:
+    maybe_update_markdown_engines(realm_filters_key, email_gateway)
+    md_engine = md_engines[(get_base_bugdown_key(realm_filters_key), email_gateway)]
+    md_engine.set_realm_filters(realm_filters_key, realm_filter_data[realm_filters_key])
+    return md_engine
+
+def render_job(job: RenderJob, use_timeout: bool=True) -> RenderResult:
+    _md_engine = get_md_engine(job.realm_filters_key, job.email_gateway)
+    # Reset the parser; otherwise it will get slower over time.
+    _md_engine.reset()
+
+    result = RenderResult()
+    # Filters such as UserMentionPattern need a message.
+    _md_engine.zulip_message = result if job.db_data is not None else None
+    _md_engine.zulip_db_data = job.db_data
+    _md_engine.image_preview_enabled = job.image_preview_enabled
+    _md_engine.url_embed_preview_enabled = job.url_embed_preview_enabled
+    _md_engine.zulip_may_embed_previews = False
+    _md_engine.zulip_alert_words_content = None
+
     try:
-        # Spend at most 5 seconds rendering; this protects the backend
-        # from being overloaded by bugs (e.g. markdown logic that is
-        # extremely inefficient in corner cases) as well as user
-        # errors (e.g. a realm filter that makes some syntax
-        # infinite-loop).
-        rendered_content = timeout(5, _md_engine.convert, content)
-
-        # Throw an exception if the content is huge; this protects the
-        # rest of the codebase from any bugs where we end up rendering
-        # something huge.
-        if len(rendered_content) > MAX_MESSAGE_LENGTH * 10:
-            raise BugdownRenderingException('Rendered content exceeds %s characters (message %s)' %
-                                            (MAX_MESSAGE_LENGTH * 10, logging_message_id))
-        return rendered_content
-    except Exception:
-        cleaned = privacy_clean_markdown(content)
-        # NOTE: Don't change this message without also changing the
-        # logic in logging_handlers.py or we can create recursive
-        # exceptions.
-        exception_message = ('Exception in Markdown parser: %sInput (sanitized) was: %s\n (message %s)'
-                             % (traceback.format_exc(), cleaned, logging_message_id))
-        bugdown_logger.exception(exception_message)
-
-        raise BugdownRenderingException()
+        if use_timeout:
+            # Spend at most 5 seconds rendering; this protects the backend
+            # from being overloaded by bugs (e.g. markdown logic that is
+            # extremely inefficient in corner cases) as well as user
+            # errors (e.g. a realm filter that makes some syntax
+            # infinite-loop).
+            result.rendered_content = timeout(5, _md_engine.convert, job.content)
+        else:
+            # The caller enforces its own deadline; see render_server.py.
+            result.rendered_content = _md_engine.convert(job.content)
+        result.may_embed_previews = _md_engine.zulip_may_embed_previews
+        result.alert_words_content = _md_engine.zulip_alert_words_content
+        return result
     finally:
-        # These next three lines are slightly paranoid, since
-        # we always set these right before actually using the
-        # engine, but better safe then sorry.
+        # These next lines are slightly paranoid, since we always
+        # set these right before actually using the engine, but
+        # better safe then sorry.
         _md_engine.zulip_message = None
-        _md_engine.zulip_realm = None
         _md_engine.zulip_db_data = None
 
+def check_render_result(job: RenderJob, result: RenderResult) -> None:
+    # Throw an exception if the content is huge; this protects the
+    # rest of the codebase from any bugs where we end up rendering
+    # something huge.
+    if len(result.rendered_content) > MAX_MESSAGE_LENGTH * 10:
+        raise BugdownRenderingException('Rendered content exceeds %s characters (message %s)' %
+                                        (MAX_MESSAGE_LENGTH * 10, job.logging_message_id))
+
+def log_render_exception(job: RenderJob, traceback_text: str) -> None:
+    cleaned = privacy_clean_markdown(job.content)
+    # NOTE: Don't change this message without also changing the
+    # logic in logging_handlers.py or we can create recursive
+    # exceptions.
+    exception_message = ('Exception in Markdown parser: %sInput (sanitized) was: %s\n (message %s)'
+                         % (traceback_text, cleaned, job.logging_message_id))
+    bugdown_logger.exception(exception_message)
+
+# Integrations often send the same content over and over (e.g. CI
+# notifications), so we cache rendered content.  The key is a hash of
+# the content together with everything else that affects how it
+# renders: the bugdown version, the realm filters, the realm emoji,
+# and the results of the mention/avatar/stream lookups done for this
+# content.  Entries are kept in a small in-process LRU cache in front
+# of memcached.
+BUGDOWN_RENDER_CACHE_SIZE = 1000
+BUGDOWN_RENDER_CACHE_TIMEOUT = 3600 * 24
+render_cache = OrderedDict()  # type: OrderedDict[str, Dict[str, Any]]
+
+def render_cache_key(job: RenderJob) -> str:
+    db_data = job.db_data
+    assert db_data is not None
+    mention_data = db_data['mention_data']
+    key_data = [
+        version,
+        job.content,
+        job.realm_filters_key,
+        realm_filters_for_realm(job.realm_filters_key),
+        job.email_gateway,
+        job.image_preview_enabled,
+        job.url_embed_preview_enabled,
+        db_data['realm_uri'],
+        db_data['sent_by_bot'],
+        db_data['translate_emoticons'],
+        db_data['active_realm_emoji'],
+        db_data['email_info'],
+        db_data['stream_names'],
+        mention_data.full_name_info,
+        {name: group['id'] for (name, group) in mention_data.user_group_name_info.items()},
+    ]
+    key_hash = hashlib.sha1(ujson.dumps(key_data, sort_keys=True).encode('utf-8')).hexdigest()
+    return 'bugdown_render:%s' % (key_hash,)
+
+def render_cache_get(key: str) -> Optional[Dict[str, Any]]:
+    if key in render_cache:
+        render_cache.move_to_end(key)
+        return render_cache[key]
+    remote_value = cache_get(key)
+    if remote_value is None:
+        return None
+    render_cache_add(key, remote_value[0])
+    return remote_value[0]
+
+def render_cache_add(key: str, value: Dict[str, Any]) -> None:
+    render_cache[key] = value
+    while len(render_cache) > BUGDOWN_RENDER_CACHE_SIZE:
+        render_cache.popitem(last=False)
+
+def render_cache_set(key: str, value: Dict[str, Any]) -> None:
+    render_cache_add(key, value)
+    cache_set(key, value, timeout=BUGDOWN_RENDER_CACHE_TIMEOUT)
+
+def make_render_cache_value(job: RenderJob, result: RenderResult) -> Dict[str, Any]:
+    alert_words_content = result.alert_words_content
+    if alert_words_content == job.content.lower():
+        # The common case; avoid storing the content twice.
+        alert_words_content = None
+    return {
+        'rendered_content': result.rendered_content,
+        'mentions_wildcard': result.mentions_wildcard,
+        'mentions_user_ids': list(result.mentions_user_ids),
+        'mentions_user_group_ids': list(result.mentions_user_group_ids),
+        'alert_words_content': alert_words_content,
+    }
+
+def result_from_render_cache_value(job: RenderJob, value: Dict[str, Any]) -> RenderResult:
+    result = RenderResult()
+    result.rendered_content = value['rendered_content']
+    result.mentions_wildcard = value['mentions_wildcard']
+    result.mentions_user_ids = set(value['mentions_user_ids'])
+    result.mentions_user_group_ids = set(value['mentions_user_group_ids'])
+
+    # Alert words depend on the realm's current alert words, so they
+    # aren't part of the cache key; render_jobs checks them.
+    result.alert_words_content = value['alert_words_content']
+    if result.alert_words_content is None:
+        result.alert_words_content = job.content.lower()
+    return result
+
+def find_alert_words(job: RenderJob, result: RenderResult) -> None:
+    if job.realm_alert_words_automaton is None or result.alert_words_content is None:
+        return
+    result.user_ids_with_alert_words = AlertWordsNotificationProcessor().find_alert_word_user_ids(
+        job.realm_alert_words_automaton, result.alert_words_content)
+
+def render_jobs(jobs: List[RenderJob]) -> List[RenderResult]:
+    """Renders the jobs, using the render cache where possible.  If a
+    render server is configured, the jobs that need rendering are
+    rendered there in parallel; otherwise, they are rendered one at a
+    time in this process.  Raises BugdownRenderingException if any of
+    them fail."""
+    results = [None] * len(jobs)  # type: List[Optional[RenderResult]]
+    cache_keys = [None] * len(jobs)  # type: List[Optional[str]]
+    indexes_to_render = []  # type: List[int]
+    for (i, job) in enumerate(jobs):
+        if job.db_data is not None and settings.BUGDOWN_RENDER_CACHE:
+            cache_key = render_cache_key(job)
+            cache_keys[i] = cache_key
+            cached_value = render_cache_get(cache_key)
+            if cached_value is not None:
+                results[i] = result_from_render_cache_value(job, cached_value)
+                continue
+        indexes_to_render.append(i)
+
+    if settings.BUGDOWN_RENDER_SERVER_SOCKET is not None and indexes_to_render:
+        from zerver.lib.bugdown.render_server import render_remote, RenderServerError
+        try:
+            remote_results = render_remote([jobs[i] for i in indexes_to_render])
+        except RenderServerError as e:
+            log_render_exception(jobs[indexes_to_render[e.index]], e.traceback_text)
+            raise BugdownRenderingException()
+        # If the render server isn't running, we fall back to
+        # rendering in this process.
+        if remote_results is not None:
+            for (i, result) in zip(indexes_to_render, remote_results):
+                results[i] = result
+
+    for i in indexes_to_render:
+        job = jobs[i]
+        try:
+            result = results[i]
+            if result is None:
+                result = render_job(job)
+                results[i] = result
+            check_render_result(job, result)
+        except Exception:
+            log_render_exception(job, traceback.format_exc())
+            raise BugdownRenderingException()
+
+        cache_key = cache_keys[i]
+        if cache_key is not None and not result.may_embed_previews:
+            render_cache_set(cache_key, make_render_cache_value(job, result))
+
+    rendered = [result for result in results if result is not None]
+    for (job, result) in zip(jobs, rendered):
+        find_alert_words(job, result)
+    return rendered
+
+def do_convert(content: str,
+               realm_alert_words_automaton: Optional[ahocorasick.Automaton] = None,
+               message: Optional[Message]=None,
+               message_realm: Optional[Realm]=None,
+               sent_by_bot: Optional[bool]=False,
+               translate_emoticons: Optional[bool]=False,
+               mention_data: Optional[MentionData]=None,
+               email_gateway: Optional[bool]=False,
+               no_previews: Optional[bool]=False) -> str:
+    """Convert Markdown to HTML, with Zulip-specific settings and hacks."""
+    job = make_render_job(content, realm_alert_words_automaton,
+                          message, message_realm, sent_by_bot,
+                          translate_emoticons, mention_data, email_gateway,
+                          no_previews=no_previews)
+    result = render_jobs([job])[0]
+    if message is not None:
+        result.update_message(message)
+    return result.rendered_content
+
 bugdown_time_start = 0.0
 bugdown_total_time = 0.0
 bugdown_total_requests = 0
@@ -2303,3 +2830,17 @@ def convert(content: str,
                      no_previews=no_previews)
     bugdown_stats_finish()
     return ret
+
+def convert_batch(batch: List[Dict[str, Any]]) -> List[str]:
+    """Like convert, for several pieces of content at once; each
+    element of `batch` is a dict of keyword arguments for convert.
+    With a render server, these are rendered in parallel."""
+    bugdown_stats_start()
+    jobs = make_render_jobs(batch)
+    results = render_jobs(jobs)
+    for (kwargs, result) in zip(batch, results):
+        message = kwargs.get('message')
+        if message is not None:
+            result.update_message(message)
+    bugdown_stats_finish()
+    return [result.rendered_content for result in results]
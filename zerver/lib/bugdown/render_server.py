@@ -0,0 +1,294 @@
+# A pool of pre-forked processes that render markdown for the Django
+# processes, over a local Unix socket (BUGDOWN_RENDER_SERVER_SOCKET).
+#
+# Rendering in the Django process itself can only be interrupted by
+# raising an exception in the rendering thread (see
+# zerver/lib/timeout.py), which doesn't work while it's stuck in C
+# code such as a pathological regular expression, and the rendering
+# thread holds the GIL of the request worker the whole time.  Here,
+# each render instead gets a hard CPU time limit via RLIMIT_CPU: a
+# worker process that exceeds it is killed by the kernel, and the
+# server starts a replacement.  Each worker keeps its markdown engines
+# warm between renders.
+#
+# The Django process does the database queries for a render (see
+# bugdown.make_render_job), and sends the resulting RenderJob over the
+# socket; each connection carries one job and its result.  Messages
+# are pickled, which is fine since only processes running as the
+# Zulip user can connect to the socket.
+
+import logging
+import math
+import os
+import pickle
+import resource
+import selectors
+import signal
+import socket
+import struct
+import sys
+import time
+import traceback
+
+from typing import Any, List, Optional, Set, Tuple
+
+from django.conf import settings
+from django.core.cache import cache as djcache
+from django.db import connection
+
+from zerver.lib.bugdown import RenderJob, RenderResult, maybe_update_markdown_engines, \
+    render_job
+from zerver.models import flush_per_request_caches
+
+logger = logging.getLogger(__name__)
+
+# How long a Django process waits for the render server to make any
+# progress on a batch before giving up on it.
+RENDER_SERVER_IDLE_TIMEOUT = 30
+# How many of a batch's jobs a Django process sends to the render
+# server at once.
+RENDER_SERVER_MAX_CONNECTIONS = 8
+# How often we retry connecting while the render server is busy.
+RENDER_SERVER_RETRY_INTERVAL = 0.05
+
+HEADER = struct.Struct('!I')
+
+class RenderServerError(Exception):
+    def __init__(self, index: int, traceback_text: str) -> None:
+        super().__init__(traceback_text)
+        # The index of the job that failed in the batch.
+        self.index = index
+        self.traceback_text = traceback_text
+
+def encode_message(obj: Any) -> bytes:
+    data = pickle.dumps(obj, protocol=pickle.HIGHEST_PROTOCOL)
+    return HEADER.pack(len(data)) + data
+
+def decode_message(data: bytes) -> Tuple[bool, Any]:
+    """Returns (True, the message) if `data` holds a complete message,
+    and (False, None) if more data is needed."""
+    if len(data) < HEADER.size:
+        return (False, None)
+    (length,) = HEADER.unpack_from(data)
+    if len(data) < HEADER.size + length:
+        return (False, None)
+    return (True, pickle.loads(data[HEADER.size:HEADER.size + length]))
+
+def recv_message(sock: socket.socket) -> Any:
+    data = b''
+    while True:
+        (complete, obj) = decode_message(data)
+        if complete:
+            return obj
+        chunk = sock.recv(65536)
+        if not chunk:
+            raise EOFError()
+        data += chunk
+
+class RenderConnection:
+    def __init__(self, index: int, sock: socket.socket, outgoing: bytes) -> None:
+        self.index = index
+        self.sock = sock
+        self.outgoing = memoryview(outgoing)
+        self.incoming = b''
+
+def connect_to_render_server(path: str) -> Optional[socket.socket]:
+    """Returns a connected, non-blocking socket, or None if the render
+    server is busy, i.e. its listen backlog is full.  Raises OSError if
+    the render server isn't running."""
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    sock.setblocking(False)
+    try:
+        sock.connect(path)
+    except BlockingIOError:
+        sock.close()
+        return None
+    except OSError:
+        sock.close()
+        raise
+    return sock
+
+def render_remote(jobs: List[RenderJob]) -> Optional[List[RenderResult]]:
+    """Renders the jobs on the render server, in parallel.  Returns None
+    if the render server isn't running, and raises RenderServerError
+    if any job fails."""
+    selector = selectors.DefaultSelector()
+    connections = []  # type: List[RenderConnection]
+    try:
+        results = [None] * len(jobs)  # type: List[Optional[RenderResult]]
+        num_remaining = len(jobs)
+        next_index = 0
+        last_progress = time.monotonic()
+        while num_remaining > 0:
+            # Keep at most RENDER_SERVER_MAX_CONNECTIONS jobs in
+            # flight, each sent as soon as it is connected, so that a
+            # big batch can't fill the server's listen backlog with
+            # connections whose jobs we haven't sent yet.
+            while (next_index < len(jobs) and
+                   len(selector.get_map()) < RENDER_SERVER_MAX_CONNECTIONS):
+                try:
+                    sock = connect_to_render_server(settings.BUGDOWN_RENDER_SERVER_SOCKET)
+                except OSError:
+                    logger.warning("Could not connect to the render server at %s; rendering locally" % (
+                        settings.BUGDOWN_RENDER_SERVER_SOCKET,))
+                    return None
+                if sock is None:
+                    # The server is busy; try again once a job of
+                    # ours finishes, or shortly.
+                    break
+                render_connection = RenderConnection(next_index, sock,
+                                                     encode_message(jobs[next_index]))
+                connections.append(render_connection)
+                selector.register(sock, selectors.EVENT_WRITE, render_connection)
+                next_index += 1
+
+            if len(selector.get_map()) > 0:
+                events = selector.select(RENDER_SERVER_RETRY_INTERVAL)
+            else:
+                events = []
+                time.sleep(RENDER_SERVER_RETRY_INTERVAL)
+            if events:
+                last_progress = time.monotonic()
+            elif time.monotonic() - last_progress > RENDER_SERVER_IDLE_TIMEOUT:
+                index = min(i for (i, result) in enumerate(results) if result is None)
+                raise RenderServerError(index, "Timed out waiting for the render server\n")
+
+            for (key, mask) in events:
+                render_connection = key.data
+                index = render_connection.index
+                try:
+                    if mask & selectors.EVENT_WRITE:
+                        sent = render_connection.sock.send(render_connection.outgoing)
+                        render_connection.outgoing = render_connection.outgoing[sent:]
+                        if len(render_connection.outgoing) == 0:
+                            selector.modify(render_connection.sock, selectors.EVENT_READ,
+                                            render_connection)
+                        continue
+                    data = render_connection.sock.recv(65536)
+                except OSError:
+                    raise RenderServerError(index, traceback.format_exc())
+                if not data:
+                    raise RenderServerError(
+                        index, "Render server process exited while rendering "
+                        "(CPU time limit exceeded?)\n")
+
+                render_connection.incoming += data
+                (complete, reply) = decode_message(render_connection.incoming)
+                if not complete:
+                    continue
+                selector.unregister(render_connection.sock)
+                render_connection.sock.close()
+                num_remaining -= 1
+                (status, value) = reply
+                if status != 'ok':
+                    raise RenderServerError(index, value)
+                results[index] = value
+        return [result for result in results if result is not None]
+    finally:
+        selector.close()
+        for render_connection in connections:
+            render_connection.sock.close()
+
+def set_cpu_deadline(cpu_limit: int) -> None:
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    cpu_used = usage.ru_utime + usage.ru_stime
+    (soft, hard) = resource.getrlimit(resource.RLIMIT_CPU)
+    deadline = math.ceil(cpu_used) + cpu_limit
+    if hard != resource.RLIM_INFINITY:
+        deadline = min(deadline, hard)
+    # When the process exceeds this, the kernel sends it SIGXCPU,
+    # whose default action kills the process even while it is
+    # running C code.
+    resource.setrlimit(resource.RLIMIT_CPU, (deadline, hard))
+
+def clear_cpu_deadline() -> None:
+    (soft, hard) = resource.getrlimit(resource.RLIMIT_CPU)
+    resource.setrlimit(resource.RLIMIT_CPU, (hard, hard))
+
+def handle_connection(conn: socket.socket, cpu_limit: int) -> None:
+    # Don't let a client that connects but never sends its job tie up
+    # this worker.
+    conn.settimeout(RENDER_SERVER_IDLE_TIMEOUT)
+    try:
+        job = recv_message(conn)
+    except (OSError, EOFError):
+        return
+
+    # Make sure we see changes to realm filters.
+    flush_per_request_caches()
+
+    set_cpu_deadline(cpu_limit)
+    try:
+        reply = ('ok', render_job(job, use_timeout=False))  # type: Tuple[str, Any]
+    except Exception:
+        reply = ('error', traceback.format_exc())
+    clear_cpu_deadline()
+
+    try:
+        conn.sendall(encode_message(reply))
+    except OSError:
+        pass
+
+def run_worker(listener: socket.socket, cpu_limit: int) -> None:
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    signal.signal(signal.SIGINT, signal.SIG_DFL)
+    # Don't write a core file for every render that hits the limit.
+    (soft, hard) = resource.getrlimit(resource.RLIMIT_CORE)
+    resource.setrlimit(resource.RLIMIT_CORE, (0, hard))
+
+    # Build the markdown engines up front, rather than on the first
+    # render.
+    maybe_update_markdown_engines(None, False)
+    maybe_update_markdown_engines(None, True)
+
+    while True:
+        (conn, address) = listener.accept()
+        with conn:
+            handle_connection(conn, cpu_limit)
+
+def start_worker(listener: socket.socket, cpu_limit: int) -> int:
+    # The worker must open its own database and memcached connections,
+    # rather than share ours.
+    connection.close()
+    djcache.close()
+    pid = os.fork()
+    if pid == 0:
+        try:
+            run_worker(listener, cpu_limit)
+        except BaseException:
+            logger.exception("Render server worker failed")
+        finally:
+            os._exit(1)
+    return pid
+
+def serve(socket_path: str, num_processes: int, cpu_limit: int) -> None:
+    if os.path.exists(socket_path):
+        os.unlink(socket_path)
+    listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    listener.bind(socket_path)
+    os.chmod(socket_path, 0o600)
+    listener.listen(128)
+
+    workers = set()  # type: Set[int]
+
+    def shutdown(signum: int, frame: Any) -> None:
+        for pid in workers:
+            os.kill(pid, signal.SIGTERM)
+        sys.exit(0)
+    signal.signal(signal.SIGTERM, shutdown)
+    signal.signal(signal.SIGINT, shutdown)
+
+    for i in range(num_processes):
+        workers.add(start_worker(listener, cpu_limit))
+    logger.info("Render server listening on %s with %d processes" % (socket_path, num_processes))
+
+    while True:
+        (pid, status) = os.wait()
+        if pid not in workers:
+            continue
+        workers.remove(pid)
+        if os.WIFSIGNALED(status) and os.WTERMSIG(status) == signal.SIGXCPU:
+            logger.warning("Render server worker %d exceeded its CPU time limit; replacing it" % (pid,))
+        else:
+            logger.warning("Render server worker %d exited with status %d; replacing it" % (pid, status))
+        workers.add(start_worker(listener, cpu_limit))
@@ -5,12 +5,15 @@ from django.utils.lru_cache import lru_cache
 from django.core.cache import cache as djcache
 from django.core.cache import caches
 from django.conf import settings
+from django.db import transaction
 from django.db.models import Q
 from django.core.cache.backends.base import BaseCache
 from django.http import HttpRequest
 
 from typing import Any, Callable, Dict, Iterable, List, Optional, TypeVar, Tuple
 
+from zerver.lib.local_cache import key_family, local_cache, local_cache_enabled, \
+    local_cache_families, publish_invalidations
 from zerver.lib.utils import statsd, statsd_key, make_safe_digest
 import time
 import base64
@@ -18,6 +21,7 @@ import random
 import sys
 import os
 import hashlib
+import math
 
 if False:
     # These modules have to be imported for type annotations but
@@ -129,22 +133,120 @@ def get_cache_with_key(
 
     return decorator
 
+# How long a process recomputing a single_flight value may hold its
+# lock, and so how long other processes wait for it.
+SINGLE_FLIGHT_LOCK_TIMEOUT = 10
+SINGLE_FLIGHT_POLL_INTERVAL = 0.05
+# How eagerly single_flight values are refreshed before they expire;
+# see should_refresh_early.
+EARLY_REFRESH_BETA = 1.0
+# generic_bulk_cached_fetch only takes locks for up to this many misses.
+SINGLE_FLIGHT_MAX_BULK_LOCKS = 20
+
+def single_flight_lock_key(key: str) -> str:
+    return "lock:%s" % (key,)
+
+def stale_copy_key(key: str) -> str:
+    return "stale:%s" % (key,)
+
+def acquire_recompute_lock(key: str, cache_name: Optional[str]=None) -> bool:
+    remote_cache_stats_start()
+    acquired = get_cache_backend(cache_name).add(KEY_PREFIX + single_flight_lock_key(key), True,
+                                                 timeout=SINGLE_FLIGHT_LOCK_TIMEOUT)
+    remote_cache_stats_finish()
+    return acquired
+
+def release_recompute_locks(keys: Iterable[str], cache_name: Optional[str]=None) -> None:
+    remote_cache_stats_start()
+    get_cache_backend(cache_name).delete_many(
+        KEY_PREFIX + single_flight_lock_key(key) for key in keys)
+    remote_cache_stats_finish()
+
+def wait_for_recompute(keys: List[str], cache_name: Optional[str]=None) -> Dict[str, Any]:
+    """Waits for whoever holds the locks for `keys` to cache them; returns
+    the ones that were cached.  We stop waiting for a key once its lock
+    is released (or expires) without the value being cached, e.g.
+    because computing it failed, so the caller can compute it."""
+    found = {}  # type: Dict[str, Any]
+    waiting = list(keys)
+    deadline = time.time() + SINGLE_FLIGHT_LOCK_TIMEOUT
+    while waiting and time.time() < deadline:
+        time.sleep(SINGLE_FLIGHT_POLL_INTERVAL)
+        ret = cache_get_many(waiting + [single_flight_lock_key(key) for key in waiting],
+                             cache_name=cache_name)
+        still_waiting = []
+        for key in waiting:
+            if key in ret:
+                found[key] = ret[key]
+            elif single_flight_lock_key(key) in ret:
+                still_waiting.append(key)
+        waiting = still_waiting
+    return found
+
+def should_refresh_early(val: Tuple[Any, ...], key: str, cache_name: Optional[str]) -> bool:
+    """Whether this caller should recompute a cached single_flight value
+    before it expires (and has the lock to do so).  This is the
+    "XFetch" algorithm: the closer the value is to expiring, and the
+    longer it took to compute, the more likely each caller is to
+    refresh it, so that a hot key is usually recomputed by one caller
+    before it expires, rather than by all of them after."""
+    if len(val) < 2:
+        # Cached by something other than cache_with_key (e.g. the
+        # cache warmup code), or without a timeout.
+        return False
+    (expires_at, compute_time) = val[1]
+    if time.time() - compute_time * EARLY_REFRESH_BETA * math.log(1 - random.random()) < expires_at:
+        return False
+    return acquire_recompute_lock(key, cache_name)
+
 def cache_with_key(
         keyfunc: Callable[..., str], cache_name: Optional[str]=None,
-        timeout: Optional[int]=None, with_statsd_key: Optional[str]=None
+        timeout: Optional[int]=None, with_statsd_key: Optional[str]=None,
+        local_cache_family: Optional[str]=None, single_flight: bool=False,
+        serve_stale: bool=False
 ) -> Callable[[Callable[..., ReturnT]], Callable[..., ReturnT]]:
     """Decorator which applies Django caching to a function.
 
        Decorator argument is a function which computes a cache key
        from the original function's arguments.  You are responsible
        for avoiding collisions with other uses of this decorator or
-       other uses of caching."""
+       other uses of caching.
+
+       For values that are read on nearly every request and rarely
+       change, pass local_cache_family, the part of the keys before
+       the first ':', to also cache them in each process when
+       settings.LOCAL_CACHE_MAX_ENTRIES is set; see
+       zerver/lib/local_cache.py.
+
+       For values that are expensive to compute and read by many
+       requests at once, pass single_flight: after a miss, only the
+       caller that gets a short lock in the remote cache recomputes
+       the value, while the others wait for it.  If there's a
+       timeout, one caller also refreshes the value shortly before it
+       expires.  With serve_stale, the callers that don't have the
+       lock return the value from before it was flushed, if any,
+       rather than wait; only use this where a slightly out-of-date
+       value is harmless."""
+
+    if local_cache_family is not None:
+        assert cache_name is None
+        local_cache_families.add(local_cache_family)
+    assert single_flight or not serve_stale
 
     def decorator(func: Callable[..., ReturnT]) -> Callable[..., ReturnT]:
         @wraps(func)
         def func_with_caching(*args: Any, **kwargs: Any) -> ReturnT:
             key = keyfunc(*args, **kwargs)
 
+            use_local_cache = local_cache_family is not None and local_cache_enabled()
+            if use_local_cache:
+                assert local_cache_family is not None
+                assert key_family(key) == local_cache_family
+                val = local_cache.get(KEY_PREFIX + key, local_cache_family)
+                if val is not None:
+                    return val[0]
+                generation = local_cache.generation
+
             val = cache_get(key, cache_name=cache_name)
 
             extra = ""
@@ -160,13 +262,45 @@ def cache_with_key(
             statsd.incr("cache%s.%s.%s" % (extra, metric_key, status))
 
             # Values are singleton tuples so that we can distinguish
-            # a result of None from a missing key.
+            # a result of None from a missing key.  (single_flight
+            # values also have the information for refreshing them
+            # early; see should_refresh_early.)
+            have_lock = False
             if val is not None:
-                return val[0]
-
-            val = func(*args, **kwargs)
+                if not single_flight or not should_refresh_early(val, key, cache_name):
+                    if use_local_cache:
+                        local_cache.set(KEY_PREFIX + key, val, generation)
+                    return val[0]
+                have_lock = True
+            elif single_flight:
+                have_lock = acquire_recompute_lock(key, cache_name)
+                if not have_lock:
+                    if serve_stale:
+                        val = cache_get(stale_copy_key(key), cache_name=cache_name)
+                        if val is not None:
+                            return val[0]
+                    val = wait_for_recompute([key], cache_name=cache_name).get(key)
+                    if val is not None:
+                        return val[0]
+                    # Whoever had the lock gave up, is taking too
+                    # long, or died; compute the value ourselves.
 
-            cache_set(key, val, cache_name=cache_name, timeout=timeout)
+            try:
+                start = time.time()
+                val = func(*args, **kwargs)
+                if not single_flight:
+                    cache_set(key, val, cache_name=cache_name, timeout=timeout)
+                else:
+                    refresh_info = None  # type: Optional[Tuple[float, float]]
+                    if timeout is not None:
+                        refresh_info = (time.time() + timeout, time.time() - start)
+                    items = {key: (val, refresh_info) if refresh_info else (val,)}
+                    if serve_stale:
+                        items[stale_copy_key(key)] = (val,)
+                    cache_set_many(items, cache_name=cache_name, timeout=timeout)
+            finally:
+                if have_lock:
+                    release_recompute_locks([key], cache_name=cache_name)
 
             return val
 
@@ -174,11 +308,34 @@ def cache_with_key(
 
     return decorator
 
+def invalidate_local_caches(keys: Iterable[str]) -> None:
+    """Drops any of these keys that other processes may have in their
+    local caches.  Called for every change to the remote cache."""
+    if not local_cache_families or not local_cache_enabled():
+        return
+    local_keys = [KEY_PREFIX + key for key in keys if key_family(key) in local_cache_families]
+    if local_keys:
+        publish_invalidations(local_keys)
+
 def cache_set(key: str, val: Any, cache_name: Optional[str]=None, timeout: Optional[int]=None) -> None:
     remote_cache_stats_start()
     cache_backend = get_cache_backend(cache_name)
     cache_backend.set(KEY_PREFIX + key, (val,), timeout=timeout)
     remote_cache_stats_finish()
+    if cache_name is None:
+        invalidate_local_caches([key])
+
+def cache_add(key: str, val: Any, cache_name: Optional[str]=None,
+              timeout: Optional[int]=None) -> bool:
+    """Like cache_set, but only sets the key if it isn't already set;
+    returns whether it did."""
+    remote_cache_stats_start()
+    cache_backend = get_cache_backend(cache_name)
+    added = cache_backend.add(KEY_PREFIX + key, (val,), timeout=timeout)
+    remote_cache_stats_finish()
+    if added and cache_name is None:
+        invalidate_local_caches([key])
+    return added
 
 def cache_get(key: str, cache_name: Optional[str]=None) -> Any:
     remote_cache_stats_start()
@@ -199,21 +356,27 @@ def cache_set_many(items: Dict[str, Any], cache_name: Optional[str]=None,
     new_items = {}
     for key in items:
         new_items[KEY_PREFIX + key] = items[key]
-    items = new_items
     remote_cache_stats_start()
-    get_cache_backend(cache_name).set_many(items, timeout=timeout)
+    get_cache_backend(cache_name).set_many(new_items, timeout=timeout)
     remote_cache_stats_finish()
+    if cache_name is None:
+        invalidate_local_caches(items.keys())
 
 def cache_delete(key: str, cache_name: Optional[str]=None) -> None:
     remote_cache_stats_start()
     get_cache_backend(cache_name).delete(KEY_PREFIX + key)
     remote_cache_stats_finish()
+    if cache_name is None:
+        invalidate_local_caches([key])
 
 def cache_delete_many(items: Iterable[str], cache_name: Optional[str]=None) -> None:
+    items = list(items)
     remote_cache_stats_start()
     get_cache_backend(cache_name).delete_many(
         KEY_PREFIX + item for item in items)
     remote_cache_stats_finish()
+    if cache_name is None:
+        invalidate_local_caches(items)
 
 # Generic_bulk_cached fetch and its helpers
 ObjKT = TypeVar('ObjKT')
@@ -253,28 +416,51 @@ def generic_bulk_cached_fetch(
         extractor: Callable[[CompressedItemT], ItemT] = default_extractor,
         setter: Callable[[ItemT], CompressedItemT] = default_setter,
         id_fetcher: Callable[[ItemT], ObjKT] = default_id_fetcher,
-        cache_transformer: Callable[[ItemT], ItemT] = default_cache_transformer
+        cache_transformer: Callable[[ItemT], ItemT] = default_cache_transformer,
+        single_flight: bool = False
 ) -> Dict[ObjKT, ItemT]:
     cache_keys = {}  # type: Dict[ObjKT, str]
     for object_id in object_ids:
         cache_keys[object_id] = cache_key_function(object_id)
     cached_objects_compressed = cache_get_many([cache_keys[object_id]
                                                 for object_id in object_ids])  # type: Dict[str, Tuple[CompressedItemT]]
+
+    locked_keys = []  # type: List[str]
+    missing_keys = set(cache_keys.values()) - set(cached_objects_compressed.keys())
+    if single_flight and len(missing_keys) <= SINGLE_FLIGHT_MAX_BULK_LOCKS:
+        # As in cache_with_key, we only query for the objects whose
+        # locks we get, and wait for whoever has the others.  Each
+        # lock is a round trip, so we don't bother for big batches of
+        # misses, which aren't what a stampede looks like anyway.
+        waiting_keys = []  # type: List[str]
+        for key in missing_keys:
+            if acquire_recompute_lock(key):
+                locked_keys.append(key)
+            else:
+                waiting_keys.append(key)
+        if waiting_keys:
+            cached_objects_compressed.update(wait_for_recompute(waiting_keys))
+
     cached_objects = {}  # type: Dict[str, ItemT]
     for (key, val) in cached_objects_compressed.items():
         cached_objects[key] = extractor(cached_objects_compressed[key][0])
     needed_ids = [object_id for object_id in object_ids if
                   cache_keys[object_id] not in cached_objects]
-    db_objects = query_function(needed_ids)
-
-    items_for_remote_cache = {}  # type: Dict[str, Tuple[CompressedItemT]]
-    for obj in db_objects:
-        key = cache_keys[id_fetcher(obj)]
-        item = cache_transformer(obj)
-        items_for_remote_cache[key] = (setter(item),)
-        cached_objects[key] = item
-    if len(items_for_remote_cache) > 0:
-        cache_set_many(items_for_remote_cache)
+
+    try:
+        db_objects = query_function(needed_ids)
+
+        items_for_remote_cache = {}  # type: Dict[str, Tuple[CompressedItemT]]
+        for obj in db_objects:
+            key = cache_keys[id_fetcher(obj)]
+            item = cache_transformer(obj)
+            items_for_remote_cache[key] = (setter(item),)
+            cached_objects[key] = item
+        if len(items_for_remote_cache) > 0:
+            cache_set_many(items_for_remote_cache)
+    finally:
+        if locked_keys:
+            release_recompute_locks(locked_keys)
     return dict((object_id, cached_objects[cache_keys[object_id]]) for object_id in object_ids
                 if cache_keys[object_id] in cached_objects)
 
@@ -297,6 +483,42 @@ def cache(func: Callable[..., ReturnT]) -> Callable[..., ReturnT]:
 def preview_url_cache_key(url: str) -> str:
     return "preview_url:%s" % (make_safe_digest(url))
 
+def tweet_data_cache_key(tweet_id: str) -> str:
+    return "tweet_data:%s" % (tweet_id,)
+
+def open_graph_image_cache_key(url: str) -> str:
+    return "open_graph_image:%s" % (make_safe_digest(url))
+
+def stream_recipient_info_version_cache_key(recipient_id: int) -> str:
+    return "stream_recipient_info_version:%d" % (recipient_id,)
+
+def stream_recipient_info_cache_key(recipient_id: int, version: str) -> str:
+    return "stream_recipient_info:%d:%s" % (recipient_id, version)
+
+def make_stream_recipient_info_version() -> str:
+    return '%016x' % (random.getrandbits(64),)
+
+def bump_stream_recipient_info_version(recipient_ids: Iterable[int]) -> None:
+    """Invalidates the cached recipient info (see
+    zerver/lib/stream_subscription.py) for these stream recipients.
+    Rather than deleting the cached info, we give the streams a new
+    version, so that a send which read the info from the database
+    before the change can't overwrite the info for after it.
+
+    Inside a transaction, a send could read the new version before we
+    commit, and cache the old info under it, so we bump the version
+    again once the transaction commits."""
+    recipient_ids = list(recipient_ids)
+
+    def bump() -> None:
+        version = make_stream_recipient_info_version()
+        cache_set_many({stream_recipient_info_version_cache_key(recipient_id): (version,)
+                        for recipient_id in recipient_ids})
+
+    bump()
+    if transaction.get_connection().in_atomic_block:
+        transaction.on_commit(bump)
+
 def display_recipient_cache_key(recipient_id: int) -> str:
     return "display_recipient_dict:%d" % (recipient_id,)
 
@@ -414,10 +636,11 @@ def flush_user_profile(sender: Any, **kwargs: Any) -> None:
         cache_delete(bot_dicts_in_realm_cache_key(user_profile.realm))
 
     # Invalidate realm-wide alert words cache if any user in the realm has changed
-    # alert words
-    if changed(['alert_words']):
+    # alert words (or stopped being able to receive them)
+    if changed(['alert_words', 'is_active']):
         cache_delete(realm_alert_words_cache_key(user_profile.realm))
-        cache_delete(realm_alert_words_automaton_cache_key(user_profile.realm))
+        alert_words = user_profile.alert_words if user_profile.is_active else '[]'
+        bump_realm_alert_words_version(user_profile.realm_id, (user_profile.id, alert_words))
 
 # Called by models.py to flush various caches whenever we save
 # a Realm object.  The main tricky thing here is that Realm info is
@@ -433,15 +656,50 @@ def flush_realm(sender: Any, **kwargs: Any) -> None:
         cache_delete(active_user_ids_cache_key(realm.id))
         cache_delete(bot_dicts_in_realm_cache_key(realm))
         cache_delete(realm_alert_words_cache_key(realm))
-        cache_delete(realm_alert_words_automaton_cache_key(realm))
+        bump_realm_alert_words_version(realm.id)
         cache_delete(active_non_guest_user_ids_cache_key(realm.id))
         cache_delete(realm_rendered_description_cache_key(realm))
 
 def realm_alert_words_cache_key(realm: 'Realm') -> str:
     return "realm_alert_words:%s" % (realm.string_id,)
 
-def realm_alert_words_automaton_cache_key(realm: 'Realm') -> str:
-    return "realm_alert_words_automaton:%s" % (realm.string_id,)
+def realm_alert_words_version_cache_key(realm_id: int) -> str:
+    return "realm_alert_words_version:%d" % (realm_id,)
+
+def realm_alert_words_change_cache_key(realm_id: int, version: int) -> str:
+    return "realm_alert_words_change:%d:%d" % (realm_id, version)
+
+def get_realm_alert_words_version(realm_id: int) -> int:
+    # The version is stored as a bare integer, rather than in a tuple
+    # like our other cached values, so that memcached can increment it.
+    cache_backend = get_cache_backend(None)
+    key = KEY_PREFIX + realm_alert_words_version_cache_key(realm_id)
+    version = cache_backend.get(key)
+    if version is None:
+        # Start from a random version, so that a version that was
+        # evicted isn't reused for different alert words.
+        cache_backend.add(key, random.getrandbits(48), timeout=None)
+        version = cache_backend.get(key)
+    return version
+
+def bump_realm_alert_words_version(realm_id: int,
+                                   change: Optional[Tuple[int, str]]=None) -> None:
+    """Tells the processes holding the realm's alert word automaton
+    (see zerver/lib/alert_words.py) that it's out of date.  `change`
+    is a user ID and that user's new JSON-encoded alert words; each
+    process applies the changes between the version it has and the
+    current one, rather than rebuilding the automaton, unless one is
+    missing (e.g. we don't know what changed)."""
+    cache_backend = get_cache_backend(None)
+    try:
+        version = cache_backend.incr(KEY_PREFIX + realm_alert_words_version_cache_key(realm_id))
+    except ValueError:
+        # Nobody has the version; the next process to need it will
+        # start a new one.
+        return
+    if change is not None:
+        cache_set(realm_alert_words_change_cache_key(realm_id, version), change,
+                  timeout=3600*24)
 
 def realm_rendered_description_cache_key(realm: 'Realm') -> str:
     return "realm_rendered_description:%s" % (realm.string_id,)
@@ -467,8 +725,12 @@ def flush_used_upload_space_cache(sender: Any, **kwargs: Any) -> None:
     if kwargs.get("created") is None or kwargs.get("created") is True:
         cache_delete(get_realm_used_upload_space_cache_key(attachment.owner.realm))
 
+# The version of the format of cached message dicts; see
+# stringify_message_dict in zerver/lib/message.py.
+MESSAGE_DICT_FORMAT_VERSION = 2
+
 def to_dict_cache_key_id(message_id: int) -> str:
-    return 'message_dict:%d' % (message_id,)
+    return 'message_dict:%d:%d' % (MESSAGE_DICT_FORMAT_VERSION, message_id)
 
 def to_dict_cache_key(message: 'Message') -> str:
     return to_dict_cache_key_id(message.id)
@@ -480,6 +742,10 @@ def flush_message(sender: Any, **kwargs: Any) -> None:
     message = kwargs['instance']
     cache_delete(to_dict_cache_key_id(message.id))
 
+def flush_stream_recipient_info(sender: Any, **kwargs: Any) -> None:
+    # Used for both Subscription and MutedTopic.
+    bump_stream_recipient_info_version([kwargs['instance'].recipient_id])
+
 def flush_submessage(sender: Any, **kwargs: Any) -> None:
     submessage = kwargs['instance']
     # submessages are not cached directly, they are part of their
@@ -1,9 +1,10 @@
 # See https://zulip.readthedocs.io/en/latest/subsystems/caching.html for docs
 
-from typing import Any, Callable, Dict, List, Tuple
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Tuple
 
 import datetime
 import logging
+from multiprocessing import Pool
 
 # This file needs to be different from cache.py because cache.py
 # cannot import anything from zerver.models or we'd have an import
@@ -21,7 +22,10 @@ from zerver.lib.message import MessageDict
 from zerver.lib.users import get_all_api_keys
 from importlib import import_module
 from django.contrib.sessions.models import Session
-from django.db.models import Q
+from django.core.cache import cache as djcache
+from django.db import connection
+from django.db.models import Max, Q
+from django.db.models.query import QuerySet
 from django.utils.timezone import now as timezone_now
 
 MESSAGE_CACHE_SIZE = 75000
@@ -87,61 +91,121 @@ def get_active_realm_ids() -> List[int]:
     trial organization that has ever been created costing us N streams
     worth of cache work (where N is the number of default streams for
     a new organization).
+
+    The realms are ordered by how many active users they have, most
+    first, so that we warm the caches that will get the most use first.
     """
     date = timezone_now() - datetime.timedelta(days=2)
-    return RealmCount.objects.filter(
+    return list(RealmCount.objects.filter(
         end_time__gte=date,
         property="1day_actives::day",
-        value__gt=0).distinct("realm_id").values_list("realm_id", flat=True)
+        value__gt=0).values('realm_id').annotate(
+            actives=Max('value')).order_by('-actives').values_list("realm_id", flat=True))
 
-def get_streams() -> List[Stream]:
+def get_streams(realm_ids: List[int]) -> QuerySet:
     return Stream.objects.select_related().filter(
-        realm__in=get_active_realm_ids()).exclude(
+        realm_id__in=realm_ids).exclude(
             # We filter out Zephyr realms, because they can easily
             # have 10,000s of streams with only 1 subscriber.
             is_in_zephyr_realm=True)
 
-def get_recipients() -> List[Recipient]:
+def get_recipients(realm_ids: List[int]) -> QuerySet:
     return Recipient.objects.select_related().filter(
-        type_id__in=get_streams().values_list("id", flat=True))  # type: ignore  # Should be QuerySet above
+        type=Recipient.STREAM,
+        type_id__in=get_streams(realm_ids).values_list("id", flat=True))
 
-def get_users() -> List[UserProfile]:
+def get_users(realm_ids: List[int]) -> QuerySet:
     return UserProfile.objects.select_related().filter(
         long_term_idle=False,
-        realm__in=get_active_realm_ids())
+        realm_id__in=realm_ids)
 
-# Format is (objects query, items filler function, timeout, batch size)
+# Format is (objects query, items filler function, timeout, batch size,
+# whether the cache is filled per realm)
 #
 # The objects queries are put inside lambdas to prevent Django from
 # doing any setup for things we're unlikely to use (without the lambda
 # wrapper the below adds an extra 3ms or so to startup time for
-# anything importing this file).
+# anything importing this file).  The queries for per-realm caches are
+# passed the realm's ID (in a list); the others get None.
 cache_fillers = {
-    'user': (get_users, user_cache_items, 3600*24*7, 10000),
-    'client': (lambda: Client.objects.select_related().all(), client_cache_items, 3600*24*7, 10000),
-    'recipient': (get_recipients, recipient_cache_items, 3600*24*7, 10000),
-    'stream': (get_streams, stream_cache_items, 3600*24*7, 10000),
+    'user': (get_users, user_cache_items, 3600*24*7, 10000, True),
+    'client': (lambda realm_ids: Client.objects.select_related().all(), client_cache_items,
+               3600*24*7, 10000, False),
+    'recipient': (get_recipients, recipient_cache_items, 3600*24*7, 10000, True),
+    'stream': (get_streams, stream_cache_items, 3600*24*7, 10000, True),
     # Message cache fetching disabled until we can fix the fact that it
     # does a bunch of inefficient memcached queries as part of filling
     # the display_recipient cache
-    #    'message': (message_fetch_objects, message_cache_items, 3600 * 24, 1000),
-    'huddle': (lambda: Huddle.objects.select_related().all(), huddle_cache_items, 3600*24*7, 10000),
-    'session': (lambda: Session.objects.all(), session_cache_items, 3600*24*7, 10000),
-}  # type: Dict[str, Tuple[Callable[[], List[Any]], Callable[[Dict[str, Any], Any], None], int, int]]
-
-def fill_remote_cache(cache: str) -> None:
+    #    'message': (message_fetch_objects, message_cache_items, 3600 * 24, 1000, False),
+    'huddle': (lambda realm_ids: Huddle.objects.select_related().all(), huddle_cache_items,
+               3600*24*7, 10000, False),
+    'session': (lambda realm_ids: Session.objects.all(), session_cache_items,
+                3600*24*7, 10000, False),
+}  # type: Dict[str, Tuple[Callable[[Optional[List[int]]], QuerySet], Callable[[Dict[str, Any], Any], None], int, int, bool]]
+
+def fill_remote_cache(cache: str, realm_id: Optional[int]=None) -> int:
+    """Fills `cache`, for just one realm if it's a per-realm cache;
+    returns the number of objects cached."""
     remote_cache_time_start = get_remote_cache_time()
     remote_cache_requests_start = get_remote_cache_requests()
     items_for_remote_cache = {}  # type: Dict[str, Any]
-    (objects, items_filler, timeout, batch_size) = cache_fillers[cache]
+    (objects, items_filler, timeout, batch_size, per_realm) = cache_fillers[cache]
+    if per_realm and realm_id is None:
+        realm_ids = get_active_realm_ids()  # type: Optional[List[int]]
+    elif per_realm:
+        realm_ids = [realm_id]
+    else:
+        realm_ids = None
+
     count = 0
-    for obj in objects():
+    # iterator() streams the rows with a server-side cursor, rather
+    # than load them all into memory.
+    for obj in objects(realm_ids).iterator():
         items_filler(items_for_remote_cache, obj)
         count += 1
         if (count % batch_size == 0):
             cache_set_many(items_for_remote_cache, timeout=3600*24)
             items_for_remote_cache = {}
     cache_set_many(items_for_remote_cache, timeout=3600*24*7)
-    logging.info("Successfully populated %s cache!  Consumed %s remote cache queries (%s time)" %
-                 (cache, get_remote_cache_requests() - remote_cache_requests_start,
-                  round(get_remote_cache_time() - remote_cache_time_start, 2)))
+    logging.debug("Successfully populated %s cache%s!  Consumed %s remote cache queries (%s time)" %
+                  (cache, " for realm %s" % (realm_id,) if realm_id is not None else "",
+                   get_remote_cache_requests() - remote_cache_requests_start,
+                   round(get_remote_cache_time() - remote_cache_time_start, 2)))
+    return count
+
+CacheFillTask = Tuple[str, Optional[int]]
+
+def get_cache_fill_tasks(caches: Iterable[str]) -> List[CacheFillTask]:
+    """The (cache, realm ID) pairs to fill, most important first: the
+    caches that aren't per-realm (e.g. sessions, without which every
+    logged-in user hits the database), and then each realm's caches,
+    in order of how active the realm is."""
+    tasks = [(cache, None) for cache in caches
+             if not cache_fillers[cache][4]]  # type: List[CacheFillTask]
+    per_realm_caches = [cache for cache in caches if cache_fillers[cache][4]]
+    if per_realm_caches:
+        for realm_id in get_active_realm_ids():
+            tasks += [(cache, realm_id) for cache in per_realm_caches]
+    return tasks
+
+def fill_remote_cache_task(task: CacheFillTask) -> Tuple[CacheFillTask, int]:
+    (cache, realm_id) = task
+    return (task, fill_remote_cache(cache, realm_id))
+
+def fill_remote_caches(caches: Iterable[str], processes: int=1) -> Iterator[Tuple[CacheFillTask, int, int]]:
+    """Fills the caches, with `processes` worker processes.  Yields
+    each finished task, with the number of objects it cached and the
+    number of tasks in total, so the caller can report progress."""
+    tasks = get_cache_fill_tasks(caches)
+    if processes <= 1:
+        for task in tasks:
+            yield fill_remote_cache_task(task) + (len(tasks),)
+        return
+
+    # The worker processes must each open their own database and
+    # memcached connections, rather than share ours.
+    connection.close()
+    djcache.close()
+    with Pool(processes) as pool:
+        for (task, count) in pool.imap_unordered(fill_remote_cache_task, tasks):
+            yield (task, count, len(tasks))
@@ -0,0 +1,116 @@
+# Deferred fan-out of UserMessage rows for messages to huge streams.
+#
+# When DEFERRED_FAN_OUT_MIN_RECIPIENTS is set, do_send_messages only
+# writes the UserMessage rows that matter right away (the sender's,
+# and those of users who were mentioned, have alert words in the
+# message, or get notifications) for a message to a public stream
+# with at least that many recipients.  The rest of the rows, none of
+# which have any flags set, are inserted by the deferred_work queue
+# processor, in batches.
+#
+# Until the queue processor gets to a message, the users whose rows
+# are still pending are recorded in redis, and code paths that read
+# a user's UserMessage rows call fill_in_deferred_user_messages first,
+# which inserts that user's pending rows.  The pending messages are
+# listed per realm, so that a read only checks the messages pending
+# in the user's realm.
+#
+# The redis keys don't expire: the queue processor deletes them once
+# it has inserted the rows, and until then, they're the only record
+# (besides the queued event) of which users still need rows.
+
+import logging
+from typing import Iterable, List
+
+from django.conf import settings
+from django.db import connection, transaction
+
+from zerver.lib.redis_utils import get_redis_client
+from zerver.models import UserProfile
+
+FAN_OUT_BATCH_SIZE = 5000
+
+redis_client = get_redis_client()
+
+def deferred_message_ids_key(realm_id: int) -> str:
+    """The IDs of the realm's messages with UserMessage rows still to
+    be inserted."""
+    return 'deferred_user_messages_realm:%d' % (realm_id,)
+
+def deferred_user_ids_key(message_id: int) -> str:
+    return 'deferred_user_messages:%d' % (message_id,)
+
+def deferred_fan_out_enabled() -> bool:
+    return settings.DEFERRED_FAN_OUT_MIN_RECIPIENTS is not None
+
+def record_deferred_user_messages(realm_id: int, message_id: int, user_ids: List[int]) -> None:
+    key = deferred_user_ids_key(message_id)
+    with redis_client.pipeline() as pipeline:
+        for i in range(0, len(user_ids), FAN_OUT_BATCH_SIZE):
+            pipeline.sadd(key, *user_ids[i:i + FAN_OUT_BATCH_SIZE])
+        pipeline.sadd(deferred_message_ids_key(realm_id), message_id)
+        pipeline.execute()
+
+def insert_user_messages_if_missing(user_profile_ids: Iterable[int],
+                                    message_ids: Iterable[int]) -> None:
+    # Either of the queue processor and a reader may get to a row
+    # first, so we skip the rows that already exist.
+    with connection.cursor() as cursor:
+        cursor.execute('''
+            INSERT INTO zerver_usermessage (user_profile_id, message_id, flags)
+            SELECT user_profile_id, message_id, 0
+            FROM unnest(%s::bigint[]) AS user_profile_id,
+                 unnest(%s::bigint[]) AS message_id
+            ON CONFLICT (user_profile_id, message_id) DO NOTHING
+        ''', [list(user_profile_ids), list(message_ids)])
+
+def fan_out_deferred_user_messages(realm_id: int, message_id: int, user_ids: List[int]) -> None:
+    for i in range(0, len(user_ids), FAN_OUT_BATCH_SIZE):
+        with transaction.atomic():
+            insert_user_messages_if_missing(user_ids[i:i + FAN_OUT_BATCH_SIZE],
+                                            [message_id])
+
+    with redis_client.pipeline() as pipeline:
+        pipeline.srem(deferred_message_ids_key(realm_id), message_id)
+        pipeline.delete(deferred_user_ids_key(message_id))
+        pipeline.execute()
+
+def fill_in_deferred_user_messages(user_profile: UserProfile) -> None:
+    if not deferred_fan_out_enabled():
+        return
+
+    message_ids_key = deferred_message_ids_key(user_profile.realm_id)
+    message_ids = sorted(int(message_id) for message_id in
+                         redis_client.smembers(message_ids_key))
+    if not message_ids:
+        return
+
+    with redis_client.pipeline() as pipeline:
+        for message_id in message_ids:
+            key = deferred_user_ids_key(message_id)
+            pipeline.sismember(key, user_profile.id)
+            pipeline.exists(key)
+        results = pipeline.execute()
+
+    pending_message_ids = []
+    lost_message_ids = []
+    for (i, message_id) in enumerate(message_ids):
+        (is_pending, key_exists) = results[2 * i:2 * i + 2]
+        if is_pending:
+            pending_message_ids.append(message_id)
+        elif not key_exists:
+            lost_message_ids.append(message_id)
+
+    if pending_message_ids:
+        insert_user_messages_if_missing([user_profile.id], pending_message_ids)
+
+    if lost_message_ids:
+        # The user IDs don't expire, so this only happens if redis
+        # lost them (e.g. it was restarted without persistence).  The
+        # queued fan-out events still have the user IDs, so the rows
+        # are inserted when the queue processor gets to them; until
+        # then, readers can't fill them in.
+        logging.warning("Pending UserMessage rows for messages %s are missing from redis; "
+                        "they will be inserted by the deferred_work queue processor."
+                        % (lost_message_ids,))
+        redis_client.srem(message_ids_key, *lost_message_ids)
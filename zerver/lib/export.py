@@ -11,6 +11,7 @@ from boto.s3.connection import S3Connection
 from boto.s3.key import Key  # for mypy
 from django.apps import apps
 from django.conf import settings
+from django.db.models.query import QuerySet
 from django.forms.models import model_to_dict
 from django.utils.timezone import make_aware as timezone_make_aware
 from django.utils.timezone import is_naive as timezone_is_naive
@@ -62,6 +63,18 @@ MessageOutput = Dict[str, Union[List[Record], List[int], int]]
 
 MESSAGE_BATCH_CHUNK_SIZE = 1000
 
+# An append-only log of the message shards that have been completely
+# written, one JSON object per line, which lets an interrupted export
+# be resumed without refetching those messages.
+MESSAGE_SHARD_MANIFEST = 'message_shards.jsonl'
+
+# Other tables that grow with the number of messages are written to
+# their own shards, e.g. attachments-000001.json, with a manifest just
+# like the message shards'.  Attachment shards have at most this many
+# rows; reactions are sharded by message (see export_reaction_table).
+TABLE_BATCH_CHUNK_SIZE = 10000
+TABLE_SHARD_MANIFEST = 'table_shards.jsonl'
+
 ALL_ZULIP_TABLES = {
     'analytics_fillstate',
     'analytics_installationcount',
@@ -296,7 +309,14 @@ def make_raw(query: Any, exclude: Optional[List[Field]]=None) -> List[Record]:
     '''
     Takes a Django query and returns a JSONable list
     of dictionaries corresponding to the database rows.
+
+    QuerySets are streamed through a server-side cursor, so that we
+    never hold more than one batch of model instances (in addition
+    to the much smaller dictionaries) in memory.
     '''
+    if isinstance(query, QuerySet):
+        query = query.iterator()
+
     rows = []
     for instance in query:
         data = model_to_dict(instance, exclude=exclude)
@@ -438,7 +458,7 @@ def export_from_config(response: TableData, config: Config, seed_object: Optiona
     for t in exported_tables:
         logging.info('Exporting via export_from_config:  %s' % (t,))
 
-    rows = None
+    rows = None  # type: Any
     if config.is_seeded:
         rows = [seed_object]
 
@@ -467,8 +487,7 @@ def export_from_config(response: TableData, config: Config, seed_object: Optiona
 
     elif config.use_all:
         assert model is not None
-        query = model.objects.all()
-        rows = list(query)
+        rows = model.objects.all()
 
     elif config.normal_parent:
         # In this mode, our current model is figuratively Article,
@@ -484,8 +503,7 @@ def export_from_config(response: TableData, config: Config, seed_object: Optiona
         if config.filter_args is not None:
             filter_parms.update(config.filter_args)
         assert model is not None
-        query = model.objects.filter(**filter_parms)
-        rows = list(query)
+        rows = model.objects.filter(**filter_parms)
 
     elif config.id_source:
         # In this mode, we are the figurative Blog, and we now
@@ -502,8 +520,7 @@ def export_from_config(response: TableData, config: Config, seed_object: Optiona
         filter_parms = dict(id__in=lookup_ids)
         if config.filter_args:
             filter_parms.update(config.filter_args)
-        query = model.objects.filter(**filter_parms)
-        rows = list(query)
+        rows = model.objects.filter(**filter_parms)
 
     # Post-process rows (which won't apply to custom fetches/concats)
     if rows is not None:
@@ -791,7 +808,7 @@ def fetch_user_profile(response: TableData, config: Config, context: Context) ->
 
     query = UserProfile.objects.filter(realm_id=realm.id)
     exclude = ['password', 'api_key']
-    rows = make_raw(list(query), exclude=exclude)
+    rows = make_raw(query, exclude=exclude)
 
     normal_rows = []  # type: List[Record]
     dummy_rows = []  # type: List[Record]
@@ -833,10 +850,7 @@ def fetch_user_profile_cross_realm(response: TableData, config: Config, context:
             recipient_id=recipient_id,
         ))
 
-def fetch_attachment_data(response: TableData, realm_id: int, message_ids: Set[int]) -> None:
-    filter_args = {'realm_id': realm_id}
-    query = Attachment.objects.filter(**filter_args)
-    response['zerver_attachment'] = make_raw(list(query))
+def clean_attachment_data(response: TableData, message_ids: Set[int]) -> None:
     floatify_datetime_fields(response, 'zerver_attachment')
 
     '''
@@ -860,10 +874,6 @@ def fetch_attachment_data(response: TableData, realm_id: int, message_ids: Set[i
         row for row in response['zerver_attachment']
         if row['messages']]
 
-def fetch_reaction_data(response: TableData, message_ids: Set[int]) -> None:
-    query = Reaction.objects.filter(message_id__in=list(message_ids))
-    response['zerver_reaction'] = make_raw(list(query))
-
 def fetch_huddle_objects(response: TableData, config: Config, context: Context) -> None:
 
     realm = context['realm']
@@ -1016,8 +1026,12 @@ def export_partial_message_files(realm: Realm,
 
     all_message_ids = set()  # type: Set[int]
     dump_file_id = 1
+    completed_shards = read_message_shard_manifest(output_dir)
+    if completed_shards:
+        logging.info("Resuming export after %d completed message shards" % (len(completed_shards),))
+        unlock_message_partials(output_dir)
 
-    for message_query in message_queries:
+    for (query_index, message_query) in enumerate(message_queries):
         dump_file_id = write_message_partial_for_query(
             realm=realm,
             message_query=message_query,
@@ -1026,16 +1040,77 @@ def export_partial_message_files(realm: Realm,
             output_dir=output_dir,
             user_profile_ids=user_ids_for_us,
             chunk_size=chunk_size,
+            query_index=query_index,
+            completed_shards=completed_shards,
         )
 
     return all_message_ids
 
+def read_message_shard_manifest(output_dir: Path) -> Dict[int, Record]:
+    '''
+    Returns the message shards recorded in the manifest by an earlier,
+    interrupted run of the export into output_dir, keyed by
+    dump_file_id.
+    '''
+    completed_shards = {}  # type: Dict[int, Record]
+    manifest_path = os.path.join(output_dir, MESSAGE_SHARD_MANIFEST)
+    if not os.path.exists(manifest_path):
+        return completed_shards
+
+    with open(manifest_path) as manifest_file:
+        for line in manifest_file:
+            try:
+                shard = ujson.loads(line)
+            except ValueError:
+                # The last line may have been cut short when the
+                # export was interrupted; that shard is redone.
+                break
+            completed_shards[shard['dump_file_id']] = shard
+    return completed_shards
+
+def record_message_shard(output_dir: Path, shard: Record) -> None:
+    manifest_path = os.path.join(output_dir, MESSAGE_SHARD_MANIFEST)
+    with open(manifest_path, 'a') as manifest_file:
+        manifest_file.write(ujson.dumps(shard) + '\n')
+
+def unlock_message_partials(output_dir: Path) -> None:
+    '''
+    Returns the .partial files claimed by export_usermessage_batch
+    processes that were interrupted to the pool of unprocessed files.
+    '''
+    for locked_path in glob.glob(os.path.join(output_dir, 'messages-*.json.locked')):
+        shutil.move(locked_path, locked_path.replace(".json.locked", ".json.partial"))
+
+def read_message_shard_ids(output_dir: Path, dump_file_id: int) -> Set[int]:
+    # If the .partial file is still there, the final .json file (if
+    # any) may have been cut short by the interruption.
+    message_filename = os.path.join(output_dir, "messages-%06d.json" % (dump_file_id,))
+    if os.path.exists(message_filename + '.partial'):
+        message_filename += '.partial'
+    with open(message_filename) as message_file:
+        data = ujson.load(message_file)
+    return set(m['id'] for m in data['zerver_message'])
+
 def write_message_partial_for_query(realm: Realm, message_query: Any, dump_file_id: int,
                                     all_message_ids: Set[int], output_dir: Path,
                                     user_profile_ids: Set[int],
-                                    chunk_size: int=MESSAGE_BATCH_CHUNK_SIZE) -> int:
+                                    chunk_size: int=MESSAGE_BATCH_CHUNK_SIZE,
+                                    query_index: int=0,
+                                    completed_shards: Optional[Dict[int, Record]]=None) -> int:
     min_id = -1
 
+    # Skip over the shards that an interrupted run of the export
+    # already wrote for this query.  Since the shards are a
+    # deterministic function of the (deactivated) realm's data, we
+    # can just pick up where that run left off.
+    while completed_shards is not None and dump_file_id in completed_shards:
+        shard = completed_shards[dump_file_id]
+        if shard['query_index'] != query_index:
+            break
+        all_message_ids.update(read_message_shard_ids(output_dir, dump_file_id))
+        min_id = shard['max_id']
+        dump_file_id += 1
+
     while True:
         actual_query = message_query.filter(id__gt=min_id)[0:chunk_size]
         message_chunk = make_raw(actual_query)
@@ -1068,6 +1143,9 @@ def write_message_partial_for_query(realm: Realm, message_query: Any, dump_file_
         # And write the data.
         write_message_export(message_filename, output)
         min_id = max(message_ids)
+        record_message_shard(output_dir, dict(dump_file_id=dump_file_id,
+                                              query_index=query_index,
+                                              max_id=min_id))
         dump_file_id += 1
 
     return dump_file_id
@@ -1326,10 +1404,12 @@ def export_emoji_from_local(realm: Realm, local_dir: Path, output_dir: Path) ->
 def do_write_stats_file_for_realm_export(output_dir: Path) -> None:
     stats_file = os.path.join(output_dir, 'stats.txt')
     realm_file = os.path.join(output_dir, 'realm.json')
-    attachment_file = os.path.join(output_dir, 'attachment.json')
     analytics_file = os.path.join(output_dir, 'analytics.json')
     message_files = glob.glob(os.path.join(output_dir, 'messages-*.json'))
-    fns = sorted([analytics_file] + [attachment_file] + message_files + [realm_file])
+    reaction_files = glob.glob(os.path.join(output_dir, 'reactions-*.json'))
+    attachment_files = glob.glob(os.path.join(output_dir, 'attachments-*.json'))
+    fns = sorted([analytics_file] + attachment_files + message_files +
+                 reaction_files + [realm_file])
 
     logging.info('Writing stats file: %s\n' % (stats_file,))
     with open(stats_file, 'w') as f:
@@ -1390,11 +1470,6 @@ def do_export_realm(realm: Realm, output_dir: Path, threads: int,
                                                public_only=public_only)
     logging.info('%d messages were exported' % (len(message_ids)))
 
-    # zerver_reaction
-    zerver_reaction = {}  # type: TableData
-    fetch_reaction_data(response=zerver_reaction, message_ids=message_ids)
-    response.update(zerver_reaction)
-
     # Write realm data
     export_file = os.path.join(output_dir, "realm.json")
     write_data_to_file(output_file=export_file, data=response)
@@ -1403,7 +1478,8 @@ def do_export_realm(realm: Realm, output_dir: Path, threads: int,
     # Write analytics data
     export_analytics_tables(realm=realm, output_dir=output_dir)
 
-    # zerver_attachment
+    # zerver_reaction and zerver_attachment
+    export_reaction_table(realm=realm, output_dir=output_dir, message_ids=message_ids)
     export_attachment_table(realm=realm, output_dir=output_dir, message_ids=message_ids)
 
     # Start parallel jobs to export the UserMessage objects.
@@ -1412,12 +1488,108 @@ def do_export_realm(realm: Realm, output_dir: Path, threads: int,
     logging.info("Finished exporting %s" % (realm.string_id))
     create_soft_link(source=output_dir, in_progress=False)
 
-def export_attachment_table(realm: Realm, output_dir: Path, message_ids: Set[int]) -> None:
-    response = {}  # type: TableData
-    fetch_attachment_data(response=response, realm_id=realm.id, message_ids=message_ids)
-    output_file = os.path.join(output_dir, "attachment.json")
-    logging.info('Writing attachment table data to %s' % (output_file,))
-    write_data_to_file(output_file=output_file, data=response)
+def export_reaction_table(realm: Realm, output_dir: Path, message_ids: Set[int],
+                          chunk_size: int=MESSAGE_BATCH_CHUNK_SIZE) -> None:
+    '''
+    Writes the reactions on the exported messages, with one shard
+    (e.g. reactions-000001.json) per chunk_size of the messages, in
+    order of their IDs; so, for a realm's own messages, the reaction
+    shards cover the same messages as the message shards.  Like the
+    other tables' shards, each completed file is recorded in the
+    manifest, and a resumed export skips over those files.
+    '''
+    table = 'zerver_reaction'
+    completed_shards = read_table_shard_manifest(output_dir, table)
+    sorted_message_ids = sorted(message_ids)
+    # We always write the first file, even if it's empty, so that the
+    # importer can tell an empty table from a missing one.
+    message_id_chunks = [sorted_message_ids[i:i + chunk_size]
+                         for i in range(0, len(sorted_message_ids), chunk_size)] or [[]]
+
+    for (i, message_id_chunk) in enumerate(message_id_chunks):
+        dump_file_id = i + 1
+        if dump_file_id in completed_shards:
+            continue
+
+        query = Reaction.objects.filter(message_id__in=message_id_chunk).order_by('id')
+        response = {table: make_raw(query)}  # type: TableData
+        output_file = os.path.join(output_dir, "reactions-%06d.json" % (dump_file_id,))
+        logging.info('Writing %s table data to %s' % (table, output_file))
+        write_data_to_file(output_file=output_file, data=response)
+        record_table_shard(output_dir, dict(table=table,
+                                            dump_file_id=dump_file_id,
+                                            max_id=message_id_chunk[-1] if message_id_chunk else -1))
+
+def export_attachment_table(realm: Realm, output_dir: Path, message_ids: Set[int],
+                            chunk_size: int=TABLE_BATCH_CHUNK_SIZE) -> None:
+    export_table_shards(
+        query=Attachment.objects.filter(realm_id=realm.id),
+        table='zerver_attachment',
+        file_prefix='attachments',
+        output_dir=output_dir,
+        process_chunk=lambda response: clean_attachment_data(response, message_ids),
+        chunk_size=chunk_size,
+    )
+
+def export_table_shards(query: Any, table: TableName, file_prefix: str, output_dir: Path,
+                        process_chunk: Callable[[TableData], None],
+                        chunk_size: int=TABLE_BATCH_CHUNK_SIZE) -> None:
+    '''
+    Writes the rows of query to files of at most chunk_size rows each
+    (e.g. reactions-000001.json), fetching them in batches by id, so
+    that only one batch is ever held in memory.  process_chunk cleans
+    up (and may filter) the rows of each batch before it's written.
+
+    Like the message shards, each completed file is recorded in a
+    manifest, and a resumed export skips over those files.
+    '''
+    completed_shards = read_table_shard_manifest(output_dir, table)
+    min_id = -1
+    dump_file_id = 1
+    while dump_file_id in completed_shards:
+        min_id = completed_shards[dump_file_id]['max_id']
+        dump_file_id += 1
+
+    while True:
+        rows = make_raw(query.filter(id__gt=min_id).order_by('id')[0:chunk_size])
+        if len(rows) == 0 and dump_file_id > 1:
+            break
+        # We always write the first file, even if it's empty, so that
+        # the importer can tell an empty table from a missing one.
+        if rows:
+            min_id = rows[-1]['id']
+
+        response = {table: rows}  # type: TableData
+        process_chunk(response)
+        output_file = os.path.join(output_dir, "%s-%06d.json" % (file_prefix, dump_file_id))
+        logging.info('Writing %s table data to %s' % (table, output_file))
+        write_data_to_file(output_file=output_file, data=response)
+        record_table_shard(output_dir, dict(table=table,
+                                            dump_file_id=dump_file_id,
+                                            max_id=min_id))
+        dump_file_id += 1
+
+def read_table_shard_manifest(output_dir: Path, table: TableName) -> Dict[int, Record]:
+    completed_shards = {}  # type: Dict[int, Record]
+    manifest_path = os.path.join(output_dir, TABLE_SHARD_MANIFEST)
+    if not os.path.exists(manifest_path):
+        return completed_shards
+
+    with open(manifest_path) as manifest_file:
+        for line in manifest_file:
+            try:
+                shard = ujson.loads(line)
+            except ValueError:
+                # As in read_message_shard_manifest.
+                break
+            if shard['table'] == table:
+                completed_shards[shard['dump_file_id']] = shard
+    return completed_shards
+
+def record_table_shard(output_dir: Path, shard: Record) -> None:
+    manifest_path = os.path.join(output_dir, TABLE_SHARD_MANIFEST)
+    with open(manifest_path, 'a') as manifest_file:
+        manifest_file.write(ujson.dumps(shard) + '\n')
 
 def create_soft_link(source: Path, in_progress: bool=True) -> None:
     is_done = not in_progress
@@ -8,6 +8,7 @@ CursorObj = TypeVar('CursorObj', bound=cursor)
 
 from django.db import connection
 
+from zerver.lib.unread_index import invalidate_unread_indexes
 from zerver.models import UserProfile
 
 '''
@@ -240,3 +241,4 @@ def fix(user_profile: UserProfile) -> None:
     with connection.cursor() as cursor:
         fix_unsubscribed(cursor, user_profile)
         fix_pre_pointer(cursor, user_profile)
+    invalidate_unread_indexes([user_profile.id])
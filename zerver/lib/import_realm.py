@@ -1,32 +1,36 @@
 import datetime
+import itertools
 import logging
+import multiprocessing
 import os
+import time
 import ujson
 import shutil
 
 from boto.s3.connection import S3Connection
 from boto.s3.key import Key
 from django.conf import settings
+from django.core.cache import cache as djcache
 from django.db import connection
 from django.db.models import Max
 from django.utils.timezone import utc as timezone_utc, now as timezone_now
 from typing import Any, Dict, List, Optional, Set, Tuple, \
-    Iterable, cast
+    Iterable, Iterator, cast
 
 from analytics.models import RealmCount, StreamCount, UserCount
-from zerver.lib.actions import UserMessageLite, bulk_insert_ums, \
-    do_change_plan_type, do_change_avatar_fields
+from zerver.lib.actions import do_change_plan_type, do_change_avatar_fields
 from zerver.lib.avatar_hash import user_avatar_path_from_ids
 from zerver.lib.bulk_create import bulk_create_users
 from zerver.lib.timestamp import datetime_to_timestamp
 from zerver.lib.export import DATE_FIELDS, \
     Record, TableData, TableName, Field, Path
-from zerver.lib.message import do_render_markdown
+from zerver.lib import bugdown
+from zerver.lib.message import do_render_markdown, reset_render_attributes
 from zerver.lib.bugdown import version as bugdown_version
 from zerver.lib.actions import render_stream_description
 from zerver.lib.upload import random_name, sanitize_name, \
     guess_type, BadImageError
-from zerver.lib.utils import generate_api_key, process_list_in_batches
+from zerver.lib.utils import generate_api_key
 from zerver.lib.parallel import run_parallel
 from zerver.models import UserProfile, Realm, Client, Huddle, Stream, \
     UserMessage, Subscription, Message, RealmEmoji, \
@@ -225,61 +229,139 @@ class FakeMessage:
     '''
     pass
 
+def render_message_content(realm: Realm,
+                           sender_map: Dict[int, Record],
+                           message: Record) -> Optional[str]:
+    message_object = FakeMessage()
+
+    try:
+        content = message['content']
+
+        sender_id = message['sender_id']
+        sender = sender_map[sender_id]
+        sent_by_bot = sender['is_bot']
+        translate_emoticons = sender['translate_emoticons']
+
+        # We don't handle alert words on import from third-party
+        # platforms, since they generally don't have an "alert
+        # words" type feature, and notifications aren't important anyway.
+        realm_alert_words_automaton = None
+        message_user_ids = set()  # type: Set[int]
+
+        rendered_content = do_render_markdown(
+            message=cast(Message, message_object),
+            content=content,
+            realm=realm,
+            realm_alert_words_automaton=realm_alert_words_automaton,
+            message_user_ids=message_user_ids,
+            sent_by_bot=sent_by_bot,
+            translate_emoticons=translate_emoticons,
+        )
+        assert(rendered_content is not None)
+        return rendered_content
+    except Exception:
+        # This generally happens with two possible causes:
+        # * rendering markdown throwing an uncaught exception
+        # * rendering markdown failing with the exception being
+        #   caught in bugdown (which then returns None, causing the the
+        #   rendered_content assert above to fire).
+        logging.warning("Error in markdown rendering for message ID %s; continuing" % (message['id']))
+        return None
+
+# Messages are rendered in batches, so that bugdown can fetch the data
+# for rendering mentions, avatars, stream links and emoji for the
+# whole batch with one query each.
+RENDER_BATCH_SIZE = 100
+
+def render_message_contents(realm: Realm,
+                            sender_map: Dict[int, Record],
+                            messages: List[Record]) -> List[Optional[str]]:
+    batch = []  # type: List[Dict[str, Any]]
+    for message in messages:
+        message_object = cast(Message, FakeMessage())
+        reset_render_attributes(message_object)
+        sender = sender_map[message['sender_id']]
+        # As in render_message_content, we don't handle alert words.
+        batch.append(dict(
+            content=message['content'],
+            message=message_object,
+            message_realm=realm,
+            sent_by_bot=sender['is_bot'],
+            translate_emoticons=sender['translate_emoticons'],
+        ))
+
+    try:
+        rendered_contents = bugdown.convert_batch(batch)  # type: List[Optional[str]]
+        return rendered_contents
+    except Exception:
+        # Render the messages one at a time, to find the ones that
+        # fail to render.
+        return [render_message_content(realm, sender_map, message)
+                for message in messages]
+
+# The realm and sender map used by the processes in the rendering
+# pool; these are set before the pool is forked, so that they don't
+# need to be pickled for every message.
+render_pool_context = {}  # type: Dict[str, Any]
+
+def render_message_contents_in_pool(messages: List[Record]) -> List[Optional[str]]:
+    return render_message_contents(render_pool_context['realm'],
+                                   render_pool_context['sender_map'],
+                                   messages)
+
+def make_render_pool(realm: Realm, sender_map: Dict[int, Record],
+                     processes: int) -> Any:
+    render_pool_context['realm'] = realm
+    render_pool_context['sender_map'] = sender_map
+    # The forked processes can't share our database and memcached
+    # connections; they each open their own, as needed.
+    connection.close()
+    djcache.close()
+    return multiprocessing.Pool(processes)
+
 def fix_message_rendered_content(realm: Realm,
                                  sender_map: Dict[int, Record],
-                                 messages: List[Record]) -> None:
+                                 messages: List[Record],
+                                 render_pool: Optional[Any]=None) -> None:
     """
     This function sets the rendered_content of all the messages
     after the messages have been imported from a non-Zulip platform.
+    If a render_pool (from make_render_pool) is passed, the messages
+    are rendered in parallel by its processes.
     """
-    for message in messages:
-        if message['rendered_content'] is not None:
-            # For Zulip->Zulip imports, we use the original rendered
-            # markdown; this avoids issues where e.g. a mention can no
-            # longer render properly because a user has changed their
-            # name.  However, some syntax ends up being broken, e.g.:
-            # data-user-id for mentions.
-            #
-            # TODO: Add logic to parse the markdown and edit those
-            # data-user-id values.
-            continue
-
-        message_object = FakeMessage()
-
-        try:
-            content = message['content']
-
-            sender_id = message['sender_id']
-            sender = sender_map[sender_id]
-            sent_by_bot = sender['is_bot']
-            translate_emoticons = sender['translate_emoticons']
-
-            # We don't handle alert words on import from third-party
-            # platforms, since they generally don't have an "alert
-            # words" type feature, and notifications aren't important anyway.
-            realm_alert_words_automaton = None
-            message_user_ids = set()  # type: Set[int]
-
-            rendered_content = do_render_markdown(
-                message=cast(Message, message_object),
-                content=content,
-                realm=realm,
-                realm_alert_words_automaton=realm_alert_words_automaton,
-                message_user_ids=message_user_ids,
-                sent_by_bot=sent_by_bot,
-                translate_emoticons=translate_emoticons,
-            )
-            assert(rendered_content is not None)
+    # For Zulip->Zulip imports, we use the original rendered
+    # markdown; this avoids issues where e.g. a mention can no
+    # longer render properly because a user has changed their
+    # name.  However, some syntax ends up being broken, e.g.:
+    # data-user-id for mentions.
+    #
+    # TODO: Add logic to parse the markdown and edit those
+    # data-user-id values.
+    unrendered_messages = [message for message in messages
+                           if message['rendered_content'] is None]
+    if not unrendered_messages:
+        return
 
+    batches = [unrendered_messages[i:i + RENDER_BATCH_SIZE]
+               for i in range(0, len(unrendered_messages), RENDER_BATCH_SIZE)]
+    if render_pool is None:
+        rendered_batches = [render_message_contents(realm, sender_map, batch)
+                            for batch in batches]
+    else:
+        # We only send the fields rendering needs to the pool.
+        rendered_batches = render_pool.map(
+            render_message_contents_in_pool,
+            [[dict(id=message['id'], content=message['content'],
+                   sender_id=message['sender_id'])
+              for message in batch]
+             for batch in batches])
+    rendered_contents = [rendered_content for rendered_batch in rendered_batches
+                         for rendered_content in rendered_batch]
+
+    for (message, rendered_content) in zip(unrendered_messages, rendered_contents):
+        if rendered_content is not None:
             message['rendered_content'] = rendered_content
             message['rendered_content_version'] = bugdown_version
-        except Exception:
-            # This generally happens with two possible causes:
-            # * rendering markdown throwing an uncaught exception
-            # * rendering markdown failing with the exception being
-            #   caught in bugdown (which then returns None, causing the the
-            #   rendered_content assert above to fire).
-            logging.warning("Error in markdown rendering for message ID %s; continuing" % (message['id']))
 
 def current_table_ids(data: TableData, table: TableName) -> List[int]:
     """
@@ -365,6 +447,17 @@ def re_map_foreign_keys_internal(data_table: List[Record],
     the re-mapping.  (It also appends `_id` to the field.)
     '''
     lookup_table = ID_MAP[related_table]
+    if not (verbose or id_field or recipient_field or reaction_field):
+        # The common case, which is the bulk of the work for large
+        # tables like zerver_message, gets a tight loop without the
+        # per-row checks below.
+        new_field_name = field_name + "_id"
+        get_new_id = lookup_table.get
+        for item in data_table:
+            old_id = item.pop(field_name)
+            item[new_field_name] = get_new_id(old_id, old_id)
+        return
+
     for item in data_table:
         old_id = item[field_name]
         if recipient_field:
@@ -484,35 +577,90 @@ def update_model_ids(model: Any, data: TableData, related_table: TableName) -> N
 def bulk_import_user_message_data(data: TableData, dump_file_id: int) -> None:
     model = UserMessage
     table = 'zerver_usermessage'
-    lst = data[table]
 
     # IMPORTANT NOTE: We do not use any primary id
     # data from either the import itself or ID_MAP.
     # We let the DB itself generate ids.  Note that
     # no tables use user_message.id as a foreign key,
     # so we can safely avoid all re-mapping complexity.
-
-    def process_batch(items: List[Dict[str, Any]]) -> None:
-        ums = [
-            UserMessageLite(
-                user_profile_id = item['user_profile_id'],
-                message_id = item['message_id'],
-                flags=item['flags'],
-            )
-            for item in items
-        ]
-        bulk_insert_ums(ums)
-
-    chunk_size = 10000
-
-    process_list_in_batches(
-        lst=lst,
-        chunk_size=chunk_size,
-        process_batch=process_batch,
-    )
+    copy_rows_to_table(table, ['user_profile_id', 'message_id', 'flags'],
+                       ((item['user_profile_id'], item['message_id'], item['flags'])
+                        for item in data[table]))
 
     logging.info("Successfully imported %s from %s[%s]." % (model, table, dump_file_id))
 
+def copy_format_value(value: Any) -> str:
+    """Formats a value for PostgreSQL's COPY text format."""
+    if value is None:
+        return '\\N'
+    if value is True:
+        return 't'
+    if value is False:
+        return 'f'
+    if isinstance(value, datetime.datetime):
+        return value.isoformat()
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t') \
+        .replace('\n', '\\n').replace('\r', '\\r')
+
+# How much of the formatted rows copy_rows_to_table buffers at a time.
+COPY_CHUNK_SIZE = 1024 * 1024
+
+class CopyRowsFile:
+    """A read-only file, for cursor.copy_expert, of rows in PostgreSQL's
+    COPY text format.  The rows are only formatted as they're read, so
+    that we never hold more than about COPY_CHUNK_SIZE of them."""
+
+    def __init__(self, rows: Iterable[Iterable[Any]]) -> None:
+        self.rows = iter(rows)
+        self.buffer = ''
+        self.count = 0
+
+    def read(self, size: int) -> str:
+        chunks = [self.buffer]
+        length = len(self.buffer)
+        for row in self.rows:
+            line = '\t'.join(copy_format_value(value) for value in row) + '\n'
+            chunks.append(line)
+            length += len(line)
+            self.count += 1
+            if length >= size:
+                break
+        data = ''.join(chunks)
+        self.buffer = data[size:]
+        return data[:size]
+
+def copy_rows_to_table(table: TableName, columns: List[str], rows: Iterable[Iterable[Any]]) -> int:
+    """Loads rows into the table with `COPY ... FROM STDIN`, which is
+    much faster than INSERT statements for large tables, since
+    PostgreSQL doesn't have to parse and plan a statement per batch
+    of rows."""
+    rows = iter(rows)
+    first_row = next(rows, None)
+    if first_row is None:
+        return 0
+
+    copy_file = CopyRowsFile(itertools.chain([first_row], rows))
+    with connection.cursor() as cursor:
+        cursor.copy_expert('COPY %s (%s) FROM STDIN' % (table, ', '.join(columns)),
+                           copy_file, size=COPY_CHUNK_SIZE)
+    return copy_file.count
+
+def bulk_copy_model(data: TableData, model: Any) -> None:
+    """Like bulk_import_model, but loads the rows with COPY.  This
+    is only suitable for models whose fields (like Message's) need no
+    conversion from their Python values beyond copy_format_value."""
+    table = get_db_table(model)
+    fields = model._meta.concrete_fields
+    defaults = {field.attname: field.get_default() for field in fields}
+
+    def get_row(item: Record) -> List[Any]:
+        return [item[attname] if attname in item else defaults[attname]
+                for attname in defaults]
+
+    copy_rows_to_table(table, [field.column for field in fields],
+                       (get_row(item) for item in data[table]))
+    logging.info("Successfully imported %s from %s." % (model, table))
+
 def bulk_import_model(data: TableData, model: Any, dump_file_id: Optional[str]=None) -> None:
     table = get_db_table(model)
     # TODO, deprecate dump_file_id
@@ -937,14 +1085,16 @@ def do_import_realm(import_dir: Path, subdomain: str, processes: int=1) -> Realm
     }
 
     # Import zerver_message and zerver_usermessage
-    import_message_data(realm=realm, sender_map=sender_map, import_dir=import_dir)
+    import_message_data(realm=realm, sender_map=sender_map, import_dir=import_dir,
+                        processes=processes)
 
-    re_map_foreign_keys(data, 'zerver_reaction', 'message', related_table="message")
-    re_map_foreign_keys(data, 'zerver_reaction', 'user_profile', related_table="user_profile")
-    re_map_foreign_keys(data, 'zerver_reaction', 'emoji_code', related_table="realmemoji", id_field=True,
-                        reaction_field=True)
-    update_model_ids(Reaction, data, 'reaction')
-    bulk_import_model(data, Reaction)
+    # Realm exports write reactions to their own reactions-*.json
+    # shards, while the converters from other products put them in
+    # realm.json.
+    if 'zerver_reaction' in data:
+        import_reactions(data)
+    for reaction_data in read_table_shards(import_dir, 'reactions'):
+        import_reactions(reaction_data)
 
     for user_profile in UserProfile.objects.filter(is_bot=False, realm=realm):
         # Since we now unconditionally renumbers message IDs, we need
@@ -981,17 +1131,22 @@ def do_import_realm(import_dir: Path, subdomain: str, processes: int=1) -> Realm
             stream.first_message_id = first_message.id
         stream.save(update_fields=["first_message_id"])
 
-    # Do attachments AFTER message data is loaded.
+    # Do attachments AFTER message data is loaded.  Realm exports
+    # write them to attachments-*.json shards, while the converters
+    # from other products write a single attachment.json.
     # TODO: de-dup how we read these json files.
     fn = os.path.join(import_dir, "attachment.json")
-    if not os.path.exists(fn):
-        raise Exception("Missing attachment.json file!")
+    if os.path.exists(fn):
+        logging.info("Importing attachment data from %s" % (fn,))
+        with open(fn) as f:
+            data = ujson.load(f)
 
-    logging.info("Importing attachment data from %s" % (fn,))
-    with open(fn) as f:
-        data = ujson.load(f)
+        import_attachments(data)
+    elif not os.path.exists(os.path.join(import_dir, "attachments-000001.json")):
+        raise Exception("Missing attachment.json file!")
 
-    import_attachments(data)
+    for data in read_table_shards(import_dir, 'attachments'):
+        import_attachments(data)
 
     # Import the analytics file.
     import_analytics_data(realm=realm, import_dir=import_dir)
@@ -1101,17 +1256,66 @@ def get_incoming_message_ids(import_dir: Path,
 
     return message_ids
 
+class ImportStageStats:
+    '''
+    Tracks the number of rows and the time spent in each stage of
+    importing message data, so that we can report rows/sec per stage.
+    '''
+
+    def __init__(self) -> None:
+        self.rows = {}  # type: Dict[str, int]
+        self.seconds = {}  # type: Dict[str, float]
+        self.start_time = time.time()
+
+    def start(self) -> None:
+        self.start_time = time.time()
+
+    def finish(self, stage: str, rows: int) -> None:
+        now = time.time()
+        self.rows[stage] = self.rows.get(stage, 0) + rows
+        self.seconds[stage] = self.seconds.get(stage, 0) + now - self.start_time
+        self.start_time = now
+
+    def log(self) -> None:
+        for stage in self.rows:
+            rows = self.rows[stage]
+            seconds = self.seconds[stage]
+            rate = rows / seconds if seconds > 0 else 0
+            logging.info("Import stage %s: %d rows in %.3fs (%d rows/sec)" % (
+                stage, rows, seconds, rate))
+
 def import_message_data(realm: Realm,
                         sender_map: Dict[int, Record],
-                        import_dir: Path) -> None:
+                        import_dir: Path,
+                        processes: int=1) -> None:
+    render_pool = None
+    if processes > 1:
+        render_pool = make_render_pool(realm, sender_map, processes)
+
+    try:
+        import_message_files(realm, sender_map, import_dir, render_pool)
+    finally:
+        if render_pool is not None:
+            render_pool.close()
+            render_pool.join()
+
+def import_message_files(realm: Realm,
+                         sender_map: Dict[int, Record],
+                         import_dir: Path,
+                         render_pool: Optional[Any]) -> None:
+    stats = ImportStageStats()
     dump_file_id = 1
     while True:
         message_filename = os.path.join(import_dir, "messages-%06d.json" % (dump_file_id,))
         if not os.path.exists(message_filename):
             break
 
+        stats.start()
         with open(message_filename) as f:
             data = ujson.load(f)
+        num_messages = len(data['zerver_message'])
+        num_user_messages = len(data['zerver_usermessage'])
+        stats.finish('load', num_messages + num_user_messages)
 
         logging.info("Importing message dump %s" % (message_filename,))
         re_map_foreign_keys(data, 'zerver_message', 'sender', related_table="user_profile")
@@ -1130,17 +1334,21 @@ def import_message_data(realm: Realm,
 
         for row in data['zerver_usermessage']:
             assert(row['message'] in message_id_map)
+        stats.finish('remap_messages', num_messages)
 
         fix_message_rendered_content(
             realm=realm,
             sender_map=sender_map,
             messages=data['zerver_message'],
+            render_pool=render_pool,
         )
         logging.info("Successfully rendered markdown for message batch")
+        stats.finish('render', num_messages)
 
         # A LOT HAPPENS HERE.
         # This is where we actually import the message data.
-        bulk_import_model(data, Message)
+        bulk_copy_model(data, Message)
+        stats.finish('copy_messages', num_messages)
 
         # Due to the structure of these message chunks, we're
         # guaranteed to have already imported all the Message objects
@@ -1148,10 +1356,34 @@ def import_message_data(realm: Realm,
         re_map_foreign_keys(data, 'zerver_usermessage', 'message', related_table="message")
         re_map_foreign_keys(data, 'zerver_usermessage', 'user_profile', related_table="user_profile")
         fix_bitfield_keys(data, 'zerver_usermessage', 'flags')
+        stats.finish('remap_usermessages', num_user_messages)
 
         bulk_import_user_message_data(data, dump_file_id)
+        stats.finish('copy_usermessages', num_user_messages)
         dump_file_id += 1
 
+    stats.log()
+
+def read_table_shards(import_dir: Path, file_prefix: str) -> Iterator[TableData]:
+    dump_file_id = 1
+    while True:
+        fn = os.path.join(import_dir, "%s-%06d.json" % (file_prefix, dump_file_id))
+        if not os.path.exists(fn):
+            break
+
+        logging.info("Importing data from %s" % (fn,))
+        with open(fn) as f:
+            yield ujson.load(f)
+        dump_file_id += 1
+
+def import_reactions(data: TableData) -> None:
+    re_map_foreign_keys(data, 'zerver_reaction', 'message', related_table="message")
+    re_map_foreign_keys(data, 'zerver_reaction', 'user_profile', related_table="user_profile")
+    re_map_foreign_keys(data, 'zerver_reaction', 'emoji_code', related_table="realmemoji", id_field=True,
+                        reaction_field=True)
+    update_model_ids(Reaction, data, 'reaction')
+    bulk_import_model(data, Reaction)
+
 def import_attachments(data: TableData) -> None:
 
     # Clean up the data in zerver_attachment that is not
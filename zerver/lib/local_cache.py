@@ -0,0 +1,147 @@
+# An in-process cache in front of memcached, for the few cache_with_key
+# functions whose values are read on nearly every request and rarely
+# change (e.g. realm emoji and filters, or API key lookups).  See
+# cache_with_key's local_cache_family.
+#
+# Each process keeps up to settings.LOCAL_CACHE_MAX_ENTRIES values,
+# for at most settings.LOCAL_CACHE_TIMEOUT seconds.  When one of these
+# keys is deleted or set in the remote cache (e.g. by the flush_*
+# signal handlers), cache.py publishes the key over redis, and a
+# thread in every process with a local cache drops its copy.  If that
+# thread loses its redis connection, we might miss invalidations, so
+# the local cache is emptied and not used until it reconnects.  (So
+# uwsgi must run with enable-threads.)
+#
+# generic_bulk_cached_fetch doesn't use the local cache: its callers
+# fetch many objects that change often (messages, user profiles), for
+# which a per-process copy would mostly be misses and invalidations.
+#
+# Values are stored pickled, like memcached stores them, so that each
+# caller gets its own copy of e.g. a Client object.
+
+from collections import OrderedDict, defaultdict
+import logging
+import os
+import pickle
+import threading
+import time
+from typing import Any, DefaultDict, Dict, Iterable, List, Optional, Set, Tuple
+
+from django.conf import settings
+import redis
+import ujson
+
+from zerver.lib.redis_utils import get_redis_client
+from zerver.lib.utils import statsd
+
+INVALIDATION_CHANNEL = 'local_cache_invalidation'
+
+redis_client = get_redis_client()
+
+# The key families (the part of a key before the first ':') whose
+# values may be in a local cache; registered by cache_with_key.
+local_cache_families = set()  # type: Set[str]
+
+def key_family(key: str) -> str:
+    return key.split(':', 1)[0]
+
+def local_cache_enabled() -> bool:
+    return settings.LOCAL_CACHE_MAX_ENTRIES > 0
+
+class LocalCache:
+    def __init__(self) -> None:
+        self.lock = threading.Lock()
+        self.entries = OrderedDict()  # type: OrderedDict[str, Tuple[float, bytes]]
+        self.stats = defaultdict(lambda: defaultdict(int))  # type: DefaultDict[str, DefaultDict[str, int]]
+        # Bumped by every invalidation; a value read from the remote
+        # cache is only stored if no invalidation arrived meanwhile,
+        # since it may be the value that was invalidated.
+        self.generation = 0
+        # Whether we're subscribed to invalidations; until we are, we
+        # don't store anything.
+        self.subscribed = threading.Event()
+        self.listener_pid = None  # type: Optional[int]
+
+    def get(self, key: str, family: str) -> Optional[Tuple[Any]]:
+        self.start_listener()
+        now = time.time()
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None and entry[0] < now:
+                del self.entries[key]
+                entry = None
+            if entry is not None:
+                self.entries.move_to_end(key)
+
+        status = "hit" if entry is not None else "miss"
+        self.stats[family][status] += 1
+        statsd.incr("local_cache.%s.%s" % (family, status))
+
+        if entry is None:
+            return None
+        return pickle.loads(entry[1])
+
+    def set(self, key: str, val: Tuple[Any], generation: int) -> None:
+        if not self.subscribed.is_set():
+            return
+        pickled = pickle.dumps(val, pickle.HIGHEST_PROTOCOL)
+        with self.lock:
+            if generation != self.generation:
+                return
+            self.entries[key] = (time.time() + settings.LOCAL_CACHE_TIMEOUT, pickled)
+            self.entries.move_to_end(key)
+            while len(self.entries) > settings.LOCAL_CACHE_MAX_ENTRIES:
+                self.entries.popitem(last=False)
+
+    def delete_many(self, keys: Iterable[str]) -> None:
+        with self.lock:
+            self.generation += 1
+            for key in keys:
+                self.entries.pop(key, None)
+
+    def clear(self) -> None:
+        with self.lock:
+            self.generation += 1
+            self.entries.clear()
+
+    def start_listener(self) -> None:
+        # The listener thread doesn't survive a fork, so a forked
+        # process starts its own.
+        if self.listener_pid == os.getpid():
+            return
+        self.listener_pid = os.getpid()
+        self.subscribed.clear()
+        self.clear()
+        thread = threading.Thread(target=self.listen_for_invalidations,
+                                  name='local_cache_invalidation')
+        thread.daemon = True
+        thread.start()
+
+    def listen_for_invalidations(self) -> None:
+        while True:
+            try:
+                pubsub = get_redis_client().pubsub()
+                pubsub.subscribe(INVALIDATION_CHANNEL)
+                for message in pubsub.listen():
+                    if message['type'] == 'subscribe':
+                        # Anything published from now on reaches us.
+                        self.clear()
+                        self.subscribed.set()
+                    elif message['type'] == 'message':
+                        self.delete_many(ujson.loads(message['data']))
+            except redis.RedisError:
+                logging.warning("Lost the local cache's invalidation subscription",
+                                exc_info=True)
+            self.subscribed.clear()
+            self.clear()
+            time.sleep(1)
+
+    def get_stats(self) -> Dict[str, Dict[str, int]]:
+        """Hits and misses by key family, since this process started."""
+        return {family: dict(stats) for (family, stats) in self.stats.items()}
+
+local_cache = LocalCache()
+
+def publish_invalidations(keys: List[str]) -> None:
+    local_cache.delete_many(keys)
+    redis_client.publish(INVALIDATION_CHANNEL, ujson.dumps(keys))
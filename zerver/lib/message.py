@@ -1,5 +1,6 @@
 
 import datetime
+import pickle
 import ujson
 import zlib
 import ahocorasick
@@ -13,6 +14,7 @@ from analytics.lib.counts import COUNT_STATS, RealmCount
 
 from zerver.lib.avatar import get_avatar_field
 import zerver.lib.bugdown as bugdown
+from zerver.lib.deferred_user_messages import fill_in_deferred_user_messages
 from zerver.lib.cache import (
     cache_with_key,
     generic_bulk_cached_fetch,
@@ -34,6 +36,11 @@ from zerver.lib.topic_mutes import (
     build_topic_mute_checker,
     topic_is_muted,
 )
+from zerver.lib.unread_index import (
+    get_indexed_unread_rows,
+    query_unread_rows,
+    unread_index_enabled,
+)
 
 from zerver.models import (
     get_display_recipient_by_id,
@@ -95,7 +102,8 @@ def messages_for_ids(message_ids: List[int],
                                               id_fetcher=id_fetcher,
                                               cache_transformer=cache_transformer,
                                               extractor=extract_message_dict,
-                                              setter=stringify_message_dict)
+                                              setter=stringify_message_dict,
+                                              single_flight=True)
 
     message_list = []  # type: List[Dict[str, Any]]
 
@@ -147,11 +155,58 @@ def sew_messages_and_submessages(messages: List[Dict[str, Any]],
             message = message_dict[message_id]
             message['submessages'].append(submessage)
 
+# Cached message dicts (see message_to_dict_json) are pickled, with
+# the keys every message dict has stored positionally, in this order,
+# rather than repeated in every message; any other keys (e.g.
+# edit_history) are stored with their values.  When changing the
+# format, bump MESSAGE_DICT_FORMAT_VERSION in zerver/lib/cache.py,
+# which is part of the cache key, so that servers running the old and
+# new code never read each other's message dicts.
+MESSAGE_DICT_FIELDS = (
+    'id',
+    'sender_id',
+    'content',
+    'recipient_type_id',
+    'recipient_type',
+    'recipient_id',
+    'timestamp',
+    'client',
+    TOPIC_NAME,
+    'sender_realm_id',
+    'raw_display_recipient',
+    TOPIC_LINKS,
+    'rendered_content',
+    'is_me_message',
+    'reactions',
+    'submessages',
+)
+MESSAGE_DICT_FIELD_SET = frozenset(MESSAGE_DICT_FIELDS)
+
+# Only message dicts bigger than this are compressed; for small ones,
+# zlib saves too few bytes to be worth the time.
+MESSAGE_DICT_COMPRESSION_THRESHOLD = 1024
+MESSAGE_DICT_UNCOMPRESSED = b'u'
+MESSAGE_DICT_COMPRESSED = b'z'
+
 def extract_message_dict(message_bytes: bytes) -> Dict[str, Any]:
-    return ujson.loads(zlib.decompress(message_bytes).decode("utf-8"))
+    data = memoryview(message_bytes)[1:]
+    if message_bytes[:1] == MESSAGE_DICT_COMPRESSED:
+        data = memoryview(zlib.decompress(data))
+    else:
+        assert message_bytes[:1] == MESSAGE_DICT_UNCOMPRESSED
+    (values, extra) = pickle.loads(data)
+    message_dict = dict(zip(MESSAGE_DICT_FIELDS, values))
+    message_dict.update(extra)
+    return message_dict
 
 def stringify_message_dict(message_dict: Dict[str, Any]) -> bytes:
-    return zlib.compress(ujson.dumps(message_dict).encode())
+    values = tuple(message_dict[field] for field in MESSAGE_DICT_FIELDS)
+    extra = {key: value for (key, value) in message_dict.items()
+             if key not in MESSAGE_DICT_FIELD_SET}
+    data = pickle.dumps((values, extra), pickle.HIGHEST_PROTOCOL)
+    if len(data) > MESSAGE_DICT_COMPRESSION_THRESHOLD:
+        return MESSAGE_DICT_COMPRESSED + zlib.compress(data)
+    return MESSAGE_DICT_UNCOMPRESSED + data
 
 @cache_with_key(to_dict_cache_key, timeout=3600*24)
 def message_to_dict_json(message: Message) -> bytes:
@@ -629,12 +684,7 @@ def do_render_markdown(message: Message,
     saved in the database.
     """
 
-    message.mentions_wildcard = False
-    message.mentions_user_ids = set()
-    message.mentions_user_group_ids = set()
-    message.alert_words = set()
-    message.links_for_preview = set()
-    message.user_ids_with_alert_words = set()
+    reset_render_attributes(message)
 
     # DO MAIN WORK HERE -- call bugdown to convert
     rendered_content = bugdown.convert(
@@ -649,6 +699,42 @@ def do_render_markdown(message: Message,
     )
     return rendered_content
 
+def reset_render_attributes(message: Message) -> None:
+    message.mentions_wildcard = False
+    message.mentions_user_ids = set()
+    message.mentions_user_group_ids = set()
+    message.alert_words = set()
+    message.links_for_preview = set()
+    message.user_ids_with_alert_words = set()
+
+def render_markdown_batch(batch: List[Dict[str, Any]]) -> List[str]:
+    '''
+    Like render_markdown, for several messages at once; each element
+    of `batch` is a dict of keyword arguments for render_markdown.
+    With a render server (BUGDOWN_RENDER_SERVER_SOCKET), the messages
+    are rendered in parallel.
+    '''
+    convert_batch = []  # type: List[Dict[str, Any]]
+    for kwargs in batch:
+        message = kwargs['message']
+        realm = kwargs.get('realm')
+        if realm is None:
+            realm = message.get_realm()
+
+        sender = get_user_profile_by_id(message.sender_id)
+        reset_render_attributes(message)
+        convert_batch.append(dict(
+            content=kwargs['content'],
+            realm_alert_words_automaton=kwargs.get('realm_alert_words_automaton'),
+            message=message,
+            message_realm=realm,
+            sent_by_bot=sender.is_bot,
+            translate_emoticons=sender.translate_emoticons,
+            mention_data=kwargs.get('mention_data'),
+            email_gateway=kwargs.get('email_gateway', False),
+        ))
+    return bugdown.convert_batch(convert_batch)
+
 def huddle_users(recipient_id: int) -> str:
     display_recipient = get_display_recipient_by_id(recipient_id,
                                                     Recipient.HUDDLE,
@@ -757,26 +843,17 @@ def get_starred_message_ids(user_profile: UserProfile) -> List[int]:
 
 def get_raw_unread_data(user_profile: UserProfile) -> RawUnreadMessagesResult:
 
-    excluded_recipient_ids = get_inactive_recipient_ids(user_profile)
+    fill_in_deferred_user_messages(user_profile)
 
-    user_msgs = UserMessage.objects.filter(
-        user_profile=user_profile
-    ).exclude(
-        message__recipient_id__in=excluded_recipient_ids
-    ).extra(
-        where=[UserMessage.where_unread()]
-    ).values(
-        'message_id',
-        'message__sender_id',
-        MESSAGE__TOPIC,
-        'message__recipient_id',
-        'message__recipient__type',
-        'message__recipient__type_id',
-        'flags',
-    ).order_by("-message_id")
+    excluded_recipient_ids = get_inactive_recipient_ids(user_profile)
 
     # Limit unread messages for performance reasons.
-    user_msgs = list(user_msgs[:MAX_UNREAD_MESSAGES])
+    if unread_index_enabled():
+        user_msgs = get_indexed_unread_rows(user_profile, MAX_UNREAD_MESSAGES,
+                                            excluded_recipient_ids=excluded_recipient_ids)
+    else:
+        user_msgs = query_unread_rows(user_profile, MAX_UNREAD_MESSAGES,
+                                      excluded_recipient_ids=excluded_recipient_ids)
 
     rows = list(reversed(user_msgs))
 
@@ -7,7 +7,7 @@ from zerver.lib.topic import (
 from django.conf import settings
 from django.utils.translation import ugettext as _
 
-from typing import Any, Callable, Dict, Iterable, List, Mapping, Optional, Sequence
+from typing import Any, Callable, Dict, Iterable, List, Mapping, Optional, Sequence, Tuple
 
 stop_words_list = None  # type: Optional[List[str]]
 def read_stop_words() -> List[str]:
@@ -34,9 +34,36 @@ def is_web_public_compatible(narrow: Iterable[Dict[str, str]]) -> bool:
             return False
     return True
 
+# The narrow operators that event queues are indexed by, most
+# selective first; see get_narrow_index_key.
+NARROW_INDEX_OPERATORS = ["stream", "topic", "sender"]
+
+def get_narrow_index_key(narrow: Iterable[Sequence[str]]) -> Tuple[str, str]:
+    """Returns the key under which event queues with this narrow are
+    indexed, so that a message only needs to be checked against the
+    narrows that could possibly match it (see
+    get_message_narrow_index_keys).  Every message accepted by
+    build_narrow_filter(narrow) must have this key among its index
+    keys; narrows without an indexable term get the catch-all key
+    ("", "")."""
+    terms = {element[0]: element[1].lower() for element in narrow
+             if element[0] in NARROW_INDEX_OPERATORS}
+    for operator in NARROW_INDEX_OPERATORS:
+        if operator in terms:
+            return (operator, terms[operator])
+    return ("", "")
+
+def get_message_narrow_index_keys(message: Mapping[str, Any]) -> List[Tuple[str, str]]:
+    keys = [("", ""), ("sender", message["sender_email"].lower())]
+    if message["type"] == "stream":
+        keys.append(("stream", message["display_recipient"].lower()))
+        keys.append(("topic", get_topic_from_message_info(message).lower()))
+    return keys
+
 def build_narrow_filter(narrow: Iterable[Sequence[str]]) -> Callable[[Mapping[str, Any]], bool]:
     """Changes to this function should come with corresponding changes to
-    BuildNarrowFilterTest."""
+    BuildNarrowFilterTest, and may require changes to
+    get_narrow_index_key."""
     check_supported_events_narrow_filter(narrow)
 
     def narrow_filter(event: Mapping[str, Any]) -> bool:
@@ -1,14 +1,14 @@
 
+from collections import OrderedDict
 import os
 
-from typing import List, Optional, Tuple
+from typing import Any, Iterable, List, Optional, Tuple
 
 from django.conf import settings
 from zerver.lib.redis_utils import get_redis_client
 
 from zerver.models import UserProfile
 
-import redis
 import time
 
 # Implement a rate-limiting scheme inspired by the one described here, but heavily modified
@@ -22,6 +22,97 @@ KEY_PREFIX = ''
 class RateLimiterLockingException(Exception):
     pass
 
+# This Lua script does the work of is_ratelimited, incr_ratelimit and
+# api_calls_left in a single atomic call, so that rate-limiting an API
+# request costs one Redis round trip, and concurrent requests for the
+# same entity don't need a WATCH/MULTI retry loop.
+#
+# KEYS are the entity's list, zset and block keys.  ARGV is the
+# timestamp for this request, the longest window and its number of
+# requests, whether to check the rules before recording the request,
+# the number of rules, each rule's window and number of requests, and
+# finally the timestamps of any earlier requests that were admitted
+# without checking Redis (see check_and_incr_ratelimit_local), which
+# are recorded unconditionally.
+#
+# Returns {rate_limited, secs_to_freedom, calls_in_longest_window,
+# fewest_calls_left_for_any_rule}; the float is returned as a string,
+# since Lua numbers are otherwise truncated to integers.
+RATELIMIT_SCRIPT = """
+local list_key, set_key, blocking_key = KEYS[1], KEYS[2], KEYS[3]
+local now = tonumber(ARGV[1])
+local max_window = tonumber(ARGV[2])
+local max_calls = tonumber(ARGV[3])
+local num_rules = tonumber(ARGV[5])
+local first_pending = 6 + 2 * num_rules
+
+-- We store each timestamp both in the list and in the sorted set,
+-- which we sort by score but remove from by value.
+local function record(timestamp)
+    local last_val = redis.call('LINDEX', list_key, max_calls - 1)
+    redis.call('LPUSH', list_key, timestamp)
+    redis.call('LTRIM', list_key, 0, max_calls - 1)
+    redis.call('ZADD', set_key, timestamp, timestamp)
+    if last_val then
+        redis.call('ZREM', set_key, last_val)
+    end
+end
+
+local function set_expiry()
+    redis.call('EXPIRE', list_key, max_window)
+    redis.call('EXPIRE', set_key, max_window)
+end
+
+for i = first_pending, #ARGV do
+    record(ARGV[i])
+end
+if #ARGV >= first_pending then
+    set_expiry()
+end
+
+if ARGV[4] == '1' then
+    -- Check if there is a manual block on this entity.
+    if redis.call('EXISTS', blocking_key) == 1 then
+        local ttl = redis.call('TTL', blocking_key)
+        if ttl < 0 then
+            return {1, '0.5', 0, 0}
+        end
+        return {1, tostring(ttl), 0, 0}
+    end
+
+    -- Go through the rules from shortest to longest, checking whether
+    -- the nth most recent request is still inside the rule's window.
+    for i = 6, first_pending - 1, 2 do
+        local range_seconds = tonumber(ARGV[i])
+        local num_requests = tonumber(ARGV[i + 1])
+        local timestamp = redis.call('LINDEX', list_key, num_requests - 1)
+        if timestamp then
+            local boundary = tonumber(timestamp) + range_seconds
+            if boundary > now then
+                return {1, tostring(boundary - now), 0, 0}
+            end
+        end
+    end
+end
+
+record(ARGV[1])
+set_expiry()
+
+local count = redis.call('ZCOUNT', set_key, now - max_window, now)
+local fewest_calls_left = max_calls - count
+for i = 6, first_pending - 1, 2 do
+    local range_seconds = tonumber(ARGV[i])
+    local num_requests = tonumber(ARGV[i + 1])
+    local calls_left = num_requests - redis.call('ZCOUNT', set_key, now - range_seconds, now)
+    if calls_left < fewest_calls_left then
+        fewest_calls_left = calls_left
+    end
+end
+return {0, '0', count, fewest_calls_left}
+"""
+
+ratelimit_script = client.register_script(RATELIMIT_SCRIPT)
+
 class RateLimitedObject:
     def get_keys(self) -> List[str]:
         key_fragment = self.key_fragment()
@@ -93,6 +184,7 @@ def clear_history(entity: RateLimitedObject) -> None:
     '''
     for key in entity.get_keys():
         client.delete(key)
+    local_buckets.pop(entity.key_fragment(), None)
 
 def _get_api_calls_left(entity: RateLimitedObject, range_seconds: int, max_calls: int) -> Tuple[int, float]:
     list_key, set_key, _ = entity.get_keys()
@@ -177,59 +269,174 @@ def is_ratelimited(entity: RateLimitedObject) -> Tuple[bool, float]:
     # No api calls recorded yet
     return False, 0.0
 
+def _ratelimit_script_args(rules: List[Tuple[int, int]], now: float, check: bool,
+                           pending: Optional[List[float]]=None) -> List[Any]:
+    max_window, max_calls = rules[-1]
+    args = [repr(now), max_window, max_calls, '1' if check else '0', len(rules)]  # type: List[Any]
+    for range_seconds, num_requests in rules:
+        args.extend([range_seconds, num_requests])
+    if pending is not None:
+        args.extend(repr(timestamp) for timestamp in pending)
+    return args
+
+def _run_ratelimit_script(entity: RateLimitedObject, rules: List[Tuple[int, int]],
+                          now: float, check: bool,
+                          pending: Optional[List[float]]=None) -> Tuple[bool, float, int, int]:
+    max_calls = rules[-1][1]
+    ratelimited, secs_to_freedom, count, fewest_calls_left = ratelimit_script(
+        keys=entity.get_keys(), args=_ratelimit_script_args(rules, now, check, pending))
+    return (bool(ratelimited), float(secs_to_freedom), max_calls - int(count),
+            int(fewest_calls_left))
+
+def check_and_incr_ratelimit(entity: RateLimitedObject) -> Tuple[bool, float, int, float]:
+    """Checks whether the entity is rate-limited, and if not, records
+    this request, in a single atomic Redis call.
+
+    Returns a tuple of (rate_limited, time_till_free, calls_left,
+    time_reset); the last two are only meaningful if the request
+    wasn't rate-limited."""
+    rules = entity.rules()
+    if len(rules) == 0:
+        return False, 0.0, 0, 0.0
+
+    now = time.time()
+    ratelimited, time_till_free, calls_left, _ = _run_ratelimit_script(entity, rules, now, check=True)
+    if ratelimited:
+        return True, time_till_free, 0, now + time_till_free
+
+    # This request is now the newest call, so the rate limit is reset
+    # once the longest window has passed.
+    return False, 0.0, calls_left, now + max_api_window(entity)
+
+# Each Django process can optionally admit requests from an entity
+# that is far below its limits without asking Redis, using a local
+# bucket of "tokens" handed out by the last exact check.  A bucket
+# gets LOCAL_BUCKET_FRACTION of the fewest calls the entity had left
+# for any rule, and expires after LOCAL_BUCKET_SYNC_SECS; the next
+# request then records the locally admitted requests in Redis as part
+# of its exact check.  Buckets of entities that stop making requests
+# are flushed to Redis once they've expired, by the next request (from
+# anyone) to this process; see flush_expired_local_buckets.
+# With N processes, an entity can thus exceed a limit by at most
+# N * LOCAL_BUCKET_FRACTION of the calls it had left, and entities
+# close to their limits always get exact checks.
+LOCAL_BUCKET_FRACTION = 0.1
+LOCAL_BUCKET_SYNC_SECS = 1.0
+# To bound memory usage, when we have this many buckets, a new bucket
+# evicts the least recently synced one; its pending requests are
+# flushed along with the expired buckets.
+LOCAL_BUCKET_MAX_ENTITIES = 10000
+
+class LocalRateLimitBucket:
+    def __init__(self, entity: RateLimitedObject, tokens: int, calls_left: int,
+                 time_reset: float, sync_time: float) -> None:
+        self.entity = entity
+        self.tokens = tokens
+        self.calls_left = calls_left
+        self.time_reset = time_reset
+        self.sync_time = sync_time
+        self.pending = []  # type: List[float]
+
+# Ordered by sync_time, oldest first, so that the expired buckets are
+# always at the front.
+local_buckets = OrderedDict()  # type: OrderedDict[str, LocalRateLimitBucket]
+# Evicted buckets whose pending requests are yet to be flushed.
+evicted_local_buckets = []  # type: List[LocalRateLimitBucket]
+last_expiry_check = 0.0
+
+def check_and_incr_ratelimit_local(entity: RateLimitedObject) -> Tuple[bool, float, int, float]:
+    """Like check_and_incr_ratelimit, but admits most requests from
+    entities that are far below their limits using only a bucket in
+    this process's memory; see LOCAL_BUCKET_FRACTION."""
+    rules = entity.rules()
+    if len(rules) == 0:
+        return False, 0.0, 0, 0.0
+
+    key = entity.key_fragment()
+    now = time.time()
+    flush_expired_local_buckets(now, key)
+    bucket = local_buckets.get(key)
+    if bucket is not None and bucket.tokens > 0 and now - bucket.sync_time < LOCAL_BUCKET_SYNC_SECS:
+        bucket.tokens -= 1
+        bucket.calls_left -= 1
+        bucket.pending.append(now)
+        return False, 0.0, bucket.calls_left, bucket.time_reset
+
+    pending = bucket.pending if bucket is not None else []
+    ratelimited, time_till_free, calls_left, fewest_calls_left = _run_ratelimit_script(
+        entity, rules, now, check=True, pending=pending)
+
+    if ratelimited:
+        time_reset = now + time_till_free
+        new_bucket = LocalRateLimitBucket(entity, 0, 0, time_reset, now)
+    else:
+        time_reset = now + max_api_window(entity)
+        tokens = int(fewest_calls_left * LOCAL_BUCKET_FRACTION)
+        new_bucket = LocalRateLimitBucket(entity, tokens, calls_left, time_reset, now)
+    set_local_bucket(key, new_bucket)
+
+    if ratelimited:
+        return True, time_till_free, 0, time_reset
+    return False, 0.0, calls_left, time_reset
+
+def set_local_bucket(key: str, bucket: LocalRateLimitBucket) -> None:
+    # Re-inserting the key moves it to the end, keeping local_buckets
+    # ordered by sync_time.
+    local_buckets.pop(key, None)
+    while len(local_buckets) >= LOCAL_BUCKET_MAX_ENTITIES:
+        (_, evicted) = local_buckets.popitem(last=False)
+        if evicted.pending:
+            evicted_local_buckets.append(evicted)
+    local_buckets[key] = bucket
+
+def flush_local_bucket_batch(buckets: Iterable[LocalRateLimitBucket]) -> None:
+    """Records the requests admitted by these buckets in Redis, in a
+    single pipelined round trip."""
+    buckets = [bucket for bucket in buckets if bucket.pending]
+    if not buckets:
+        return
+    with client.pipeline(transaction=False) as pipe:
+        for bucket in buckets:
+            pending = bucket.pending
+            args = _ratelimit_script_args(bucket.entity.rules(), pending[-1],
+                                          check=False, pending=pending[:-1])
+            ratelimit_script(keys=bucket.entity.get_keys(), args=args, client=pipe)
+        pipe.execute()
+
+def flush_local_buckets() -> None:
+    """Records the requests admitted by the local buckets in Redis, and
+    clears the buckets."""
+    flush_local_bucket_batch(list(local_buckets.values()) + evicted_local_buckets)
+    local_buckets.clear()
+    del evicted_local_buckets[:]
+
+def flush_expired_local_buckets(now: float, current_key: Optional[str]=None) -> None:
+    """At most once every LOCAL_BUCKET_SYNC_SECS, records the requests
+    admitted by expired and evicted buckets in Redis, and drops those
+    buckets.  current_key's bucket is left to the request being
+    checked."""
+    global last_expiry_check
+    if now - last_expiry_check < LOCAL_BUCKET_SYNC_SECS:
+        return
+    last_expiry_check = now
+
+    expired_keys = []  # type: List[str]
+    for (key, bucket) in local_buckets.items():
+        if now - bucket.sync_time < LOCAL_BUCKET_SYNC_SECS:
+            # The rest of the buckets were synced even more recently.
+            break
+        if key != current_key:
+            expired_keys.append(key)
+    buckets = [local_buckets.pop(key) for key in expired_keys] + evicted_local_buckets
+    del evicted_local_buckets[:]
+    flush_local_bucket_batch(buckets)
+
 def incr_ratelimit(entity: RateLimitedObject) -> None:
     """Increases the rate-limit for the specified entity"""
-    list_key, set_key, _ = entity.get_keys()
-    now = time.time()
+    rules = entity.rules()
 
     # If we have no rules, we don't store anything
     if len(rules) == 0:
         return
 
-    # Start redis transaction
-    with client.pipeline() as pipe:
-        count = 0
-        while True:
-            try:
-                # To avoid a race condition between getting the element we might trim from our list
-                # and removing it from our associated set, we abort this whole transaction if
-                # another agent manages to change our list out from under us
-                # When watching a value, the pipeline is set to Immediate mode
-                pipe.watch(list_key)
-
-                # Get the last elem that we'll trim (so we can remove it from our sorted set)
-                last_val = pipe.lindex(list_key, max_api_calls(entity) - 1)
-
-                # Restart buffered execution
-                pipe.multi()
-
-                # Add this timestamp to our list
-                pipe.lpush(list_key, now)
-
-                # Trim our list to the oldest rule we have
-                pipe.ltrim(list_key, 0, max_api_calls(entity) - 1)
-
-                # Add our new value to the sorted set that we keep
-                # We need to put the score and val both as timestamp,
-                # as we sort by score but remove by value
-                pipe.zadd(set_key, now, now)
-
-                # Remove the trimmed value from our sorted set, if there was one
-                if last_val is not None:
-                    pipe.zrem(set_key, last_val)
-
-                # Set the TTL for our keys as well
-                api_window = max_api_window(entity)
-                pipe.expire(list_key, api_window)
-                pipe.expire(set_key, api_window)
-
-                pipe.execute()
-
-                # If no exception was raised in the execution, there were no transaction conflicts
-                break
-            except redis.WatchError:
-                if count > 10:
-                    raise RateLimiterLockingException()
-                count += 1
-
-                continue
+    _run_ratelimit_script(entity, rules, time.time(), check=False)
@@ -33,15 +33,24 @@ def json_method_not_allowed(methods: List[str]) -> HttpResponseNotAllowed:
 def json_response(res_type: str="success",
                   msg: str="",
                   data: Optional[Dict[str, Any]]=None,
-                  status: int=200) -> HttpResponse:
+                  status: int=200,
+                  raw_json_data: Optional[Dict[str, str]]=None) -> HttpResponse:
+    """`raw_json_data` maps keys to values that are already encoded as
+    JSON; they are spliced into the response as-is, which saves
+    re-encoding values that are shared between many responses."""
     content = {"result": res_type, "msg": msg}
     if data is not None:
         content.update(data)
-    return HttpResponse(content=ujson.dumps(content) + "\n",
+    encoded = ujson.dumps(content)
+    if raw_json_data:
+        encoded = encoded[:-1] + "".join(
+            ',%s:%s' % (ujson.dumps(key), value) for (key, value) in raw_json_data.items()) + "}"
+    return HttpResponse(content=encoded + "\n",
                         content_type='application/json', status=status)
 
-def json_success(data: Optional[Dict[str, Any]]=None) -> HttpResponse:
-    return json_response(data=data)
+def json_success(data: Optional[Dict[str, Any]]=None,
+                 raw_json_data: Optional[Dict[str, str]]=None) -> HttpResponse:
+    return json_response(data=data, raw_json_data=raw_json_data)
 
 def json_response_from_error(exception: JsonableError) -> HttpResponse:
     '''
@@ -9,6 +9,7 @@ from django.conf import settings
 from django.utils.timezone import now as timezone_now
 from typing import DefaultDict, Dict, List, Optional, Union, Any
 
+from zerver.lib.unread_index import invalidate_unread_indexes
 from zerver.models import UserProfile, UserMessage, RealmAuditLog, \
     Subscription, Message, Recipient, UserActivity, Realm
 
@@ -166,6 +167,9 @@ def add_missing_messages(user_profile: UserProfile) -> None:
         UserMessage.objects.bulk_create(messages)
         user_profile.last_active_message_id = messages[-1].message_id
         user_profile.save(update_fields=['last_active_message_id'])
+        # These messages may be older than those in the user's
+        # unread index.
+        invalidate_unread_indexes([user_profile.id])
 
 def do_soft_deactivate_user(user_profile: UserProfile) -> None:
     try:
@@ -1,8 +1,17 @@
-from typing import Dict, List, Tuple
+from typing import Dict, List, Set, Tuple
 from mypy_extensions import TypedDict
 
 from django.db.models.query import QuerySet
+from zerver.lib.cache import (
+    cache_add,
+    cache_get,
+    cache_set,
+    make_stream_recipient_info_version,
+    stream_recipient_info_cache_key,
+    stream_recipient_info_version_cache_key,
+)
 from zerver.models import (
+    MutedTopic,
     Recipient,
     Stream,
     Subscription,
@@ -74,3 +83,75 @@ def num_subscribers_for_stream_id(stream_id: int) -> int:
     return get_active_subscriptions_for_stream_id(stream_id).filter(
         user_profile__is_active=True,
     ).count()
+
+StreamRecipientInfo = TypedDict('StreamRecipientInfo', {
+    'user_ids': List[int],
+    'push_user_ids': Set[int],
+    'email_user_ids': Set[int],
+    'user_ids_muting_topic': Dict[str, Set[int]],
+})
+
+def get_stream_recipient_info(recipient_id: int) -> StreamRecipientInfo:
+    """The subscribers of a stream, and their notification settings,
+    as needed for sending a message to the stream.  Busy streams get
+    many messages a minute, with the same subscribers, so we cache
+    this.  The cache is keyed by a version for the stream, which the
+    subscription and topic muting code bump (see
+    bump_stream_recipient_info_version); the muted topics are keyed by
+    lowercased topic name."""
+    version_key = stream_recipient_info_version_cache_key(recipient_id)
+    version = cache_get(version_key)
+    if version is None:
+        # Don't overwrite a version a concurrent bump just set; use
+        # whichever version ended up stored.
+        cache_add(version_key, make_stream_recipient_info_version())
+        version = cache_get(version_key)
+    if version is None:
+        # The cache isn't storing anything; don't cache the info.
+        return compute_stream_recipient_info(recipient_id)
+    version = version[0]
+    info_key = stream_recipient_info_cache_key(recipient_id, version)
+    info = cache_get(info_key)
+    if info is not None:
+        return info[0]
+
+    info = compute_stream_recipient_info(recipient_id)
+    cache_set(info_key, info, timeout=3600*24)
+    return info
+
+def compute_stream_recipient_info(recipient_id: int) -> StreamRecipientInfo:
+
+    subscription_rows = Subscription.objects.filter(
+        recipient_id=recipient_id,
+        active=True,
+    ).values(
+        'user_profile_id',
+        'push_notifications',
+        'email_notifications',
+        'in_home_view',
+    ).order_by('user_profile_id')
+
+    user_ids_muting_topic = {}  # type: Dict[str, Set[int]]
+    muted_topic_rows = MutedTopic.objects.filter(
+        recipient_id=recipient_id,
+    ).values_list('topic_name', 'user_profile_id')
+    for (topic_name, user_profile_id) in muted_topic_rows:
+        user_ids_muting_topic.setdefault(topic_name.lower(), set()).add(user_profile_id)
+
+    info = StreamRecipientInfo(
+        user_ids=[row['user_profile_id'] for row in subscription_rows],
+        # Note: muting a stream overrides stream_push_notify and
+        # stream_email_notify
+        push_user_ids={
+            row['user_profile_id']
+            for row in subscription_rows
+            if row['push_notifications'] and row['in_home_view']
+        },
+        email_user_ids={
+            row['user_profile_id']
+            for row in subscription_rows
+            if row['email_notifications'] and row['in_home_view']
+        },
+        user_ids_muting_topic=user_ids_muting_topic,
+    )
+    return info
@@ -18,6 +18,7 @@ from django.db.utils import IntegrityError
 from django.http import HttpRequest
 
 from two_factor.models import PhoneDevice
+from zerver.lib import bugdown
 from zerver.lib.initial_password import initial_password
 from zerver.lib.utils import is_remote_server
 from zerver.lib.users import get_api_key
@@ -69,6 +70,9 @@ API_KEYS = {}  # type: Dict[str, str]
 def flush_caches_for_testing() -> None:
     global API_KEYS
     API_KEYS = {}
+    # The render cache's memcached entries are already isolated by
+    # each test's key prefix, but not its in-process copy.
+    bugdown.render_cache.clear()
 
 class UploadSerializeMixin(SerializeMixin):
     """
@@ -0,0 +1,231 @@
+# A per-user index of unread messages, kept in redis, so that
+# get_raw_unread_data doesn't need to join all of a user's unread
+# UserMessage rows against Message and Recipient on every register.
+#
+# For each user, a sorted set holds their newest unread messages,
+# scored by message ID, each with the fields get_raw_unread_data needs
+# (the message's recipient, sender and topic, and the user's flags).
+# It's trimmed to the number of messages get_raw_unread_data returns,
+# so reads and writes stay bounded however many unread messages the
+# user has.  A separate hash holds the index's watermark (every unread
+# message with an ID at most the watermark that isn't older than the
+# index's oldest entry is in the index), and which recipients it
+# excludes.  So sending a message doesn't touch any indexes; the next
+# read picks up new messages with a query for the user's unread rows
+# above the watermark, which only has to join those few rows.
+#
+# Marking messages as read removes them from the index; if that
+# leaves a trimmed index with fewer messages than the limit, the next
+# read rebuilds it, since older unread messages now belong in it.
+# Rarer per-user changes (e.g. marking messages as unread, or an edit
+# changing who is mentioned) drop the user's index, and so does a
+# change in the recipients it excludes (e.g. unsubscribing).  Changes
+# to messages that many users may have unread (topic edits and
+# deletions) bump a per-realm version, which invalidates all of the
+# realm's indexes.  A dropped or invalidated index is rebuilt from the
+# database on the next read.
+#
+# Every write bumps the user's generation counter, and a reader only
+# stores what it read from the database if the generation didn't
+# change meanwhile, so that it can't put back a message that was just
+# marked as read.
+#
+# The keys include the remote cache's KEY_PREFIX, which changes on
+# each deploy, so a new version of this code never reads an index
+# written by an older one.
+
+import hashlib
+from typing import Any, Dict, Iterable, List, Optional
+
+from django.conf import settings
+import redis
+import ujson
+
+from zerver.lib import cache
+from zerver.lib.redis_utils import get_redis_client
+from zerver.lib.topic import MESSAGE__TOPIC
+from zerver.models import UserMessage, UserProfile
+
+UNREAD_INDEX_EXPIRY = 7 * 24 * 60 * 60
+# Messages aren't committed in exactly the order of their IDs, so each
+# read also rescans this many message IDs below the watermark.
+UNREAD_INDEX_RESCAN_MESSAGES = 10000
+
+WATERMARK_FIELD = b'watermark'
+REALM_VERSION_FIELD = b'realm_version'
+EXCLUDED_RECIPIENTS_FIELD = b'excluded_recipients'
+# Whether the index has every unread message older than its watermark,
+# i.e. it has never been trimmed.
+COMPLETE_FIELD = b'complete'
+
+# The fields stored for each message, in the order they're stored in.
+UNREAD_ROW_FIELDS = [
+    'message__sender_id',
+    MESSAGE__TOPIC,
+    'message__recipient_id',
+    'message__recipient__type',
+    'message__recipient__type_id',
+    'flags',
+]
+
+redis_client = get_redis_client()
+
+def unread_index_enabled() -> bool:
+    return settings.ENABLE_UNREAD_INDEX
+
+def unread_index_key(user_profile_id: int) -> str:
+    return 'unread_index:%s%d' % (cache.KEY_PREFIX, user_profile_id)
+
+def unread_index_state_key(user_profile_id: int) -> str:
+    return 'unread_index_state:%s%d' % (cache.KEY_PREFIX, user_profile_id)
+
+def unread_index_generation_key(user_profile_id: int) -> str:
+    return 'unread_index_generation:%s%d' % (cache.KEY_PREFIX, user_profile_id)
+
+def unread_index_realm_version_key(realm_id: int) -> str:
+    return 'unread_index_realm_version:%s%d' % (cache.KEY_PREFIX, realm_id)
+
+def query_unread_rows(user_profile: UserProfile, limit: int,
+                      excluded_recipient_ids: Iterable[int]=(),
+                      min_message_id: Optional[int]=None) -> List[Dict[str, Any]]:
+    """The user's newest unread messages, newest first."""
+    user_msgs = UserMessage.objects.filter(
+        user_profile=user_profile
+    ).exclude(
+        message__recipient_id__in=excluded_recipient_ids
+    ).extra(
+        where=[UserMessage.where_unread()]
+    )
+    if min_message_id is not None:
+        user_msgs = user_msgs.filter(message_id__gt=min_message_id)
+
+    return list(user_msgs.values(
+        'message_id',
+        *UNREAD_ROW_FIELDS
+    ).order_by("-message_id")[:limit])
+
+def excluded_recipients_fingerprint(excluded_recipient_ids: Iterable[int]) -> bytes:
+    ids = ','.join(str(recipient_id) for recipient_id in sorted(excluded_recipient_ids))
+    return hashlib.sha1(ids.encode()).hexdigest().encode()
+
+def get_indexed_unread_rows(user_profile: UserProfile, limit: int,
+                            excluded_recipient_ids: Iterable[int]=()) -> List[Dict[str, Any]]:
+    """Like query_unread_rows, but served from (and updating) the
+    user's unread index."""
+    excluded_recipient_ids = list(excluded_recipient_ids)
+    key = unread_index_key(user_profile.id)
+    state_key = unread_index_state_key(user_profile.id)
+    generation_key = unread_index_generation_key(user_profile.id)
+
+    with redis_client.pipeline() as pipeline:
+        pipeline.get(generation_key)
+        pipeline.get(unread_index_realm_version_key(user_profile.realm_id))
+        pipeline.hgetall(state_key)
+        pipeline.zrevrange(key, 0, limit - 1)
+        pipeline.expire(state_key, UNREAD_INDEX_EXPIRY)
+        pipeline.expire(key, UNREAD_INDEX_EXPIRY)
+        (generation, realm_version, state, index, _, _) = pipeline.execute()
+    realm_version = realm_version or b'0'
+    excluded_fingerprint = excluded_recipients_fingerprint(excluded_recipient_ids)
+
+    rebuild = (WATERMARK_FIELD not in state or
+               state.get(REALM_VERSION_FIELD) != realm_version or
+               state.get(EXCLUDED_RECIPIENTS_FIELD) != excluded_fingerprint or
+               (state.get(COMPLETE_FIELD) != b'1' and len(index) < limit))
+    if rebuild:
+        entries = {}  # type: Dict[int, List[Any]]
+        rows = query_unread_rows(user_profile, limit,
+                                 excluded_recipient_ids=excluded_recipient_ids)
+        watermark = 0
+        complete = len(rows) < limit
+    else:
+        entries = {}
+        for value in index:
+            entry = ujson.loads(value)
+            entries[entry[0]] = entry[1:]
+        watermark = int(state[WATERMARK_FIELD])
+        complete = state.get(COMPLETE_FIELD) == b'1'
+        rows = query_unread_rows(user_profile, limit,
+                                 excluded_recipient_ids=excluded_recipient_ids,
+                                 min_message_id=watermark - UNREAD_INDEX_RESCAN_MESSAGES)
+
+    new_entries = {row['message_id']: [row[field] for field in UNREAD_ROW_FIELDS]
+                   for row in rows
+                   if row['message_id'] not in entries}
+    entries.update(new_entries)
+    message_ids = sorted(entries, reverse=True)
+    if len(message_ids) > limit:
+        message_ids = message_ids[:limit]
+        complete = False
+
+    if rebuild or new_entries:
+        watermark = max([watermark] + list(new_entries.keys()))
+        with redis_client.pipeline() as pipeline:
+            try:
+                pipeline.watch(generation_key)
+                if pipeline.get(generation_key) == generation:
+                    pipeline.multi()
+                    if rebuild:
+                        pipeline.delete(key)
+                    if new_entries:
+                        args = []  # type: List[Any]
+                        for (message_id, value) in new_entries.items():
+                            args += [message_id, ujson.dumps([message_id] + value)]
+                        pipeline.zadd(key, *args)
+                        # Keep just the newest `limit` messages.
+                        pipeline.zremrangebyrank(key, 0, -limit - 1)
+                    pipeline.hmset(state_key, {
+                        WATERMARK_FIELD: watermark,
+                        REALM_VERSION_FIELD: realm_version,
+                        EXCLUDED_RECIPIENTS_FIELD: excluded_fingerprint,
+                        COMPLETE_FIELD: int(complete),
+                    })
+                    pipeline.expire(state_key, UNREAD_INDEX_EXPIRY)
+                    pipeline.expire(key, UNREAD_INDEX_EXPIRY)
+                    pipeline.execute()
+            except redis.WatchError:
+                # The index changed while we were querying the
+                # database; the next read will catch up.
+                pass
+
+    return [dict(zip(UNREAD_ROW_FIELDS, entries[message_id]), message_id=message_id)
+            for message_id in message_ids]
+
+def bump_unread_index_generations(pipeline: Any,
+                                  user_profile_ids: Iterable[int]) -> None:
+    for user_profile_id in user_profile_ids:
+        generation_key = unread_index_generation_key(user_profile_id)
+        pipeline.incr(generation_key)
+        pipeline.expire(generation_key, UNREAD_INDEX_EXPIRY)
+
+def remove_from_unread_index(user_profile_id: int, message_ids: List[int]) -> None:
+    if not unread_index_enabled() or not message_ids:
+        return
+
+    with redis_client.pipeline() as pipeline:
+        bump_unread_index_generations(pipeline, [user_profile_id])
+        key = unread_index_key(user_profile_id)
+        for message_id in message_ids:
+            pipeline.zremrangebyscore(key, message_id, message_id)
+        pipeline.execute()
+
+def invalidate_unread_indexes(user_profile_ids: Iterable[int]) -> None:
+    if not unread_index_enabled():
+        return
+
+    user_profile_ids = list(user_profile_ids)
+    if not user_profile_ids:
+        return
+
+    with redis_client.pipeline() as pipeline:
+        bump_unread_index_generations(pipeline, user_profile_ids)
+        for user_profile_id in user_profile_ids:
+            pipeline.delete(unread_index_key(user_profile_id),
+                            unread_index_state_key(user_profile_id))
+        pipeline.execute()
+
+def invalidate_realm_unread_indexes(realm_id: int) -> None:
+    if not unread_index_enabled():
+        return
+
+    redis_client.incr(unread_index_realm_version_key(realm_id))
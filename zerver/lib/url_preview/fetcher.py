@@ -0,0 +1,98 @@
+import asyncio
+import functools
+import logging
+import urllib
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Dict, Iterable, Optional, Tuple
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from zerver.lib.bugdown import fetch_open_graph_image, fetch_tweet_data, \
+    get_tweet_id, is_dropbox_url
+from zerver.lib.cache import cache_get, open_graph_image_cache_key, \
+    preview_url_cache_key, tweet_data_cache_key
+from zerver.lib.url_preview.preview import CACHE_NAME, cache_preview_data, \
+    fetch_link_embed_data
+
+# How many previews a fetcher downloads at once, in total and from any
+# one host; the latter keeps a message full of links to one site from
+# hammering it (or getting us rate-limited by it).
+MAX_CONCURRENT_FETCHES = 16
+MAX_CONCURRENT_FETCHES_PER_DOMAIN = 2
+
+class LinkPreviewFetcher:
+    """Fetches previews for the links bugdown found no cached preview
+    for, and caches them for the next render.  Each link is handled by
+    a coroutine, which waits for a slot for the link's host and then
+    runs the blocking fetch in a thread pool; HTTP connections are
+    pooled across all the links (and events) a fetcher handles.
+
+    Only the fetches run in the thread pool; the cache, which is
+    database-backed, is only used from the calling thread."""
+
+    def __init__(self, max_concurrent_fetches: int=MAX_CONCURRENT_FETCHES,
+                 max_concurrent_fetches_per_domain: int=MAX_CONCURRENT_FETCHES_PER_DOMAIN) -> None:
+        self.max_concurrent_fetches_per_domain = max_concurrent_fetches_per_domain
+        self.executor = ThreadPoolExecutor(max_workers=max_concurrent_fetches)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=max_concurrent_fetches,
+                              pool_maxsize=max_concurrent_fetches_per_domain)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+
+    def fetch(self, urls: Iterable[str]) -> None:
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(self.fetch_all(loop, urls))
+        finally:
+            loop.close()
+
+    async def fetch_all(self, loop: asyncio.AbstractEventLoop, urls: Iterable[str]) -> None:
+        domain_semaphores = defaultdict(
+            lambda: asyncio.Semaphore(self.max_concurrent_fetches_per_domain)
+        )  # type: Dict[str, asyncio.Semaphore]
+
+        async def fetch_one(url: str) -> None:
+            uncached_fetch = self.get_uncached_fetch(url)
+            if uncached_fetch is None:
+                return
+            (key, fetch) = uncached_fetch
+
+            domain = urllib.parse.urlparse(url).netloc.lower()
+            async with domain_semaphores[domain]:
+                try:
+                    data = await loop.run_in_executor(self.executor, fetch)
+                except Exception:
+                    # Errors that may well go away (e.g. being
+                    # rate-limited by Twitter) are raised rather than
+                    # returned, so that we don't cache them, and fetch
+                    # the link again the next time it's sent.
+                    logging.warning("Error fetching preview for %s" % (url,), exc_info=True)
+                    return
+            cache_preview_data(key, data)
+
+        await asyncio.gather(*[fetch_one(url) for url in set(urls)])
+
+    def get_uncached_fetch(self, url: str) -> Optional[Tuple[str, Callable[[], Any]]]:
+        """Returns the cache key for the preview of `url`, and how to
+        fetch it, unless the preview is cached already."""
+        tweet_id = get_tweet_id(url)
+        if tweet_id is not None:
+            key = tweet_data_cache_key(tweet_id)
+            fetch = functools.partial(fetch_tweet_data, tweet_id)  # type: Callable[[], Any]
+        elif is_dropbox_url(url):
+            key = open_graph_image_cache_key(url)
+            fetch = functools.partial(fetch_open_graph_image, url, session=self.session)
+        else:
+            key = preview_url_cache_key(url)
+            fetch = functools.partial(fetch_link_embed_data, url, session=self.session)
+
+        if cache_get(key, cache_name=CACHE_NAME) is not None:
+            return None
+        return (key, fetch)
+
+    def close(self) -> None:
+        self.executor.shutdown()
+        self.session.close()
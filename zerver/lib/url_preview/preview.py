@@ -2,13 +2,22 @@ import re
 from typing import Any, Optional, Dict
 from typing.re import Match
 import requests
-from zerver.lib.cache import cache_with_key, get_cache_with_key, preview_url_cache_key
+from zerver.lib.cache import cache_set, get_cache_with_key, preview_url_cache_key, \
+    NotFoundInCache
 from zerver.lib.url_preview.oembed import get_oembed_data
 from zerver.lib.url_preview.parsers import OpenGraphParser, GenericParser
 from django.utils.encoding import smart_text
 
 
 CACHE_NAME = "database"
+# Previews are fetched by the FetchLinksEmbedData queue worker (see
+# zerver/lib/url_preview/fetcher.py), never while rendering.  Failed
+# fetches are cached too, so that a slow or broken site is not fetched
+# again for every message linking to it, but for a much shorter time,
+# so that it gets a preview once it's back.
+PREVIEW_CACHE_TIMEOUT = 3600 * 24 * 7
+NEGATIVE_PREVIEW_CACHE_TIMEOUT = 3600
+PREVIEW_FETCH_TIMEOUT = 10
 # Based on django.core.validators.URLValidator, with ftp support removed.
 link_regex = re.compile(
     r'^(?:http)s?://'  # http:// or https://
@@ -22,10 +31,31 @@ def is_link(url: str) -> Match[str]:
     return link_regex.match(smart_text(url))
 
 
-@cache_with_key(preview_url_cache_key, cache_name=CACHE_NAME, with_statsd_key="urlpreview_data")
+def cache_preview_data(key: str, data: Any) -> None:
+    if data:
+        timeout = PREVIEW_CACHE_TIMEOUT
+    else:
+        timeout = NEGATIVE_PREVIEW_CACHE_TIMEOUT
+    cache_set(key, data, cache_name=CACHE_NAME, timeout=timeout)
+
+
 def get_link_embed_data(url: str,
                         maxwidth: Optional[int]=640,
-                        maxheight: Optional[int]=480) -> Optional[Dict[str, Any]]:
+                        maxheight: Optional[int]=480,
+                        session: Optional[requests.Session]=None) -> Optional[Dict[str, Any]]:
+    try:
+        return link_embed_data_from_cache(url, maxwidth=maxwidth, maxheight=maxheight)
+    except NotFoundInCache:
+        pass
+    data = fetch_link_embed_data(url, maxwidth=maxwidth, maxheight=maxheight, session=session)
+    cache_preview_data(preview_url_cache_key(url), data)
+    return data
+
+
+def fetch_link_embed_data(url: str,
+                          maxwidth: Optional[int]=640,
+                          maxheight: Optional[int]=480,
+                          session: Optional[requests.Session]=None) -> Optional[Dict[str, Any]]:
     if not is_link(url):
         return None
     # Fetch information from URL.
@@ -41,7 +71,13 @@ def get_link_embed_data(url: str,
         # open graph data.
         return None
     data = data or {}
-    response = requests.get(url)
+    try:
+        if session is not None:
+            response = session.get(url, timeout=PREVIEW_FETCH_TIMEOUT)
+        else:
+            response = requests.get(url, timeout=PREVIEW_FETCH_TIMEOUT)
+    except requests.exceptions.RequestException:
+        return None
     if response.ok:
         og_data = OpenGraphParser(response.text).extract_data()
         if og_data:
@@ -81,7 +81,10 @@ class Command(ZulipBaseCommand):
     hours of serial runtime (goes down to ~50m with --threads=6 on a
     machine with 8 CPUs).  Importing that same data set took about 30
     minutes.  But this will vary a lot depending on the average number
-    of recipients of messages in the realm, hardware, etc."""
+    of recipients of messages in the realm, hardware, etc.
+
+    If an export is interrupted, rerunning it with the same --output
+    and --resume skips the message files that were already written."""
 
     def add_arguments(self, parser: ArgumentParser) -> None:
         parser.add_argument('--output',
@@ -97,6 +100,10 @@ class Command(ZulipBaseCommand):
         parser.add_argument('--public-only',
                             action="store_true",
                             help='Export only public stream messages and associated attachments')
+        parser.add_argument('--resume',
+                            action="store_true",
+                            help='Resume an interrupted export into the same --output directory, '
+                                 'reusing the message files it had already written')
         parser.add_argument('--upload-to-s3',
                             action="store_true",
                             help="Whether to upload resulting tarball to s3")
@@ -111,9 +118,14 @@ class Command(ZulipBaseCommand):
             output_dir = tempfile.mkdtemp(prefix="zulip-export-")
         else:
             output_dir = os.path.realpath(os.path.expanduser(output_dir))
-        if os.path.exists(output_dir):
-            shutil.rmtree(output_dir)
-        os.makedirs(output_dir)
+        if options["resume"]:
+            if options["output_dir"] is None:
+                raise CommandError('You must specify the --output of the export to resume.')
+            os.makedirs(output_dir, exist_ok=True)
+        else:
+            if os.path.exists(output_dir):
+                shutil.rmtree(output_dir)
+            os.makedirs(output_dir)
         print("Exporting realm %s" % (realm.string_id,))
         num_threads = int(options['threads'])
         if num_threads < 1:
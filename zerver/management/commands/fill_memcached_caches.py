@@ -1,20 +1,40 @@
 
+import time
 from argparse import ArgumentParser
 from typing import Any
 
-from django.core.management.base import BaseCommand
+from django.core.management.base import BaseCommand, CommandError
 
-from zerver.lib.cache_helpers import cache_fillers, fill_remote_cache
+from zerver.lib.cache_helpers import cache_fillers, fill_remote_caches
 
 class Command(BaseCommand):
+    help = """Fill the remote cache with the objects most requests need, for
+the most active realms first, e.g. after memcached was restarted."""
+
     def add_arguments(self, parser: ArgumentParser) -> None:
         parser.add_argument('--cache', dest="cache", default=None,
-                            help="Populate the memcached cache of messages.")
+                            help="Comma-separated list of the caches to populate (%s); "
+                                 "defaults to all of them." % (', '.join(sorted(cache_fillers)),))
+        parser.add_argument('--processes', dest="processes", default=4, type=int,
+                            help="Number of worker processes to fill the caches with.")
 
-    def handle(self, *args: Any, **options: str) -> None:
+    def handle(self, *args: Any, **options: Any) -> None:
         if options["cache"] is not None:
-            fill_remote_cache(options["cache"])
-            return
+            caches = options["cache"].split(",")
+            for cache in caches:
+                if cache not in cache_fillers:
+                    raise CommandError("Unknown cache: %s" % (cache,))
+        else:
+            caches = list(cache_fillers.keys())
 
-        for cache in cache_fillers.keys():
-            fill_remote_cache(cache)
+        start = time.time()
+        num_done = 0
+        for ((cache, realm_id), count, num_tasks) in fill_remote_caches(caches, options["processes"]):
+            num_done += 1
+            elapsed = time.time() - start
+            eta = elapsed / num_done * (num_tasks - num_done)
+            self.stdout.write("[%d/%d] Populated %s cache%s with %d objects; ETA %ds" % (
+                num_done, num_tasks, cache,
+                " for realm %s" % (realm_id,) if realm_id is not None else "",
+                count, eta))
+        self.stdout.write("Populated the caches in %.1fs." % (time.time() - start,))
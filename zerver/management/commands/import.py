@@ -40,7 +40,8 @@ import a database dump from one or more JSON files."""
                             dest='processes',
                             action="store",
                             default=6,
-                            help='Number of processes to use for uploading Avatars to S3 in parallel')
+                            help='Number of processes to use for uploading Avatars to S3 '
+                                 'and rendering messages in parallel')
         parser.formatter_class = argparse.RawTextHelpFormatter
 
     def do_destroy_and_rebuild_database(self, db_name: str) -> None:
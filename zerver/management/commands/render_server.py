@@ -0,0 +1,29 @@
+import logging
+import multiprocessing
+from argparse import ArgumentParser
+from typing import Any
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from zerver.lib.bugdown.render_server import serve
+
+class Command(BaseCommand):
+    help = """Runs the markdown render server, a pool of processes that render
+messages for the Django processes over BUGDOWN_RENDER_SERVER_SOCKET.
+
+Each render is limited to --cpu-limit seconds of CPU time; a process
+that exceeds that is killed and replaced."""
+
+    def add_arguments(self, parser: ArgumentParser) -> None:
+        parser.add_argument('--processes', default=multiprocessing.cpu_count(), type=int,
+                            help='Number of rendering processes')
+        parser.add_argument('--cpu-limit', default=5, type=int,
+                            help='Seconds of CPU time allowed for each render')
+
+    def handle(self, *args: Any, **options: Any) -> None:
+        if settings.BUGDOWN_RENDER_SERVER_SOCKET is None:
+            raise CommandError("BUGDOWN_RENDER_SERVER_SOCKET is not set.")
+        logging.basicConfig()
+        logging.getLogger('zerver.lib.bugdown.render_server').setLevel(logging.INFO)
+        serve(settings.BUGDOWN_RENDER_SERVER_SOCKET, options['processes'], options['cpu_limit'])
@@ -0,0 +1,106 @@
+import sys
+from argparse import ArgumentParser
+from typing import Any
+
+from django.conf import settings
+from django.core.management.base import CommandError
+
+from zerver.lib.management import ZulipBaseCommand
+from zerver.models import Realm
+from zerver.tornado.event_queue import send_drain_realm_event
+from zerver.tornado.sharding import get_nginx_shard_map, get_shard_map, \
+    get_tornado_port, get_tornado_ports, write_nginx_shard_map, write_shard_map
+
+class Command(ZulipBaseCommand):
+    help = """Show or change which Tornado process serves each realm's event queues.
+
+Realms are assigned to Tornado processes using the same consistent-hash
+ring over the realm's hostname that nginx uses to route long-polling
+requests, so new realms need no configuration.  Individual realms can
+be pinned to a specific process, which is recorded in
+TORNADO_SHARDING_MAP_PATH, and for nginx, in
+TORNADO_NGINX_SHARDING_CONF_PATH.
+
+Usage examples:
+
+./manage.py tornado_shards
+./manage.py tornado_shards --op move -r zulip --port 9801
+./manage.py tornado_shards --op drain -r zulip
+./manage.py tornado_shards --op nginx-map
+
+Moving (or unpinning) a realm only changes where its events are sent
+and where nginx will route its long-polling requests.  Once nginx has
+been reloaded (`service nginx reload`), run `--op drain` to drop the
+realm's event queues on the other Tornado processes; clients then
+re-register and get a queue on the realm's new process."""
+
+    def add_arguments(self, parser: ArgumentParser) -> None:
+        parser.add_argument('--op',
+                            dest='op',
+                            type=str,
+                            default="show",
+                            help='What operation to do (show, move, unpin, drain, nginx-map).')
+        parser.add_argument('--port',
+                            dest='port',
+                            type=int,
+                            help='The Tornado port to move the realm to.')
+        self.add_realm_args(parser)
+
+    def handle(self, *args: Any, **options: Any) -> None:
+        if settings.TORNADO_PROCESSES == 1:
+            raise CommandError("Tornado sharding requires TORNADO_PROCESSES > 1.")
+
+        realm = self.get_realm(options)
+        shard_map = get_shard_map()
+
+        if options["op"] == "show":
+            realms = [realm] if realm is not None else Realm.objects.order_by("string_id")
+            for r in realms:
+                pinned = " (pinned)" if r.string_id in shard_map else ""
+                print("%-30s %d%s" % (r.string_id, get_tornado_port(r), pinned))
+            sys.exit(0)
+
+        if options["op"] == "nginx-map":
+            # The contents of TORNADO_NGINX_SHARDING_CONF_PATH, which
+            # is included in nginx's `map $host $tornado_server` block.
+            for (host, port) in get_nginx_shard_map():
+                print("%s tornado_%d;" % (host, port))
+            sys.exit(0)
+
+        if realm is None:
+            raise CommandError("You must specify a realm with --realm.")
+
+        if options["op"] == "drain":
+            port = get_tornado_port(realm)
+            for other_port in get_tornado_ports():
+                if other_port != port:
+                    send_drain_realm_event(realm, other_port)
+            print("Drained %s's event queues on every Tornado process but port %d."
+                  % (realm.string_id, port))
+            return
+
+        old_port = get_tornado_port(realm)
+        if options["op"] == "move":
+            new_port = options["port"]
+            if new_port not in get_tornado_ports():
+                raise CommandError("Port must be one of %s." % (
+                    ", ".join(str(port) for port in get_tornado_ports()),))
+            new_shard_map = dict(shard_map)
+            new_shard_map[realm.string_id] = new_port
+        elif options["op"] == "unpin":
+            new_shard_map = {string_id: port for (string_id, port) in shard_map.items()
+                             if string_id != realm.string_id}
+        else:
+            self.print_help("./manage.py", "tornado_shards")
+            sys.exit(1)
+
+        write_shard_map(new_shard_map)
+        write_nginx_shard_map()
+        new_port = get_tornado_port(realm)
+        if new_port == old_port:
+            print("%s is already served by port %d." % (realm.string_id, old_port))
+            return
+
+        print("Moved %s from port %d to port %d." % (realm.string_id, old_port, new_port))
+        print("Now reload nginx, and then run `./manage.py tornado_shards --op drain -r %s`."
+              % (realm.string_id,))
@@ -21,7 +21,8 @@ from zerver.lib.cache import cache_with_key, flush_user_profile, flush_realm, \
     get_stream_cache_key, realm_user_dicts_cache_key, \
     bot_dicts_in_realm_cache_key, realm_user_dict_fields, \
     bot_dict_fields, flush_message, flush_submessage, bot_profile_cache_key, \
-    flush_used_upload_space_cache, get_realm_used_upload_space_cache_key
+    flush_used_upload_space_cache, get_realm_used_upload_space_cache_key, \
+    flush_stream_recipient_info
 from zerver.lib.utils import make_safe_digest, generate_random_token
 from django.db import transaction
 from django.utils.timezone import now as timezone_now
@@ -366,11 +367,13 @@ class Realm(models.Model):
     def __str__(self) -> str:
         return "<Realm: %s %s>" % (self.string_id, self.id)
 
-    @cache_with_key(get_realm_emoji_cache_key, timeout=3600*24*7)
+    @cache_with_key(get_realm_emoji_cache_key, timeout=3600*24*7,
+                    local_cache_family='realm_emoji')
     def get_emoji(self) -> Dict[str, Dict[str, Iterable[str]]]:
         return get_realm_emoji_uncached(self)
 
-    @cache_with_key(get_active_realm_emoji_cache_key, timeout=3600*24*7)
+    @cache_with_key(get_active_realm_emoji_cache_key, timeout=3600*24*7,
+                    local_cache_family='active_realm_emoji')
     def get_active_emoji(self) -> Dict[str, Dict[str, Iterable[str]]]:
         return get_active_realm_emoji_uncached(self)
 
@@ -641,7 +644,7 @@ class RealmFilter(models.Model):
         return "<RealmFilter(%s): %s %s>" % (self.realm.string_id, self.pattern, self.url_format_string)
 
 def get_realm_filters_cache_key(realm_id: int) -> str:
-    return u'%s:all_realm_filters:%s' % (cache.KEY_PREFIX, realm_id,)
+    return u'all_realm_filters:%s' % (realm_id,)
 
 # We have a per-process cache to avoid doing 1000 remote cache queries during page load
 per_request_realm_filters_cache = {}  # type: Dict[int, List[Tuple[str, str, int]]]
@@ -654,7 +657,8 @@ def realm_filters_for_realm(realm_id: int) -> List[Tuple[str, str, int]]:
         per_request_realm_filters_cache[realm_id] = realm_filters_for_realm_remote_cache(realm_id)
     return per_request_realm_filters_cache[realm_id]
 
-@cache_with_key(get_realm_filters_cache_key, timeout=3600*24*7)
+@cache_with_key(get_realm_filters_cache_key, timeout=3600*24*7,
+                local_cache_family='all_realm_filters')
 def realm_filters_for_realm_remote_cache(realm_id: int) -> List[Tuple[str, str, int]]:
     filters = []
     for realm_filter in RealmFilter.objects.filter(realm_id=realm_id):
@@ -678,6 +682,9 @@ def flush_realm_filter(sender: Any, **kwargs: Any) -> None:
         per_request_realm_filters_cache.pop(realm_id)
     except KeyError:
         pass
+    # Imported here to avoid a circular import.
+    from zerver.lib.bugdown import realm_filter_matchers
+    realm_filter_matchers.pop(realm_id, None)
 
 post_save.connect(flush_realm_filter, sender=RealmFilter)
 post_delete.connect(flush_realm_filter, sender=RealmFilter)
@@ -1271,6 +1278,9 @@ class MutedTopic(models.Model):
     def __str__(self) -> str:
         return "<MutedTopic: (%s, %s, %s)>" % (self.user_profile.email, self.stream.name, self.topic_name)
 
+post_save.connect(flush_stream_recipient_info, sender=MutedTopic)
+post_delete.connect(flush_stream_recipient_info, sender=MutedTopic)
+
 class Client(models.Model):
     name = models.CharField(max_length=30, db_index=True, unique=True)  # type: str
 
@@ -1864,6 +1874,9 @@ class Subscription(models.Model):
     def __str__(self) -> str:
         return "<Subscription: %s -> %s>" % (self.user_profile, self.recipient)
 
+post_save.connect(flush_stream_recipient_info, sender=Subscription)
+post_delete.connect(flush_stream_recipient_info, sender=Subscription)
+
 @cache_with_key(user_profile_by_id_cache_key, timeout=3600*24*7)
 def get_user_profile_by_id(uid: int) -> UserProfile:
     return UserProfile.objects.select_related().get(id=uid)
@@ -1872,7 +1885,8 @@ def get_user_profile_by_id(uid: int) -> UserProfile:
 def get_user_profile_by_email(email: str) -> UserProfile:
     return UserProfile.objects.select_related().get(delivery_email__iexact=email.strip())
 
-@cache_with_key(user_profile_by_api_key_cache_key, timeout=3600*24*7)
+@cache_with_key(user_profile_by_api_key_cache_key, timeout=3600*24*7,
+                local_cache_family='user_profile_by_api_key')
 def get_user_profile_by_api_key(api_key: str) -> UserProfile:
     return UserProfile.objects.select_related().get(api_key=api_key)
 
@@ -1930,13 +1944,15 @@ def get_user_by_id_in_realm_including_cross_realm(
 
     raise UserProfile.DoesNotExist()
 
-@cache_with_key(realm_user_dicts_cache_key, timeout=3600*24*7)
+@cache_with_key(realm_user_dicts_cache_key, timeout=3600*24*7,
+                single_flight=True, serve_stale=True)
 def get_realm_user_dicts(realm_id: int) -> List[Dict[str, Any]]:
     return UserProfile.objects.filter(
         realm_id=realm_id,
     ).values(*realm_user_dict_fields)
 
-@cache_with_key(active_user_ids_cache_key, timeout=3600*24*7)
+@cache_with_key(active_user_ids_cache_key, timeout=3600*24*7,
+                single_flight=True)
 def active_user_ids(realm_id: int) -> List[int]:
     query = UserProfile.objects.filter(
         realm_id=realm_id,
@@ -3,10 +3,12 @@
 from zerver.lib.alert_words import (
     add_user_alert_words,
     alert_words_in_realm,
+    get_alert_word_automaton,
     remove_user_alert_words,
     user_alert_words,
 )
 
+from zerver.lib.actions import do_deactivate_user
 from zerver.lib.test_helpers import (
     most_recent_message,
     most_recent_usermessage,
@@ -20,7 +22,9 @@ from zerver.models import (
     UserProfile,
 )
 
+import mock
 import ujson
+from typing import Dict, Set
 
 class AlertWordTests(ZulipTestCase):
     interesting_alert_word_list = ['alert', 'multi-word word', u'☃']
@@ -97,6 +101,34 @@ class AlertWordTests(ZulipTestCase):
                          self.interesting_alert_word_list)
         self.assertEqual(realm_words[user2.id], ['another'])
 
+    def test_automaton_updated_incrementally(self) -> None:
+        user1 = self.example_user('cordelia')
+        user2 = self.example_user('othello')
+        add_user_alert_words(user1, ['alert', 'Snowman'])
+        realm = user1.realm
+
+        def user_ids_by_word(text: str) -> Dict[str, Set[int]]:
+            automaton = get_alert_word_automaton(realm)
+            return {word: set(user_ids) for (end_index, (word, user_ids)) in automaton.iter(text)}
+
+        self.assertEqual(user_ids_by_word('alert snowman'),
+                         {'alert': {user1.id}, 'snowman': {user1.id}})
+
+        # After the first build, changes to one user's words are
+        # applied to this process's automaton, without rebuilding it.
+        with mock.patch('zerver.lib.alert_words.alert_words_in_realm') as mock_alert_words_in_realm:
+            add_user_alert_words(user2, ['alert', 'another'])
+            self.assertEqual(user_ids_by_word('alert another'),
+                             {'alert': {user1.id, user2.id}, 'another': {user2.id}})
+
+            remove_user_alert_words(user1, ['alert'])
+            self.assertEqual(user_ids_by_word('alert'), {'alert': {user2.id}})
+
+            do_deactivate_user(user2)
+            self.assertEqual(user_ids_by_word('alert another snowman'),
+                             {'alert': set(), 'another': set(), 'snowman': {user1.id}})
+        mock_alert_words_in_realm.assert_not_called()
+
     def test_json_list_default(self) -> None:
         self.login(self.example_email("hamlet"))
 
@@ -3,17 +3,21 @@ from django.conf import settings
 from django.test import TestCase, override_settings
 
 from zerver.lib import bugdown
+from zerver.lib.bugdown import render_server, testing_mocks
+from zerver.lib.cache import tweet_data_cache_key
 from zerver.lib.actions import (
     do_set_user_display_setting,
     do_remove_realm_emoji,
     do_set_alert_words,
+    do_change_full_name,
 )
 from zerver.lib.alert_words import get_alert_word_automaton
 from zerver.lib.create_user import create_user
 from zerver.lib.emoji import get_emoji_url
 from zerver.lib.exceptions import BugdownRenderingException
 from zerver.lib.mention import possible_mentions, possible_user_group_mentions
-from zerver.lib.message import render_markdown
+from zerver.lib.message import render_markdown, render_markdown_batch
+from zerver.lib.url_preview.preview import cache_preview_data
 from zerver.lib.request import (
     JsonableError,
 )
@@ -21,6 +25,7 @@ from zerver.lib.user_groups import create_user_group
 from zerver.lib.test_classes import (
     ZulipTestCase,
 )
+from zerver.lib.test_helpers import queries_captured
 from zerver.lib.test_runner import slow
 from zerver.lib import mdiff
 from zerver.lib.tex import render_tex
@@ -45,6 +50,12 @@ from zerver.models import (
 import copy
 import mock
 import os
+import pickle
+import re
+import shutil
+import socket
+import tempfile
+import threading
 import ujson
 
 from typing import cast, Any, Dict, List, Optional, Set, Tuple
@@ -338,6 +349,8 @@ class BugdownTest(ZulipTestCase):
             bugdown.maybe_update_markdown_engines(realm.id, False)
             converted = bugdown.convert(msg, message_realm=realm)
             self.assertEqual(converted, '<p>Check out this file file:///Volumes/myserver/Users/Shared/pi.py</p>')
+        # All realms share the engine we just built without file links.
+        bugdown.clear_state_for_testing()
 
     def test_inline_bitcoin(self) -> None:
         msg = 'To bitcoin:1A1zP1eP5QGefi2DMPTfTL5SLmv7DivfNa or not to bitcoin'
@@ -517,14 +530,14 @@ class BugdownTest(ZulipTestCase):
     def test_inline_dropbox(self) -> None:
         msg = 'Look at how hilarious our old office was: https://www.dropbox.com/s/ymdijjcg67hv2ta/IMG_0923.JPG'
         image_info = {'image': 'https://photos-4.dropbox.com/t/2/AABIre1oReJgPYuc_53iv0IHq1vUzRaDg2rrCfTpiWMccQ/12/129/jpeg/1024x1024/2/_/0/4/IMG_0923.JPG/CIEBIAEgAiAHKAIoBw/ymdijjcg67hv2ta/AABz2uuED1ox3vpWWvMpBxu6a/IMG_0923.JPG', 'desc': 'Shared with Dropbox', 'title': 'IMG_0923.JPG'}
-        with mock.patch('zerver.lib.bugdown.fetch_open_graph_image', return_value=image_info):
+        with mock.patch('zerver.lib.bugdown.open_graph_image_from_cache', return_value=image_info):
             converted = bugdown_convert(msg)
 
         self.assertEqual(converted, '<p>Look at how hilarious our old office was: <a href="https://www.dropbox.com/s/ymdijjcg67hv2ta/IMG_0923.JPG" target="_blank" title="https://www.dropbox.com/s/ymdijjcg67hv2ta/IMG_0923.JPG">https://www.dropbox.com/s/ymdijjcg67hv2ta/IMG_0923.JPG</a></p>\n<div class="message_inline_image"><a href="https://www.dropbox.com/s/ymdijjcg67hv2ta/IMG_0923.JPG" target="_blank" title="IMG_0923.JPG"><img src="https://www.dropbox.com/s/ymdijjcg67hv2ta/IMG_0923.JPG?dl=1"></a></div>')
 
         msg = 'Look at my hilarious drawing folder: https://www.dropbox.com/sh/cm39k9e04z7fhim/AAAII5NK-9daee3FcF41anEua?dl='
         image_info = {'image': 'https://cf.dropboxstatic.com/static/images/icons128/folder_dropbox.png', 'desc': 'Shared with Dropbox', 'title': 'Saves'}
-        with mock.patch('zerver.lib.bugdown.fetch_open_graph_image', return_value=image_info):
+        with mock.patch('zerver.lib.bugdown.open_graph_image_from_cache', return_value=image_info):
             converted = bugdown_convert(msg)
 
         self.assertEqual(converted, '<p>Look at my hilarious drawing folder: <a href="https://www.dropbox.com/sh/cm39k9e04z7fhim/AAAII5NK-9daee3FcF41anEua?dl=" target="_blank" title="https://www.dropbox.com/sh/cm39k9e04z7fhim/AAAII5NK-9daee3FcF41anEua?dl=">https://www.dropbox.com/sh/cm39k9e04z7fhim/AAAII5NK-9daee3FcF41anEua?dl=</a></p>\n<div class="message_inline_ref"><a href="https://www.dropbox.com/sh/cm39k9e04z7fhim/AAAII5NK-9daee3FcF41anEua?dl=" target="_blank" title="Saves"><img src="https://cf.dropboxstatic.com/static/images/icons128/folder_dropbox.png"></a><div><div class="message_inline_image_title">Saves</div><desc class="message_inline_image_desc"></desc></div></div>')
@@ -533,7 +546,7 @@ class BugdownTest(ZulipTestCase):
         # Test photo album previews
         msg = 'https://www.dropbox.com/sc/tditp9nitko60n5/03rEiZldy5'
         image_info = {'image': 'https://photos-6.dropbox.com/t/2/AAAlawaeD61TyNewO5vVi-DGf2ZeuayfyHFdNTNzpGq-QA/12/271544745/jpeg/1024x1024/2/_/0/5/baby-piglet.jpg/CKnjvYEBIAIgBygCKAc/tditp9nitko60n5/AADX03VAIrQlTl28CtujDcMla/0', 'desc': 'Shared with Dropbox', 'title': '1 photo'}
-        with mock.patch('zerver.lib.bugdown.fetch_open_graph_image', return_value=image_info):
+        with mock.patch('zerver.lib.bugdown.open_graph_image_from_cache', return_value=image_info):
             converted = bugdown_convert(msg)
 
         self.assertEqual(converted, '<p><a href="https://www.dropbox.com/sc/tditp9nitko60n5/03rEiZldy5" target="_blank" title="https://www.dropbox.com/sc/tditp9nitko60n5/03rEiZldy5">https://www.dropbox.com/sc/tditp9nitko60n5/03rEiZldy5</a></p>\n<div class="message_inline_image"><a href="https://www.dropbox.com/sc/tditp9nitko60n5/03rEiZldy5" target="_blank" title="1 photo"><img src="https://photos-6.dropbox.com/t/2/AAAlawaeD61TyNewO5vVi-DGf2ZeuayfyHFdNTNzpGq-QA/12/271544745/jpeg/1024x1024/2/_/0/5/baby-piglet.jpg/CKnjvYEBIAIgBygCKAc/tditp9nitko60n5/AADX03VAIrQlTl28CtujDcMla/0"></a></div>')
@@ -541,7 +554,7 @@ class BugdownTest(ZulipTestCase):
     def test_inline_dropbox_negative(self) -> None:
         # Make sure we're not overzealous in our conversion:
         msg = 'Look at the new dropbox logo: https://www.dropbox.com/static/images/home_logo.png'
-        with mock.patch('zerver.lib.bugdown.fetch_open_graph_image', return_value=None):
+        with mock.patch('zerver.lib.bugdown.open_graph_image_from_cache', return_value=None):
             converted = bugdown_convert(msg)
 
         self.assertEqual(converted, '<p>Look at the new dropbox logo: <a href="https://www.dropbox.com/static/images/home_logo.png" target="_blank" title="https://www.dropbox.com/static/images/home_logo.png">https://www.dropbox.com/static/images/home_logo.png</a></p>\n<div class="message_inline_image"><a href="https://www.dropbox.com/static/images/home_logo.png" target="_blank" title="https://www.dropbox.com/static/images/home_logo.png"><img data-src-fullsize="/thumbnail?url=https%3A%2F%2Fwww.dropbox.com%2Fstatic%2Fimages%2Fhome_logo.png&amp;size=full" src="/thumbnail?url=https%3A%2F%2Fwww.dropbox.com%2Fstatic%2Fimages%2Fhome_logo.png&amp;size=thumbnail"></a></div>')
@@ -549,7 +562,7 @@ class BugdownTest(ZulipTestCase):
     def test_inline_dropbox_bad(self) -> None:
         # Don't fail on bad dropbox links
         msg = "https://zulip-test.dropbox.com/photos/cl/ROmr9K1XYtmpneM"
-        with mock.patch('zerver.lib.bugdown.fetch_open_graph_image', return_value=None):
+        with mock.patch('zerver.lib.bugdown.open_graph_image_from_cache', return_value=None):
             converted = bugdown_convert(msg)
         self.assertEqual(converted, '<p><a href="https://zulip-test.dropbox.com/photos/cl/ROmr9K1XYtmpneM" target="_blank" title="https://zulip-test.dropbox.com/photos/cl/ROmr9K1XYtmpneM">https://zulip-test.dropbox.com/photos/cl/ROmr9K1XYtmpneM</a></p>')
 
@@ -574,7 +587,8 @@ class BugdownTest(ZulipTestCase):
         self.assertEqual(bugdown.get_tweet_id('https://twitter.com/windyoona/status/410766290349879296/photo/1'), '410766290349879296')
         self.assertEqual(bugdown.get_tweet_id('https://twitter.com/windyoona/status/410766290349879296/'), '410766290349879296')
 
-    def test_inline_interesting_links(self) -> None:
+    @mock.patch('zerver.lib.bugdown.tweet_data_from_cache', side_effect=testing_mocks.twitter)
+    def test_inline_interesting_links(self, mock_tweet_data_from_cache: Any) -> None:
         def make_link(url: str) -> str:
             return '<a href="%s" target="_blank" title="%s">%s</a>' % (url, url, url)
 
@@ -698,6 +712,27 @@ class BugdownTest(ZulipTestCase):
         with self.settings(TEST_SUITE=False, TWITTER_CONSUMER_KEY=None):
             self.assertIs(None, bugdown.fetch_tweet_data('287977969287315459'))
 
+    def test_inline_previews_not_in_cache(self) -> None:
+        # Previews we haven't fetched yet are left out, and the links
+        # are queued for the FetchLinksEmbedData worker to fetch.
+        msg = ('http://twitter.com/wdaher/status/287977969287315456 '
+               'https://www.dropbox.com/sh/cm39k9e04z7fhim/AAAII5NK-9daee3FcF41anEua?dl=')
+        message = cast(Message, FakeMessage())
+        message.content = msg
+        message.id = 999
+        message.links_for_preview = set()
+        with mock.patch('zerver.lib.bugdown.fetch_tweet_data') as fetch_tweet_data, \
+                mock.patch('zerver.lib.bugdown.fetch_open_graph_image') as fetch_open_graph_image:
+            converted = bugdown.convert(msg, message_realm=get_realm('zulip'), message=message)
+        fetch_tweet_data.assert_not_called()
+        fetch_open_graph_image.assert_not_called()
+        self.assertNotIn('twitter-tweet', converted)
+        self.assertNotIn('message_inline_ref', converted)
+        self.assertEqual(message.links_for_preview, {
+            'http://twitter.com/wdaher/status/287977969287315456',
+            'https://www.dropbox.com/sh/cm39k9e04z7fhim/AAAII5NK-9daee3FcF41anEua?dl=',
+        })
+
     def test_content_has_emoji(self) -> None:
         self.assertFalse(bugdown.content_has_emoji_syntax('boring'))
         self.assertFalse(bugdown.content_has_emoji_syntax('hello: world'))
@@ -847,6 +882,31 @@ class BugdownTest(ZulipTestCase):
         self.assertEqual(zulip_filters[0],
                          (u'#(?P<id>[0-9]{2,8})', u'https://trac.zulip.net/ticket/%(id)s', realm_filter.id))
 
+    def test_md_engines_shared_between_realms(self) -> None:
+        zulip_realm = get_realm('zulip')
+        lear_realm = get_realm('lear')
+        RealmFilter(realm=zulip_realm, pattern=r"#(?P<id>[0-9]{2,8})",
+                    url_format_string=r"https://trac.zulip.net/ticket/%(id)s").save()
+        RealmFilter(realm=lear_realm, pattern=r"#(?P<id>[0-9]{2,8})",
+                    url_format_string=r"https://trac.lear.net/ticket/%(id)s").save()
+
+        zulip_engine = bugdown.get_md_engine(zulip_realm.id, False)
+        self.assertIs(bugdown.get_md_engine(lear_realm.id, False), zulip_engine)
+        self.assertEqual(len(bugdown.md_engines), 1)
+
+        # Each realm's filters are swapped in before rendering.
+        self.assertIn('trac.zulip.net', bugdown.convert('#123', message_realm=zulip_realm))
+        self.assertIn('trac.lear.net', bugdown.convert('#123', message_realm=lear_realm))
+        self.assertIn('trac.zulip.net', bugdown.convert('#123', message_realm=zulip_realm))
+        self.assertEqual(bugdown.convert('#123'), '<p>#123</p>')
+
+        # The least recently used realms' filters are evicted.
+        zephyr_realm = get_realm('zephyr')
+        with mock.patch('zerver.lib.bugdown.REALM_FILTER_CACHE_SIZE', 1):
+            bugdown.convert('#123', message_realm=zephyr_realm)
+        self.assertEqual(list(zulip_engine.realm_filter_patterns.keys()), [zephyr_realm.id])
+        self.assertIn('trac.zulip.net', bugdown.convert('#123', message_realm=zulip_realm))
+
     def test_flush_realm_filter(self) -> None:
         realm = get_realm('zulip')
 
@@ -893,6 +953,48 @@ class BugdownTest(ZulipTestCase):
         converted_boring_topic = bugdown.topic_links(realm.id, boring_msg.topic_name())
         self.assertEqual(converted_boring_topic, [])
 
+    def test_realm_filter_matchers(self) -> None:
+        realm = get_realm('zulip')
+        RealmFilter(realm=realm, pattern=r"#(?P<id>[0-9]{2,8})",
+                    url_format_string=r"https://trac.zulip.net/ticket/%(id)s").save()
+        RealmFilter(realm=realm, pattern=r"(?P<project>[A-Z]+)-(?P<id>[0-9]+)",
+                    url_format_string=r"https://jira.example.com/%(project)s/%(id)s").save()
+        flush_per_request_caches()
+
+        # All of the realm's filters share one regex, even though they
+        # use the same group names.
+        realm_filters = realm_filters_for_realm(realm.id)
+        matchers = bugdown.get_realm_filter_matchers(realm.id, realm_filters)
+        self.assertEqual(len(matchers), 1)
+        self.assertIs(bugdown.get_realm_filter_matchers(realm.id, realm_filters), matchers)
+
+        self.assertEqual(bugdown.topic_links(realm.id, 'ZUL-12 and #34'),
+                         ['https://trac.zulip.net/ticket/34',
+                          'https://jira.example.com/ZUL/12'])
+        # Markdown wraps the regex in groups of its own, so the match
+        # is found through the filter groups, not m.lastgroup.
+        pattern = bugdown.RealmFilterPattern(matchers[0])
+        m = pattern.getCompiledRegExp().match('See ZUL-12 today')
+        self.assertEqual(matchers[0].get_match(m),
+                         (1, 'https://jira.example.com/ZUL/12', 'ZUL-12'))
+
+        msg = Message(sender=self.example_user('othello'))
+        converted = bugdown.convert('See ZUL-12 and #34', message_realm=realm, message=msg)
+        self.assertEqual(converted, '<p>See <a href="https://jira.example.com/ZUL/12" target="_blank" title="https://jira.example.com/ZUL/12">ZUL-12</a> and <a href="https://trac.zulip.net/ticket/34" target="_blank" title="https://trac.zulip.net/ticket/34">#34</a></p>')
+
+        # Changing the filters throws away the cached matchers.
+        RealmFilter(realm=realm, pattern=r"PR(?P<id>[0-9]+)",
+                    url_format_string=r"https://github.com/zulip/zulip/pull/%(id)s").save()
+        self.assertNotIn(realm.id, bugdown.realm_filter_matchers)
+        self.assertEqual(bugdown.topic_links(realm.id, 'PR12'),
+                         ['https://github.com/zulip/zulip/pull/12'])
+
+        # If the filters can't be combined, we match them one at a time.
+        with mock.patch('zerver.lib.bugdown.RealmFilterMatcher.__init__',
+                        side_effect=[re.error("error"), None]) as mock_init:
+            bugdown.make_realm_filter_matchers([('a', 'b', 1)])
+        self.assertEqual(mock_init.call_count, 2)
+
     def test_is_status_message(self) -> None:
         user_profile = self.example_user('othello')
         msg = Message(sender=user_profile, sending_client=get_client("test"))
@@ -942,6 +1044,113 @@ class BugdownTest(ZulipTestCase):
         self.assertEqual(render(msg, content), "<p>We have a NOTHINGWORD day today!</p>")
         self.assertEqual(msg.user_ids_with_alert_words, set())
 
+    def test_render_cache(self) -> None:
+        user_profile = self.example_user('othello')
+        hamlet = self.example_user('hamlet')
+        do_set_alert_words(user_profile, ["alertword"])
+        realm_alert_words_automaton = get_alert_word_automaton(user_profile.realm)
+
+        def render(content: str) -> Tuple[Message, str]:
+            msg = Message(sender=user_profile, sending_client=get_client("test"))
+            rendered_content = render_markdown(msg,
+                                               content,
+                                               realm_alert_words_automaton=realm_alert_words_automaton,
+                                               user_ids={user_profile.id})
+            return (msg, rendered_content)
+
+        content = "@**King Hamlet** has an alertword day"
+        expected = ('<p><span class="user-mention" data-user-id="%s">'
+                    '@King Hamlet</span> has an alertword day</p>' % (hamlet.id,))
+        with mock.patch('zerver.lib.bugdown.timeout', wraps=bugdown.timeout) as m:
+            for i in range(2):
+                (msg, rendered_content) = render(content)
+                self.assertEqual(rendered_content, expected)
+                self.assertEqual(msg.mentions_user_ids, {hamlet.id})
+                self.assertEqual(msg.user_ids_with_alert_words, {user_profile.id})
+            self.assertEqual(m.call_count, 1)
+
+        # Alert words aren't part of the key, but are still checked
+        # on a cache hit.
+        do_set_alert_words(user_profile, [])
+        realm_alert_words_automaton = get_alert_word_automaton(user_profile.realm)
+        with mock.patch('zerver.lib.bugdown.timeout', wraps=bugdown.timeout) as m:
+            (msg, rendered_content) = render(content)
+            self.assertEqual(rendered_content, expected)
+            self.assertEqual(msg.user_ids_with_alert_words, set())
+            self.assertEqual(m.call_count, 0)
+
+        # Changing the mentioned user changes the key.
+        do_change_full_name(hamlet, "Prince Hamlet", acting_user=None)
+        with mock.patch('zerver.lib.bugdown.timeout', wraps=bugdown.timeout) as m:
+            (msg, rendered_content) = render(content)
+            self.assertEqual(rendered_content, "<p>@**King Hamlet** has an alertword day</p>")
+            self.assertEqual(msg.mentions_user_ids, set())
+            self.assertEqual(m.call_count, 1)
+
+        # Messages that might embed previews are never cached.
+        content = "Look at http://example.com/image.png"
+        with mock.patch('zerver.lib.bugdown.timeout', wraps=bugdown.timeout) as m:
+            render(content)
+            render(content)
+            self.assertEqual(m.call_count, 2)
+
+    @override_settings(INLINE_IMAGE_PREVIEW=False, INLINE_URL_EMBED_PREVIEW=False)
+    def test_render_cache_tweet_preview(self) -> None:
+        user_profile = self.example_user('othello')
+        tweet_id = '287977969287315456'
+        content = 'http://twitter.com/wdaher/status/%s' % (tweet_id,)
+
+        def render() -> Tuple[Message, str]:
+            msg = Message(sender=user_profile, sending_client=get_client("test"))
+            return (msg, render_markdown(msg, content))
+
+        # The tweet isn't cached yet, so the first rendering (which
+        # queues the link) has no preview, and isn't cached either.
+        (msg, rendered_content) = render()
+        self.assertNotIn('twitter-tweet', rendered_content)
+        self.assertEqual(msg.links_for_preview, {content})
+
+        # Once the FetchLinksEmbedData worker has fetched the tweet,
+        # rendering the message again embeds it.
+        cache_preview_data(tweet_data_cache_key(tweet_id), testing_mocks.twitter(tweet_id))
+        (msg, rendered_content) = render()
+        self.assertIn('twitter-tweet', rendered_content)
+
+        # And the rendering with the preview isn't cached either.
+        with mock.patch('zerver.lib.bugdown.timeout', wraps=bugdown.timeout) as m:
+            render()
+            self.assertEqual(m.call_count, 1)
+
+    def test_render_markdown_batch(self) -> None:
+        othello = self.example_user('othello')
+        hamlet = self.example_user('hamlet')
+        cordelia = self.example_user('cordelia')
+        contents = [
+            "@**King Hamlet** !avatar(%s)" % (hamlet.email,),
+            "@**Cordelia Lear** on #**Denmark**",
+            "@*hamletcharacters* :green_tick:",
+        ]
+        create_user_group('hamletcharacters', [hamlet, cordelia], get_realm('zulip'))
+
+        def make_message() -> Message:
+            return Message(sender=othello, sending_client=get_client("test"))
+
+        expected = [render_markdown(make_message(), content) for content in contents]
+
+        with queries_captured() as single_queries:
+            for content in contents:
+                render_markdown(make_message(), content)
+
+        messages = [make_message() for content in contents]
+        with queries_captured() as batch_queries:
+            rendered = render_markdown_batch([dict(message=message, content=content)
+                                              for (message, content) in zip(messages, contents)])
+        self.assertEqual(rendered, expected)
+        self.assertEqual(messages[0].mentions_user_ids, {hamlet.id})
+        self.assertEqual(messages[1].mentions_user_ids, {cordelia.id})
+        self.assertEqual(len(messages[2].mentions_user_group_ids), 1)
+        self.assertLess(len(batch_queries), len(single_queries))
+
     def test_alert_words_returns_user_ids_with_alert_words(self) -> None:
         alert_words_for_users = {
             'hamlet': ['how'], 'cordelia': ['this possible'],
@@ -1690,6 +1899,129 @@ class BugdownErrorTests(ZulipTestCase):
                 bugdown_convert(msg)
 
 
+class BugdownRenderServerTest(ZulipTestCase):
+    def test_render_job_pickling(self) -> None:
+        hamlet = self.example_user('hamlet')
+        do_set_alert_words(hamlet, ["alertword"])
+        msg = Message(sender=self.example_user('othello'), sending_client=get_client("test"))
+        user_group = create_user_group('support', [hamlet], hamlet.realm)
+        job = bugdown.make_render_job(
+            "alertword @*support*", message=msg,
+            realm_alert_words_automaton=get_alert_word_automaton(hamlet.realm))
+
+        # The render server gets neither the alert words automaton nor
+        # any model objects...
+        sent_job = pickle.loads(pickle.dumps(job))
+        self.assertIsNone(sent_job.realm_alert_words_automaton)
+        self.assertEqual(sent_job.db_data['mention_data'].get_user_group('support'),
+                         dict(id=user_group.id, name='support'))
+
+        # ... and the alert words are found in this process.
+        result = bugdown.render_job(sent_job)
+        self.assertEqual(result.user_ids_with_alert_words, set())
+        bugdown.find_alert_words(job, result)
+        self.assertEqual(result.user_ids_with_alert_words, {hamlet.id})
+        self.assertEqual(result.mentions_user_group_ids, {user_group.id})
+
+    def test_handle_connection(self) -> None:
+        hamlet = self.example_user('hamlet')
+        msg = Message(sender=self.example_user('othello'), sending_client=get_client("test"))
+        job = bugdown.make_render_job("@**King Hamlet**", message=msg)
+
+        def handle(job: bugdown.RenderJob) -> Tuple[str, Any]:
+            (client_sock, server_sock) = socket.socketpair()
+            with client_sock, server_sock:
+                client_sock.sendall(render_server.encode_message(job))
+                render_server.handle_connection(server_sock, cpu_limit=5)
+                return render_server.recv_message(client_sock)
+
+        (status, result) = handle(job)
+        self.assertEqual(status, 'ok')
+        self.assertEqual(result.rendered_content,
+                         '<p><span class="user-mention" data-user-id="%s">'
+                         '@King Hamlet</span></p>' % (hamlet.id,))
+        self.assertEqual(result.mentions_user_ids, {hamlet.id})
+
+        with mock.patch('zerver.lib.bugdown.render_server.render_job', side_effect=KeyError('foo')):
+            (status, traceback_text) = handle(job)
+        self.assertEqual(status, 'error')
+        self.assertIn("KeyError: 'foo'", traceback_text)
+
+    def test_render_remote(self) -> None:
+        socket_dir = tempfile.mkdtemp()
+        socket_path = os.path.join(socket_dir, 'render_server.sock')
+        msg = Message(sender=self.example_user('othello'), sending_client=get_client("test"))
+        content = "**hello**"
+
+        with self.settings(BUGDOWN_RENDER_SERVER_SOCKET=socket_path):
+            # If the render server isn't running, we render locally.
+            with mock.patch('zerver.lib.bugdown.render_server.logger') as mock_logger:
+                self.assertEqual(render_markdown(msg, content), '<p><strong>hello</strong></p>')
+            mock_logger.warning.assert_called_once()
+
+            listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            listener.bind(socket_path)
+            listener.listen(5)
+
+            def serve_one(reply: Optional[Tuple[str, Any]]) -> None:
+                (conn, address) = listener.accept()
+                with conn:
+                    render_server.recv_message(conn)
+                    if reply is not None:
+                        conn.sendall(render_server.encode_message(reply))
+
+            result = bugdown.RenderResult()
+            result.rendered_content = '<p>from the render server</p>'
+            thread = threading.Thread(target=serve_one, args=(('ok', result),))
+            thread.start()
+            self.assertEqual(render_markdown(msg, content), '<p>from the render server</p>')
+            thread.join()
+
+            # A render server process that dies while rendering (e.g. by
+            # exceeding its CPU time limit) fails the render.
+            thread = threading.Thread(target=serve_one, args=(None,))
+            thread.start()
+            with mock.patch('zerver.lib.bugdown.bugdown_logger'):
+                with self.assertRaises(BugdownRenderingException):
+                    render_markdown(msg, content)
+            thread.join()
+            listener.close()
+        shutil.rmtree(socket_dir)
+
+    def test_render_remote_big_batch(self) -> None:
+        socket_dir = tempfile.mkdtemp()
+        socket_path = os.path.join(socket_dir, 'render_server.sock')
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(socket_path)
+        listener.listen(1)
+
+        def serve(num_jobs: int) -> None:
+            for i in range(num_jobs):
+                (conn, address) = listener.accept()
+                with conn:
+                    job = render_server.recv_message(conn)
+                    conn.sendall(render_server.encode_message(('ok', job)))
+
+        # A batch bigger than the server's listen backlog is sent a
+        # few jobs at a time, rather than blocking on connecting.
+        thread = threading.Thread(target=serve, args=(10,))
+        thread.start()
+        with self.settings(BUGDOWN_RENDER_SERVER_SOCKET=socket_path), \
+                mock.patch('zerver.lib.bugdown.render_server.RENDER_SERVER_MAX_CONNECTIONS', 3):
+            self.assertEqual(render_server.render_remote(list(range(10))), list(range(10)))
+        thread.join()
+        listener.close()
+        shutil.rmtree(socket_dir)
+
+        # A worker doesn't wait forever for a client that never sends
+        # its job.
+        (client_sock, server_sock) = socket.socketpair()
+        with client_sock, server_sock:
+            with mock.patch('zerver.lib.bugdown.render_server.RENDER_SERVER_IDLE_TIMEOUT', 0.01), \
+                    mock.patch('zerver.lib.bugdown.render_server.render_job') as mock_render_job:
+                render_server.handle_connection(server_sock, cpu_limit=5)
+            mock_render_job.assert_not_called()
+
 class BugdownAvatarTestCase(ZulipTestCase):
     def test_possible_avatar_emails(self) -> None:
         content = '''
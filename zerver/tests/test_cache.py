@@ -1,7 +1,21 @@
+from django.test import override_settings
+from django.utils.timezone import now as timezone_now
 from mock import Mock, patch
+import time
+import ujson
 
+from analytics.models import RealmCount
 from zerver.apps import flush_cache
+from zerver.lib import cache
+from zerver.lib.actions import do_add_realm_filter
+from zerver.lib.local_cache import INVALIDATION_CHANNEL, local_cache
+from zerver.lib.cache import active_user_ids_cache_key, realm_user_dicts_cache_key, \
+    user_profile_cache_key
+from zerver.lib.cache_helpers import fill_remote_caches, get_cache_fill_tasks
 from zerver.lib.test_classes import ZulipTestCase
+from zerver.lib.test_helpers import queries_captured
+from zerver.models import UserProfile, active_user_ids, get_realm, \
+    get_realm_filters_cache_key, get_realm_user_dicts, realm_filters_for_realm_remote_cache
 
 class AppsTest(ZulipTestCase):
     def test_cache_gets_flushed(self) -> None:
@@ -11,3 +25,139 @@ class AppsTest(ZulipTestCase):
                 flush_cache(Mock())
                 mock.assert_called_once()
             mock_logging.assert_called_once()
+
+class LocalCacheTest(ZulipTestCase):
+    @override_settings(LOCAL_CACHE_MAX_ENTRIES=10)
+    def test_local_cache(self) -> None:
+        realm = get_realm('zulip')
+        key = cache.KEY_PREFIX + get_realm_filters_cache_key(realm.id)
+
+        # Pretend that we're subscribed to invalidations.
+        with patch.object(local_cache, 'start_listener'), \
+                patch('zerver.lib.local_cache.redis_client') as mock_redis_client:
+            local_cache.subscribed.set()
+            try:
+                # The first read fills the remote cache, and the second
+                # copies the value from there to the local cache.
+                cache.cache_delete(get_realm_filters_cache_key(realm.id))
+                filters = realm_filters_for_realm_remote_cache(realm.id)
+                self.assertEqual(realm_filters_for_realm_remote_cache(realm.id), filters)
+                with patch('zerver.lib.cache.cache_get') as mock_cache_get:
+                    self.assertEqual(realm_filters_for_realm_remote_cache(realm.id), filters)
+                mock_cache_get.assert_not_called()
+                self.assertEqual(local_cache.get_stats()['all_realm_filters']['hit'], 1)
+
+                # Changing the realm's filters drops the key from our
+                # local cache, and everyone else's.
+                do_add_realm_filter(realm, "#(?P<id>[123])",
+                                    "https://realm.com/my_realm_filter/%(id)s")
+                mock_redis_client.publish.assert_called_with(INVALIDATION_CHANNEL,
+                                                             ujson.dumps([key]))
+                self.assertEqual(len(realm_filters_for_realm_remote_cache(realm.id)),
+                                 len(filters) + 1)
+                realm_filters_for_realm_remote_cache(realm.id)
+
+                # An invalidation from another process.
+                self.assertIn(key, local_cache.entries)
+                local_cache.delete_many([key])
+                self.assertNotIn(key, local_cache.entries)
+            finally:
+                local_cache.subscribed.clear()
+                local_cache.clear()
+
+class SingleFlightTest(ZulipTestCase):
+    def test_waits_for_lock_holder(self) -> None:
+        realm = get_realm('zulip')
+        key = active_user_ids_cache_key(realm.id)
+        cache.cache_delete(key)
+
+        # Someone else is recomputing the value; we wait for them,
+        # rather than query for it too.
+        self.assertTrue(cache.acquire_recompute_lock(key))
+
+        def finish_recompute(seconds: float) -> None:
+            cache.cache_set(key, [1, 2, 3])
+
+        with patch('zerver.lib.cache.time.sleep', side_effect=finish_recompute), \
+                queries_captured() as queries:
+            self.assertEqual(active_user_ids(realm.id), [1, 2, 3])
+        self.assertEqual(len(queries), 0)
+        cache.release_recompute_locks([key])
+
+        # Without the lock, we recompute the value ourselves.
+        cache.cache_delete(key)
+        with queries_captured() as queries:
+            user_ids = active_user_ids(realm.id)
+        self.assertEqual(len(queries), 1)
+        self.assertIn(self.example_user('hamlet').id, user_ids)
+        # ... and released the lock afterwards.
+        self.assertTrue(cache.acquire_recompute_lock(key))
+
+        # If the lock holder gives up without caching anything, we
+        # stop waiting as soon as the lock is released.
+        cache.cache_delete(key)
+
+        def fail_recompute(seconds: float) -> None:
+            cache.release_recompute_locks([key])
+
+        with patch('zerver.lib.cache.time.sleep', side_effect=fail_recompute) as mock_sleep, \
+                queries_captured() as queries:
+            user_ids = active_user_ids(realm.id)
+        self.assertEqual(mock_sleep.call_count, 1)
+        self.assertEqual(len(queries), 1)
+        self.assertIn(self.example_user('hamlet').id, user_ids)
+
+    def test_serve_stale(self) -> None:
+        realm = get_realm('zulip')
+        key = realm_user_dicts_cache_key(realm.id)
+        user_dicts = list(get_realm_user_dicts(realm.id))
+
+        # While someone recomputes a flushed value, we get the old one.
+        cache.cache_delete(key)
+        self.assertTrue(cache.acquire_recompute_lock(key))
+        with queries_captured() as queries:
+            self.assertEqual(list(get_realm_user_dicts(realm.id)), user_dicts)
+        self.assertEqual(len(queries), 0)
+        cache.release_recompute_locks([key])
+
+    def test_early_refresh(self) -> None:
+        realm = get_realm('zulip')
+        key = active_user_ids_cache_key(realm.id)
+
+        # A value that's about to expire is recomputed...
+        cache.get_cache_backend(None).set(cache.KEY_PREFIX + key, ([1, 2, 3], (time.time(), 1.0)))
+        with queries_captured() as queries:
+            user_ids = active_user_ids(realm.id)
+        self.assertEqual(len(queries), 1)
+        self.assertIn(self.example_user('hamlet').id, user_ids)
+
+        # ... unless someone else is already doing so.
+        cache.get_cache_backend(None).set(cache.KEY_PREFIX + key, ([1, 2, 3], (time.time(), 1.0)))
+        self.assertTrue(cache.acquire_recompute_lock(key))
+        with queries_captured() as queries:
+            self.assertEqual(active_user_ids(realm.id), [1, 2, 3])
+        self.assertEqual(len(queries), 0)
+        cache.release_recompute_locks([key])
+
+class CacheWarmupTest(ZulipTestCase):
+    def test_fill_remote_caches(self) -> None:
+        zulip = get_realm('zulip')
+        lear = get_realm('lear')
+        for (realm, actives) in [(zulip, 10), (lear, 20)]:
+            RealmCount.objects.create(realm=realm, property='1day_actives::day',
+                                      end_time=timezone_now(), value=actives)
+
+        # Caches that aren't per-realm come first, and then the most
+        # active realms.
+        self.assertEqual(get_cache_fill_tasks(['user', 'client']),
+                         [('client', None), ('user', lear.id), ('user', zulip.id)])
+
+        hamlet = self.example_user('hamlet')
+        key = user_profile_cache_key(hamlet.email, zulip)
+        cache.cache_delete(key)
+        results = list(fill_remote_caches(['user']))
+        self.assertEqual([task for (task, count, num_tasks) in results],
+                         [('user', lear.id), ('user', zulip.id)])
+        self.assertEqual(results[1][1], UserProfile.objects.filter(
+            realm=zulip, long_term_idle=False).count())
+        self.assertEqual(cache.cache_get(key)[0].id, hamlet.id)
@@ -1,4 +1,5 @@
 import mock
+import os
 import time
 import ujson
 
@@ -8,10 +9,18 @@ from typing import Any, Callable, Dict, Tuple
 from zerver.lib.actions import do_mute_topic, do_change_subscription_property
 from zerver.lib.test_classes import ZulipTestCase
 from zerver.lib.test_helpers import POSTRequestMock
-from zerver.models import Recipient, Stream, Subscription, UserProfile, get_stream
+from zerver.models import Recipient, Stream, Subscription, UserProfile, get_realm, get_stream
+from zerver.tornado import event_queue
 from zerver.tornado.event_queue import maybe_enqueue_notifications, \
-    allocate_client_descriptor, \
-    get_client_descriptor, missedmessage_hook, persistent_queue_filename
+    allocate_client_descriptor, clear_client_event_queues_for_testing, \
+    gc_event_queues, get_client_descriptor, get_client_descriptors_for_user, \
+    process_notification, load_event_queues, \
+    missedmessage_hook, persist_event_queues, persistent_queue_filename, \
+    persistent_queue_store_filename
+from zerver.tornado.event_queue_store import EventQueueStore
+from zerver.tornado.sharding import get_hash_ring, get_hash_ring_port, \
+    get_nginx_shard_map, get_tornado_port, get_tornado_uri, \
+    notify_tornado_queue_name, realm_hash_key, write_nginx_shard_map, write_shard_map
 from zerver.tornado.views import get_events
 
 class MissedMessageNotificationsTest(ZulipTestCase):
@@ -333,3 +342,211 @@ class FileReloadLogicTest(ZulipTestCase):
                              "/home/zulip/tornado/event_queues.9993.json")
             self.assertEqual(persistent_queue_filename(9993, last=True),
                              "/home/zulip/tornado/event_queues.9993.last.json")
+
+    def test_persistent_queue_store_filename(self) -> None:
+        with self.settings(EVENT_QUEUE_STORE_FILENAME_PATTERN="/home/zulip/tornado/event_queues%s.sqlite3"):
+            self.assertEqual(persistent_queue_store_filename(9993),
+                             "/home/zulip/tornado/event_queues.sqlite3")
+        with self.settings(EVENT_QUEUE_STORE_FILENAME_PATTERN="/home/zulip/tornado/event_queues%s.sqlite3",
+                           TORNADO_PROCESSES=4):
+            self.assertEqual(persistent_queue_store_filename(9993),
+                             "/home/zulip/tornado/event_queues.9993.sqlite3")
+
+    def test_persist_and_load_event_queues(self) -> None:
+        user_profile = self.example_user('hamlet')
+        store_filename_pattern = "/tmp/test-event-queues-%d%%s.sqlite3" % (os.getpid(),)
+        store_filename = store_filename_pattern % ('',)
+        event_queue.event_queue_store = EventQueueStore(store_filename)
+        try:
+            client = allocate_client_descriptor(
+                dict(user_profile_id=user_profile.id,
+                     user_profile_email=user_profile.email,
+                     realm_id=user_profile.realm_id,
+                     event_types=None,
+                     client_type_name="website",
+                     apply_markdown=True,
+                     client_gravatar=True,
+                     all_public_streams=False,
+                     queue_timeout=600,
+                     last_connection_time=time.time(),
+                     narrow=[]))
+            queue_id = client.event_queue.id
+            client.add_event(dict(type="pointer", pointer=5))
+            client.add_event(dict(type="stream", op="create"))
+            persist_event_queues(9993)
+            self.assertEqual(event_queue.dirty_queue_ids, set())
+
+            # Only changed queues are written.
+            with mock.patch.object(event_queue.event_queue_store, 'save') as mock_save:
+                persist_event_queues(9993)
+            mock_save.assert_called_once_with([], [], [], set())
+
+            # Later writes only add the events queued since the last
+            # one, and delete the acknowledged ones.
+            store = event_queue.event_queue_store
+            client.add_event(dict(type="stream", op="delete"))
+            client.event_queue.prune(1)
+            with mock.patch.object(store, 'save', wraps=store.save) as mock_save:
+                persist_event_queues(9993)
+            (descriptor_rows, new_event_rows, pruned_rows, removed_queue_ids) = mock_save.call_args[0]
+            self.assertEqual([row[:2] for row in new_event_rows], [(queue_id, 2)])
+            self.assertEqual(pruned_rows, [(queue_id, 1)])
+            self.assertEqual([event["op"] for event in store.load_queue(queue_id)], ["delete"])
+
+            event_queue.event_queue_store.close()
+            clear_client_event_queues_for_testing()
+            with self.settings(EVENT_QUEUE_STORE_FILENAME_PATTERN=store_filename_pattern,
+                               JSON_PERSISTENT_QUEUE_FILENAME_PATTERN="/tmp/nonexistent-event-queues%s.json",
+                               TORNADO_PROCESSES=1):
+                load_event_queues(9993)
+
+            restored = get_client_descriptor(queue_id)
+            self.assertEqual(restored.user_profile_id, user_profile.id)
+            # The events themselves are loaded lazily.
+            self.assertFalse(restored.event_queue.events_loaded())
+            self.assertEqual([event["type"] for event in restored.event_queue.contents()],
+                             ["pointer", "stream"])
+            self.assertTrue(restored.event_queue.events_loaded())
+
+            restored.cleanup()
+            persist_event_queues(9993)
+            self.assertIsNone(event_queue.event_queue_store.load_queue(queue_id))
+        finally:
+            event_queue.event_queue_store.close()
+            event_queue.event_queue_store = None
+            os.remove(store_filename)
+
+class TornadoShardingTest(ZulipTestCase):
+    def test_single_process(self) -> None:
+        realm = get_realm("zulip")
+        with self.settings(TORNADO_SERVER="http://127.0.0.1:9983", TORNADO_PROCESSES=1):
+            self.assertEqual(get_tornado_port(realm), 9983)
+            self.assertEqual(get_tornado_uri(realm), "http://127.0.0.1:9983")
+            self.assertEqual(notify_tornado_queue_name(9983), "notify_tornado")
+
+    def test_hash_ring(self) -> None:
+        ports = (9800, 9801, 9802, 9803)
+        # Like nginx's `hash ... consistent`, 160 points per server.
+        (points, ring_ports) = get_hash_ring(ports)
+        self.assertEqual(len(points), 160 * len(ports))
+        self.assertEqual(points, sorted(points))
+
+        assignments = {host: get_hash_ring_port(host, ports)
+                       for host in ["realm%d.zulip.example.com" % (i,) for i in range(200)]}
+        # Every shard gets some realms.
+        self.assertEqual(set(assignments.values()), set(ports))
+
+        # Adding a shard only moves realms onto the new shard.
+        new_ports = ports + (9804,)
+        for string_id, port in assignments.items():
+            new_port = get_hash_ring_port(string_id, new_ports)
+            self.assertIn(new_port, {port, 9804})
+
+    def test_pinned_realm(self) -> None:
+        realm = get_realm("zulip")
+        ports = (9800, 9801, 9802, 9803)
+        shard_map_path = "/tmp/test-tornado-sharding-%d.json" % (os.getpid(),)
+        nginx_conf_path = "/tmp/test-tornado-nginx-sharding-%d.conf" % (os.getpid(),)
+        with self.settings(TORNADO_SERVER="http://127.0.0.1:9993", TORNADO_PROCESSES=4,
+                           TORNADO_SHARDING_MAP_PATH=shard_map_path,
+                           TORNADO_NGINX_SHARDING_CONF_PATH=nginx_conf_path):
+            # Realms are hashed by their hostname, which is what nginx
+            # hashes requests by.
+            self.assertEqual(realm_hash_key(realm), realm.host.split(":")[0])
+            hashed_port = get_hash_ring_port(realm_hash_key(realm), ports)
+            self.assertEqual(get_tornado_port(realm), hashed_port)
+            self.assertEqual(get_nginx_shard_map(), [])
+
+            pinned_port = [port for port in ports if port != hashed_port][0]
+            write_shard_map({"zulip": pinned_port})
+            self.assertEqual(get_tornado_port(realm), pinned_port)
+            self.assertEqual(get_tornado_uri(realm), "http://127.0.0.1:%d" % (pinned_port,))
+            self.assertEqual(notify_tornado_queue_name(9802), "notify_tornado_port_9802")
+
+            # Only realms pinned away from their hashed port need an
+            # entry in nginx's map.
+            write_nginx_shard_map()
+            with open(nginx_conf_path) as f:
+                self.assertEqual(f.read(), "%s tornado_%d;\n" % (realm_hash_key(realm), pinned_port))
+            write_shard_map({"zulip": hashed_port})
+            self.assertEqual(get_nginx_shard_map(), [])
+
+            # Pins to ports that don't exist are ignored.
+            write_shard_map({"zulip": 9900})
+            self.assertEqual(get_tornado_port(realm), hashed_port)
+        os.remove(shard_map_path)
+        os.remove(nginx_conf_path)
+
+    def test_drain_realm(self) -> None:
+        user_profile = self.example_user("hamlet")
+        client = allocate_client_descriptor(
+            dict(user_profile_id=user_profile.id,
+                 user_profile_email=user_profile.email,
+                 realm_id=user_profile.realm_id,
+                 event_types=None,
+                 client_type_name="website",
+                 apply_markdown=True,
+                 client_gravatar=True,
+                 all_public_streams=False,
+                 queue_timeout=600,
+                 last_connection_time=time.time(),
+                 narrow=[]))
+        queue_id = client.event_queue.id
+        self.assertEqual(get_client_descriptor(queue_id), client)
+
+        process_notification(dict(event=dict(type="drain_realm",
+                                              realm_id=user_profile.realm_id + 1),
+                                  users=[]))
+        self.assertEqual(get_client_descriptor(queue_id), client)
+
+        process_notification(dict(event=dict(type="drain_realm",
+                                              realm_id=user_profile.realm_id),
+                                  users=[]))
+        self.assertIsNone(get_client_descriptor(queue_id))
+
+class EventQueueGCTest(ZulipTestCase):
+    def allocate_client(self, user_profile: UserProfile, queue_timeout: int,
+                        last_connection_time: float) -> Any:
+        return allocate_client_descriptor(
+            dict(user_profile_id=user_profile.id,
+                 user_profile_email=user_profile.email,
+                 realm_id=user_profile.realm_id,
+                 event_types=None,
+                 client_type_name="website",
+                 apply_markdown=True,
+                 client_gravatar=True,
+                 all_public_streams=True,
+                 queue_timeout=queue_timeout,
+                 last_connection_time=last_connection_time,
+                 narrow=[]))
+
+    def test_gc_event_queues(self) -> None:
+        user_profile = self.example_user("hamlet")
+        now = time.time()
+        expired_client = self.allocate_client(user_profile, 600, now - 601)
+        active_client = self.allocate_client(user_profile, 600, now - 10)
+        reconnected_client = self.allocate_client(user_profile, 600, now - 601)
+        # Reconnecting pushes back the expiry time without updating
+        # the client's entry in the expiry heap.
+        reconnected_client.last_connection_time = now - 5
+
+        with mock.patch("zerver.tornado.event_queue.statsd") as mock_statsd:
+            gc_event_queues(9993)
+        mock_statsd.timing.assert_called_once()
+        self.assertEqual(mock_statsd.timing.call_args[0][0], 'tornado.gc_event_queues')
+
+        self.assertIsNone(get_client_descriptor(expired_client.event_queue.id))
+        self.assertEqual(set(get_client_descriptors_for_user(user_profile.id)),
+                         {active_client, reconnected_client})
+        self.assertEqual(set(event_queue.realm_clients_all_streams[user_profile.realm_id].values()),
+                         {active_client, reconnected_client})
+        self.assertEqual(sorted(id for (_, id) in event_queue.expiry_heap),
+                         sorted([active_client.event_queue.id, reconnected_client.event_queue.id]))
+
+        with mock.patch("time.time", return_value=now + 600):
+            gc_event_queues(9993)
+        self.assertIsNone(get_client_descriptor(active_client.event_queue.id))
+        self.assertIsNone(get_client_descriptor(reconnected_client.event_queue.id))
+        self.assertEqual(get_client_descriptors_for_user(user_profile.id), [])
+        self.assertNotIn(user_profile.realm_id, event_queue.realm_clients_all_streams)
+        self.assertEqual(event_queue.expiry_heap, [])
@@ -8,7 +8,7 @@ import sys
 
 from django.conf import settings
 from django.http import HttpRequest, HttpResponse
-from django.test import TestCase
+from django.test import TestCase, override_settings
 from django.utils.timezone import now as timezone_now
 from io import StringIO
 
@@ -58,6 +58,7 @@ from zerver.lib.actions import (
     do_deactivate_user,
     do_delete_messages,
     do_invite_users,
+    do_mark_all_as_read,
     do_mark_hotspot_as_read,
     do_mute_topic,
     do_reactivate_user,
@@ -138,6 +139,7 @@ from zerver.tornado.event_queue import (
     get_client_info_for_message_event,
     process_message_event,
     EventQueue,
+    QueuedMessageEvent,
 )
 from zerver.tornado.views import get_events
 
@@ -2790,6 +2792,94 @@ class GetUnreadMsgsTest(ZulipTestCase):
             dict(sender_id=cordelia.id),
         )
 
+    @override_settings(ENABLE_UNREAD_INDEX=True)
+    def test_raw_unread_index(self) -> None:
+        cordelia = self.example_user('cordelia')
+        hamlet = self.example_user('hamlet')
+        client = get_client('website')
+        self.subscribe(hamlet, 'Denmark')
+        do_mark_all_as_read(hamlet, client)
+
+        def get_unread_message_ids() -> Set[int]:
+            raw_unread_data = get_raw_unread_data(hamlet)
+            return set(raw_unread_data['stream_dict']) | set(raw_unread_data['pm_dict'])
+
+        stream_message_ids = [
+            self.send_stream_message(cordelia.email, 'Denmark', topic_name='lunch')
+            for i in range(3)
+        ]
+        pm_message_id = self.send_personal_message(cordelia.email, hamlet.email)
+        self.assertEqual(get_unread_message_ids(), set(stream_message_ids) | {pm_message_id})
+
+        # Messages sent since the last read are picked up from the
+        # database, and the rest are served from the index.
+        new_message_id = self.send_stream_message(cordelia.email, 'Denmark', topic_name='lunch')
+        UserMessage.objects.filter(user_profile=hamlet, message_id=pm_message_id).update(
+            flags=UserMessage.flags.read)
+        with mock.patch('zerver.lib.unread_index.UNREAD_INDEX_RESCAN_MESSAGES', 0):
+            self.assertEqual(get_unread_message_ids(),
+                             set(stream_message_ids) | {pm_message_id, new_message_id})
+        stream_message_ids.append(new_message_id)
+
+        do_update_message_flags(hamlet, client, 'add', 'read', [pm_message_id, stream_message_ids[0]])
+        self.assertEqual(get_unread_message_ids(), set(stream_message_ids[1:]))
+
+        do_update_message_flags(hamlet, client, 'remove', 'read', [stream_message_ids[0]])
+        self.assertEqual(get_unread_message_ids(), set(stream_message_ids))
+
+        message = Message.objects.get(id=stream_message_ids[0])
+        do_update_message(cordelia, message, 'dinner', 'change_all', None, None, set(), set())
+        stream_dict = get_raw_unread_data(hamlet)['stream_dict']
+        self.assertEqual({message_id: stream_dict[message_id]['topic']
+                          for message_id in stream_dict},
+                         {message_id: 'dinner' for message_id in stream_message_ids})
+
+        do_mark_all_as_read(hamlet, client)
+        self.assertEqual(get_unread_message_ids(), set())
+
+    def test_raw_unread_index_matches_query(self) -> None:
+        from zerver.lib.unread_index import redis_client, unread_index_key
+
+        cordelia = self.example_user('cordelia')
+        hamlet = self.example_user('hamlet')
+        client = get_client('website')
+        for stream_name in ['Denmark', 'Verona']:
+            self.subscribe(hamlet, stream_name)
+        do_mark_all_as_read(hamlet, client)
+
+        verona_message_ids = [self.send_stream_message(cordelia.email, 'Verona')
+                              for i in range(3)]
+        denmark_message_ids = [self.send_stream_message(cordelia.email, 'Denmark')
+                               for i in range(3)]
+
+        def check_unread_message_ids(expected: List[int]) -> None:
+            results = []
+            for enable_unread_index in [False, True]:
+                with override_settings(ENABLE_UNREAD_INDEX=enable_unread_index):
+                    raw_unread_data = get_raw_unread_data(hamlet)
+                results.append(sorted(raw_unread_data['stream_dict']))
+            self.assertEqual(results, [sorted(expected)] * 2)
+            self.assertLessEqual(redis_client.zcard(unread_index_key(hamlet.id)), 3)
+
+        with mock.patch('zerver.lib.message.MAX_UNREAD_MESSAGES', 3):
+            # The index holds just the newest messages.
+            check_unread_message_ids(denmark_message_ids)
+
+            # Messages to recipients the user is no longer subscribed
+            # to are excluded before the limit is applied.
+            denmark_subscription = Subscription.objects.filter(
+                user_profile=hamlet, recipient=get_stream_recipient(get_stream('Denmark', hamlet.realm).id))
+            denmark_subscription.update(active=False)
+            check_unread_message_ids(verona_message_ids)
+
+            denmark_subscription.update(active=True)
+            check_unread_message_ids(denmark_message_ids)
+
+            # Once messages are marked as read, older unread messages
+            # take their place.
+            do_update_message_flags(hamlet, client, 'add', 'read', denmark_message_ids[1:])
+            check_unread_message_ids([denmark_message_ids[0]] + verona_message_ids[1:])
+
     def test_unread_msgs(self) -> None:
         cordelia = self.example_user('cordelia')
         sender_id = cordelia.id
@@ -3006,6 +3096,56 @@ class EventQueueTest(TestCase):
                            'type': 'unknown',
                            "timestamp": "1"}])
 
+    def test_message_events_share_payload(self) -> None:
+        message = {"id": 5, "content": "hello"}
+        queue1 = EventQueue("1")
+        queue2 = EventQueue("2")
+        queue1.push({"type": "message", "message": message, "flags": ["mentioned"]})
+        queue2.push({"type": "pointer", "pointer": 1})
+        queue2.push({"type": "message", "message": message, "flags": ["mentioned"],
+                     "push_notified": True})
+
+        entry1 = queue1.queue[0]
+        entry2 = queue2.queue[0]
+        self.assertIsInstance(entry1, QueuedMessageEvent)
+        self.assertIs(entry1.message, entry2.message)
+        self.assertIs(entry1.flags, entry2.flags)
+
+        self.assertEqual(queue1.contents(),
+                         [{"id": 0, "type": "message", "message": message,
+                           "flags": ["mentioned"]}])
+        self.assertEqual(queue2.contents(),
+                         [{"id": 0, "type": "pointer", "pointer": 1},
+                          {"id": 1, "type": "message", "message": message,
+                           "flags": ["mentioned"], "push_notified": True}])
+
+        # Round-tripping through to_dict, as done when persisting
+        # queues, preserves the events.
+        restored = EventQueue.from_dict(queue2.to_dict())
+        self.assertEqual(restored.contents(), queue2.contents())
+
+        queue2.prune(0)
+        self.assertEqual(queue2.pop()["message"], message)
+        self.assertTrue(queue2.empty())
+
+    def test_contents_json(self) -> None:
+        message = {"id": 5, "content": "hello"}
+        message_json = ujson.dumps(message)
+        queue = EventQueue("1")
+        queue.push({"type": "message", "message": message, "flags": ["read"]},
+                   message_json=message_json)
+        queue.push({"type": "pointer", "pointer": 1})
+        # Message events without an encoded payload are encoded on demand.
+        queue.push({"type": "message", "message": message, "flags": [],
+                    "push_notified": False})
+        queue.push({"type": "unknown"})
+
+        expected = queue.contents()
+        events_json, event_types = queue.contents_json()
+        self.assertEqual(ujson.loads(events_json), expected)
+        self.assertEqual(event_types, ["message", "pointer", "message", "unknown"])
+        self.assertIs(queue.queue[0].message_json, message_json)
+
 class ClientDescriptorsTest(ZulipTestCase):
     def test_get_client_info_for_all_public_streams(self) -> None:
         hamlet = self.example_user('hamlet')
@@ -3057,6 +3197,53 @@ class ClientDescriptorsTest(ZulipTestCase):
         dct = client_info[client.event_queue.id]
         self.assertEqual(dct['is_sender'], True)
 
+    def test_get_client_info_for_narrowed_clients(self) -> None:
+        hamlet = self.example_user('hamlet')
+        realm = hamlet.realm
+
+        def allocate(narrow: List[List[str]]) -> Any:
+            return allocate_client_descriptor(dict(
+                all_public_streams=False,
+                apply_markdown=True,
+                client_gravatar=True,
+                client_type_name='website',
+                event_types=['message'],
+                last_connection_time=time.time(),
+                queue_timeout=0,
+                realm_id=realm.id,
+                user_profile_id=hamlet.id,
+                narrow=narrow,
+            ))
+
+        devel_client = allocate([['stream', 'Devel']])
+        topic_client = allocate([['topic', 'bark']])
+        other_topic_client = allocate([['topic', 'meow']])
+        sender_client = allocate([['sender', 'othello@zulip.com']])
+        private_client = allocate([['is', 'private']])
+
+        message_event = dict(
+            realm_id=realm.id,
+            stream_name='devel',
+            message_dict=dict(
+                type='stream',
+                display_recipient='devel',
+                subject='Bark',
+                sender_email='iago@zulip.com',
+            ),
+        )
+        client_info = get_client_info_for_message_event(message_event, users=[])
+        self.assertEqual(set(client_info.keys()),
+                         {devel_client.event_queue.id, topic_client.event_queue.id,
+                          private_client.event_queue.id})
+
+        # Garbage-collected queues are removed from the index.
+        devel_client.cleanup()
+        other_topic_client.cleanup()
+        sender_client.cleanup()
+        client_info = get_client_info_for_message_event(message_event, users=[])
+        self.assertEqual(set(client_info.keys()),
+                         {topic_client.event_queue.id, private_client.event_queue.id})
+
     def test_get_client_info_for_normal_users(self) -> None:
         hamlet = self.example_user('hamlet')
         cordelia = self.example_user('cordelia')
@@ -3134,7 +3321,7 @@ class ClientDescriptorsTest(ZulipTestCase):
                 assert(event['type'] == 'message')
                 return True
 
-            def add_event(self, event: Dict[str, Any]) -> None:
+            def add_event(self, event: Dict[str, Any], message_json: Optional[str]=None) -> None:
                 self.events.append(event)
 
         client1 = MockClient(
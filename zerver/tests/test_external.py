@@ -7,10 +7,17 @@ from zerver.forms import email_is_not_mit_mailing_list
 
 from zerver.lib.rate_limiter import (
     add_ratelimit_rule,
+    api_calls_left,
+    block_access,
+    check_and_incr_ratelimit,
+    check_and_incr_ratelimit_local,
     clear_history,
+    client as redis_client,
+    flush_local_buckets,
+    ratelimit_script,
     remove_ratelimit_rule,
+    unblock_access,
     RateLimitedUser,
-    RateLimiterLockingException,
 )
 from zerver.lib.zephyr import compute_mit_user_fullname
 
@@ -109,12 +116,123 @@ class RateLimitTests(ZulipTestCase):
 
             self.assert_json_success(result)
 
-    def test_hit_ratelimiterlockingexception(self) -> None:
+    def test_check_and_incr_ratelimit_local(self) -> None:
+        user = self.example_user('cordelia')
+        entity = RateLimitedUser(user)
+        clear_history(entity)
+        flush_local_buckets()
+
+        start_time = time.time()
+        results = []
+        with mock.patch('zerver.lib.rate_limiter.LOCAL_BUCKET_FRACTION', 0.5), \
+                mock.patch('zerver.lib.rate_limiter.ratelimit_script',
+                           side_effect=ratelimit_script) as mock_script:
+            for i in range(6):
+                with mock.patch('time.time', return_value=(start_time + i * 0.1)):
+                    results.append(check_and_incr_ratelimit_local(entity))
+
+        # The first request leaves 4 calls for the (1, 5) rule, so the
+        # local bucket admits the next 2 requests without Redis; the
+        # remaining requests are too close to the limit, and so are
+        # checked exactly, recording the locally admitted requests.
+        self.assertEqual(mock_script.call_count, 4)
+        self.assertEqual([result[0] for result in results],
+                         [False, False, False, False, False, True])
+        self.assertEqual([result[2] for result in results[:5]],
+                         [199, 198, 197, 196, 195])
+        self.assertEqual(results[5][1], 0.5)
+
+    def test_flush_expired_local_buckets(self) -> None:
+        cordelia = RateLimitedUser(self.example_user('cordelia'))
+        hamlet = RateLimitedUser(self.example_user('hamlet'))
+        for entity in [cordelia, hamlet]:
+            clear_history(entity)
+        flush_local_buckets()
+
+        start_time = time.time()
+        with mock.patch('zerver.lib.rate_limiter.LOCAL_BUCKET_FRACTION', 0.5):
+            for i in range(3):
+                with mock.patch('time.time', return_value=(start_time + i * 0.1)):
+                    check_and_incr_ratelimit_local(cordelia)
+        # Only the first request was recorded in Redis.
+        self.assertEqual(api_calls_left(cordelia)[0], 199)
+
+        # Once cordelia's bucket has expired, a request from anyone
+        # records the requests it admitted, even though cordelia made
+        # no more requests.
+        with mock.patch('time.time', return_value=(start_time + 1.5)):
+            check_and_incr_ratelimit_local(hamlet)
+            self.assertEqual(api_calls_left(cordelia)[0], 197)
+
+    def test_evict_local_buckets(self) -> None:
+        cordelia = RateLimitedUser(self.example_user('cordelia'))
+        hamlet = RateLimitedUser(self.example_user('hamlet'))
+        othello = RateLimitedUser(self.example_user('othello'))
+        for entity in [cordelia, hamlet, othello]:
+            clear_history(entity)
+        flush_local_buckets()
+
+        start_time = time.time()
+        with mock.patch('zerver.lib.rate_limiter.LOCAL_BUCKET_FRACTION', 0.5), \
+                mock.patch('zerver.lib.rate_limiter.LOCAL_BUCKET_MAX_ENTITIES', 1):
+            for i in range(3):
+                with mock.patch('time.time', return_value=(start_time + i * 0.1)):
+                    check_and_incr_ratelimit_local(cordelia)
+
+            # hamlet's bucket evicts cordelia's, without flushing its
+            # requests to Redis right away.
+            with mock.patch('time.time', return_value=(start_time + 0.5)), \
+                    mock.patch('zerver.lib.rate_limiter.ratelimit_script',
+                               side_effect=ratelimit_script) as mock_script:
+                check_and_incr_ratelimit_local(hamlet)
+            self.assertEqual(mock_script.call_count, 1)
+            self.assertEqual(api_calls_left(cordelia)[0], 199)
+
+            # The next expiry check flushes them, in a single pipeline.
+            with mock.patch('time.time', return_value=(start_time + 2.0)), \
+                    mock.patch('zerver.lib.rate_limiter.client.pipeline',
+                               side_effect=redis_client.pipeline) as mock_pipeline:
+                check_and_incr_ratelimit_local(othello)
+            self.assertEqual(mock_pipeline.call_count, 1)
+            self.assertEqual(api_calls_left(cordelia)[0], 197)
+
+    def test_single_redis_call(self) -> None:
         user = self.example_user('cordelia')
         email = user.email
         clear_history(RateLimitedUser(user))
 
-        with mock.patch('zerver.decorator.incr_ratelimit',
-                        side_effect=RateLimiterLockingException):
+        # Checking and incrementing the rate limit is done by a single
+        # script call, rather than with pipelines.
+        with mock.patch('zerver.lib.rate_limiter.client.pipeline') as mock_pipeline:
             result = self.send_api_message(email, "some stuff")
-            self.assertEqual(result.status_code, 429)
+        self.assert_json_success(result)
+        mock_pipeline.assert_not_called()
+
+    def test_check_and_incr_ratelimit(self) -> None:
+        user = self.example_user('cordelia')
+        entity = RateLimitedUser(user)
+        clear_history(entity)
+
+        start_time = time.time()
+        for i in range(5):
+            with mock.patch('time.time', return_value=(start_time + i * 0.1)):
+                ratelimited, time_till_free, calls_left, time_reset = check_and_incr_ratelimit(entity)
+            self.assertFalse(ratelimited)
+            # The longest rule, (60, 200), determines calls_left.
+            self.assertEqual(calls_left, 199 - i)
+
+        with mock.patch('time.time', return_value=(start_time + 0.5)):
+            ratelimited, time_till_free, calls_left, time_reset = check_and_incr_ratelimit(entity)
+        self.assertTrue(ratelimited)
+        self.assertEqual(time_till_free, 0.5)
+
+        with mock.patch('time.time', return_value=(start_time + 1.0)):
+            ratelimited, time_till_free, calls_left, time_reset = check_and_incr_ratelimit(entity)
+        self.assertFalse(ratelimited)
+        self.assertEqual(time_reset, start_time + 61.0)
+
+        block_access(entity, 60)
+        ratelimited, time_till_free, calls_left, time_reset = check_and_incr_ratelimit(entity)
+        self.assertTrue(ratelimited)
+        self.assertEqual(time_till_free, 60)
+        unblock_access(entity)
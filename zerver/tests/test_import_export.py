@@ -1,23 +1,32 @@
 # -*- coding: utf-8 -*-
 
 from django.conf import settings
+from django.utils.timezone import utc as timezone_utc
 
+import datetime
+import glob
 import os
 import ujson
 
 from mock import patch
-from typing import Any, Dict, List, Set, Optional, Tuple, Callable, \
+from typing import Any, Dict, Iterable, List, Set, Optional, Tuple, Callable, \
     FrozenSet
 
 from zerver.lib.export import (
     do_export_realm,
     export_usermessages_batch,
     do_export_user,
+    export_reaction_table,
 )
 from zerver.lib.import_realm import (
+    allocate_ids,
+    bulk_copy_model,
+    copy_format_value,
+    copy_rows_to_table,
     do_import_realm,
     get_incoming_message_ids,
 )
+from zerver.lib.bugdown import version as bugdown_version
 from zerver.lib.avatar_hash import (
     user_avatar_path,
 )
@@ -48,18 +57,21 @@ from zerver.lib.bot_config import (
     set_bot_config
 )
 from zerver.lib.actions import (
+    do_add_reaction_legacy,
     do_create_user,
 )
 
 from zerver.lib.test_runner import slow
 
 from zerver.models import (
+    Client,
     Message,
     Realm,
     Stream,
     UserProfile,
     Subscription,
     Attachment,
+    Reaction,
     RealmEmoji,
     Recipient,
     UserMessage,
@@ -247,7 +259,8 @@ class ImportExportTest(ZulipTestCase):
 
         result = {}
         result['realm'] = read_file('realm.json')
-        result['attachment'] = read_file('attachment.json')
+        result['attachment'] = read_file('attachments-000001.json')
+        result['reaction'] = read_file('reactions-000001.json')
         result['message'] = read_file('messages-000001.json')
         result['uploads_dir'] = os.path.join(output_dir, 'uploads')
         result['uploads_dir_records'] = read_file(os.path.join('uploads', 'records.json'))
@@ -443,6 +456,100 @@ class ImportExportTest(ZulipTestCase):
         self.assertIn(self.example_email('iago'), dummy_user_emails)
         self.assertNotIn(self.example_email('cordelia'), dummy_user_emails)
 
+    def test_resume_export_realm(self) -> None:
+        realm = Realm.objects.get(string_id='zulip')
+        output_dir = self._make_output_dir()
+        with patch('logging.info'), patch('zerver.lib.export.create_soft_link'):
+            do_export_realm(realm=realm, output_dir=output_dir, threads=0)
+
+        with open(os.path.join(output_dir, 'message_shards.jsonl')) as f:
+            shards = [ujson.loads(line) for line in f]
+        self.assertEqual(shards[0]['dump_file_id'], 1)
+        self.assertEqual(shards[0]['query_index'], 0)
+        with open(os.path.join(output_dir, 'messages-000001.json.partial')) as f:
+            partial = ujson.load(f)
+        self.assertEqual(shards[0]['max_id'],
+                         max(m['id'] for m in partial['zerver_message']))
+        with open(os.path.join(output_dir, 'attachments-000001.json')) as f:
+            attachment = ujson.load(f)
+
+        # Simulate an export interrupted while a UserMessage worker
+        # was processing the first message file.
+        os.rename(os.path.join(output_dir, 'messages-000001.json.partial'),
+                  os.path.join(output_dir, 'messages-000001.json.locked'))
+
+        # Resuming doesn't refetch the messages that were already
+        # written, but still produces the same output.
+        with patch('logging.info'), patch('zerver.lib.export.create_soft_link'), \
+                patch('zerver.lib.export.write_message_export') as mock_write:
+            do_export_realm(realm=realm, output_dir=output_dir, threads=0)
+        mock_write.assert_not_called()
+
+        with open(os.path.join(output_dir, 'messages-000001.json.partial')) as f:
+            self.assertEqual(ujson.load(f), partial)
+        with open(os.path.join(output_dir, 'attachments-000001.json')) as f:
+            self.assertEqual(ujson.load(f), attachment)
+
+    def test_export_table_shards(self) -> None:
+        realm = Realm.objects.get(string_id='zulip')
+        messages = list(Message.objects.filter(sender__realm=realm).order_by('id')[0:4])
+        for message in messages:
+            do_add_reaction_legacy(self.example_user('hamlet'), message, 'tada')
+        output_dir = self._make_output_dir()
+
+        def export_reactions(message_ids: Set[int], chunk_size: int) -> List[List[int]]:
+            with patch('logging.info'):
+                export_reaction_table(realm=realm, output_dir=output_dir,
+                                      message_ids=message_ids, chunk_size=chunk_size)
+            shards = []
+            for fn in sorted(glob.glob(os.path.join(output_dir, 'reactions-*.json'))):
+                with open(fn) as f:
+                    shards.append([row['id'] for row in ujson.load(f)['zerver_reaction']])
+            return shards
+
+        def reaction_ids(messages: List[Message]) -> List[int]:
+            return list(Reaction.objects.filter(message__in=messages).order_by(
+                'id').values_list('id', flat=True))
+
+        # The shards follow the exported messages, and leave out the
+        # reactions on messages that weren't exported.
+        exported_message_ids = {message.id for message in messages[:3]}
+        self.assertEqual(export_reactions(exported_message_ids, chunk_size=2),
+                         [reaction_ids(messages[:2]), reaction_ids(messages[2:3])])
+        with open(os.path.join(output_dir, 'table_shards.jsonl')) as f:
+            shards = [ujson.loads(line) for line in f]
+        self.assertEqual([(shard['table'], shard['dump_file_id']) for shard in shards],
+                         [('zerver_reaction', 1), ('zerver_reaction', 2)])
+
+        # Resuming the export doesn't rewrite the completed shards.
+        with patch('zerver.lib.export.write_data_to_file') as mock_write:
+            export_reactions(exported_message_ids, chunk_size=2)
+        mock_write.assert_not_called()
+
+        # Without messages, there's still an (empty) first shard.
+        self._make_output_dir()
+        self.assertEqual(export_reactions(set(), chunk_size=2), [[]])
+
+    def test_import_realm_with_reaction_shards(self) -> None:
+        realm = Realm.objects.get(string_id='zulip')
+        messages = list(Message.objects.filter(sender__realm=realm).order_by('id'))
+        for message in messages[::len(messages) // 5]:
+            do_add_reaction_legacy(self.example_user('hamlet'), message, 'tada')
+
+        def get_reactions(r: Realm) -> List[Tuple[str, str, str]]:
+            return sorted((reaction.message.content, reaction.user_profile.email,
+                           reaction.emoji_name)
+                          for reaction in Reaction.objects.filter(user_profile__realm=r))
+
+        with patch('zerver.lib.export.export_reaction_table',
+                   side_effect=lambda **kwargs: export_reaction_table(chunk_size=10, **kwargs)):
+            self._export_realm(realm)
+        self.assertGreater(len(glob.glob('var/test-export/reactions-*.json')), 1)
+
+        with patch('logging.info'):
+            imported_realm = do_import_realm('var/test-export', 'test-zulip')
+        self.assertEqual(get_reactions(imported_realm), get_reactions(realm))
+
     def test_export_single_user(self) -> None:
         output_dir = self._make_output_dir()
         cordelia = self.example_user('cordelia')
@@ -800,6 +907,79 @@ class ImportExportTest(ZulipTestCase):
         image_data = original_image_key.get_contents_as_string()
         self.assertEqual(image_data, test_image_data)
 
+    def test_copy_format_value(self) -> None:
+        self.assertEqual(copy_format_value(None), '\\N')
+        self.assertEqual(copy_format_value(True), 't')
+        self.assertEqual(copy_format_value(False), 'f')
+        self.assertEqual(copy_format_value(42), '42')
+        self.assertEqual(copy_format_value('a\tb\nc\rd\\e'), 'a\\tb\\nc\\rd\\\\e')
+        self.assertEqual(copy_format_value('\\N'), '\\\\N')
+        dt = datetime.datetime(2019, 1, 2, 3, 4, 5, tzinfo=timezone_utc)
+        self.assertEqual(copy_format_value(dt), '2019-01-02T03:04:05+00:00')
+
+    def test_bulk_copy_model(self) -> None:
+        client_ids = allocate_ids(Client, 3)
+        names = ['copy test', 'a\tb\nc\\d', '\\N']
+        data = {'zerver_client': [dict(id=client_id, name=name)
+                                  for (client_id, name) in zip(client_ids, names)]}
+        # The rows are streamed to the database in chunks.
+        with patch('zerver.lib.import_realm.COPY_CHUNK_SIZE', 16), patch('logging.info'):
+            bulk_copy_model(data, Client)
+        self.assertEqual({client.id: client.name for client in Client.objects.filter(id__in=client_ids)},
+                         dict(zip(client_ids, names)))
+
+        self.assertEqual(copy_rows_to_table('zerver_client', ['id', 'name'], []), 0)
+
+    def test_import_realm_with_render_pool(self) -> None:
+        realm = Realm.objects.get(string_id='zulip')
+        self._export_realm(realm)
+
+        # Make the import render the messages, as it does for imports
+        # from other products.
+        messages_file = os.path.join('var/test-export', 'messages-000001.json')
+        with open(messages_file) as f:
+            data = ujson.load(f)
+        for message in data['zerver_message']:
+            message['rendered_content'] = None
+        with open(messages_file, 'w') as f:
+            ujson.dump(data, f)
+
+        # The tests run in a transaction, which the pool's processes
+        # couldn't see, so we run the pool's work in this process.
+        class SerialPool:
+            def __init__(self, processes: int) -> None:
+                pass
+
+            def map(self, func: Callable[[Any], Any], iterable: Iterable[Any]) -> List[Any]:
+                return [func(item) for item in iterable]
+
+            def close(self) -> None:
+                pass
+
+            def join(self) -> None:
+                pass
+
+        max_message_id = Message.objects.latest('id').id
+        with patch('logging.info'), \
+                patch('zerver.lib.import_realm.connection.close') as mock_connection_close, \
+                patch('zerver.lib.import_realm.djcache.close') as mock_cache_close, \
+                patch('zerver.lib.import_realm.multiprocessing.Pool',
+                      side_effect=SerialPool) as mock_pool, \
+                patch('zerver.lib.import_realm.run_parallel',
+                      side_effect=lambda job, data, processes: [(job(item), item) for item in data]):
+            do_import_realm('var/test-export', 'test-zulip', processes=2)
+
+        mock_pool.assert_called_once_with(2)
+        # Both connections are closed before forking the pool.
+        self.assertTrue(mock_connection_close.called)
+        mock_cache_close.assert_called_once_with()
+
+        messages = Message.objects.filter(id__gt=max_message_id)
+        self.assertEqual(messages.count(), len(data['zerver_message']))
+        for message in messages:
+            self.assertIsNotNone(message.rendered_content)
+            self.assertEqual(message.rendered_content_version, bugdown_version)
+
     def test_get_incoming_message_ids(self) -> None:
         import_dir = os.path.join(settings.DEPLOY_ROOT, "zerver", "tests", "fixtures", "import_fixtures")
         message_ids = get_incoming_message_ids(
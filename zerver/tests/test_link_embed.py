@@ -1,8 +1,12 @@
 # -*- coding: utf-8 -*-
 
 import mock
+import threading
+import time
 import ujson
-from typing import Any
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from socketserver import ThreadingMixIn
+from typing import Any, List
 from requests.exceptions import ConnectionError
 from django.test import override_settings
 
@@ -11,8 +15,10 @@ from zerver.lib.actions import queue_json_publish
 from zerver.lib.test_classes import ZulipTestCase
 from zerver.lib.test_helpers import MockPythonResponse
 from zerver.worker.queue_processors import FetchLinksEmbedData
+from zerver.lib.url_preview.fetcher import LinkPreviewFetcher
 from zerver.lib.url_preview.preview import (
-    get_link_embed_data, link_embed_data_from_cache)
+    get_link_embed_data, link_embed_data_from_cache,
+    NEGATIVE_PREVIEW_CACHE_TIMEOUT, PREVIEW_CACHE_TIMEOUT)
 from zerver.lib.url_preview.oembed import get_oembed_data
 from zerver.lib.url_preview.parsers import (
     OpenGraphParser, GenericParser)
@@ -176,7 +182,7 @@ class PreviewTestCase(ZulipTestCase):
         url = 'http://test.org/'
         response = MockPythonResponse(self.open_graph_html, 200)
         mocked_response = mock.Mock(
-            side_effect=lambda k: {url: response}.get(k, MockPythonResponse('', 404)))
+            side_effect=lambda k, **kwargs: {url: response}.get(k, MockPythonResponse('', 404)))
 
         with mock.patch('zerver.views.messages.queue_json_publish') as patched:
             result = self.client_patch("/json/messages/" + str(msg_id), {
@@ -189,7 +195,7 @@ class PreviewTestCase(ZulipTestCase):
             event = patched.call_args[0][1]
 
         with self.settings(TEST_SUITE=False, CACHES=TEST_CACHES):
-            with mock.patch('requests.get', mocked_response):
+            with mock.patch('requests.Session.get', mocked_response):
                 FetchLinksEmbedData().consume(event)
 
         embedded_link = '<a href="{0}" target="_blank" title="The Rock">The Rock</a>'.format(url)
@@ -228,11 +234,11 @@ class PreviewTestCase(ZulipTestCase):
         if relative_url is True:
             response = MockPythonResponse(self.open_graph_html.replace('http://ia.media-imdb.com', ''), 200)
         mocked_response = mock.Mock(
-            side_effect=lambda k: {url: response}.get(k, MockPythonResponse('', 404)))
+            side_effect=lambda k, **kwargs: {url: response}.get(k, MockPythonResponse('', 404)))
 
         # Run the queue processor to potentially rerender things
         with self.settings(TEST_SUITE=False, CACHES=TEST_CACHES):
-            with mock.patch('requests.get', mocked_response):
+            with mock.patch('requests.Session.get', mocked_response):
                 FetchLinksEmbedData().consume(event)
         msg = Message.objects.select_related("sender").get(id=msg_id)
         return msg
@@ -255,11 +261,11 @@ class PreviewTestCase(ZulipTestCase):
             # Mock the network request result so the test can be fast without Internet
             response = MockPythonResponse(self.open_graph_html, 200)
             mocked_response_original = mock.Mock(
-                side_effect=lambda k: {original_url: response}.get(k, MockPythonResponse('', 404)))
+                side_effect=lambda k, **kwargs: {original_url: response}.get(k, MockPythonResponse('', 404)))
             mocked_response_edited = mock.Mock(
-                side_effect=lambda k: {edited_url: response}.get(k, MockPythonResponse('', 404)))
+                side_effect=lambda k, **kwargs: {edited_url: response}.get(k, MockPythonResponse('', 404)))
             with self.settings(TEST_SUITE=False, CACHES=TEST_CACHES):
-                with mock.patch('requests.get', mocked_response_original):
+                with mock.patch('requests.Session.get', mocked_response_original):
                     # Run the queue processor. This will simulate the event for original_url being
                     # processed after the message has been edited.
                     FetchLinksEmbedData().consume(event)
@@ -271,7 +277,7 @@ class PreviewTestCase(ZulipTestCase):
             mocked_response_edited.assert_not_called()
 
             with self.settings(TEST_SUITE=False, CACHES=TEST_CACHES):
-                with mock.patch('requests.get', mocked_response_edited):
+                with mock.patch('requests.Session.get', mocked_response_edited):
                     # Now proceed with the original queue_json_publish and call the
                     # up-to-date event for edited_url.
                     queue_json_publish(*args, **kwargs)
@@ -347,7 +353,7 @@ class PreviewTestCase(ZulipTestCase):
             'message_realm_id': msg.sender.realm_id,
             'message_content': url}
         with self.settings(INLINE_URL_EMBED_PREVIEW=True, TEST_SUITE=False, CACHES=TEST_CACHES):
-            with mock.patch('requests.get', mock.Mock(side_effect=ConnectionError())):
+            with mock.patch('requests.Session.get', mock.Mock(side_effect=ConnectionError())):
                 FetchLinksEmbedData().consume(event)
         msg = Message.objects.get(id=msg_id)
         self.assertEqual(
@@ -370,3 +376,88 @@ class PreviewTestCase(ZulipTestCase):
             key = preview_url_cache_key(url)
             cache_set(key, link_embed_data, 'database')
             self.assertEqual(link_embed_data, link_embed_data_from_cache(url))
+
+
+class ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+class LinkPreviewFetcherTest(ZulipTestCase):
+    """Tests LinkPreviewFetcher against a local HTTP server standing in
+    for the sites being previewed."""
+
+    def setUp(self) -> None:
+        super().setUp()
+        self.concurrent_requests = 0
+        self.max_concurrent_requests = 0
+        self.requested_paths = []  # type: List[str]
+        lock = threading.Lock()
+        test = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self) -> None:
+                with lock:
+                    test.requested_paths.append(self.path)
+                    test.concurrent_requests += 1
+                    test.max_concurrent_requests = max(test.max_concurrent_requests,
+                                                       test.concurrent_requests)
+                time.sleep(0.05)
+                with lock:
+                    test.concurrent_requests -= 1
+
+                if self.path.startswith('/missing'):
+                    self.send_response(404)
+                    self.end_headers()
+                    return
+                body = PreviewTestCase.open_graph_html.encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/html')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, *args: Any) -> None:
+                pass
+
+        self.server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self.server_thread = threading.Thread(target=self.server.serve_forever)
+        self.server_thread.start()
+        self.base_url = 'http://127.0.0.1:%d' % (self.server.server_port,)
+
+    def tearDown(self) -> None:
+        self.server.shutdown()
+        self.server.server_close()
+        self.server_thread.join()
+        super().tearDown()
+
+    def test_fetch(self) -> None:
+        urls = ['%s/page/%d' % (self.base_url, i) for i in range(6)]
+        fetcher = LinkPreviewFetcher(max_concurrent_fetches=8,
+                                     max_concurrent_fetches_per_domain=2)
+        with self.settings(TEST_SUITE=False, CACHES=TEST_CACHES):
+            fetcher.fetch(urls)
+            for url in urls:
+                self.assertEqual(link_embed_data_from_cache(url)['title'], 'The Rock')
+            self.assertEqual(len(self.requested_paths), 6)
+            self.assertLessEqual(self.max_concurrent_requests, 2)
+
+            # Cached previews aren't fetched again.
+            fetcher.fetch(urls)
+            self.assertEqual(len(self.requested_paths), 6)
+        fetcher.close()
+
+    def test_negative_cache(self) -> None:
+        good_url = self.base_url + '/page'
+        bad_url = self.base_url + '/missing'
+        fetcher = LinkPreviewFetcher()
+        with self.settings(TEST_SUITE=False, CACHES=TEST_CACHES):
+            with mock.patch('zerver.lib.url_preview.preview.cache_set', wraps=cache_set) as patched:
+                fetcher.fetch([good_url, bad_url])
+            timeouts = {call[0][0]: call[1]['timeout'] for call in patched.call_args_list}
+            self.assertEqual(timeouts[preview_url_cache_key(good_url)], PREVIEW_CACHE_TIMEOUT)
+            self.assertEqual(timeouts[preview_url_cache_key(bad_url)], NEGATIVE_PREVIEW_CACHE_TIMEOUT)
+            self.assertFalse(link_embed_data_from_cache(bad_url))
+
+            # Failed fetches are cached too.
+            fetcher.fetch([bad_url])
+            self.assertEqual(self.requested_paths.count('/missing'), 1)
+        fetcher.close()
@@ -43,14 +43,18 @@ from zerver.lib.create_user import (
 )
 
 from zerver.lib.message import (
+    MESSAGE_DICT_COMPRESSED,
+    MESSAGE_DICT_UNCOMPRESSED,
     MessageDict,
     bulk_access_messages,
+    extract_message_dict,
     get_first_visible_message_id,
     get_raw_unread_data,
     get_recent_private_conversations,
     maybe_update_first_visible_message_id,
     messages_for_ids,
     sew_messages_and_reactions,
+    stringify_message_dict,
     update_first_visible_message_id,
 )
 
@@ -921,6 +925,99 @@ class StreamMessagesTest(ZulipTestCase):
         num_active_users = num_extra_users / 2
         self.assertTrue(ums_created > (num_active_users * num_messages))
 
+    def test_user_messages_loaded_with_copy(self) -> None:
+        # The UserMessage rows for messages to big streams are loaded
+        # with COPY; check that gives the same rows as an INSERT.
+        sender = self.example_user('hamlet')
+        iago = self.example_user('iago')
+        cordelia = self.example_user('cordelia')
+        for user_profile in [sender, iago, cordelia]:
+            self.subscribe(user_profile, 'Denmark')
+
+        def get_flags(message_id: int) -> Dict[int, List[str]]:
+            return {um.user_profile_id: um.flags_list()
+                    for um in UserMessage.objects.filter(message_id=message_id)}
+
+        content = 'Hi @**%s**' % (iago.full_name,)
+        insert_message_id = self.send_stream_message(sender.email, 'Denmark', content=content)
+        with mock.patch('zerver.lib.actions.USER_MESSAGE_COPY_THRESHOLD', 0):
+            copy_message_id = self.send_stream_message(sender.email, 'Denmark', content=content)
+
+        copy_flags = get_flags(copy_message_id)
+        self.assertEqual(copy_flags, get_flags(insert_message_id))
+        self.assertEqual(copy_flags[sender.id], ['read'])
+        self.assertEqual(copy_flags[iago.id], ['mentioned'])
+        self.assertEqual(copy_flags[cordelia.id], [])
+
+    @override_settings(DEFERRED_FAN_OUT_MIN_RECIPIENTS=1)
+    def test_deferred_fan_out(self) -> None:
+        from zerver.lib.deferred_user_messages import deferred_message_ids_key, \
+            deferred_user_ids_key, fill_in_deferred_user_messages, redis_client
+        from zerver.worker.queue_processors import DeferredWorker
+
+        sender = self.example_user('hamlet')
+        iago = self.example_user('iago')
+        cordelia = self.example_user('cordelia')
+        othello = self.example_user('othello')
+        for user_profile in [sender, iago, cordelia, othello]:
+            self.subscribe(user_profile, 'Denmark')
+
+        def get_flags(message_id: int) -> Dict[int, List[str]]:
+            return {um.user_profile_id: um.flags_list()
+                    for um in UserMessage.objects.filter(message_id=message_id)}
+
+        content = 'Hi @**%s**' % (iago.full_name,)
+        with mock.patch('zerver.lib.actions.queue_json_publish') as mock_queue_json_publish:
+            message_id = self.send_stream_message(sender.email, 'Denmark', content=content)
+        events = [call[0][1] for call in mock_queue_json_publish.call_args_list
+                  if call[0][0] == 'deferred_work']
+        self.assertEqual(len(events), 1)
+        self.assertEqual(events[0]['type'], 'fan_out_user_messages')
+        self.assertIn(cordelia.id, events[0]['user_ids'])
+        self.assertIn(othello.id, events[0]['user_ids'])
+        self.assertEqual(events[0]['realm_id'], sender.realm_id)
+
+        # The pending user IDs don't expire while the message is queued.
+        message_ids_key = deferred_message_ids_key(sender.realm_id)
+        self.assertTrue(redis_client.sismember(message_ids_key, message_id))
+        self.assertEqual(redis_client.ttl(deferred_user_ids_key(message_id)), -1)
+
+        # Only the sender's and the mentioned user's rows were written.
+        flags = get_flags(message_id)
+        self.assertEqual(flags[sender.id], ['read'])
+        self.assertEqual(flags[iago.id], ['mentioned'])
+        self.assertNotIn(cordelia.id, flags)
+        self.assertNotIn(othello.id, flags)
+
+        # Reading a user's messages fills in their pending rows.
+        fill_in_deferred_user_messages(cordelia)
+        self.assertEqual(get_flags(message_id)[cordelia.id], [])
+        self.assertNotIn(othello.id, get_flags(message_id))
+
+        # The queue processor fills in the rest, skipping the rows
+        # that already exist.
+        DeferredWorker().consume(events[0])
+        flags = get_flags(message_id)
+        self.assertEqual(flags[cordelia.id], [])
+        self.assertEqual(flags[othello.id], [])
+        self.assertFalse(redis_client.sismember(message_ids_key, message_id))
+        self.assertFalse(redis_client.exists(deferred_user_ids_key(message_id)))
+
+        # If redis lost a message's pending user IDs, the next read
+        # drops it from the realm's deferred messages, with a warning.
+        redis_client.sadd(message_ids_key, message_id)
+        with mock.patch('logging.warning') as mock_warning:
+            fill_in_deferred_user_messages(cordelia)
+        mock_warning.assert_called_once()
+        self.assertFalse(redis_client.sismember(message_ids_key, message_id))
+
+        # Private streams never defer their rows.
+        self.make_stream('private stream', invite_only=True)
+        for user_profile in [sender, cordelia]:
+            self.subscribe(user_profile, 'private stream')
+        message_id = self.send_stream_message(sender.email, 'private stream')
+        self.assertIn(cordelia.id, get_flags(message_id))
+
     def test_not_too_many_queries(self) -> None:
         recipient_list  = [self.example_user("hamlet"), self.example_user("iago"),
                            self.example_user("cordelia"), self.example_user("othello")]
@@ -1218,6 +1315,29 @@ class MessageDictTest(ZulipTestCase):
         self.assert_length(queries, 7)
         self.assertEqual(len(rows), num_ids)
 
+    def test_cached_message_dict_format(self) -> None:
+        sender = self.example_user('othello')
+        message_id = self.send_stream_message(sender.email, 'Denmark', content='hello')
+        self.login(sender.email)
+        self.client_patch("/json/messages/" + str(message_id), {
+            'message_id': message_id,
+            'content': 'hello again',
+        })
+        row = MessageDict.get_raw_db_rows([message_id])[0]
+        dct = MessageDict.build_dict_from_raw_db_row(row)
+        self.assertIn('edit_history', dct)
+
+        message_bytes = stringify_message_dict(dct)
+        self.assertEqual(message_bytes[:1], MESSAGE_DICT_UNCOMPRESSED)
+        self.assertEqual(extract_message_dict(message_bytes), dct)
+
+        # Big messages are compressed.
+        dct['rendered_content'] = '<p>' + 'hello ' * 1000 + '</p>'
+        message_bytes = stringify_message_dict(dct)
+        self.assertEqual(message_bytes[:1], MESSAGE_DICT_COMPRESSED)
+        self.assertLess(len(message_bytes), 1000)
+        self.assertEqual(extract_message_dict(message_bytes), dct)
+
     def test_applying_markdown(self) -> None:
         sender = self.example_user('othello')
         receiver = self.example_user('hamlet')
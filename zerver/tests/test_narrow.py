@@ -18,6 +18,8 @@ from zerver.lib.message import (
 )
 from zerver.lib.narrow import (
     build_narrow_filter,
+    get_message_narrow_index_keys,
+    get_narrow_index_key,
     is_web_public_compatible,
 )
 from zerver.lib.request import JsonableError
@@ -382,6 +384,40 @@ class NarrowLibraryTest(TestCase):
         with self.assertRaises(JsonableError):
             build_narrow_filter(["invalid_operator", "operand"])
 
+    def test_narrow_index_keys(self) -> None:
+        self.assertEqual(get_narrow_index_key([["topic", "Bark"], ["stream", "Devel"]]),
+                         ("stream", "devel"))
+        self.assertEqual(get_narrow_index_key([["is", "starred"], ["topic", "Bark"]]),
+                         ("topic", "bark"))
+        self.assertEqual(get_narrow_index_key([["sender", "Hamlet@zulip.com"]]),
+                         ("sender", "hamlet@zulip.com"))
+        self.assertEqual(get_narrow_index_key([["is", "private"]]), ("", ""))
+
+        stream_message = dict(type="stream", display_recipient="Devel", subject="BarK",
+                              sender_email="hamlet@zulip.com")
+        private_message = dict(type="private", display_recipient=[],
+                               sender_email="Hamlet@zulip.com")
+        self.assertEqual(set(get_message_narrow_index_keys(stream_message)),
+                         {("", ""), ("sender", "hamlet@zulip.com"),
+                          ("stream", "devel"), ("topic", "bark")})
+        self.assertEqual(set(get_message_narrow_index_keys(private_message)),
+                         {("", ""), ("sender", "hamlet@zulip.com")})
+
+        # Every message accepted by a narrow has the narrow's index key.
+        narrows = [
+            [["stream", "devel"], ["topic", "bark"]],
+            [["topic", "bark"]],
+            [["sender", "hamlet@zulip.com"], ["is", "mentioned"]],
+            [["is", "private"]],
+        ]
+        for narrow in narrows:
+            narrow_filter = build_narrow_filter(narrow)
+            for message in [stream_message, private_message]:
+                event = dict(message=message, flags=["mentioned"])
+                if narrow_filter(event):
+                    self.assertIn(get_narrow_index_key(narrow),
+                                  get_message_narrow_index_keys(message))
+
     def test_is_web_public_compatible(self) -> None:
         self.assertTrue(is_web_public_compatible([]))
         self.assertTrue(is_web_public_compatible([{"operator": "has",
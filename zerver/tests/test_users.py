@@ -14,7 +14,7 @@ from zerver.lib.test_classes import (
 
 from zerver.models import UserProfile, Recipient, \
     RealmDomain, UserHotspot, \
-    get_user, get_realm, get_stream, get_stream_recipient, \
+    get_user, get_realm, get_stream, get_stream_recipient, get_client, \
     get_source_profile, \
     ScheduledEmail, check_valid_user_ids, \
     get_user_by_id_in_realm_including_cross_realm, CustomProfileField
@@ -30,7 +30,12 @@ from zerver.lib.actions import (
     do_reactivate_user,
     do_change_is_admin,
     do_create_user,
+    bulk_remove_subscriptions,
+    do_change_subscription_property,
 )
+from zerver.lib.cache import bump_stream_recipient_info_version, cache_add, \
+    cache_delete, cache_get, stream_recipient_info_cache_key, \
+    stream_recipient_info_version_cache_key
 from zerver.lib.create_user import copy_user_settings
 from zerver.lib.topic_mutes import add_topic_mute
 from zerver.lib.stream_topic import StreamTopicTarget
@@ -1013,6 +1018,84 @@ class RecipientInfoTest(ZulipTestCase):
         )
         self.assertEqual(info['default_bot_user_ids'], {normal_bot.id})
 
+    def test_stream_recipient_info_cache(self) -> None:
+        hamlet = self.example_user('hamlet')
+        cordelia = self.example_user('cordelia')
+        realm = hamlet.realm
+
+        stream_name = 'Test Stream'
+        for user in [hamlet, cordelia]:
+            self.subscribe(user, stream_name)
+
+        stream = get_stream(stream_name, realm)
+        recipient = get_stream_recipient(stream.id)
+        stream_topic = StreamTopicTarget(
+            stream_id=stream.id,
+            topic_name='Test Topic',
+        )
+
+        def get_info() -> Dict[str, Any]:
+            return get_recipient_info(
+                recipient=recipient,
+                sender_id=hamlet.id,
+                stream_topic=stream_topic,
+            )
+
+        self.assertEqual(get_info()['active_user_ids'], {hamlet.id, cordelia.id})
+
+        # The subscriptions and muted topics are cached; only the
+        # users are fetched.
+        with queries_captured() as queries:
+            info = get_info()
+        self.assert_length(queries, 1)
+        self.assertEqual(info['active_user_ids'], {hamlet.id, cordelia.id})
+
+        # Subscription changes made with bulk updates invalidate the cache.
+        bulk_remove_subscriptions([cordelia], [stream], get_client('website'))
+        self.assertEqual(get_info()['active_user_ids'], {hamlet.id})
+        self.subscribe(cordelia, stream_name)
+        self.assertEqual(get_info()['active_user_ids'], {hamlet.id, cordelia.id})
+
+        do_change_subscription_property(cordelia, get_subscription(stream_name, cordelia),
+                                        stream, 'email_notifications', True)
+        self.assertEqual(get_info()['stream_email_user_ids'], {cordelia.id})
+
+        # Topics are muted case-insensitively.
+        add_topic_mute(
+            user_profile=cordelia,
+            stream_id=stream.id,
+            recipient_id=recipient.id,
+            topic_name='test topic',
+        )
+        self.assertEqual(get_info()['stream_email_user_ids'], set())
+
+        # Changes made in a transaction bump the version again once
+        # it commits, since a send could have cached the old
+        # subscriptions under the first new version meanwhile.
+        with mock.patch('zerver.lib.cache.transaction.on_commit') as mock_on_commit:
+            bulk_remove_subscriptions([cordelia], [stream], get_client('website'))
+        self.assertEqual(get_info()['active_user_ids'], {hamlet.id})
+        version = cache_get(stream_recipient_info_version_cache_key(recipient.id))[0]
+        for call in mock_on_commit.call_args_list:
+            call[0][0]()
+        self.assertNotEqual(cache_get(stream_recipient_info_version_cache_key(recipient.id))[0],
+                            version)
+
+        # A send that finds no version doesn't overwrite one that a
+        # concurrent change sets meanwhile; it caches the info under
+        # the version that was stored.
+        version_key = stream_recipient_info_version_cache_key(recipient.id)
+        cache_delete(version_key)
+
+        def bump_then_add(key: str, val: Any) -> bool:
+            bump_stream_recipient_info_version([recipient.id])
+            return cache_add(key, val)
+
+        with mock.patch('zerver.lib.stream_subscription.cache_add', side_effect=bump_then_add):
+            get_info()
+        version = cache_get(version_key)[0]
+        self.assertIsNotNone(cache_get(stream_recipient_info_cache_key(recipient.id, version)))
+
     def test_get_recipient_info_invalid_recipient_type(self) -> None:
         hamlet = self.example_user('hamlet')
         realm = hamlet.realm
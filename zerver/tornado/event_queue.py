@@ -1,7 +1,7 @@
 # See https://zulip.readthedocs.io/en/latest/subsystems/events-system.html for
 # high-level documentation on how this system works.
 from typing import cast, AbstractSet, Any, Callable, Dict, List, \
-    Mapping, MutableMapping, Optional, Iterable, Sequence, Set, Union
+    Mapping, MutableMapping, Optional, Iterable, Sequence, Set, Tuple, Union
 from mypy_extensions import TypedDict
 
 from django.utils.translation import ugettext as _
@@ -25,14 +25,17 @@ from zerver.tornado.handlers import clear_handler_by_id, get_handler_by_id, \
 from zerver.lib.utils import statsd
 from zerver.middleware import async_request_timer_restart
 from zerver.lib.message import MessageDict
-from zerver.lib.narrow import build_narrow_filter
+from zerver.lib.narrow import build_narrow_filter, get_message_narrow_index_keys, \
+    get_narrow_index_key
 from zerver.lib.queue import queue_json_publish
 from zerver.lib.request import JsonableError
 from zerver.tornado.descriptors import clear_descriptor_by_handler_id, set_descriptor_by_handler_id
+from zerver.tornado.event_queue_store import EventQueueStore
 from zerver.tornado.exceptions import BadEventQueueIdError
-from zerver.tornado.sharding import get_tornado_uri, get_tornado_port, \
-    notify_tornado_queue_name
+from zerver.tornado.sharding import get_tornado_uri, get_tornado_uri_for_port, \
+    get_tornado_port, notify_tornado_queue_name
 import copy
+import heapq
 
 requests_client = requests.Session()
 for host in ['127.0.0.1', 'localhost']:
@@ -45,9 +48,12 @@ for host in ['127.0.0.1', 'localhost']:
 # situation, queues from dead browser sessions would grow quite large
 # due to the accumulation of message data in those queues.
 DEFAULT_EVENT_QUEUE_TIMEOUT_SECS = 60 * 10
-# We garbage-collect every minute; this is totally fine given that the
-# GC scan takes ~2ms with 1000 event queues.
+# We garbage-collect every minute; each pass only looks at the queues
+# whose scheduled expiry time has passed (see expiry_heap).
 EVENT_QUEUE_GC_FREQ_MSECS = 1000 * 60 * 1
+# How often changed event queues are written to the persistent
+# store; this bounds how many events a crash can lose.
+EVENT_QUEUE_PERSIST_FREQ_MSECS = 1000 * 5
 
 # Capped limit for how long a client can request an event queue
 # to live
@@ -91,6 +97,7 @@ class ClientDescriptor:
         self._timeout_handle = None  # type: Any # TODO: should be return type of ioloop.call_later
         self.narrow = narrow
         self.narrow_filter = build_narrow_filter(narrow)
+        self.narrow_index_key = get_narrow_index_key(narrow)
 
         # Default for lifespan_secs is DEFAULT_EVENT_QUEUE_TIMEOUT_SECS;
         # but users can set it as high as MAX_QUEUE_TIMEOUT_SECS.
@@ -98,14 +105,14 @@ class ClientDescriptor:
             lifespan_secs = DEFAULT_EVENT_QUEUE_TIMEOUT_SECS
         self.queue_timeout = min(lifespan_secs, MAX_QUEUE_TIMEOUT_SECS)
 
-    def to_dict(self) -> Dict[str, Any]:
+    def to_dict(self, include_events: bool=True) -> Dict[str, Any]:
         # If you add a new key to this dict, make sure you add appropriate
         # migration code in from_dict or load_event_queues to account for
         # loading event queues that lack that key.
         return dict(user_profile_id=self.user_profile_id,
                     user_profile_email=self.user_profile_email,
                     realm_id=self.realm_id,
-                    event_queue=self.event_queue.to_dict(),
+                    event_queue=self.event_queue.to_dict(include_events=include_events),
                     queue_timeout=self.queue_timeout,
                     event_types=self.event_types,
                     last_connection_time=self.last_connection_time,
@@ -151,20 +158,22 @@ class ClientDescriptor:
         self.current_handler_id = None
         self._timeout_handle = None
 
-    def add_event(self, event: Dict[str, Any]) -> None:
+    def add_event(self, event: Dict[str, Any], message_json: Optional[str]=None) -> None:
         if self.current_handler_id is not None:
             handler = get_handler_by_id(self.current_handler_id)
             async_request_timer_restart(handler._request)
 
-        self.event_queue.push(event)
+        self.event_queue.push(event, message_json=message_json)
+        mark_client_dirty(self)
         self.finish_current_handler()
 
     def finish_current_handler(self) -> bool:
         if self.current_handler_id is not None:
             err_msg = "Got error finishing handler for queue %s" % (self.event_queue.id,)
             try:
+                events_json, event_types = self.event_queue.contents_json()
                 finish_handler(self.current_handler_id, self.event_queue.id,
-                               self.event_queue.contents(), self.apply_markdown)
+                               events_json, event_types, self.apply_markdown)
             except Exception:
                 logging.exception(err_msg)
             finally:
@@ -187,11 +196,15 @@ class ClientDescriptor:
         return (self.current_handler_id is None and
                 now - self.last_connection_time >= self.queue_timeout)
 
+    def expiry_time(self) -> float:
+        return self.last_connection_time + self.queue_timeout
+
     def connect_handler(self, handler_id: int, client_name: str) -> None:
         self.current_handler_id = handler_id
         self.current_client_name = client_name
         set_descriptor_by_handler_id(handler_id, self)
         self.last_connection_time = time.time()
+        mark_client_dirty(self)
 
         def timeout_callback() -> None:
             self._timeout_handle = None
@@ -225,8 +238,7 @@ class ClientDescriptor:
         # invariant that event queues are idle when passed to
         # `do_gc_event_queues` is preserved.
         self.finish_current_handler()
-        do_gc_event_queues({self.event_queue.id}, {self.user_profile_id},
-                           {self.realm_id})
+        do_gc_event_queues({self.event_queue.id})
 
 def compute_full_event_type(event: Mapping[str, Any]) -> str:
     if event["type"] == "update_message_flags":
@@ -236,31 +248,146 @@ def compute_full_event_type(event: Mapping[str, Any]) -> str:
         return "flags/%s/%s" % (event["operation"], event["flag"])
     return event["type"]
 
+# Interned tuples of message flags; there are only a handful of
+# distinct flag combinations, so all queued message events share them.
+interned_flags = {}  # type: Dict[Tuple[str, ...], Tuple[str, ...]]
+
+class QueuedMessageEvent:
+    """Compact representation of a `message` event in an EventQueue.
+
+    A message sent to a large stream is queued for every client of
+    every recipient.  The message payload itself is shared between
+    all clients with the same (apply_markdown, client_gravatar)
+    settings (see process_message_event), so instead of holding a full
+    event dict per client, we only store the per-client event id,
+    flags, and notification data, and build the event dict when the
+    queue's contents are returned to the client.
+
+    Similarly, `message_json` is the shared, already-encoded JSON for
+    the message payload, so that long-poll responses can splice it in
+    rather than encoding the same message once per client.
+    """
+    __slots__ = ('id', 'message', 'flags', 'extra_data', 'message_json')
+
+    def __init__(self, id: int, message: Dict[str, Any], flags: Iterable[str],
+                 extra_data: Optional[Dict[str, Any]],
+                 message_json: Optional[str]=None) -> None:
+        self.id = id
+        self.message = message
+        flags_tuple = tuple(flags)
+        self.flags = interned_flags.setdefault(flags_tuple, flags_tuple)
+        self.extra_data = extra_data
+        self.message_json = message_json
+
+    @classmethod
+    def from_event(cls, event: Mapping[str, Any],
+                   message_json: Optional[str]=None) -> 'QueuedMessageEvent':
+        extra_data = {key: value for (key, value) in event.items()
+                      if key not in ('type', 'id', 'message', 'flags')}
+        return cls(event['id'], event['message'], event['flags'], extra_data or None,
+                   message_json)
+
+    def to_event(self) -> Dict[str, Any]:
+        event = dict(type='message', id=self.id, message=self.message,
+                     flags=list(self.flags))  # type: Dict[str, Any]
+        if self.extra_data is not None:
+            event.update(self.extra_data)
+        return event
+
+    def to_json(self) -> str:
+        if self.message_json is None:
+            self.message_json = ujson.dumps(self.message)
+        event = dict(type='message', id=self.id, flags=self.flags)  # type: Dict[str, Any]
+        if self.extra_data is not None:
+            event.update(self.extra_data)
+        # Splice the message payload into the (small) encoded event.
+        return ujson.dumps(event)[:-1] + ',"message":' + self.message_json + '}'
+
+QueueEntry = Union[Dict[str, Any], QueuedMessageEvent]
+
+def make_queue_entry(event: Dict[str, Any], message_json: Optional[str]=None) -> QueueEntry:
+    if event['type'] == 'message':
+        return QueuedMessageEvent.from_event(event, message_json)
+    return event
+
+def queue_entry_id(entry: QueueEntry) -> int:
+    if isinstance(entry, QueuedMessageEvent):
+        return entry.id
+    return entry['id']
+
+def queue_entry_to_event(entry: QueueEntry) -> Dict[str, Any]:
+    if isinstance(entry, QueuedMessageEvent):
+        return entry.to_event()
+    return entry
+
+def queue_entry_to_json(entry: QueueEntry) -> str:
+    if isinstance(entry, QueuedMessageEvent):
+        return entry.to_json()
+    return ujson.dumps(entry)
+
+def queue_entry_type(entry: QueueEntry) -> str:
+    if isinstance(entry, QueuedMessageEvent):
+        return 'message'
+    return entry['type']
+
 class EventQueue:
     def __init__(self, id: str) -> None:
-        self.queue = deque()  # type: ignore # Should be Deque[Dict[str, Any]], but Deque isn't available in Python 3.4
+        # _queue is None for queues restored from the persistent store
+        # whose events haven't been loaded yet; see the `queue` property.
+        self._queue = deque()  # type: ignore # Should be Optional[Deque[Dict[str, Any]]], but Deque isn't available in Python 3.4
         self.next_event_id = 0  # type: int
         self.id = id  # type: str
         self.virtual_events = {}  # type: Dict[str, Dict[str, Any]]
-
-    def to_dict(self) -> Dict[str, Any]:
+        # The changes to the queue's events since they were last
+        # written to the persistent store: the entries added since
+        # then, and the id of the last entry removed, if any.
+        self.unpersisted_entries = []  # type: List[QueueEntry]
+        self.pruned_through_id = None  # type: Optional[int]
+
+    @property
+    def queue(self) -> Any:
+        if self._queue is None:
+            self._queue = deque(make_queue_entry(event)
+                                for event in load_persisted_events(self.id))
+        return self._queue
+
+    @queue.setter
+    def queue(self, queue: Any) -> None:
+        self._queue = queue
+
+    def events_loaded(self) -> bool:
+        return self._queue is not None
+
+    def events(self) -> List[Dict[str, Any]]:
+        """The queued (non-virtual) events, as plain dicts suitable for
+        serialization."""
+        return [queue_entry_to_event(entry) for entry in self.queue]
+
+    def to_dict(self, include_events: bool=True) -> Dict[str, Any]:
         # If you add a new key to this dict, make sure you add appropriate
         # migration code in from_dict or load_event_queues to account for
         # loading event queues that lack that key.
-        return dict(id=self.id,
-                    next_event_id=self.next_event_id,
-                    queue=list(self.queue),
-                    virtual_events=self.virtual_events)
+        ret = dict(id=self.id,
+                   next_event_id=self.next_event_id,
+                   virtual_events=self.virtual_events)  # type: Dict[str, Any]
+        if include_events:
+            ret['queue'] = self.events()
+        return ret
 
     @classmethod
     def from_dict(cls, d: Dict[str, Any]) -> 'EventQueue':
         ret = cls(d['id'])
         ret.next_event_id = d['next_event_id']
-        ret.queue = deque(d['queue'])
+        if 'queue' in d:
+            ret.queue = deque(make_queue_entry(event) for event in d['queue'])
+            ret.unpersisted_entries = list(ret.queue)
+        else:
+            # The events are loaded lazily from the persistent store.
+            ret.queue = None
         ret.virtual_events = d.get("virtual_events", {})
         return ret
 
-    def push(self, event: Dict[str, Any]) -> None:
+    def push(self, event: Dict[str, Any], message_json: Optional[str]=None) -> None:
         event['id'] = self.next_event_id
         self.next_event_id += 1
         full_event_type = compute_full_event_type(event)
@@ -281,51 +408,122 @@ class EventQueue:
             elif full_event_type.startswith("flags/"):
                 virtual_event["messages"] += event["messages"]
         else:
-            self.queue.append(event)
+            entry = make_queue_entry(event, message_json)
+            self.queue.append(entry)
+            self.unpersisted_entries.append(entry)
 
     # Note that pop ignores virtual events.  This is fine in our
     # current usage since virtual events should always be resolved to
     # a real event before being given to users.
     def pop(self) -> Dict[str, Any]:
-        return self.queue.popleft()
+        entry = self.queue.popleft()
+        self.mark_pruned(queue_entry_id(entry))
+        return queue_entry_to_event(entry)
 
     def empty(self) -> bool:
         return len(self.queue) == 0 and len(self.virtual_events) == 0
 
     # See the comment on pop; that applies here as well
     def prune(self, through_id: int) -> None:
-        while len(self.queue) != 0 and self.queue[0]['id'] <= through_id:
-            self.pop()
+        pruned_through_id = None  # type: Optional[int]
+        while len(self.queue) != 0 and queue_entry_id(self.queue[0]) <= through_id:
+            pruned_through_id = queue_entry_id(self.queue.popleft())
+        if pruned_through_id is not None:
+            self.mark_pruned(pruned_through_id)
+
+    def mark_pruned(self, through_id: int) -> None:
+        # Events that were queued and removed again since the last
+        # write to the persistent store never need to be written.
+        self.pruned_through_id = through_id
+        if self.unpersisted_entries:
+            self.unpersisted_entries = [entry for entry in self.unpersisted_entries
+                                        if queue_entry_id(entry) > through_id]
+
+    def unpersisted_changes(self) -> Tuple[List[Tuple[str, int, str]],
+                                           Optional[Tuple[str, int]]]:
+        """Returns the rows to write to the persistent store for the
+        changes to the queue's events since mark_persisted was last
+        called: the new events, and the id through which events were
+        removed."""
+        new_event_rows = [(self.id, queue_entry_id(entry), queue_entry_to_json(entry))
+                          for entry in self.unpersisted_entries]
+        if self.pruned_through_id is None:
+            return (new_event_rows, None)
+        return (new_event_rows, (self.id, self.pruned_through_id))
+
+    def mark_persisted(self) -> None:
+        self.unpersisted_entries = []
+        self.pruned_through_id = None
 
     def contents(self) -> List[Dict[str, Any]]:
-        contents = []  # type: List[Dict[str, Any]]
+        return [queue_entry_to_event(entry) for entry in self.merged_entries()]
+
+    def contents_json(self) -> Tuple[str, List[str]]:
+        """Like contents(), but returns the events already encoded as a
+        JSON list (along with their types, for logging).  Message
+        payloads are spliced in from their shared encoded form, rather
+        than being re-encoded for every client."""
+        entries = self.merged_entries()
+        events_json = '[' + ','.join(queue_entry_to_json(entry) for entry in entries) + ']'
+        return (events_json, [queue_entry_type(entry) for entry in entries])
+
+    def merged_entries(self) -> List[QueueEntry]:
         virtual_id_map = {}  # type: Dict[str, Dict[str, Any]]
         for event_type in self.virtual_events:
             virtual_id_map[self.virtual_events[event_type]["id"]] = self.virtual_events[event_type]
         virtual_ids = sorted(list(virtual_id_map.keys()))
 
         # Merge the virtual events into their final place in the queue
+        entries = []  # type: List[QueueEntry]
         index = 0
         length = len(virtual_ids)
-        for event in self.queue:
-            while index < length and virtual_ids[index] < event["id"]:
-                contents.append(virtual_id_map[virtual_ids[index]])
+        for entry in self.queue:
+            while index < length and virtual_ids[index] < queue_entry_id(entry):
+                entries.append(virtual_id_map[virtual_ids[index]])
                 index += 1
-            contents.append(event)
+            entries.append(entry)
         while index < length:
-            contents.append(virtual_id_map[virtual_ids[index]])
+            entries.append(virtual_id_map[virtual_ids[index]])
             index += 1
 
+        # The virtual events are now part of the queue, rather than
+        # of its descriptor.
+        self.unpersisted_entries.extend(virtual_id_map[virtual_id] for virtual_id in virtual_ids)
+        if virtual_ids:
+            dirty_queue_ids.add(self.id)
         self.virtual_events = {}
-        self.queue = deque(contents)
-        return contents
+        self.queue = deque(entries)
+        return entries
 
 # maps queue ids to client descriptors
 clients = {}  # type: Dict[str, ClientDescriptor]
-# maps user id to list of client descriptors
-user_clients = {}  # type: Dict[int, List[ClientDescriptor]]
-# maps realm id to list of client descriptors with all_public_streams=True
-realm_clients_all_streams = {}  # type: Dict[int, List[ClientDescriptor]]
+# maps user id to a dict mapping queue ids to client descriptors
+user_clients = {}  # type: Dict[int, Dict[str, ClientDescriptor]]
+# maps realm id to a dict mapping queue ids to client descriptors with
+# all_public_streams=True and no narrow
+realm_clients_all_streams = {}  # type: Dict[int, Dict[str, ClientDescriptor]]
+# maps realm id to an index of the client descriptors with a narrow,
+# keyed by get_narrow_index_key(narrow); the innermost dicts map queue
+# ids to client descriptors.
+realm_narrowed_clients = {}  # type: Dict[int, Dict[Tuple[str, str], Dict[str, ClientDescriptor]]]
+
+# The persistent store for event queues; None in the test suite.
+event_queue_store = None  # type: Optional[EventQueueStore]
+# ids of queues that have changed since they were last written to the
+# persistent store, and of queues that have been garbage-collected
+# since then.
+dirty_queue_ids = set()  # type: Set[str]
+removed_queue_ids = set()  # type: Set[str]
+
+# A heap of (expiry time, queue id) pairs, so that garbage collection
+# only needs to look at queues that may have expired, rather than
+# scanning every queue.  Entries are not updated when a client
+# reconnects (which pushes back its expiry time); instead, when an
+# entry whose client hasn't actually expired comes up, it's pushed
+# back with the client's current expiry time.  Similarly, entries for
+# queues that were removed by other means are just skipped.  Each
+# queue thus has exactly one entry in the heap at a time.
+expiry_heap = []  # type: List[Tuple[float, str]]
 
 # list of registered gc hooks.
 # each one will be called with a user profile id, queue, and bool
@@ -341,6 +539,10 @@ def clear_client_event_queues_for_testing() -> None:
     clients.clear()
     user_clients.clear()
     realm_clients_all_streams.clear()
+    realm_narrowed_clients.clear()
+    del expiry_heap[:]
+    dirty_queue_ids.clear()
+    removed_queue_ids.clear()
     gc_hooks.clear()
     global next_queue_id
     next_queue_id = 0
@@ -352,15 +554,63 @@ def get_client_descriptor(queue_id: str) -> ClientDescriptor:
     return clients.get(queue_id)
 
 def get_client_descriptors_for_user(user_profile_id: int) -> List[ClientDescriptor]:
-    return user_clients.get(user_profile_id, [])
+    return list(user_clients.get(user_profile_id, {}).values())
 
 def get_client_descriptors_for_realm_all_streams(realm_id: int) -> List[ClientDescriptor]:
-    return realm_clients_all_streams.get(realm_id, [])
+    return list(realm_clients_all_streams.get(realm_id, {}).values())
+
+def get_narrowed_client_descriptors_for_message(realm_id: int,
+                                                message: Optional[Mapping[str, Any]]
+                                                ) -> List[ClientDescriptor]:
+    """Returns the clients with a narrow that could match the message,
+    using the index rather than checking every narrowed client in the
+    realm; callers still need to check accepts_event."""
+    narrow_index = realm_narrowed_clients.get(realm_id)
+    if not narrow_index:
+        return []
+    if message is None:
+        return [client for index_clients in narrow_index.values()
+                for client in index_clients.values()]
+
+    result = []  # type: List[ClientDescriptor]
+    for key in get_message_narrow_index_keys(message):
+        index_clients = narrow_index.get(key)
+        if index_clients is not None:
+            result.extend(index_clients.values())
+    return result
 
 def add_to_client_dicts(client: ClientDescriptor) -> None:
-    user_clients.setdefault(client.user_profile_id, []).append(client)
-    if client.all_public_streams or client.narrow != []:
-        realm_clients_all_streams.setdefault(client.realm_id, []).append(client)
+    queue_id = client.event_queue.id
+    user_clients.setdefault(client.user_profile_id, {})[queue_id] = client
+    if client.narrow != []:
+        narrow_index = realm_narrowed_clients.setdefault(client.realm_id, {})
+        index_clients = narrow_index.setdefault(client.narrow_index_key, {})
+        index_clients[queue_id] = client
+    elif client.all_public_streams:
+        realm_clients_all_streams.setdefault(client.realm_id, {})[queue_id] = client
+    heapq.heappush(expiry_heap, (client.expiry_time(), queue_id))
+
+def remove_from_client_dict(client_dict: Dict[int, Dict[str, ClientDescriptor]],
+                            key: int, queue_id: str) -> None:
+    key_clients = client_dict.get(key)
+    if key_clients is None:
+        return
+    key_clients.pop(queue_id, None)
+    if not key_clients:
+        del client_dict[key]
+
+def remove_from_narrow_index(client: ClientDescriptor) -> None:
+    narrow_index = realm_narrowed_clients.get(client.realm_id)
+    if narrow_index is None:
+        return
+    index_clients = narrow_index.get(client.narrow_index_key)
+    if index_clients is None:
+        return
+    index_clients.pop(client.event_queue.id, None)
+    if not index_clients:
+        del narrow_index[client.narrow_index_key]
+        if not narrow_index:
+            del realm_narrowed_clients[client.realm_id]
 
 def allocate_client_descriptor(new_queue_data: MutableMapping[str, Any]) -> ClientDescriptor:
     global next_queue_id
@@ -370,52 +620,79 @@ def allocate_client_descriptor(new_queue_data: MutableMapping[str, Any]) -> Clie
     client = ClientDescriptor.from_dict(new_queue_data)
     clients[queue_id] = client
     add_to_client_dicts(client)
+    mark_client_dirty(client)
     return client
 
-def do_gc_event_queues(to_remove: AbstractSet[str], affected_users: AbstractSet[int],
-                       affected_realms: AbstractSet[int]) -> None:
-    def filter_client_dict(client_dict: MutableMapping[int, List[ClientDescriptor]], key: int) -> None:
-        if key not in client_dict:
-            return
-
-        new_client_list = [c for c in client_dict[key] if c.event_queue.id not in to_remove]
-        if len(new_client_list) == 0:
-            del client_dict[key]
-        else:
-            client_dict[key] = new_client_list
+def mark_client_dirty(client: ClientDescriptor) -> None:
+    dirty_queue_ids.add(client.event_queue.id)
 
-    for user_id in affected_users:
-        filter_client_dict(user_clients, user_id)
+def load_persisted_events(queue_id: str) -> List[Dict[str, Any]]:
+    if event_queue_store is None:
+        return []
+    events = event_queue_store.load_queue(queue_id)
+    if events is None:
+        logging.warning("Tornado could not find persisted events for queue %s" % (queue_id,))
+        return []
+    return events
 
-    for realm_id in affected_realms:
-        filter_client_dict(realm_clients_all_streams, realm_id)
+def do_gc_event_queues(to_remove: AbstractSet[str]) -> None:
+    for id in to_remove:
+        client = clients[id]
+        remove_from_client_dict(user_clients, client.user_profile_id, id)
+        if client.narrow != []:
+            remove_from_narrow_index(client)
+        elif client.all_public_streams:
+            remove_from_client_dict(realm_clients_all_streams, client.realm_id, id)
 
     for id in to_remove:
         for cb in gc_hooks:
             cb(clients[id].user_profile_id, clients[id], clients[id].user_profile_id not in user_clients)
         del clients[id]
+        dirty_queue_ids.discard(id)
+        removed_queue_ids.add(id)
 
-def gc_event_queues(port: int) -> None:
-    start = time.time()
+def pop_expired_client_ids(now: float) -> Set[str]:
+    """Pops the entries in expiry_heap that are due, returning the ids
+    of the queues that have actually expired; the rest are pushed
+    back with their current expiry time."""
     to_remove = set()  # type: Set[str]
-    affected_users = set()  # type: Set[int]
-    affected_realms = set()  # type: Set[int]
-    for (id, client) in clients.items():
-        if client.expired(start):
+    to_reschedule = []  # type: List[Tuple[float, str]]
+    while expiry_heap and expiry_heap[0][0] <= now:
+        (_, id) = heapq.heappop(expiry_heap)
+        client = clients.get(id)
+        if client is None or id in to_remove:
+            continue
+        if client.expired(now):
             to_remove.add(id)
-            affected_users.add(client.user_profile_id)
-            affected_realms.add(client.realm_id)
+        elif client.current_handler_id is not None:
+            # Connected clients can't expire until they disconnect, at
+            # which point their expiry time is at least queue_timeout
+            # away; check back at the next GC pass.
+            to_reschedule.append((max(client.expiry_time(),
+                                      now + EVENT_QUEUE_GC_FREQ_MSECS / 1000), id))
+        else:
+            to_reschedule.append((client.expiry_time(), id))
+    for entry in to_reschedule:
+        heapq.heappush(expiry_heap, entry)
+    return to_remove
+
+def gc_event_queues(port: int) -> None:
+    start = time.time()
+    to_remove = pop_expired_client_ids(start)
+    affected_users = {clients[id].user_profile_id for id in to_remove}
 
     # We don't need to call e.g. finish_current_handler on the clients
     # being removed because they are guaranteed to be idle (because
     # they are expired) and thus not have a current handler.
-    do_gc_event_queues(to_remove, affected_users, affected_realms)
+    do_gc_event_queues(to_remove)
 
+    elapsed = time.time() - start
     if settings.PRODUCTION:
         logging.info(('Tornado %d removed %d expired event queues owned by %d users in %.3fs.' +
                       '  Now %d active queues, %s')
-                     % (port, len(to_remove), len(affected_users), time.time() - start,
+                     % (port, len(to_remove), len(affected_users), elapsed,
                         len(clients), handler_stats_string()))
+    statsd.timing('tornado.gc_event_queues', int(elapsed * 1000))
     statsd.gauge('tornado.active_queues', len(clients))
     statsd.gauge('tornado.active_users', len(user_clients))
 
@@ -429,20 +706,75 @@ def persistent_queue_filename(port: int, last: bool=False) -> str:
         return settings.JSON_PERSISTENT_QUEUE_FILENAME_PATTERN % ('.' + str(port) + '.last',)
     return settings.JSON_PERSISTENT_QUEUE_FILENAME_PATTERN % ('.' + str(port),)
 
-def dump_event_queues(port: int) -> None:
+def persistent_queue_store_filename(port: int) -> str:
+    if settings.TORNADO_PROCESSES == 1:
+        return settings.EVENT_QUEUE_STORE_FILENAME_PATTERN % ('',)
+    return settings.EVENT_QUEUE_STORE_FILENAME_PATTERN % ('.' + str(port),)
+
+def persist_event_queues(port: int) -> None:
+    """Writes the changes to event queues since the last call to the
+    persistent store: the changed queues' descriptors, the events
+    queued since then, and which events were acknowledged.  Queues
+    whose events were never loaded from the store can only have had
+    their descriptor (e.g. the virtual events or last connection time)
+    change."""
+    if event_queue_store is None:
+        return
+
     start = time.time()
+    descriptor_rows = []  # type: List[Tuple[str, Dict[str, Any]]]
+    new_event_rows = []  # type: List[Tuple[str, int, str]]
+    pruned_rows = []  # type: List[Tuple[str, int]]
+    for queue_id in dirty_queue_ids:
+        client = clients[queue_id]
+        descriptor_rows.append((queue_id, client.to_dict(include_events=False)))
+        if client.event_queue.events_loaded():
+            (queue_event_rows, pruned_row) = client.event_queue.unpersisted_changes()
+            new_event_rows.extend(queue_event_rows)
+            if pruned_row is not None:
+                pruned_rows.append(pruned_row)
 
-    with open(persistent_queue_filename(port), "w") as stored_queues:
-        ujson.dump([(qid, client.to_dict()) for (qid, client) in clients.items()],
-                   stored_queues)
+    try:
+        event_queue_store.save(descriptor_rows, new_event_rows, pruned_rows, removed_queue_ids)
+    except Exception:
+        # Leave the dirty sets alone, so that we retry next time.
+        logging.exception("Tornado %d could not persist event queues" % (port,))
+        return
+    for queue_id in dirty_queue_ids:
+        clients[queue_id].event_queue.mark_persisted()
+    num_removed = len(removed_queue_ids)
+    dirty_queue_ids.clear()
+    removed_queue_ids.clear()
 
-    logging.info('Tornado %d dumped %d event queues in %.3fs'
-                 % (port, len(clients), time.time() - start))
+    statsd.timing('tornado.persist_event_queues', 1000 * (time.time() - start))
+    logging.debug('Tornado %d persisted %d event queues (%d new events) and removed %d in %.3fs'
+                  % (port, len(descriptor_rows), len(new_event_rows), num_removed,
+                     time.time() - start))
+
+def dump_event_queues(port: int) -> None:
+    start = time.time()
+    num_dirty = len(dirty_queue_ids)
+    persist_event_queues(port)
+
+    logging.info('Tornado %d dumped %d changed event queues in %.3fs'
+                 % (port, num_dirty, time.time() - start))
 
 def load_event_queues(port: int) -> None:
-    global clients
+    global event_queue_store
     start = time.time()
 
+    try:
+        event_queue_store = EventQueueStore(persistent_queue_store_filename(port))
+        # Only the descriptors are loaded here; each queue's events
+        # are loaded the first time that queue is accessed.
+        for (qid, client) in event_queue_store.load_descriptors():
+            clients[qid] = ClientDescriptor.from_dict(client)
+    except Exception:
+        logging.exception("Tornado %d could not load persisted event queues" % (port,))
+
+    # Migrate queues from the legacy format, a single JSON file dumped
+    # on shutdown, into the persistent store.
+    #
     # ujson chokes on bad input pretty easily.  We separate out the actual
     # file reading from the loading so that we don't silently fail if we get
     # bad input.
@@ -450,8 +782,9 @@ def load_event_queues(port: int) -> None:
         with open(persistent_queue_filename(port), "r") as stored_queues:
             json_data = stored_queues.read()
         try:
-            clients = dict((qid, ClientDescriptor.from_dict(client))
-                           for (qid, client) in ujson.loads(json_data))
+            for (qid, client) in ujson.loads(json_data):
+                clients[qid] = ClientDescriptor.from_dict(client)
+                dirty_queue_ids.add(qid)
         except Exception:
             logging.exception("Tornado %d could not deserialize event queues" % (port,))
     except (IOError, EOFError):
@@ -465,6 +798,17 @@ def load_event_queues(port: int) -> None:
     logging.info('Tornado %d loaded %d event queues in %.3fs'
                  % (port, len(clients), time.time() - start))
 
+def drain_realm_clients(realm_id: int) -> int:
+    """Garbage-collects every event queue for the realm, used when a
+    realm is moved to a different Tornado shard.  Any connected
+    long-poll is finished with the events already in its queue, and
+    the client's next request gets a BAD_EVENT_QUEUE_ID error, causing
+    it to register a new queue on the realm's new shard."""
+    to_drain = [client for client in clients.values() if client.realm_id == realm_id]
+    for client in to_drain:
+        client.cleanup()
+    return len(to_drain)
+
 def send_restart_events(immediate: bool=False) -> None:
     event = dict(type='restart', server_generation=settings.SERVER_GENERATION)  # type: Dict[str, Any]
     if immediate:
@@ -492,6 +836,11 @@ def setup_event_queue(port: int) -> None:
                                          EVENT_QUEUE_GC_FREQ_MSECS, ioloop)
     pc.start()
 
+    # Set up incremental persistence of changed event queues
+    persist_pc = tornado.ioloop.PeriodicCallback(lambda: persist_event_queues(port),
+                                                 EVENT_QUEUE_PERSIST_FREQ_MSECS, ioloop)
+    persist_pc.start()
+
     send_restart_events(immediate=settings.DEVELOPMENT)
 
 def fetch_events(query: Mapping[str, Any]) -> Dict[str, Any]:
@@ -523,21 +872,24 @@ def fetch_events(query: Mapping[str, Any]) -> Dict[str, Any]:
             if user_profile_id != client.user_profile_id:
                 raise JsonableError(_("You are not authorized to get events from this queue"))
             client.event_queue.prune(last_event_id)
+            mark_client_dirty(client)
             was_connected = client.finish_current_handler()
 
         if not client.event_queue.empty() or dont_block:
-            response = dict(events=client.event_queue.contents(),
-                            handler_id=handler_id)  # type: Dict[str, Any]
+            # The events are returned already encoded as JSON; see
+            # EventQueue.contents_json.
+            events_json, event_types = client.event_queue.contents_json()
+            response = dict(handler_id=handler_id)  # type: Dict[str, Any]
             if orig_queue_id is None:
                 response['queue_id'] = queue_id
-            if len(response["events"]) == 1:
-                extra_log_data = "[%s/%s/%s]" % (queue_id, len(response["events"]),
-                                                 response["events"][0]["type"])
+            if len(event_types) == 1:
+                extra_log_data = "[%s/%s/%s]" % (queue_id, len(event_types), event_types[0])
             else:
-                extra_log_data = "[%s/%s]" % (queue_id, len(response["events"]))
+                extra_log_data = "[%s/%s]" % (queue_id, len(event_types))
             if was_connected:
                 extra_log_data += " [was connected]"
-            return dict(type="response", response=response, extra_log_data=extra_log_data)
+            return dict(type="response", response=response, events_json=events_json,
+                        extra_log_data=extra_log_data)
 
         # After this point, dont_block=False, the queue is empty, and we
         # have a pre-existing queue, so we wait for new events.
@@ -761,7 +1113,8 @@ def get_client_info_for_message_event(event_template: Mapping[str, Any],
         return (sender_queue_id is not None) and client.event_queue.id == sender_queue_id
 
     # If we're on a public stream, look for clients (typically belonging to
-    # bots) that are registered to get events for ALL streams.
+    # bots) that are registered to get events for ALL streams, or for
+    # a narrow that may match this message.
     if 'stream_name' in event_template and not event_template.get("invite_only"):
         realm_id = event_template['realm_id']
         for client in get_client_descriptors_for_realm_all_streams(realm_id):
@@ -770,6 +1123,13 @@ def get_client_info_for_message_event(event_template: Mapping[str, Any],
                 flags=[],
                 is_sender=is_sender_client(client)
             )
+        for client in get_narrowed_client_descriptors_for_message(
+                realm_id, event_template.get('message_dict')):
+            send_to_clients[client.event_queue.id] = dict(
+                client=client,
+                flags=[],
+                is_sender=is_sender_client(client)
+            )
 
     for user_data in users:
         user_profile_id = user_data['id']  # type: int
@@ -806,6 +1166,12 @@ def process_message_event(event_template: Mapping[str, Any], users: Iterable[Map
         MessageDict.finalize_payload(dct, apply_markdown, client_gravatar)
         return dct
 
+    @cachify
+    def get_client_payload_json(apply_markdown: bool, client_gravatar: bool) -> str:
+        # Each payload variant is encoded only once, no matter how
+        # many clients it is delivered to.
+        return ujson.dumps(get_client_payload(apply_markdown, client_gravatar))
+
     # Extra user-specific data to include
     extra_user_data = {}  # type: Dict[int, Any]
 
@@ -841,17 +1207,23 @@ def process_message_event(event_template: Mapping[str, Any], users: Iterable[Map
 
         if not client.accepts_messages():
             # The actual check is the accepts_event() check below;
-            # this line is just an optimization to avoid copying
-            # message data unnecessarily
+            # this line is just an optimization to avoid building
+            # the event unnecessarily
             continue
 
         message_dict = get_client_payload(client.apply_markdown, client.client_gravatar)
+        message_json = None  # type: Optional[str]
 
         # Make sure Zephyr mirroring bots know whether stream is invite-only
         if "mirror" in client.client_type_name and event_template.get("invite_only"):
             message_dict = message_dict.copy()
             message_dict["invite_only_stream"] = True
+        else:
+            message_json = get_client_payload_json(client.apply_markdown, client.client_gravatar)
 
+        # This event dict is short-lived; EventQueue.push stores
+        # message events as a compact QueuedMessageEvent that refers
+        # to the shared message_dict.
         user_event = dict(type='message', message=message_dict, flags=flags)  # type: Dict[str, Any]
         if extra_data is not None:
             user_event.update(extra_data)
@@ -868,7 +1240,7 @@ def process_message_event(event_template: Mapping[str, Any], users: Iterable[Map
         if ('mirror' in sending_client and
                 sending_client.lower() == client.client_type_name.lower()):
             continue
-        client.add_event(user_event)
+        client.add_event(user_event, message_json=message_json)
 
 def process_event(event: Mapping[str, Any], users: Iterable[int]) -> None:
     for user_profile_id in users:
@@ -987,6 +1359,10 @@ def process_notification(notice: Mapping[str, Any]) -> None:
         process_message_update_event(event, cast(Iterable[Mapping[str, Any]], users))
     elif event['type'] == "delete_message":
         process_userdata_event(event, cast(Iterable[Mapping[str, Any]], users))
+    elif event['type'] == "drain_realm":
+        num_drained = drain_realm_clients(event['realm_id'])
+        logging.info("Tornado: Drained %d event queues for realm %s" % (
+            num_drained, event['realm_id']))
     else:
         process_event(event, cast(Iterable[int], users))
     logging.debug("Tornado: Event %s for %s users took %sms" % (
@@ -998,8 +1374,11 @@ def process_notification(notice: Mapping[str, Any]) -> None:
 # different types and for compatibility with non-HTTP transports.
 
 def send_notification_http(realm: Realm, data: Mapping[str, Any]) -> None:
+    send_notification_http_to_port(get_tornado_port(realm), data)
+
+def send_notification_http_to_port(port: int, data: Mapping[str, Any]) -> None:
     if settings.TORNADO_SERVER and not settings.RUNNING_INSIDE_TORNADO:
-        tornado_uri = get_tornado_uri(realm)
+        tornado_uri = get_tornado_uri_for_port(port)
         requests_client.post(tornado_uri + '/notify_tornado', data=dict(
             data   = ujson.dumps(data),
             secret = settings.SHARED_SECRET))
@@ -1015,3 +1394,13 @@ def send_event(realm: Realm, event: Mapping[str, Any],
     queue_json_publish(notify_tornado_queue_name(port),
                        dict(event=event, users=users),
                        lambda *args, **kwargs: send_notification_http(realm, *args, **kwargs))
+
+def send_drain_realm_event(realm: Realm, port: int) -> None:
+    """Tells the Tornado process listening on `port` to drop all of
+    the realm's event queues.  Unlike send_event, this targets an
+    explicit port, since this is used after the realm has been
+    reassigned, when get_tornado_port(realm) already returns the realm's
+    new shard."""
+    queue_json_publish(notify_tornado_queue_name(port),
+                       dict(event=dict(type='drain_realm', realm_id=realm.id), users=[]),
+                       lambda *args, **kwargs: send_notification_http_to_port(port, *args, **kwargs))
@@ -0,0 +1,91 @@
+import sqlite3
+import ujson
+
+from typing import Any, Dict, Iterable, Iterator, List, Optional, Tuple
+
+# Tornado's event queues are persisted in a local SQLite database, so
+# that restarts (and crashes) don't lose clients' queues.  Each queue
+# has a row holding its "descriptor" as JSON (the ClientDescriptor's
+# settings and the EventQueue's bookkeeping), which is loaded for
+# every queue on startup, and a row per queued event, which are only
+# loaded when the queue is first accessed.
+#
+# Rows are written incrementally: Tornado tracks which queues have
+# changed and periodically writes just those.  Events are append-only:
+# each flush inserts the events queued since the last one and deletes
+# the ones that clients have acknowledged, so a message sent to many
+# queues costs one small row per queue, rather than rewriting every
+# queue's events.
+
+class EventQueueStore:
+    def __init__(self, filename: str) -> None:
+        self.filename = filename
+        self.conn = sqlite3.connect(filename, isolation_level=None)
+        # WAL mode lets a write be interrupted (e.g. by SIGKILL)
+        # without corrupting the database; a crash loses at most the
+        # changes since the last flush.
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS event_queue_descriptors (
+                queue_id TEXT PRIMARY KEY,
+                descriptor TEXT NOT NULL
+            )""")
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS event_queue_events (
+                queue_id TEXT NOT NULL,
+                event_id INTEGER NOT NULL,
+                event TEXT NOT NULL,
+                PRIMARY KEY (queue_id, event_id)
+            )""")
+
+    def close(self) -> None:
+        self.conn.close()
+
+    def load_descriptors(self) -> Iterator[Tuple[str, Dict[str, Any]]]:
+        cursor = self.conn.execute("SELECT queue_id, descriptor FROM event_queue_descriptors")
+        for (queue_id, descriptor) in cursor:
+            yield (queue_id, ujson.loads(descriptor))
+
+    def load_queue(self, queue_id: str) -> Optional[List[Dict[str, Any]]]:
+        row = self.conn.execute("SELECT 1 FROM event_queue_descriptors WHERE queue_id = ?",
+                                (queue_id,)).fetchone()
+        if row is None:
+            return None
+        cursor = self.conn.execute(
+            "SELECT event FROM event_queue_events WHERE queue_id = ? ORDER BY event_id",
+            (queue_id,))
+        return [ujson.loads(event) for (event,) in cursor]
+
+    def save(self, descriptor_rows: Iterable[Tuple[str, Dict[str, Any]]],
+             new_event_rows: Iterable[Tuple[str, int, str]],
+             pruned_rows: Iterable[Tuple[str, int]],
+             removed_queue_ids: Iterable[str]) -> None:
+        """Writes a batch of changes in a single transaction.
+        `descriptor_rows` are the changed queues' descriptors;
+        `new_event_rows` are (queue id, event id, JSON-encoded event)
+        for the events queued since the last save, and `pruned_rows`
+        are (queue id, event id) pairs, meaning that the queue's events
+        with ids up to and including that one are gone."""
+        removed_queue_ids = list(removed_queue_ids)
+        with self.conn:
+            self.conn.execute("BEGIN")
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO event_queue_descriptors (queue_id, descriptor) VALUES (?, ?)",
+                ((queue_id, ujson.dumps(descriptor))
+                 for (queue_id, descriptor) in descriptor_rows))
+            # The pruned rows go first, since a virtual event may be
+            # added to the queue after events with higher ids were
+            # acknowledged.
+            self.conn.executemany(
+                "DELETE FROM event_queue_events WHERE queue_id = ? AND event_id <= ?",
+                pruned_rows)
+            self.conn.executemany(
+                "INSERT OR REPLACE INTO event_queue_events (queue_id, event_id, event) VALUES (?, ?, ?)",
+                new_event_rows)
+            self.conn.executemany(
+                "DELETE FROM event_queue_events WHERE queue_id = ?",
+                ((queue_id,) for queue_id in removed_queue_ids))
+            self.conn.executemany(
+                "DELETE FROM event_queue_descriptors WHERE queue_id = ?",
+                ((queue_id,) for queue_id in removed_queue_ids))
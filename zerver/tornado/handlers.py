@@ -44,8 +44,8 @@ def clear_handler_by_id(handler_id: int) -> None:
 def handler_stats_string() -> str:
     return "%s handlers, latest ID %s" % (len(handlers), current_handler_id)
 
-def finish_handler(handler_id: int, event_queue_id: str,
-                   contents: List[Dict[str, Any]], apply_markdown: bool) -> None:
+def finish_handler(handler_id: int, event_queue_id: str, events_json: str,
+                   event_types: List[str], apply_markdown: bool) -> None:
     err_msg = "Got error finishing handler for queue %s" % (event_queue_id,)
     try:
         # We call async_request_timer_restart here in case we are
@@ -54,15 +54,15 @@ def finish_handler(handler_id: int, event_queue_id: str,
         handler = get_handler_by_id(handler_id)
         request = handler._request
         async_request_timer_restart(request)
-        if len(contents) != 1:
+        if len(event_types) != 1:
             request._log_data['extra'] = "[%s/1]" % (event_queue_id,)
         else:
-            request._log_data['extra'] = "[%s/1/%s]" % (event_queue_id, contents[0]["type"])
+            request._log_data['extra'] = "[%s/1/%s]" % (event_queue_id, event_types[0])
 
         handler.zulip_finish(dict(result='success', msg='',
-                                  events=contents,
                                   queue_id=event_queue_id),
-                             request, apply_markdown=apply_markdown)
+                             request, apply_markdown=apply_markdown,
+                             raw_json_data=dict(events=events_json))
     except IOError as e:
         if str(e) != 'Stream is closed':
             logging.exception(err_msg)
@@ -326,7 +326,8 @@ class AsyncDjangoHandlerBase(tornado.web.RequestHandler, base.BaseHandler):  # n
 
 class AsyncDjangoHandler(AsyncDjangoHandlerBase):
     def zulip_finish(self, response: Dict[str, Any], request: HttpRequest,
-                     apply_markdown: bool) -> None:
+                     apply_markdown: bool,
+                     raw_json_data: Optional[Dict[str, str]]=None) -> None:
         # Make sure that Markdown rendering really happened, if requested.
         # This is a security issue because it's where we escape HTML.
         # c.f. ticket #64
@@ -346,7 +347,8 @@ class AsyncDjangoHandler(AsyncDjangoHandlerBase):
         # tricky; instead just send the (already json-rendered)
         # content on to Tornado
         django_response = json_response(res_type=response['result'],
-                                        data=response, status=self.get_status())
+                                        data=response, status=self.get_status(),
+                                        raw_json_data=raw_json_data)
         django_response = self.apply_response_middleware(request, django_response,
                                                          request._resolver)
         # Pass through the content-type from Django, as json content should be
@@ -1,19 +1,155 @@
+import bisect
+import os
+import struct
+import ujson
+import zlib
+
+from typing import Any, Dict, List, Optional, Tuple
+
 from django.conf import settings
 
 from zerver.models import Realm
 
-def get_tornado_port(realm: Realm) -> int:
+# When running multiple Tornado processes, they listen on consecutive
+# ports starting at this one; this must match the supervisor
+# configuration generated by puppet (`runtornado 127.0.0.1:98%(process_num)02d`).
+TORNADO_SHARD_BASE_PORT = 9800
+
+# Long-polling requests are routed to a realm's Tornado process by
+# nginx, using `hash $host consistent;` in the `tornado` upstream (see
+# puppet/zulip/templates/nginx/tornado-upstreams.conf.template.erb).
+# We use the same ketama-style hash ring as nginx does, so that Django
+# sends each realm's events to the process that nginx sends its
+# clients to, without nginx needing an entry for every realm: nginx
+# places 160 points on the ring for each `server 127.0.0.1:PORT`,
+# at crc32("127.0.0.1" "\0" PORT PREV_POINT), and a key goes to the
+# first point at or after crc32(key).
+HASH_RING_POINTS_PER_SHARD = 160
+
+def get_tornado_ports() -> List[int]:
+    if settings.TORNADO_PROCESSES == 1:
+        return [get_tornado_port_for_single_process()]
+    return [TORNADO_SHARD_BASE_PORT + i for i in range(settings.TORNADO_PROCESSES)]
+
+def get_tornado_port_for_single_process() -> int:
     if settings.TORNADO_SERVER is None:
         return 9993
+    return int(settings.TORNADO_SERVER.split(":")[-1])
+
+# Maps the tuple of ports to the sorted (points, ports) arrays of the
+# hash ring for those ports.  The ring only depends on the set of
+# ports, so it is computed once per process.
+hash_rings = {}  # type: Dict[Tuple[int, ...], Tuple[List[int], List[int]]]
+
+def get_hash_ring(ports: Tuple[int, ...]) -> Tuple[List[int], List[int]]:
+    if ports not in hash_rings:
+        ring = {}  # type: Dict[int, int]
+        for port in ports:
+            base_hash = zlib.crc32(("127.0.0.1\0%d" % (port,)).encode('utf-8'))
+            point = 0
+            for i in range(HASH_RING_POINTS_PER_SHARD):
+                point = zlib.crc32(struct.pack("<I", point), base_hash)
+                # nginx also drops duplicate points; with 32-bit
+                # points, these are vanishingly rare.
+                ring.setdefault(point, port)
+        points = sorted(ring)
+        hash_rings[ports] = (points, [ring[point] for point in points])
+    return hash_rings[ports]
+
+def get_hash_ring_port(key: str, ports: Tuple[int, ...]) -> int:
+    """Consistent hashing means that adding or removing a Tornado
+    process only moves the realms assigned to that process, rather
+    than reshuffling every realm (and thus every event queue) on the
+    server."""
+    points, ring_ports = get_hash_ring(ports)
+    index = bisect.bisect_left(points, zlib.crc32(key.encode('utf-8')))
+    return ring_ports[index % len(ring_ports)]
+
+def realm_hash_key(realm: Realm) -> str:
+    # What nginx's $host is for the realm's requests: the hostname,
+    # lowercased and without a port.
+    return realm.host.split(":")[0].lower()
+
+# The persisted shard map lets the server administrator pin realms to
+# specific Tornado processes, overriding the hash ring.  We cache it
+# keyed by the file's inode and mtime (write_shard_map always replaces
+# the file), so that edits made by the `tornado_shards` management
+# command are picked up by long-running Django processes without a
+# restart.
+shard_map_cache = {
+    'stat_key': None,
+    'shard_map': {},
+}  # type: Dict[str, Any]
+
+def get_shard_map() -> Dict[str, int]:
+    path = settings.TORNADO_SHARDING_MAP_PATH
+    try:
+        stat = os.stat(path)
+        stat_key = (path, stat.st_ino, stat.st_mtime)  # type: Optional[Tuple[str, int, float]]
+    except OSError:
+        stat_key = None
+
+    if stat_key != shard_map_cache['stat_key']:
+        shard_map = {}  # type: Dict[str, int]
+        if stat_key is not None:
+            with open(path) as f:
+                shard_map = {string_id: int(port)
+                             for (string_id, port) in ujson.load(f).items()}
+        shard_map_cache['shard_map'] = shard_map
+        shard_map_cache['stat_key'] = stat_key
+    return shard_map_cache['shard_map']
+
+def write_shard_map(shard_map: Dict[str, int]) -> None:
+    path = settings.TORNADO_SHARDING_MAP_PATH
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        ujson.dump(shard_map, f, indent=4, sort_keys=True)
+    # Atomically replace the old map, so readers never see a
+    # partially written file.
+    os.rename(tmp_path, path)
+
+def get_tornado_port(realm: Realm) -> int:
+    if settings.TORNADO_SERVER is None or settings.TORNADO_PROCESSES == 1:
+        return get_tornado_port_for_single_process()
+
+    ports = tuple(get_tornado_ports())
+    port = get_shard_map().get(realm.string_id)
+    if port is not None and port in ports:
+        return port
+    return get_hash_ring_port(realm_hash_key(realm), ports)
+
+def get_nginx_shard_map() -> List[Tuple[str, int]]:
+    """The (host, port) pairs for the realms pinned to a Tornado
+    process other than the one the hash ring assigns them to; see the
+    `tornado_shards` management command."""
     if settings.TORNADO_PROCESSES == 1:
-        return int(settings.TORNADO_SERVER.split(":")[-1])
-    return 9993
+        return []
+    ports = tuple(get_tornado_ports())
+    result = []
+    for realm in Realm.objects.filter(string_id__in=get_shard_map().keys()).order_by("string_id"):
+        port = get_tornado_port(realm)
+        if port != get_hash_ring_port(realm_hash_key(realm), ports):
+            result.append((realm_hash_key(realm), port))
+    return result
+
+def write_nginx_shard_map() -> None:
+    path = settings.TORNADO_NGINX_SHARDING_CONF_PATH
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        for (host, port) in get_nginx_shard_map():
+            f.write("%s tornado_%d;\n" % (host, port))
+    os.rename(tmp_path, path)
 
 def get_tornado_uri(realm: Realm) -> str:
     if settings.TORNADO_PROCESSES == 1:
         return settings.TORNADO_SERVER
 
     port = get_tornado_port(realm)
+    return get_tornado_uri_for_port(port)
+
+def get_tornado_uri_for_port(port: int) -> str:
+    if settings.TORNADO_PROCESSES == 1:
+        return settings.TORNADO_SERVER
     return "http://127.0.0.1:%d" % (port,)
 
 def notify_tornado_queue_name(port: int) -> str:
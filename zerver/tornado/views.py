@@ -103,4 +103,4 @@ def get_events_backend(request: HttpRequest, user_profile: UserProfile, handler:
         return RespondAsynchronously
     if result["type"] == "error":
         raise result["exception"]
-    return json_success(result["response"])
+    return json_success(result["response"], raw_json_data=dict(events=result["events_json"]))
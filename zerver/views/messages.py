@@ -8,11 +8,11 @@ from django.http import HttpRequest, HttpResponse
 from typing import Dict, List, Set, Any, Iterable, \
     Optional, Tuple, Union, Sequence, cast
 from zerver.lib.exceptions import JsonableError, ErrorCode
+from zerver.lib.deferred_user_messages import fill_in_deferred_user_messages
 from zerver.lib.html_diff import highlight_html_differences
 from zerver.decorator import has_request_variables, \
     REQ, to_non_negative_int
 from django.utils.html import escape as escape_html
-from zerver.lib import bugdown
 from zerver.lib.zcommand import process_zcommands
 from zerver.lib.actions import recipient_for_emails, do_update_message_flags, \
     compute_irc_user_fullname, compute_jabber_user_fullname, \
@@ -720,6 +720,7 @@ def get_messages_backend(request: HttpRequest, user_profile: UserProfile,
         return json_error(_("Too many messages requested (maximum %s)."
                             % (MAX_MESSAGES_PER_FETCH,)))
     include_history = ok_to_include_history(narrow, user_profile)
+    fill_in_deferred_user_messages(user_profile)
 
     if include_history:
         # The initial query in this case doesn't use `zerver_usermessage`,
@@ -1441,7 +1442,7 @@ def update_message_backend(request: HttpRequest, user_profile: UserMessage,
 
     # Include the number of messages changed in the logs
     request._log_data['extra'] = "[%s]" % (number_changed,)
-    if links_for_embed and bugdown.url_embed_preview_enabled(message):
+    if links_for_embed:
         event_data = {
             'message_id': message.id,
             'message_content': message.content,
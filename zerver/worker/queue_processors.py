@@ -29,7 +29,7 @@ from zerver.lib.actions import do_send_confirmation_email, \
     do_update_user_activity, do_update_user_activity_interval, do_update_user_presence, \
     internal_send_message, \
     render_incoming_message, do_update_embedded_data, do_mark_stream_messages_as_read
-from zerver.lib.url_preview import preview as url_preview
+from zerver.lib.url_preview.fetcher import LinkPreviewFetcher
 from zerver.lib.digest import handle_digest_email
 from zerver.lib.send_email import send_future_email, send_email_from_dict, \
     FromAddress, EmailNotDeliveredException, handle_send_email_format_changes
@@ -39,6 +39,7 @@ from zerver.lib.streams import access_stream_by_id
 from zerver.tornado.socket import req_redis_key, respond_send_message
 from confirmation.models import Confirmation, create_confirmation_link
 from zerver.lib.db import reset_queries
+from zerver.lib.deferred_user_messages import fan_out_deferred_user_messages
 from zerver.lib.redis_utils import get_redis_client
 from zerver.context_processors import common_context
 from zerver.lib.outgoing_webhook import do_rest_call, get_outgoing_webhook_service_handler
@@ -514,9 +515,12 @@ class TestWorker(QueueProcessingWorker):
 
 @assign_queue('embed_links')
 class FetchLinksEmbedData(QueueProcessingWorker):
+    def __init__(self) -> None:
+        super().__init__()
+        self.fetcher = LinkPreviewFetcher()
+
     def consume(self, event: Mapping[str, Any]) -> None:
-        for url in event['urls']:
-            url_preview.get_link_embed_data(url)
+        self.fetcher.fetch(event['urls'])
 
         message = Message.objects.get(id=event['message_id'])
         # If the message changed, we will run this task after updating the message
@@ -609,3 +613,6 @@ class DeferredWorker(QueueProcessingWorker):
                 (stream, recipient, sub) = access_stream_by_id(user_profile, stream_id,
                                                                require_active=False)
                 do_mark_stream_messages_as_read(user_profile, client, stream)
+        elif event['type'] == 'fan_out_user_messages':
+            fan_out_deferred_user_messages(event['realm_id'], event['message_id'],
+                                           event['user_ids'])
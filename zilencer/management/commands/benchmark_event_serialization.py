@@ -0,0 +1,87 @@
+import time
+from typing import Any, Callable, Dict, List
+
+import ujson
+from django.core.management.base import BaseCommand, CommandParser
+
+from zerver.tornado.event_queue import EventQueue
+
+def make_message_payload(message_id: int, content_length: int) -> Dict[str, Any]:
+    # Roughly the shape of a finalized stream message payload.
+    return {
+        'id': message_id,
+        'sender_id': 10,
+        'sender_email': 'iago@zulip.com',
+        'sender_full_name': 'Iago',
+        'sender_short_name': 'iago',
+        'sender_realm_str': 'zulip',
+        'sender_is_mirror_dummy': False,
+        'avatar_url': 'https://secure.gravatar.com/avatar/af4f06322c177ef4e1e9b2c424986b54?d=identicon&version=1',
+        'client': 'website',
+        'content': '<p>' + 'x' * content_length + '</p>',
+        'content_type': 'text/html',
+        'display_recipient': 'Denmark',
+        'stream_id': 1,
+        'recipient_id': 20,
+        'subject': 'benchmark',
+        'subject_links': [],
+        'reactions': [],
+        'submessages': [],
+        'timestamp': 1550000000,
+        'type': 'stream',
+        'is_me_message': False,
+    }
+
+class Command(BaseCommand):
+    help = """Benchmark the CPU cost of encoding long-poll responses for
+message events, with and without sharing each message's encoded JSON
+between clients (see EventQueue.contents_json).
+
+Usage: ./manage.py benchmark_event_serialization [--clients=5000] [--messages=10]"""
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument('--clients', default=5000, type=int,
+                            help='Number of event queues receiving each message')
+        parser.add_argument('--messages', default=10, type=int,
+                            help='Number of messages delivered to each queue')
+        parser.add_argument('--content-length', default=1000, type=int,
+                            help='Length of the rendered content of each message')
+
+    def handle(self, *args: Any, **options: Any) -> None:
+        num_clients = options['clients']
+        num_messages = options['messages']
+        payloads = [make_message_payload(message_id, options['content_length'])
+                    for message_id in range(num_messages)]
+
+        def fill_queues(share_json: bool) -> List[EventQueue]:
+            queues = [EventQueue(str(i)) for i in range(num_clients)]
+            for payload in payloads:
+                message_json = ujson.dumps(payload) if share_json else None
+                for queue in queues:
+                    queue.push(dict(type='message', message=payload, flags=[]),
+                               message_json=message_json)
+            return queues
+
+        def uncached(queues: List[EventQueue]) -> None:
+            for queue in queues:
+                ujson.dumps(dict(result='success', msg='', events=queue.contents(),
+                                 queue_id=queue.id))
+
+        def cached(queues: List[EventQueue]) -> None:
+            for queue in queues:
+                events_json, event_types = queue.contents_json()
+                ujson.dumps(dict(result='success', msg='', queue_id=queue.id))[:-1] + \
+                    ',"events":' + events_json + '}'
+
+        def measure(name: str, share_json: bool, encode: Callable[[List[EventQueue]], None]) -> None:
+            start = time.process_time()
+            queues = fill_queues(share_json)
+            encode(queues)
+            elapsed = time.process_time() - start
+            num_events = num_clients * num_messages
+            self.stdout.write('%-16s %8.3fs CPU, %6.2fus per delivered event' % (
+                name, elapsed, 1000000 * elapsed / num_events))
+
+        self.stdout.write('%d clients, %d messages each' % (num_clients, num_messages))
+        measure('without cache', False, uncached)
+        measure('with cache', True, cached)
@@ -0,0 +1,81 @@
+import time
+import zlib
+from typing import Any, Callable, Dict, List
+
+import ujson
+from django.core.management.base import BaseCommand, CommandParser
+
+from zerver.lib.cache import cache_delete_many, to_dict_cache_key_id
+from zerver.lib.message import MessageDict, extract_message_dict, messages_for_ids, \
+    stringify_message_dict
+from zerver.models import Message, get_realm
+
+def extract_json_message_dict(message_bytes: bytes) -> Dict[str, Any]:
+    return ujson.loads(zlib.decompress(message_bytes).decode("utf-8"))
+
+def stringify_json_message_dict(message_dict: Dict[str, Any]) -> bytes:
+    return zlib.compress(ujson.dumps(message_dict).encode())
+
+class Command(BaseCommand):
+    help = """Benchmark fetching message dicts through messages_for_ids,
+and the format they're cached in, compared to the zlib-compressed
+JSON we used to cache them as.
+
+Usage: ./manage.py benchmark_messages_for_ids [--messages=1000] [--realm=zulip]"""
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument('--messages', default=1000, type=int,
+                            help='Number of (recent) messages to fetch')
+        parser.add_argument('--realm', default='zulip',
+                            help='The string_id of the realm to fetch messages from')
+        parser.add_argument('--iterations', default=10, type=int,
+                            help='Number of times to repeat each measurement')
+
+    def handle(self, *args: Any, **options: Any) -> None:
+        realm = get_realm(options['realm'])
+        message_ids = list(Message.objects.filter(sender__realm=realm).order_by(
+            '-id').values_list('id', flat=True)[:options['messages']])
+        message_ids.reverse()
+        iterations = options['iterations']
+
+        def best_time(f: Callable[[], Any]) -> float:
+            times = []  # type: List[float]
+            for i in range(iterations):
+                start = time.time()
+                f()
+                times.append(time.time() - start)
+            return min(times)
+
+        message_dicts = [MessageDict.build_dict_from_raw_db_row(row)
+                         for row in MessageDict.get_raw_db_rows(message_ids)]
+        for (name, setter, extractor) in [
+                ('zlib JSON', stringify_json_message_dict, extract_json_message_dict),
+                ('current', stringify_message_dict, extract_message_dict)]:
+            encoded = [setter(message_dict) for message_dict in message_dicts]
+            encode_time = best_time(lambda: [setter(message_dict)
+                                             for message_dict in message_dicts])
+            decode_time = best_time(lambda: [extractor(message_bytes)
+                                             for message_bytes in encoded])
+            self.stdout.write('%-10s %8d bytes, %8.2fms to encode, %8.2fms to decode %d messages' % (
+                name, sum(len(message_bytes) for message_bytes in encoded),
+                1000 * encode_time, 1000 * decode_time, len(encoded)))
+
+        user_message_flags = {message_id: [] for message_id in message_ids}  # type: Dict[int, List[str]]
+
+        def fetch() -> None:
+            messages_for_ids(
+                message_ids=message_ids,
+                user_message_flags=user_message_flags,
+                search_fields={},
+                apply_markdown=True,
+                client_gravatar=True,
+                allow_edit_history=False,
+            )
+
+        cache_delete_many([to_dict_cache_key_id(message_id) for message_id in message_ids])
+        start = time.time()
+        fetch()
+        self.stdout.write('messages_for_ids: %8.2fms with a cold cache' % (
+            1000 * (time.time() - start),))
+        self.stdout.write('messages_for_ids: %8.2fms with a warm cache' % (
+            1000 * best_time(fetch),))
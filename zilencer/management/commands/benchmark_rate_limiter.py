@@ -0,0 +1,80 @@
+import multiprocessing
+import time
+from typing import Any, List, Tuple
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandParser
+
+from zerver.lib.rate_limiter import RateLimitedObject, check_and_incr_ratelimit, \
+    clear_history
+
+class BenchmarkRateLimitedObject(RateLimitedObject):
+    def __init__(self, rules: List[Tuple[int, int]]) -> None:
+        self._rules = rules
+
+    def key_fragment(self) -> str:
+        return "benchmark"
+
+    def rules(self) -> List[Tuple[int, int]]:
+        return self._rules
+
+def parse_rules(rules: str) -> List[Tuple[int, int]]:
+    result = []  # type: List[Tuple[int, int]]
+    for rule in rules.split(','):
+        (seconds, requests) = rule.split(':', 2)
+        result.append((int(seconds), int(requests)))
+    return sorted(result)
+
+def run_requests(args: Tuple[List[Tuple[int, int]], int]) -> Tuple[List[float], int]:
+    (rules, num_requests) = args
+    entity = BenchmarkRateLimitedObject(rules)
+    latencies = []  # type: List[float]
+    num_limited = 0
+    for i in range(num_requests):
+        start = time.perf_counter()
+        ratelimited = check_and_incr_ratelimit(entity)[0]
+        latencies.append(time.perf_counter() - start)
+        if ratelimited:
+            num_limited += 1
+    return latencies, num_limited
+
+def percentile(sorted_values: List[float], fraction: float) -> float:
+    index = min(int(len(sorted_values) * fraction), len(sorted_values) - 1)
+    return sorted_values[index]
+
+class Command(BaseCommand):
+    help = """Benchmark the latency of rate-limiting API requests against the
+configured Redis server, with many concurrent processes all making
+requests as a single hot API key.
+
+Usage: ./manage.py benchmark_rate_limiter [--processes=32] [--requests=2000] [--rules=60:200]"""
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument('--processes', default=32, type=int,
+                            help='Number of concurrent processes making requests')
+        parser.add_argument('--requests', default=2000, type=int,
+                            help='Number of requests made by each process')
+        parser.add_argument('--rules', default=','.join('%d:%d' % rule for rule in
+                                                        settings.RATE_LIMITING_RULES),
+                            help='Rate limiting rules for the API key, as seconds:requests,...')
+
+    def handle(self, *args: Any, **options: Any) -> None:
+        rules = parse_rules(options['rules'])
+        num_processes = options['processes']
+        entity = BenchmarkRateLimitedObject(rules)
+        clear_history(entity)
+
+        start = time.perf_counter()
+        with multiprocessing.Pool(num_processes) as pool:
+            results = pool.map(run_requests, [(rules, options['requests'])] * num_processes)
+        elapsed = time.perf_counter() - start
+        clear_history(entity)
+
+        latencies = sorted(latency for (process_latencies, _) in results
+                           for latency in process_latencies)
+        num_limited = sum(limited for (_, limited) in results)
+        self.stdout.write('%d processes, %d requests (%d rate-limited) in %.3fs: %d requests/sec' % (
+            num_processes, len(latencies), num_limited, elapsed, len(latencies) / elapsed))
+        for (name, fraction) in [('p50', 0.5), ('p90', 0.9), ('p99', 0.99), ('p99.9', 0.999)]:
+            self.stdout.write('%-6s %8.3fms' % (name, 1000 * percentile(latencies, fraction)))
+        self.stdout.write('%-6s %8.3fms' % ('max', 1000 * latencies[-1]))
@@ -0,0 +1,71 @@
+import time
+from typing import Any, Callable, List, Tuple
+
+from django.core.management.base import BaseCommand, CommandParser
+
+from zerver.lib.bugdown import RealmFilterMatcher, make_realm_filter_matchers
+
+def make_realm_filters(num_filters: int) -> List[Tuple[str, str, int]]:
+    # Roughly what a large organization's linkifiers look like: one
+    # per issue tracker project, plus a few generic ones.
+    realm_filters = [
+        (r'#(?P<id>[0-9]{2,8})', 'https://trac.example.com/ticket/%(id)s', 1),
+        (r'PR(?P<id>[0-9]+)', 'https://github.com/example/example/pull/%(id)s', 2),
+        (r'(?P<sha>[0-9a-f]{40})', 'https://github.com/example/example/commit/%(sha)s', 3),
+    ]
+    for i in range(len(realm_filters), num_filters):
+        realm_filters.append((r'PROJ%d-(?P<id>[0-9]+)' % (i,),
+                              'https://jira.example.com/browse/PROJ%d-%%(id)s' % (i,), i + 1))
+    return realm_filters
+
+def make_texts(num_texts: int, num_filters: int) -> List[str]:
+    texts = []
+    for i in range(num_texts):
+        texts.append('Looking at PROJ%d-%d again; see #%d and PR%d, which should fix '
+                     'the regression from last week for everyone on the team.' % (
+                         i % num_filters, i, i + 100, i))
+    return texts
+
+class Command(BaseCommand):
+    help = """Benchmark the CPU cost of applying a realm's filters
+(linkifiers) to message text, as done when rendering messages and
+computing topic links, with each filter matched separately and with
+all of them combined into one regex (see RealmFilterMatcher).
+
+Usage: ./manage.py benchmark_realm_filters [--filters=100] [--texts=10000]"""
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument('--filters', default=100, type=int,
+                            help='Number of realm filters in the realm')
+        parser.add_argument('--texts', default=10000, type=int,
+                            help='Number of message texts to scan')
+
+    def handle(self, *args: Any, **options: Any) -> None:
+        num_filters = options['filters']
+        realm_filters = make_realm_filters(num_filters)
+        texts = make_texts(options['texts'], num_filters)
+
+        def scan(matchers: List[RealmFilterMatcher]) -> List[str]:
+            urls = []  # type: List[str]
+            for text in texts:
+                for matcher in matchers:
+                    for m in matcher.regex.finditer(text):
+                        urls.append(matcher.get_match(m)[1])
+            return urls
+
+        def measure(name: str, make_matchers: Callable[[], List[RealmFilterMatcher]]) -> List[str]:
+            start = time.process_time()
+            matchers = make_matchers()
+            compiled = time.process_time()
+            urls = scan(matchers)
+            elapsed = time.process_time() - compiled
+            self.stdout.write('%-10s %8.3fms to compile, %8.3fs CPU to scan, %6.2fus per text' % (
+                name, 1000 * (compiled - start), elapsed, 1000000 * elapsed / len(texts)))
+            return urls
+
+        self.stdout.write('%d realm filters, %d texts' % (num_filters, len(texts)))
+        separate_urls = measure('separate', lambda: make_realm_filter_matchers(realm_filters,
+                                                                                combine=False))
+        combined_urls = measure('combined', lambda: make_realm_filter_matchers(realm_filters))
+        if sorted(separate_urls) != sorted(combined_urls):
+            self.stderr.write('The combined regex found different links!')
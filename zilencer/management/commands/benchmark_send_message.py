@@ -0,0 +1,78 @@
+import time
+from typing import Any, List
+
+import mock
+from django.core.management.base import BaseCommand, CommandParser
+from django.db import transaction
+from django.utils.timezone import now as timezone_now
+
+from zerver.lib.actions import create_stream_if_needed, do_send_messages
+from zerver.lib.bulk_create import bulk_create_users
+from zerver.models import Message, Subscription, UserProfile, get_client, \
+    get_realm, get_stream_recipient
+
+class Rollback(Exception):
+    pass
+
+class Command(BaseCommand):
+    help = """Benchmark the latency of sending a stream message, for streams
+with various numbers of subscribers.  The users, streams and messages
+the benchmark creates are rolled back at the end, and no events are
+sent to Tornado or the queue processors.
+
+Usage: ./manage.py benchmark_send_message [--subscribers=10,1000,10000] [--messages=10]"""
+
+    def add_arguments(self, parser: CommandParser) -> None:
+        parser.add_argument('--subscribers', default='10,1000,10000',
+                            help='Comma-separated numbers of stream subscribers to benchmark')
+        parser.add_argument('--messages', default=10, type=int,
+                            help='Number of messages to send to each stream')
+        parser.add_argument('--realm', default='zulip',
+                            help='The string_id of the realm to create users in')
+
+    def handle(self, *args: Any, **options: Any) -> None:
+        subscriber_counts = [int(count) for count in options['subscribers'].split(',')]
+        realm = get_realm(options['realm'])
+        client = get_client('benchmark_send_message')
+
+        try:
+            with transaction.atomic(), \
+                    mock.patch('zerver.lib.actions.send_event'), \
+                    mock.patch('zerver.lib.actions.queue_json_publish'):
+                bulk_create_users(realm, {
+                    ('send-benchmark-%d@zulip.example.com' % (i,), 'Benchmark User %d' % (i,),
+                     'benchmark%d' % (i,), True)
+                    for i in range(max(subscriber_counts))
+                })
+                users = list(UserProfile.objects.filter(
+                    realm=realm, email__startswith='send-benchmark-').order_by('id'))
+                sender = users[0]
+
+                for count in subscriber_counts:
+                    stream, _ = create_stream_if_needed(realm, 'send benchmark %d' % (count,))
+                    recipient = get_stream_recipient(stream.id)
+                    Subscription.objects.bulk_create([
+                        Subscription(user_profile=user, recipient=recipient)
+                        for user in users[:count]
+                    ])
+
+                    times = []  # type: List[float]
+                    for i in range(options['messages']):
+                        message = Message(
+                            sender=sender,
+                            recipient=recipient,
+                            content='Benchmark message %d' % (i,),
+                            pub_date=timezone_now(),
+                            sending_client=client,
+                        )
+                        message.set_topic_name('benchmark')
+                        start = time.time()
+                        do_send_messages([dict(message=message)])
+                        times.append(time.time() - start)
+
+                    times.sort()
+                    self.stdout.write('%6d subscribers: %8.2fms median, %8.2fms max per message' % (
+                        count, 1000 * times[len(times) // 2], 1000 * times[-1]))
+                raise Rollback()
+        except Rollback:
+            pass
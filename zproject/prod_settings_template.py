@@ -273,6 +273,42 @@ FEEDBACK_EMAIL = ZULIP_ADMINISTRATOR
 # can also be disabled in a realm's organization settings.
 #INLINE_URL_EMBED_PREVIEW = False
 
+# Controls whether Zulip caches rendered message content, so that
+# identical messages (e.g. repeated integration notifications) are
+# only rendered once.  Messages with link or image previews are never
+# cached.
+#BUGDOWN_RENDER_CACHE = True
+
+# Render messages in a separate pool of processes, which enforces a
+# hard CPU time limit on each render and renders bulk sends in
+# parallel.  The pool is started with `./manage.py render_server`,
+# which listens on this Unix socket; if it isn't running, messages
+# are rendered in the Django process as usual.  To have supervisor
+# run it, set `render_server_processes` (e.g. to the number of CPUs)
+# in the [application_server] section of /etc/zulip/zulip.conf, and
+# run zulip-puppet-apply.
+#BUGDOWN_RENDER_SERVER_SOCKET = '/home/zulip/deployments/render_server.sock'
+
+# For messages to public streams with at least this many recipients,
+# only write the UserMessage rows that are needed right away (e.g. for
+# mentions and notifications) while sending the message, and leave
+# the rest to the deferred_work queue processor.  This keeps senders
+# to huge announcement streams from waiting on tens of thousands of
+# row inserts.
+#DEFERRED_FAN_OUT_MIN_RECIPIENTS = 10000
+
+# Keep up to this many of the most frequently read cached values
+# (e.g. realm emoji and filters) in each Zulip process, in front of
+# memcached, for up to LOCAL_CACHE_TIMEOUT seconds.  Changes to them
+# are broadcast to all processes over redis.
+#LOCAL_CACHE_MAX_ENTRIES = 10000
+#LOCAL_CACHE_TIMEOUT = 60
+
+# Keep an index of each user's unread messages in redis, so that
+# loading the app doesn't need to look up all of the user's unread
+# messages in the database.
+#ENABLE_UNREAD_INDEX = True
+
 # Controls whether or not Zulip will parse links starting with
 # "file:///" as a hyperlink (useful if you have e.g. an NFS share).
 ENABLE_FILE_LINKS = False
@@ -527,6 +563,12 @@ CAMO_URI = '/external_content/'
 # Controls whether Zulip will rate-limit user requests.
 # RATE_LIMITING = True
 
+# Controls whether each Zulip server process can admit API requests
+# from users that are far below their rate limits without checking
+# redis.  This makes rate limiting cheaper for busy bots, at the cost
+# of users being able to slightly exceed their rate limits.
+# RATE_LIMITING_LOCAL_BUCKETS = False
+
 # By default, Zulip connects to the thumbor (the thumbnailing software
 # we use) service running locally on the machine.  If you're running
 # thumbor on a different server, you can configure that by setting
@@ -221,6 +221,12 @@ DEFAULT_SETTINGS = {
     'ENABLE_GRAVATAR': True,
     'INLINE_IMAGE_PREVIEW': True,
     'INLINE_URL_EMBED_PREVIEW': False,
+    'BUGDOWN_RENDER_CACHE': True,
+    'BUGDOWN_RENDER_SERVER_SOCKET': None,
+    'DEFERRED_FAN_OUT_MIN_RECIPIENTS': None,
+    'LOCAL_CACHE_MAX_ENTRIES': 0,
+    'LOCAL_CACHE_TIMEOUT': 60,
+    'ENABLE_UNREAD_INDEX': False,
     'NAME_CHANGES_DISABLED': False,
     'PASSWORD_MIN_LENGTH': 6,
     'PASSWORD_MIN_GUESSES': 10000,
@@ -228,6 +234,7 @@ DEFAULT_SETTINGS = {
     'PUSH_NOTIFICATION_REDACT_CONTENT': False,
     'SUBMIT_USAGE_STATISTICS': True,
     'RATE_LIMITING': True,
+    'RATE_LIMITING_LOCAL_BUCKETS': False,
     'SEND_LOGIN_EMAILS': True,
     'EMBEDDED_BOTS_ENABLED': False,
 
@@ -1043,6 +1050,9 @@ ZULIP_PATHS = [
     ("MANAGEMENT_LOG_PATH", "/var/log/zulip/manage.log"),
     ("WORKER_LOG_PATH", "/var/log/zulip/workers.log"),
     ("JSON_PERSISTENT_QUEUE_FILENAME_PATTERN", "/home/zulip/tornado/event_queues%s.json"),
+    ("EVENT_QUEUE_STORE_FILENAME_PATTERN", "/home/zulip/tornado/event_queues%s.sqlite3"),
+    ("TORNADO_SHARDING_MAP_PATH", "/home/zulip/tornado/sharding.json"),
+    ("TORNADO_NGINX_SHARDING_CONF_PATH", "/home/zulip/tornado/nginx_sharding.conf"),
     ("EMAIL_LOG_PATH", "/var/log/zulip/send_email.log"),
     ("EMAIL_MIRROR_LOG_PATH", "/var/log/zulip/email_mirror.log"),
     ("EMAIL_DELIVERER_LOG_PATH", "/var/log/zulip/email-deliverer.log"),